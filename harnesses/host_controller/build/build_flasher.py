@@ -15,6 +15,7 @@
 #
 """Class to flash build artifacts onto devices"""
 
+import contextlib
 import hashlib
 import logging
 import os
@@ -24,6 +25,11 @@ import tempfile
 import time
 
 from host_controller import common
+from host_controller.build import flash_telemetry
+from host_controller.build import sparse_image_cache
+from host_controller.utils.adb import boot_watcher
+from host_controller.utils.usb import transfer_scheduler
+from host_controller.utils.usb import usb_utils
 from vts.utils.python.common import cmd_utils
 from vts.utils.python.controllers import android_device
 
@@ -33,8 +39,24 @@ class BuildFlasher(object):
 
     Attributes:
         device: AndroidDevice, the device associated with the client.
+        _sparse_image_cache: SparseImageCache, the cache of sparse chunks.
+                             Created on first use.
+        _sparse_chunks: dict, maps an image path to the chunks held while
+                        the device is flashed. None if not held.
+        _flash_telemetry: FlashTelemetry, the store of the flash timings.
+                          Created on first use.
+        _telemetry_keys: dict, the product and USB port path of the device
+                         recorded with the timings.
+        _transfer_scheduler: UsbTransferScheduler, admits the transfers of
+                             the images per USB bus segment.
     """
 
+    _sparse_image_cache = None
+    _sparse_chunks = None
+    _flash_telemetry = None
+    _transfer_scheduler = None
+    _telemetry_keys = None
+
     def __init__(self, serial="", customflasher_path=""):
         """Initialize the client.
 
@@ -79,6 +101,7 @@ class BuildFlasher(object):
 
         self.device = android_device.AndroidDevice(
             serial, device_callback_port=-1)
+        self._telemetry_keys = None
         return True
 
     def FlashGSI(self,
@@ -103,15 +126,234 @@ class BuildFlasher(object):
             self.device.adb.wait_for_device()
             if not self.device.isBootloaderMode:
                 self.device.log.info(self.device.adb.reboot_bootloader())
-        if vbmeta_img is not None:
-            if skip_vbmeta == False or self.device.hasVbmetaSlot:
-                self.device.log.info(
-                    self.device.fastboot.flash('vbmeta', vbmeta_img))
-        self.device.log.info(self.device.fastboot.erase('system'))
-        self.device.log.info(self.device.fastboot.flash('system', system_img))
-        self.device.log.info(self.device.fastboot.erase('metadata'))
-        self.device.log.info(self.device.fastboot._w())
-        self.device.log.info(self.device.fastboot.reboot())
+        with self._HoldSparseChunks({"system": system_img}):
+            if vbmeta_img is not None:
+                if skip_vbmeta == False or self.device.hasVbmetaSlot:
+                    self.device.log.info(
+                        self._RunFastboot("flash", "vbmeta", [vbmeta_img],
+                                          self.device.fastboot.flash, 'vbmeta',
+                                          vbmeta_img))
+            self.device.log.info(
+                self._RunFastboot("erase", "system", [],
+                                  self.device.fastboot.erase, 'system'))
+            self._FlashPartition('system', system_img)
+            self.device.log.info(
+                self._RunFastboot("erase", "metadata", [],
+                                  self.device.fastboot.erase, 'metadata'))
+            self.device.log.info(
+                self._RunFastboot("wipe", "", [], self.device.fastboot._w))
+            self.device.log.info(
+                self._RunFastboot("reboot", "", [],
+                                  self.device.fastboot.reboot))
+
+    def GetMaxDownloadSize(self):
+        """Returns the max download size of the device in bootloader mode.
+
+        Returns:
+            int, the max download size in bytes. None if unknown.
+        """
+        try:
+            getvar_output = self.device.fastboot.getvar("max-download-size")
+        except Exception as e:
+            logging.warning("failed to get max-download-size: %s", e)
+            return None
+        return sparse_image_cache.ParseMaxDownloadSize(getvar_output)
+
+    def _FlashPartition(self, partition, image_path):
+        """Flashes an image, using the cached sparse chunks if possible.
+
+        Images in common.SPARSE_IMAGE_PARTITIONS larger than the device's
+        max download size are split once per host and the chunks are
+        flashed one by one, instead of letting fastboot re-sparse the image
+        for every device.
+
+        Args:
+            partition: string, the partition name.
+            image_path: string, path to the image file.
+        """
+        with self._HoldSparseChunks({partition: image_path}):
+            chunks = (self._sparse_chunks or {}).get(image_path,
+                                                     [image_path])
+
+            def _FlashChunks():
+                for chunk in chunks:
+                    self.device.log.info(
+                        self.device.fastboot.flash(partition, chunk))
+
+            self._RunFastboot("flash", partition, chunks, _FlashChunks)
+
+    @contextlib.contextmanager
+    def _HoldSparseChunks(self, device_images):
+        """Chunks the sparse images and keeps the chunks while flashing.
+
+        The images in common.SPARSE_IMAGE_PARTITIONS larger than the
+        device's max download size are split concurrently. The chunks
+        cannot be trimmed from the cache until the context exits. Nothing is
+        done if the caller already holds the chunks.
+
+        Args:
+            device_images: dict, where the key is partition name and value is
+                           image file path.
+        """
+        image_paths = [
+            image_path for partition, image_path in device_images.iteritems()
+            if partition in common.SPARSE_IMAGE_PARTITIONS and image_path
+        ]
+        max_download_size = None
+        if image_paths and self._sparse_chunks is None:
+            max_download_size = self.GetMaxDownloadSize()
+        if not max_download_size:
+            yield
+            return
+
+        try:
+            if BuildFlasher._sparse_image_cache is None:
+                BuildFlasher._sparse_image_cache = (
+                    sparse_image_cache.SparseImageCache())
+        except (IOError, OSError) as e:
+            logging.exception(e)
+            yield
+            return
+
+        with BuildFlasher._sparse_image_cache.Hold(
+                image_paths, max_download_size) as chunks:
+            self._sparse_chunks = chunks
+            try:
+                yield
+            finally:
+                self._sparse_chunks = None
+
+    def _GetTelemetryKeys(self):
+        """Returns the product and USB port path of the device.
+
+        They are looked up once per device since the product is read
+        through fastboot. The first lookup precedes the first fastboot
+        operation, while the device is still in the bootloader; a reboot
+        or flashall leaves the bootloader and getvar would wait for it.
+
+        Returns:
+            a dict with "product" and "usb_path".
+        """
+        if self._telemetry_keys is None:
+            self._telemetry_keys = {"product": "", "usb_path": ""}
+            try:
+                getvar_output = self.device.fastboot.getvar("product")
+                if isinstance(getvar_output, basestring):
+                    for line in getvar_output.splitlines():
+                        if line.startswith("product:"):
+                            self._telemetry_keys["product"] = line.split(
+                                ":", 1)[1].strip()
+                            break
+                self._telemetry_keys["usb_path"] = (
+                    usb_utils.GetDevicesUSBPortPath().get(
+                        self.device.serial, ""))
+            except Exception as e:
+                logging.warning("failed to get the device's product and "
+                                "USB port: %s", e)
+        return self._telemetry_keys
+
+    def _RecordFlashEvent(self, operation, partition, image_paths,
+                          duration, success):
+        """Records the duration and size of a fastboot operation.
+
+        Args:
+            operation: string, the fastboot operation.
+            partition: string, the partition name.
+            image_paths: a list of strings, the files sent to the device.
+            duration: float, the elapsed time in seconds.
+            success: bool, whether the operation succeeded.
+        """
+        num_bytes = self._GetImageBytes(image_paths)
+        try:
+            if BuildFlasher._flash_telemetry is None:
+                BuildFlasher._flash_telemetry = (
+                    flash_telemetry.FlashTelemetry())
+            keys = self._GetTelemetryKeys()
+            BuildFlasher._flash_telemetry.Record(
+                self.device.serial,
+                operation,
+                duration,
+                partition=partition,
+                num_bytes=num_bytes,
+                product=keys["product"],
+                usb_path=keys["usb_path"],
+                success=success)
+        except Exception as e:
+            logging.warning("failed to record flash telemetry: %s", e)
+
+    @staticmethod
+    def _GetImageBytes(image_paths):
+        """Returns the total size of the images.
+
+        Args:
+            image_paths: a list of strings, the files sent to the device.
+
+        Returns:
+            int, the number of bytes of the existing files.
+        """
+        num_bytes = 0
+        for image_path in image_paths:
+            try:
+                size = os.path.getsize(image_path)
+            except (OSError, TypeError):
+                continue
+            if isinstance(size, (int, long)):
+                num_bytes += size
+        return num_bytes
+
+    def _RunFastboot(self, operation, partition, image_paths, command,
+                     *args):
+        """Runs a fastboot command and records its duration.
+
+        A command sending images waits for the USB transfer scheduler.
+
+        Args:
+            operation: string, the fastboot operation.
+            partition: string, the partition name. Empty if not applicable.
+            image_paths: a list of strings, the files sent to the device.
+            command: function, the fastboot proxy method to call.
+            *args: the arguments to the command.
+
+        Returns:
+            the output of the command.
+        """
+        if not image_paths:
+            return self._RunTimed(operation, partition, image_paths, command,
+                                  *args)
+        if BuildFlasher._transfer_scheduler is None:
+            BuildFlasher._transfer_scheduler = (
+                transfer_scheduler.GetTransferScheduler())
+        with BuildFlasher._transfer_scheduler.Transfer(
+                self.device.serial,
+                self._GetImageBytes(image_paths)) as transfer:
+            output = self._RunTimed(operation, partition, image_paths,
+                                    command, *args)
+            transfer.success = True
+            return output
+
+    def _RunTimed(self, operation, partition, image_paths, command, *args):
+        """Runs a fastboot command and records its duration.
+
+        Args:
+            operation: string, the fastboot operation.
+            partition: string, the partition name. Empty if not applicable.
+            image_paths: a list of strings, the files sent to the device.
+            command: function, the fastboot proxy method to call.
+            *args: the arguments to the command.
+
+        Returns:
+            the output of the command.
+        """
+        self._GetTelemetryKeys()
+        start = time.time()
+        success = False
+        try:
+            output = command(*args)
+            success = True
+            return output
+        finally:
+            self._RecordFlashEvent(operation, partition, image_paths,
+                                   time.time() - start, success)
 
     def Flashall(self, directory):
         """Flash all images in a directory to the device using flashall.
@@ -125,7 +367,9 @@ class BuildFlasher(object):
         self.device.adb.wait_for_device()
         if not self.device.isBootloaderMode:
             self.device.log.info(self.device.adb.reboot_bootloader())
-        self.device.log.info(self.device.fastboot.flashall())
+        self.device.log.info(
+            self._RunFastboot("flashall", "", [],
+                              self.device.fastboot.flashall))
 
     def Flash(self, device_images, skip_vbmeta=False):
         """Flash the Generic System Image to the device.
@@ -154,49 +398,59 @@ class BuildFlasher(object):
                 self.device.log.info("fastboot flash %s %s", partition,
                                      image_path)
                 self.device.log.info(
-                    self.device.fastboot.flash(partition, image_path))
+                    self._RunFastboot("flash", partition, [image_path],
+                                      self.device.fastboot.flash, partition,
+                                      image_path))
                 self.device.log.info("fastboot reboot_bootloader")
-                self.device.log.info(self.device.fastboot.reboot_bootloader())
-
-        logging.info("starting to flash vendor and other images...")
-        full_zipfile = False
-        if common.FULL_ZIPFILE in device_images:
-            logging.info("fastboot update %s --skip-reboot",
-                         (device_images[common.FULL_ZIPFILE]))
-            self.device.log.info(
-                self.device.fastboot.update(device_images[common.FULL_ZIPFILE],
-                                            "--skip-reboot"))
-            full_zipfile = True
-
-        for partition, image_path in device_images.iteritems():
-            if partition in (common.FULL_ZIPFILE, common.FULL_ZIPFILE_DIR,
-                             "system", "vbmeta", "bootloader", "radio",
-                             "metadata", "userdata"):
-                continue
-            if full_zipfile and partition in ("vendor", "boot"):
-                logging.info("%s skipped because full zipfile was updated.",
-                             partition)
-                continue
-            if not image_path:
-                self.device.log.warning("%s image is empty", partition)
-                continue
-            self.device.log.info("fastboot flash %s %s", partition, image_path)
-            self.device.log.info(
-                self.device.fastboot.flash(partition, image_path))
-
-        logging.info("starting to flash system and other images...")
-        if "system" in device_images and device_images["system"]:
-            system_img = device_images["system"]
-            vbmeta_img = device_images["vbmeta"] if (
-                "vbmeta" in device_images
-                and device_images["vbmeta"]) else None
-            self.FlashGSI(
-                system_img,
-                vbmeta_img,
-                skip_check=True,
-                skip_vbmeta=skip_vbmeta)
-        else:
-            self.device.log.info(self.device.fastboot.reboot())
+                self.device.log.info(
+                    self._RunFastboot("reboot_bootloader", "", [],
+                                      self.device.fastboot.reboot_bootloader))
+
+        with self._HoldSparseChunks(device_images):
+            logging.info("starting to flash vendor and other images...")
+            full_zipfile = False
+            if common.FULL_ZIPFILE in device_images:
+                logging.info("fastboot update %s --skip-reboot",
+                             (device_images[common.FULL_ZIPFILE]))
+                self.device.log.info(
+                    self._RunFastboot("update", "",
+                                      [device_images[common.FULL_ZIPFILE]],
+                                      self.device.fastboot.update,
+                                      device_images[common.FULL_ZIPFILE],
+                                      "--skip-reboot"))
+                full_zipfile = True
+
+            for partition, image_path in device_images.iteritems():
+                if partition in (common.FULL_ZIPFILE, common.FULL_ZIPFILE_DIR,
+                                 "system", "vbmeta", "bootloader", "radio",
+                                 "metadata", "userdata"):
+                    continue
+                if full_zipfile and partition in ("vendor", "boot"):
+                    logging.info("%s skipped because full zipfile was updated.",
+                                 partition)
+                    continue
+                if not image_path:
+                    self.device.log.warning("%s image is empty", partition)
+                    continue
+                self.device.log.info("fastboot flash %s %s", partition,
+                                     image_path)
+                self._FlashPartition(partition, image_path)
+
+            logging.info("starting to flash system and other images...")
+            if "system" in device_images and device_images["system"]:
+                system_img = device_images["system"]
+                vbmeta_img = device_images["vbmeta"] if (
+                    "vbmeta" in device_images
+                    and device_images["vbmeta"]) else None
+                self.FlashGSI(
+                    system_img,
+                    vbmeta_img,
+                    skip_check=True,
+                    skip_vbmeta=skip_vbmeta)
+            else:
+                self.device.log.info(
+                    self._RunFastboot("reboot", "", [],
+                                      self.device.fastboot.reboot))
         return True
 
     def FlashImage(self, device_images, image_partition=None, reboot=False):
@@ -226,9 +480,13 @@ class BuildFlasher(object):
             if partition.endswith(".img"):
                 partition = partition[:-4]
             self.device.log.info(
-                self.device.fastboot.flash(partition, image_path))
+                self._RunFastboot("flash", partition, [image_path],
+                                  self.device.fastboot.flash, partition,
+                                  image_path))
         if reboot:
-            self.device.log.info(self.device.fastboot.reboot())
+            self.device.log.info(
+                self._RunFastboot("reboot", "", [],
+                                  self.device.fastboot.reboot))
         return True
 
     def WaitForDevice(self, timeout_secs=600):
@@ -241,7 +499,11 @@ class BuildFlasher(object):
         Returns:
             True if device is booted successfully; False otherwise.
         """
-        return self.device.waitForBootCompletion(timeout=timeout_secs)
+        booted = boot_watcher.WaitForBootCompletion(self.device.serial,
+                                                    timeout_secs)
+        if booted is None:
+            return self.device.waitForBootCompletion(timeout=timeout_secs)
+        return booted
 
     def FlashUsingCustomBinary(self,
                                device_images,
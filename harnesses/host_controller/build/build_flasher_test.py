@@ -30,6 +30,17 @@ from host_controller.build import build_flasher
 class BuildFlasherTest(unittest.TestCase):
     """Tests for Build Flasher"""
 
+    def setUp(self):
+        """Replaces the flash telemetry store and the scheduler with mocks."""
+        self._mock_telemetry = mock.Mock()
+        build_flasher.BuildFlasher._flash_telemetry = self._mock_telemetry
+        build_flasher.BuildFlasher._transfer_scheduler = mock.MagicMock()
+
+    def tearDown(self):
+        """Resets the flash telemetry store and the scheduler."""
+        build_flasher.BuildFlasher._flash_telemetry = None
+        build_flasher.BuildFlasher._transfer_scheduler = None
+
     @mock.patch(
         "host_controller.build.build_flasher.android_device")
     @mock.patch("host_controller.build.build_flasher.os")
@@ -54,6 +65,56 @@ class BuildFlasherTest(unittest.TestCase):
         mock_device.fastboot.flash.assert_any_call('system', 'exists.img')
         mock_device.fastboot.erase.assert_any_call('metadata')
 
+    @mock.patch("host_controller.build.build_flasher.usb_utils")
+    @mock.patch(
+        "host_controller.build.build_flasher.android_device")
+    @mock.patch("host_controller.build.build_flasher.os")
+    def testFlashGSITelemetry(self, mock_os, mock_class, mock_usb_utils):
+        mock_device = mock.Mock()
+        mock_device.serial = "thisismyserial"
+        mock_device.fastboot.getvar.return_value = "product: walleye"
+        mock_class.AndroidDevice.return_value = mock_device
+        mock_usb_utils.GetDevicesUSBPortPath.return_value = {
+            "thisismyserial": "1-2.3"}
+        mock_os.path.getsize.return_value = 1024
+        flasher = build_flasher.BuildFlasher("thisismyserial")
+        mock_os.path.exists.return_value = True
+        flasher.FlashGSI("exists.img")
+        self._mock_telemetry.Record.assert_any_call(
+            "thisismyserial", "flash", mock.ANY, partition="system",
+            num_bytes=1024, product="walleye", usb_path="1-2.3",
+            success=True)
+        self._mock_telemetry.Record.assert_any_call(
+            "thisismyserial", "reboot", mock.ANY, partition="",
+            num_bytes=0, product="walleye", usb_path="1-2.3", success=True)
+        mock_usb_utils.GetDevicesUSBPortPath.assert_called_once_with()
+        mock_scheduler = build_flasher.BuildFlasher._transfer_scheduler
+        mock_scheduler.Transfer.assert_any_call("thisismyserial", 1024)
+
+    @mock.patch(
+        "host_controller.build.build_flasher.sparse_image_cache.SparseImageCache")
+    @mock.patch(
+        "host_controller.build.build_flasher.android_device")
+    @mock.patch("host_controller.build.build_flasher.os")
+    def testFlashGSISparseChunks(self, mock_os, mock_class, mock_cache_class):
+        mock_device = mock.Mock()
+        mock_device.fastboot.getvar.return_value = (
+            "max-download-size: 0x20000000")
+        mock_class.AndroidDevice.return_value = mock_device
+        mock_hold = mock_cache_class.return_value.Hold
+        mock_hold.return_value.__enter__.return_value = {
+            "exists.img": ["chunk.0", "chunk.1"]}
+        build_flasher.BuildFlasher._sparse_image_cache = None
+        flasher = build_flasher.BuildFlasher("thisismyserial")
+        mock_os.path.exists.return_value = True
+        flasher.FlashGSI("exists.img")
+        build_flasher.BuildFlasher._sparse_image_cache = None
+        mock_hold.assert_called_once_with(["exists.img"], 0x20000000)
+        mock_hold.return_value.__exit__.assert_called_once_with(
+            None, None, None)
+        mock_device.fastboot.flash.assert_has_calls(
+            [mock.call('system', 'chunk.0'), mock.call('system', 'chunk.1')])
+
     @mock.patch(
         "host_controller.build.build_flasher.android_device")
     def testFlashall(self, mock_class):
@@ -63,6 +124,19 @@ class BuildFlasherTest(unittest.TestCase):
         flasher.Flashall("path/to/dir")
         mock_device.fastboot.flashall.assert_called_with()
 
+    @mock.patch("host_controller.build.build_flasher.usb_utils")
+    @mock.patch(
+        "host_controller.build.build_flasher.android_device")
+    def testFlashallTelemetryKeys(self, mock_class, mock_usb_utils):
+        mock_device = mock.Mock()
+        mock_device.fastboot.getvar.return_value = "product: walleye"
+        mock_class.AndroidDevice.return_value = mock_device
+        flasher = build_flasher.BuildFlasher("thisismyserial")
+        flasher.Flashall("path/to/dir")
+        self.assertEqual(
+            [mock.call.getvar("product"), mock.call.flashall()],
+            mock_device.fastboot.mock_calls)
+
     @mock.patch(
         "host_controller.build.build_flasher.android_device")
     def testEmptySerial(self, mock_class):
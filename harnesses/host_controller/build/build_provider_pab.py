@@ -39,6 +39,7 @@ from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support.ui import WebDriverWait
 
 from host_controller.build import build_provider
+from host_controller.build import prestage
 
 # constants for GET and POST endpoints
 GET = 'GET'
@@ -575,19 +576,22 @@ class BuildProviderPAB(build_provider.BuildProvider):
                 raise ValueError("%s not found in artifact list" %
                                  artifact_name)
 
-        url = self.GetArtifactURL(account_id=account_id,
-                                  build_id=build_id,
-                                  target=target,
-                                  artifact_name=artifact_name,
-                                  branch=branch,
-                                  internal=False,
-                                  method=method)
-
         if self.tmp_dirpath:
             artifact_path = os.path.join(self.tmp_dirpath, artifact_name)
         else:
             artifact_path = artifact_name
-        self.DownloadArtifact(url, artifact_path)
+
+        if not prestage.PrestageStore().ClaimArtifact(
+                prestage.Artifact(account_id, branch, target, build_id,
+                                  artifact_name), artifact_path):
+            url = self.GetArtifactURL(account_id=account_id,
+                                      build_id=build_id,
+                                      target=target,
+                                      artifact_name=artifact_name,
+                                      branch=branch,
+                                      internal=False,
+                                      method=method)
+            self.DownloadArtifact(url, artifact_path)
 
         self.SetFetchedFile(
             artifact_path, full_device_images=full_device_images)
@@ -0,0 +1,267 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Time-series store of the duration and size of flash operations."""
+
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+from host_controller import common
+
+# Columns by which the records can be filtered and grouped.
+KEY_COLUMNS = ("host", "serial", "product", "usb_path", "operation",
+               "partition")
+
+# Default percentiles reported by GetStats.
+DEFAULT_PERCENTILES = (50, 90, 99)
+
+# Seconds in a day.
+_SECS_PER_DAY = 24 * 60 * 60
+
+_CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS flash_events (
+    timestamp REAL NOT NULL,
+    host TEXT NOT NULL,
+    serial TEXT NOT NULL,
+    product TEXT NOT NULL,
+    usb_path TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    partition TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    success INTEGER NOT NULL
+)"""
+
+_CREATE_INDEX_SQLS = (
+    "CREATE INDEX IF NOT EXISTS flash_events_timestamp "
+    "ON flash_events (timestamp)",
+    "CREATE INDEX IF NOT EXISTS flash_events_product_partition "
+    "ON flash_events (product, partition)",
+    "CREATE INDEX IF NOT EXISTS flash_events_serial "
+    "ON flash_events (serial)",
+)
+
+
+def Percentile(sorted_values, percentile):
+    """Returns a percentile with linear interpolation.
+
+    Args:
+        sorted_values: a sorted list of numbers.
+        percentile: number between 0 and 100.
+
+    Returns:
+        float, the percentile. None if the list is empty.
+    """
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * percentile / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return (sorted_values[lower] +
+            (sorted_values[upper] - sorted_values[lower]) * (rank - lower))
+
+
+class FlashTelemetry(object):
+    """Records and queries the flash operations in a sqlite database.
+
+    The database is shared among the console and the job pool processes.
+    Each operation opens its own connection, so an instance can be used
+    after fork.
+
+    Attributes:
+        _db_path: string, path to the sqlite database file.
+        _host: string, the host name recorded with the events.
+    """
+
+    def __init__(self, db_path=None, host=None):
+        """Creates the database if it does not exist and prunes old events.
+
+        Args:
+            db_path: string, path to the database. Defaults to
+                     common._FLASH_TELEMETRY_DB under the home directory.
+            host: string, the host name. Defaults to this host's name.
+        """
+        if db_path is None:
+            db_path = os.path.join(
+                os.path.expanduser("~"), common._FLASH_TELEMETRY_DB)
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            try:
+                os.makedirs(db_dir)
+            except OSError:
+                if not os.path.isdir(db_dir):
+                    raise
+        self._db_path = db_path
+        self._host = host or socket.gethostname()
+        with self._Connect() as conn:
+            conn.execute(_CREATE_TABLE_SQL)
+            for sql in _CREATE_INDEX_SQLS:
+                conn.execute(sql)
+        self.Prune()
+
+    def _Connect(self):
+        """Opens a connection which commits on exit of a with block."""
+        return sqlite3.connect(self._db_path, timeout=30)
+
+    def Record(self,
+               serial,
+               operation,
+               duration,
+               partition="",
+               num_bytes=0,
+               product="",
+               usb_path="",
+               success=True,
+               timestamp=None):
+        """Records a flash operation.
+
+        Args:
+            serial: string, the device serial.
+            operation: string, e.g., "flash", "update", "erase", "reboot".
+            duration: float, the elapsed time in seconds.
+            partition: string, the partition name, if any.
+            num_bytes: int, the number of bytes sent to the device.
+            product: string, the product name of the device.
+            usb_path: string, the USB port path of the device.
+            success: bool, whether the operation succeeded.
+            timestamp: float, the end time. Defaults to now.
+
+        Returns:
+            True if recorded; False otherwise.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        try:
+            with self._Connect() as conn:
+                conn.execute(
+                    "INSERT INTO flash_events VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (timestamp, self._host, serial, product or "",
+                     usb_path or "", operation, partition or "",
+                     int(num_bytes or 0), float(duration),
+                     1 if success else 0))
+        except sqlite3.Error as e:
+            logging.error("Failed to record flash telemetry: %s", e)
+            return False
+        return True
+
+    @staticmethod
+    def _WhereClause(since, filters):
+        """Builds the WHERE clause of a query.
+
+        Args:
+            since: float, the minimum timestamp. None for no limit.
+            filters: dict, maps a column in KEY_COLUMNS to its value.
+
+        Returns:
+            a tuple of (string, list), the clause and its parameters.
+        """
+        conditions = []
+        params = []
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(since)
+        for column in KEY_COLUMNS:
+            if filters.get(column):
+                conditions.append("%s = ?" % column)
+                params.append(filters[column])
+        if not conditions:
+            return "", params
+        return " WHERE " + " AND ".join(conditions), params
+
+    def Query(self, since=None, **filters):
+        """Returns the recorded events.
+
+        Args:
+            since: float, the minimum timestamp. None for no limit.
+            filters: values of the columns in KEY_COLUMNS to match.
+
+        Returns:
+            a list of dicts, one per event, ordered by time.
+        """
+        where, params = self._WhereClause(since, filters)
+        with self._Connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT * FROM flash_events" + where +
+                " ORDER BY timestamp", params).fetchall()
+        return [dict(zip(row.keys(), row)) for row in rows]
+
+    def GetStats(self,
+                 group_by=("product", "partition"),
+                 percentiles=DEFAULT_PERCENTILES,
+                 since=None,
+                 **filters):
+        """Returns the percentiles of the duration and throughput.
+
+        Only successful operations are counted.
+
+        Args:
+            group_by: a list of columns in KEY_COLUMNS.
+            percentiles: a list of numbers between 0 and 100.
+            since: float, the minimum timestamp. None for no limit.
+            filters: values of the columns in KEY_COLUMNS to match.
+
+        Returns:
+            a list of dicts sorted by the group values. Each dict has the
+            group_by columns, "count", "bytes", and "duration_p<N>" and
+            "throughput_p<N>" (bytes per sec, None if no byte was sent) for
+            each percentile N formatted with "%g".
+        """
+        for column in group_by:
+            if column not in KEY_COLUMNS:
+                raise ValueError("Unknown column %s" % column)
+        groups = {}
+        for event in self.Query(since=since, **filters):
+            if not event["success"]:
+                continue
+            key = tuple(event[column] for column in group_by)
+            groups.setdefault(key, []).append(event)
+
+        stats = []
+        for key in sorted(groups):
+            events = groups[key]
+            durations = sorted(event["duration"] for event in events)
+            throughputs = sorted(
+                event["bytes"] / event["duration"] for event in events
+                if event["bytes"] and event["duration"] > 0)
+            stat = dict(zip(group_by, key))
+            stat["count"] = len(events)
+            stat["bytes"] = sum(event["bytes"] for event in events)
+            for percentile in percentiles:
+                stat["duration_p%g" % percentile] = Percentile(
+                    durations, percentile)
+                stat["throughput_p%g" % percentile] = Percentile(
+                    throughputs, percentile)
+            stats.append(stat)
+        return stats
+
+    def Prune(self, retention_days=common.FLASH_TELEMETRY_RETENTION_DAYS):
+        """Deletes the events older than the retention period.
+
+        Args:
+            retention_days: number of days to keep.
+
+        Returns:
+            int, the number of deleted events.
+        """
+        with self._Connect() as conn:
+            cursor = conn.execute(
+                "DELETE FROM flash_events WHERE timestamp < ?",
+                (time.time() - retention_days * _SECS_PER_DAY, ))
+            return cursor.rowcount
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from host_controller.build import flash_telemetry
+
+
+class FlashTelemetryTest(unittest.TestCase):
+    """Tests for FlashTelemetry."""
+
+    def setUp(self):
+        """Creates a database in a temp dir."""
+        self._temp_dir = tempfile.mkdtemp()
+        self._telemetry = flash_telemetry.FlashTelemetry(
+            os.path.join(self._temp_dir, "telemetry.db"), host="host1")
+
+    def tearDown(self):
+        """Deletes the temp dir."""
+        shutil.rmtree(self._temp_dir)
+
+    def testPercentile(self):
+        """Tests the interpolated percentiles."""
+        self.assertIsNone(flash_telemetry.Percentile([], 50))
+        self.assertEqual(3, flash_telemetry.Percentile([3], 90))
+        self.assertEqual(2.5, flash_telemetry.Percentile([1, 2, 3, 4], 50))
+        self.assertEqual(4, flash_telemetry.Percentile([1, 2, 3, 4], 100))
+
+    def testRecordAndQuery(self):
+        """Tests recording and filtering the events."""
+        self._telemetry.Record("serial1", "flash", 10, partition="system",
+                               num_bytes=1000, product="walleye",
+                               usb_path="1-2")
+        self._telemetry.Record("serial2", "erase", 1, partition="system",
+                               product="taimen", usb_path="1-3")
+        events = self._telemetry.Query(serial="serial1")
+        self.assertEqual(1, len(events))
+        self.assertEqual("host1", events[0]["host"])
+        self.assertEqual("walleye", events[0]["product"])
+        self.assertEqual("1-2", events[0]["usb_path"])
+        self.assertEqual(1000, events[0]["bytes"])
+        self.assertEqual(2, len(self._telemetry.Query(partition="system")))
+        self.assertEqual([], self._telemetry.Query(since=time.time() + 10))
+
+    def testGetStats(self):
+        """Tests the percentiles grouped by USB port path."""
+        for duration in (1, 2, 3, 4):
+            self._telemetry.Record("serial1", "flash", duration,
+                                   partition="vendor", num_bytes=4000,
+                                   usb_path="1-2")
+        self._telemetry.Record("serial2", "flash", 10, partition="vendor",
+                               num_bytes=4000, usb_path="1-3")
+        self._telemetry.Record("serial2", "flash", 99, partition="vendor",
+                               num_bytes=4000, usb_path="1-3", success=False)
+
+        stats = self._telemetry.GetStats(group_by=["usb_path"],
+                                         percentiles=[50, 100],
+                                         operation="flash")
+        self.assertEqual(["1-2", "1-3"], [s["usb_path"] for s in stats])
+        self.assertEqual(4, stats[0]["count"])
+        self.assertEqual(16000, stats[0]["bytes"])
+        self.assertEqual(2.5, stats[0]["duration_p50"])
+        self.assertEqual(4000, stats[0]["throughput_p100"])
+        self.assertEqual(1, stats[1]["count"])
+        self.assertEqual(400, stats[1]["throughput_p50"])
+
+        with self.assertRaises(ValueError):
+            self._telemetry.GetStats(group_by=["bytes"])
+
+    def testPrune(self):
+        """Tests deleting the old events."""
+        self._telemetry.Record("serial1", "reboot", 5,
+                               timestamp=time.time() - 10 * 24 * 60 * 60)
+        self._telemetry.Record("serial1", "reboot", 5)
+        self.assertEqual(1, self._telemetry.Prune(retention_days=7))
+        self.assertEqual(1, len(self._telemetry.Query()))
+
+
+if __name__ == "__main__":
+    unittest.main()
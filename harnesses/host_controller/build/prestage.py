@@ -0,0 +1,923 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Pre-staging of idle devices with the predicted next build."""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+from host_controller import common
+from host_controller.utils.ipc import ipc_utils
+from vti.test_serving.proto import TestScheduleConfigMessage_pb2 as pb
+
+# Keys identifying the images flashed on a device.
+IDENTITY_KEYS = ("manifest_branch", "build_target", "build_id", "gsi_branch",
+                 "gsi_build_target", "gsi_build_id", "gsi_vendor_version")
+
+# Job attributes describing where the device images are fetched from.
+_JOB_ATTRS = ("manifest_branch", "build_target", "pab_account_id",
+              "build_storage_type", "require_signed_device_build",
+              "has_bootloader_img", "has_radio_img")
+
+# Job attributes describing where the GSI is fetched from.
+_GSI_JOB_ATTRS = ("gsi_branch", "gsi_build_target", "gsi_pab_account_id",
+                  "gsi_storage_type", "gsi_vendor_version")
+
+# Job attributes that decide which images end up on the device.
+_CANDIDATE_KEY_ATTRS = ("manifest_branch", "build_target", "gsi_branch",
+                        "gsi_build_target", "gsi_vendor_version")
+
+# Build targets whose setup depends on files pulled during the job.
+_UNSUPPORTED_BUILD_TARGETS = (common.SDM845, )
+
+_STAGED_FILE_SUFFIX = ".staged"
+_ACTIVE_FILE_SUFFIX = ".active"
+_PREFETCH_FILE_SUFFIX = ".prefetch"
+_ARTIFACT_DIR = "artifacts"
+_ARTIFACT_INFO_SUFFIX = ".json"
+_ARTIFACT_TMP_PREFIX = "tmp"
+
+# Attributes identifying a build artifact.
+_ARTIFACT_ATTRS = ("account_id", "branch", "target", "build_id",
+                   "artifact_name")
+
+# Job attributes describing where the test suite is fetched from.
+_TEST_JOB_ATTRS = ("test_name", "test_branch", "test_build_target",
+                   "test_build_id", "test_pab_account_id", "test_storage_type")
+_LATEST_BUILDS_FILE = "latest_builds.json"
+_JOB_HISTORY_FILE = "job_history.jsonl"
+_LOCK_FILE = ".lock"
+
+
+def GetProduct(build_target):
+    """Returns the product name of a build target.
+
+    Args:
+        build_target: string, e.g., "walleye-userdebug".
+
+    Returns:
+        string, e.g., "walleye".
+    """
+    return build_target.split("-")[0] if build_target else ""
+
+
+def _CompareBuildIds(build_id1, build_id2):
+    """Compares two build IDs numerically if possible."""
+    if build_id1.isdigit() and build_id2.isdigit():
+        return cmp(int(build_id1), int(build_id2))
+    return cmp(build_id1, build_id2)
+
+
+class PrestageStore(object):
+    """File-based state shared by the console and the job pool processes.
+
+    Attributes:
+        _store_dir: string, the directory holding the state files.
+    """
+
+    def __init__(self, store_dir=None):
+        if store_dir is None:
+            store_dir = os.path.join(
+                os.path.expanduser("~"), common._PRESTAGE_DIR)
+        self._store_dir = store_dir
+        if not os.path.exists(self._store_dir):
+            try:
+                os.makedirs(self._store_dir)
+            except OSError:
+                if not os.path.isdir(self._store_dir):
+                    raise
+
+    @property
+    def store_dir(self):
+        """getter for self._store_dir"""
+        return self._store_dir
+
+    def _Path(self, name):
+        return os.path.join(self._store_dir, name)
+
+    def _Lock(self):
+        """Returns a file object holding the exclusive lock of the store."""
+        lock_file = open(self._Path(_LOCK_FILE), "a")
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _ReadJson(self, name):
+        """Reads a JSON file of the store.
+
+        Returns:
+            the decoded object. None if the file does not exist or is broken.
+        """
+        try:
+            with open(self._Path(name), "r") as json_file:
+                return json.load(json_file)
+        except IOError:
+            return None
+        except ValueError as e:
+            logging.error("Broken prestage file %s: %s", name, e)
+            return None
+
+    def _WriteJson(self, name, obj):
+        """Writes a JSON file of the store atomically."""
+        fd, tmp_path = tempfile.mkstemp(dir=self._store_dir)
+        with os.fdopen(fd, "w") as json_file:
+            json.dump(obj, json_file, sort_keys=True)
+        os.rename(tmp_path, self._Path(name))
+
+    def _Remove(self, name):
+        try:
+            os.remove(self._Path(name))
+        except OSError:
+            pass
+
+    def GetStaged(self, serial):
+        """Returns the identity of the images pre-staged on a device.
+
+        Args:
+            serial: string, the device serial.
+
+        Returns:
+            a dict with "identity" and "detailed_fetch_info". None if the
+            device is not pre-staged.
+        """
+        return self._ReadJson(serial + _STAGED_FILE_SUFFIX)
+
+    def SetStaged(self, serial, identity, detailed_fetch_info):
+        """Records that a device has been pre-staged.
+
+        Args:
+            serial: string, the device serial.
+            identity: dict, the values of IDENTITY_KEYS.
+            detailed_fetch_info: dict, the console's fetch info of the
+                                 device and GSI artifacts.
+        """
+        self._WriteJson(serial + _STAGED_FILE_SUFFIX, {
+            "identity": identity,
+            "detailed_fetch_info": detailed_fetch_info,
+            "timestamp": time.time(),
+        })
+
+    def ClearStaged(self, serial):
+        """Forgets the pre-staged identity of a device."""
+        self._Remove(serial + _STAGED_FILE_SUFFIX)
+
+    def GetActive(self, serial):
+        """Returns the running pre-stager of a device.
+
+        Args:
+            serial: string, the device serial.
+
+        Returns:
+            a process entry with "product" and "identity". None if no
+            pre-stager is running.
+        """
+        active = self._ReadJson(serial + _ACTIVE_FILE_SUFFIX)
+        if active and ipc_utils.IsProcessAlive(active):
+            return active
+        return None
+
+    def SetActive(self, serial, pid, product, identity):
+        """Records the pre-stager running on a device.
+
+        The record identifies the process by its start time as well, so
+        that a later process reusing the pid is not taken for it.
+        """
+        self._WriteJson(serial + _ACTIVE_FILE_SUFFIX,
+                        ipc_utils.NewProcessEntry(
+                            pid, product=product, identity=identity))
+
+    def ClearActive(self, serial, pid=None):
+        """Removes the record of a pre-stager.
+
+        Args:
+            serial: string, the device serial.
+            pid: int, removes the record only if it belongs to this process.
+        """
+        if pid is not None:
+            active = self._ReadJson(serial + _ACTIVE_FILE_SUFFIX)
+            if not active or active["pid"] != pid:
+                return
+        self._Remove(serial + _ACTIVE_FILE_SUFFIX)
+
+    def GetPrefetch(self, serial):
+        """Returns the prefetcher of the job predicted next on a device.
+
+        Args:
+            serial: string, the device serial.
+
+        Returns:
+            a process entry with "artifacts" and "running". None if no
+            artifacts have been prefetched for the device.
+        """
+        prefetch = self._ReadJson(serial + _PREFETCH_FILE_SUFFIX)
+        if prefetch:
+            prefetch["running"] = ipc_utils.IsProcessAlive(prefetch)
+        return prefetch
+
+    def SetPrefetch(self, serial, pid, artifacts):
+        """Records the prefetcher started for a device.
+
+        Args:
+            serial: string, the device serial.
+            pid: int, the ID of the prefetcher process.
+            artifacts: a list of dicts returned by Artifact, the artifacts
+                       being prefetched.
+        """
+        self._WriteJson(serial + _PREFETCH_FILE_SUFFIX,
+                        ipc_utils.NewProcessEntry(pid, artifacts=artifacts))
+
+    def ClearPrefetch(self, serial):
+        """Removes the record of a prefetcher."""
+        self._Remove(serial + _PREFETCH_FILE_SUFFIX)
+
+    def _ArtifactName(self, artifact):
+        """Returns the name of a prefetched artifact in the store."""
+        key = "|".join(artifact[attr] for attr in _ARTIFACT_ATTRS)
+        return os.path.join(_ARTIFACT_DIR,
+                            hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def GetArtifact(self, artifact):
+        """Returns the path of a prefetched artifact.
+
+        Args:
+            artifact: dict returned by Artifact.
+
+        Returns:
+            string, the path. None if the artifact is not prefetched.
+        """
+        path = self._Path(self._ArtifactName(artifact))
+        return path if os.path.isfile(path) else None
+
+    def FetchArtifact(self, artifact, download, serials):
+        """Downloads an artifact into the store.
+
+        The artifact is downloaded to a temporary file and renamed when
+        complete, so that a cancelled download is never claimed.
+
+        Args:
+            artifact: dict returned by Artifact.
+            download: a function which takes a path, downloads the
+                      artifact to it, and returns whether it succeeded.
+            serials: a list of strings, the devices the artifact is
+                     prefetched for.
+
+        Returns:
+            string, the path of the artifact. None if the download failed.
+        """
+        name = self._ArtifactName(artifact)
+        path = self._Path(name)
+        artifact_dir = os.path.dirname(path)
+        if not os.path.exists(artifact_dir):
+            try:
+                os.makedirs(artifact_dir)
+            except OSError:
+                if not os.path.isdir(artifact_dir):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(
+            dir=artifact_dir, prefix=_ARTIFACT_TMP_PREFIX)
+        os.close(fd)
+        try:
+            if not download(tmp_path):
+                return None
+            lock_file = self._Lock()
+            try:
+                self._WriteJson(name + _ARTIFACT_INFO_SUFFIX, {
+                    "artifact": artifact,
+                    "serials": serials,
+                    "timestamp": time.time(),
+                })
+                os.rename(tmp_path, path)
+            finally:
+                lock_file.close()
+            return path
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def ClaimArtifact(self, artifact, dest_path):
+        """Moves a prefetched artifact out of the store.
+
+        Args:
+            artifact: dict returned by Artifact.
+            dest_path: string, the path to move the artifact to.
+
+        Returns:
+            True if the artifact was prefetched and moved, False otherwise.
+        """
+        name = self._ArtifactName(artifact)
+        lock_file = self._Lock()
+        try:
+            if not os.path.isfile(self._Path(name)):
+                return False
+            shutil.move(self._Path(name), dest_path)
+            self._Remove(name + _ARTIFACT_INFO_SUFFIX)
+        finally:
+            lock_file.close()
+        logging.info("Claimed the prefetched artifact %s", artifact)
+        return True
+
+    def DiscardArtifacts(self, serial=None, max_age_secs=None, now=None,
+                         keep=None):
+        """Deletes the prefetched artifacts.
+
+        Args:
+            serial: string, deletes the artifacts prefetched for this
+                    device. None for any device.
+            max_age_secs: float, deletes only the artifacts and the
+                          incomplete downloads older than this.
+                          None for any age.
+            now: float, the current time. Defaults to time.time().
+            keep: a function which takes an artifact dict and returns
+                  True if the artifact is kept. None to keep none.
+
+        Returns:
+            a list of the deleted artifact dicts.
+        """
+        if now is None:
+            now = time.time()
+        if not os.path.isdir(self._Path(_ARTIFACT_DIR)):
+            return []
+        discarded = []
+        lock_file = self._Lock()
+        try:
+            for file_name in os.listdir(self._Path(_ARTIFACT_DIR)):
+                name = os.path.join(_ARTIFACT_DIR, file_name)
+                if file_name.startswith(_ARTIFACT_TMP_PREFIX):
+                    # Left by a killed prefetcher.
+                    if (serial is None and max_age_secs is not None and
+                            now - os.path.getmtime(self._Path(name)) >
+                            max_age_secs):
+                        self._Remove(name)
+                    continue
+                if not file_name.endswith(_ARTIFACT_INFO_SUFFIX):
+                    continue
+                info = self._ReadJson(name)
+                if info is None:
+                    continue
+                if serial is not None and serial not in info["serials"]:
+                    continue
+                if (max_age_secs is not None and
+                        now - info["timestamp"] <= max_age_secs):
+                    continue
+                if keep and keep(info["artifact"]):
+                    continue
+                self._Remove(name[:-len(_ARTIFACT_INFO_SUFFIX)])
+                self._Remove(name)
+                discarded.append(info["artifact"])
+        finally:
+            lock_file.close()
+        if discarded:
+            logging.info("Discarded the prefetched artifacts %s", discarded)
+        return discarded
+
+    def GetLatestBuilds(self):
+        """Returns the newest build IDs found by the build command.
+
+        Returns:
+            a dict where the key is "<branch>|<target>" and the value is the
+            build ID.
+        """
+        return self._ReadJson(_LATEST_BUILDS_FILE) or {}
+
+    def UpdateLatestBuilds(self, builds):
+        """Records the newest build IDs among the listed builds.
+
+        Args:
+            builds: a list of dicts in the format uploaded by the build
+                    command, with manifest_branch, build_target, build_type
+                    and build_id.
+        """
+        lock_file = self._Lock()
+        try:
+            latest_builds = self.GetLatestBuilds()
+            for build in builds:
+                target = build["build_target"]
+                if build.get("build_type"):
+                    target += "-" + build["build_type"]
+                key = "%s|%s" % (build["manifest_branch"], target)
+                build_id = str(build["build_id"])
+                if (key not in latest_builds or _CompareBuildIds(
+                        build_id, latest_builds[key]) > 0):
+                    latest_builds[key] = build_id
+            self._WriteJson(_LATEST_BUILDS_FILE, latest_builds)
+        finally:
+            lock_file.close()
+
+    def RecordJob(self, kwargs, timestamp=None):
+        """Appends a leased job to the job history.
+
+        Args:
+            kwargs: dict, the leased job's attributes.
+            timestamp: float, the lease time. Defaults to now.
+        """
+        build_target = kwargs.get("build_target", "")
+        if isinstance(build_target, list):
+            build_target = build_target[0]
+        record = dict((attr, kwargs[attr])
+                      for attr in _JOB_ATTRS + _GSI_JOB_ATTRS
+                      if kwargs.get(attr))
+        record["build_target"] = build_target
+        record["product"] = GetProduct(build_target)
+        record["timestamp"] = time.time() if timestamp is None else timestamp
+
+        lock_file = self._Lock()
+        try:
+            with open(self._Path(_JOB_HISTORY_FILE), "a") as history_file:
+                history_file.write(json.dumps(record, sort_keys=True) + "\n")
+            history = self.GetJobHistory()
+            if len(history) > 2 * common.PRESTAGE_MAX_JOB_HISTORY:
+                lines = [
+                    json.dumps(job, sort_keys=True) for job in
+                    history[-common.PRESTAGE_MAX_JOB_HISTORY:]
+                ]
+                fd, tmp_path = tempfile.mkstemp(dir=self._store_dir)
+                with os.fdopen(fd, "w") as history_file:
+                    history_file.write("\n".join(lines) + "\n")
+                os.rename(tmp_path, self._Path(_JOB_HISTORY_FILE))
+        finally:
+            lock_file.close()
+
+    def GetJobHistory(self):
+        """Returns the past jobs, oldest first.
+
+        Returns:
+            a list of dicts recorded by RecordJob.
+        """
+        history = []
+        try:
+            with open(self._Path(_JOB_HISTORY_FILE), "r") as history_file:
+                for line in history_file:
+                    try:
+                        history.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except IOError:
+            pass
+        return history
+
+
+def GetScheduleCandidates(schedules):
+    """Lists the jobs that the schedules can lease.
+
+    Args:
+        schedules: a list of ScheduleConfigMessage protobuf messages.
+
+    Returns:
+        a list of dicts, each with the attributes in _JOB_ATTRS and
+        _GSI_JOB_ATTRS which are set in the schedule.
+    """
+    candidates = []
+    for schedule in schedules:
+        for build_target in schedule.build_target:
+            for test_schedule in build_target.test_schedule:
+                candidate = {}
+                for attr in _JOB_ATTRS:
+                    value = getattr(schedule, attr, None)
+                    if value in (None, ""):
+                        value = getattr(build_target, attr, None)
+                    if value not in (None, ""):
+                        candidate[attr] = value
+                candidate["build_target"] = build_target.name
+                for attr in _GSI_JOB_ATTRS:
+                    value = getattr(test_schedule, attr, None)
+                    if value not in (None, ""):
+                        candidate[attr] = value
+                candidates.append(candidate)
+    return candidates
+
+
+def _CandidateKey(job):
+    return tuple(str(job.get(attr, "")) for attr in _CANDIDATE_KEY_ATTRS)
+
+
+def ResolveIdentity(job, latest_builds):
+    """Returns the identity of the images a job flashes.
+
+    Args:
+        job: dict, the job's attributes. A missing or "latest" build ID is
+             resolved to the newest known build.
+        latest_builds: dict returned by PrestageStore.GetLatestBuilds().
+
+    Returns:
+        a dict with the values of IDENTITY_KEYS. None if a build ID cannot
+        be resolved.
+    """
+    build_target = job.get("build_target", "")
+    if isinstance(build_target, list):
+        build_target = build_target[0]
+    identity = dict((key, str(job.get(key) or "")) for key in IDENTITY_KEYS)
+    identity["build_target"] = build_target
+
+    build_id = identity["build_id"]
+    if not build_id or build_id == "latest":
+        build_id = latest_builds.get(
+            "%s|%s" % (identity["manifest_branch"], build_target))
+        if not build_id:
+            return None
+        identity["build_id"] = build_id
+
+    if identity["gsi_branch"]:
+        gsi_build_id = identity["gsi_build_id"]
+        if not gsi_build_id or gsi_build_id == "latest":
+            gsi_build_id = latest_builds.get("%s|%s" % (
+                identity["gsi_branch"], identity["gsi_build_target"]))
+            if not gsi_build_id:
+                return None
+            identity["gsi_build_id"] = gsi_build_id
+    return identity
+
+
+def PredictNextJob(product, schedules, latest_builds, history, now=None):
+    """Predicts the build combination most likely leased next on a device.
+
+    Each past job of the product adds a weight halving every
+    PRESTAGE_HISTORY_HALF_LIFE_SECS to its (device build, GSI) combination.
+    Without history, the first schedule for the product is chosen.
+
+    Args:
+        product: string, the device's product name.
+        schedules: a list of ScheduleConfigMessage protobuf messages.
+        latest_builds: dict returned by PrestageStore.GetLatestBuilds().
+        history: a list of dicts returned by PrestageStore.GetJobHistory().
+        now: float, the current time. Defaults to time.time().
+
+    Returns:
+        a dict of the job attributes with build_id and gsi_build_id
+        resolved. None if no build combination can be predicted.
+    """
+    if now is None:
+        now = time.time()
+
+    candidates = {}
+    order = []
+    for job in GetScheduleCandidates(schedules) + [
+            job for job in history if job.get("product") == product
+    ]:
+        if GetProduct(job.get("build_target", "")) != product:
+            continue
+        if any(target in job["build_target"]
+               for target in _UNSUPPORTED_BUILD_TARGETS):
+            continue
+        key = _CandidateKey(job)
+        if key not in candidates:
+            candidates[key] = dict((attr, value)
+                                   for attr, value in job.items()
+                                   if attr not in ("timestamp", "product"))
+            order.append(key)
+
+    weights = dict((key, 0.0) for key in order)
+    for job in history:
+        key = _CandidateKey(job)
+        if key in weights and job.get("product") == product:
+            age = max(0.0, now - job.get("timestamp", now))
+            weights[key] += 0.5**(
+                age / common.PRESTAGE_HISTORY_HALF_LIFE_SECS)
+
+    # Ties are broken by the order of the schedules, then of the history.
+    for key in sorted(order, key=lambda k: (-weights[k], order.index(k))):
+        job = dict(candidates[key])
+        job.pop("build_id", None)
+        job.pop("gsi_build_id", None)
+        identity = ResolveIdentity(job, latest_builds)
+        if identity is None:
+            continue
+        job["build_id"] = identity["build_id"]
+        if identity["gsi_build_id"]:
+            job["gsi_build_id"] = identity["gsi_build_id"]
+        return job
+    return None
+
+
+def _StopProcessGroup(entry, timeout):
+    """Terminates a process group and kills it if it does not exit in time.
+
+    The group is signaled only while its leader is the recorded process,
+    so that a group whose leader reused the pid is left alone.
+
+    Args:
+        entry: dict, the process entry of the group leader.
+        timeout: float, seconds to wait before killing the processes.
+    """
+    if not ipc_utils.IsProcessAlive(entry):
+        return
+    try:
+        os.killpg(entry["pid"], signal.SIGTERM)
+    except OSError as e:
+        logging.warning("Failed to stop the process group %d: %s",
+                        entry["pid"], e)
+    deadline = time.time() + timeout
+    while ipc_utils.IsProcessAlive(entry) and time.time() < deadline:
+        time.sleep(0.1)
+    if ipc_utils.IsProcessAlive(entry):
+        try:
+            os.killpg(entry["pid"], signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def PreemptPrestaging(serial, store=None,
+                      timeout=common.PRESTAGE_PREEMPT_TIMEOUT_SECS):
+    """Stops the pre-stager running on a device.
+
+    The pre-stager runs in its own process group, so the fastboot and adb
+    processes it spawned are terminated together. The device's pre-staged
+    identity is cleared since the flashing may have been interrupted.
+
+    Args:
+        serial: string, the device serial.
+        store: PrestageStore object. Creates a default one if None.
+        timeout: float, seconds to wait before killing the processes.
+
+    Returns:
+        True if a pre-stager was stopped; False if none was running.
+    """
+    store = store or PrestageStore()
+    active = store.GetActive(serial)
+    if not active:
+        return False
+
+    pid = active["pid"]
+    logging.info("Preempting the pre-staging on %s (pid %d).", serial, pid)
+    _StopProcessGroup(active, timeout)
+    store.ClearActive(serial, pid)
+    store.ClearStaged(serial)
+    return True
+
+
+def ClaimPrestagedDevices(kwargs, store=None):
+    """Checks whether a leased job can skip fetching and flashing images.
+
+    Stops the pre-stagers on the leased devices. The pre-staged identities
+    are consumed, so that a device is never considered pre-staged after a
+    job has used it.
+
+    Args:
+        kwargs: dict, the leased job's attributes.
+        store: PrestageStore object. Creates a default one if None.
+
+    Returns:
+        the detailed fetch info of the pre-staged images if all the devices
+        have the images the job flashes. None otherwise.
+    """
+    store = store or PrestageStore()
+    serials = kwargs.get("serial", [])
+    staged = []
+    for serial in serials:
+        PreemptPrestaging(serial, store)
+        staged.append(store.GetStaged(serial))
+        store.ClearStaged(serial)
+    if not serials or None in staged:
+        return None
+
+    identity = ResolveIdentity(kwargs, store.GetLatestBuilds())
+    if identity is None:
+        return None
+    for entry in staged:
+        if entry["identity"] != identity:
+            logging.info("Pre-staged %s does not match the job %s.",
+                         entry["identity"], identity)
+            return None
+    logging.info("Devices %s are pre-staged with %s.", serials, identity)
+    return staged[0]["detailed_fetch_info"]
+
+
+def Artifact(account_id, branch, target, build_id, artifact_name):
+    """Returns the dict identifying a build artifact.
+
+    Args:
+        account_id: string, the PAB account ID.
+        branch: string, the build branch.
+        target: string, the build target.
+        build_id: string, the build ID. None if the latest build is
+                  fetched.
+        artifact_name: string, the artifact file name, in which
+                       "{build_id}" is replaced with the build ID.
+
+    Returns:
+        a dict with the keys in _ARTIFACT_ATTRS.
+    """
+    if build_id == "latest":
+        build_id = None
+    if build_id is not None:
+        artifact_name = artifact_name.format(build_id=build_id)
+    return {
+        "account_id": str(account_id),
+        "branch": str(branch),
+        "target": str(target),
+        "build_id": None if build_id is None else str(build_id),
+        "artifact_name": str(artifact_name),
+    }
+
+
+def _MatchArtifact(artifact, wanted):
+    """Checks whether an artifact is the one a job fetches.
+
+    Args:
+        artifact: dict returned by Artifact.
+        wanted: dict returned by Artifact, whose build ID may be None.
+
+    Returns:
+        True if they match.
+    """
+    for attr in _ARTIFACT_ATTRS:
+        if attr == "build_id":
+            if wanted[attr] is not None and wanted[attr] != artifact[attr]:
+                return False
+        elif attr == "artifact_name":
+            if wanted[attr].format(build_id=artifact["build_id"] or
+                                   "{build_id}") != artifact[attr]:
+                return False
+        elif artifact[attr] != wanted[attr]:
+            return False
+    return True
+
+
+def _MatchSource(artifact1, artifact2):
+    """Checks whether two artifacts may be fetched from the same build.
+
+    Args:
+        artifact1: dict returned by Artifact.
+        artifact2: dict returned by Artifact.
+
+    Returns:
+        True if the builds match. A None build ID matches any build.
+    """
+    for attr in ("account_id", "branch", "target"):
+        if artifact1[attr] != artifact2[attr]:
+            return False
+    return (artifact1["build_id"] is None or artifact2["build_id"] is None
+            or artifact1["build_id"] == artifact2["build_id"])
+
+
+def GetJobArtifacts(job):
+    """Lists the artifacts fetched from PAB by the common campaign commands.
+
+    The device images of signed builds, the artifacts on GCS, and the
+    optional bootloader and radio images are not listed.
+
+    Args:
+        job: dict, the job's attributes.
+
+    Returns:
+        a list of dicts returned by Artifact.
+    """
+    artifacts = []
+    build_target = job.get("build_target", "")
+    if isinstance(build_target, list):
+        build_target = build_target[0]
+    if (job.get("manifest_branch") and build_target and
+            int(job.get("build_storage_type") or pb.BUILD_STORAGE_TYPE_PAB)
+            == pb.BUILD_STORAGE_TYPE_PAB and
+            not job.get("require_signed_device_build")):
+        artifacts.append(
+            Artifact(
+                job.get("pab_account_id") or
+                common._DEFAULT_ACCOUNT_ID_INTERNAL, job["manifest_branch"],
+                build_target, job.get("build_id"),
+                "%s-img-{build_id}.zip" % GetProduct(build_target)))
+
+    if (job.get("gsi_branch") and job.get("gsi_build_target") and
+            int(job.get("gsi_storage_type") or pb.BUILD_STORAGE_TYPE_PAB)
+            == pb.BUILD_STORAGE_TYPE_PAB):
+        artifacts.append(
+            Artifact(
+                job.get("gsi_pab_account_id") or common._DEFAULT_ACCOUNT_ID,
+                job["gsi_branch"], job["gsi_build_target"],
+                job.get("gsi_build_id"), "%s-img-{build_id}.zip" %
+                GetProduct(job["gsi_build_target"])))
+
+    if (job.get("test_name") and job.get("test_branch") and
+            job.get("test_build_target") and
+            int(job.get("test_storage_type") or pb.BUILD_STORAGE_TYPE_PAB)
+            == pb.BUILD_STORAGE_TYPE_PAB):
+        suite_name = job["test_name"].split("/")[0]
+        artifacts.append(
+            Artifact(
+                job.get("test_pab_account_id") or common._DEFAULT_ACCOUNT_ID,
+                job["test_branch"], job["test_build_target"],
+                job.get("test_build_id"), "android-%s.zip" % suite_name))
+    return artifacts
+
+
+def PredictPipelinedJob(job, schedules, store, now=None):
+    """Predicts the job leased next on the devices of a running job.
+
+    The device and GSI builds are predicted in the same way as for an idle
+    device, or else assumed to be the running job's. The test suite is
+    assumed to be the running job's.
+
+    Args:
+        job: dict, the running job's attributes.
+        schedules: a list of ScheduleConfigMessage protobuf messages.
+        store: PrestageStore object.
+        now: float, the current time. Defaults to time.time().
+
+    Returns:
+        a dict of the predicted job's attributes.
+    """
+    build_target = job.get("build_target", "")
+    if isinstance(build_target, list):
+        build_target = build_target[0]
+    next_job = PredictNextJob(
+        GetProduct(build_target), schedules, store.GetLatestBuilds(),
+        store.GetJobHistory(), now)
+    if next_job is None:
+        next_job = dict((attr, job[attr]) for attr in
+                        _JOB_ATTRS + _GSI_JOB_ATTRS + IDENTITY_KEYS
+                        if job.get(attr))
+        next_job["build_target"] = build_target
+    for attr in _TEST_JOB_ATTRS:
+        if job.get(attr):
+            next_job[attr] = job[attr]
+    return next_job
+
+
+def CancelPrefetching(serial, store=None,
+                      timeout=common.PRESTAGE_PREEMPT_TIMEOUT_SECS):
+    """Stops the prefetcher of a device and deletes what it fetched.
+
+    Args:
+        serial: string, the device serial.
+        store: PrestageStore object. Creates a default one if None.
+        timeout: float, seconds to wait before killing the processes.
+
+    Returns:
+        True if a prefetcher was stopped; False if none was running.
+    """
+    store = store or PrestageStore()
+    prefetch = store.GetPrefetch(serial)
+    stopped = False
+    if prefetch and prefetch["running"]:
+        logging.info("Cancelling the prefetching for %s (pid %d).", serial,
+                     prefetch["pid"])
+        _StopProcessGroup(prefetch, timeout)
+        stopped = True
+    store.ClearPrefetch(serial)
+    store.DiscardArtifacts(serial)
+    return stopped
+
+
+def ClaimPrefetchedArtifacts(kwargs, store=None,
+                             timeout=common.PREFETCH_WAIT_SECS):
+    """Settles the prefetching for the devices of a leased job.
+
+    If the prefetcher of a device is still fetching artifacts from the
+    sources the leased job fetches from, it is given time to finish.
+    Otherwise, or if it does not finish in time, it is stopped. The
+    prefetched artifacts which the leased job does not fetch are deleted,
+    and the rest are left for the fetch commands to claim.
+
+    Args:
+        kwargs: dict, the leased job's attributes.
+        store: PrestageStore object. Creates a default one if None.
+        timeout: float, seconds to wait for a running prefetcher.
+
+    Returns:
+        a list of the deleted artifact dicts.
+    """
+    store = store or PrestageStore()
+    wanted = GetJobArtifacts(kwargs)
+    discarded = []
+    for serial in kwargs.get("serial", []):
+        prefetch = store.GetPrefetch(serial)
+        if not prefetch:
+            continue
+        if prefetch["running"]:
+            shared = any(
+                _MatchSource(artifact, job_artifact)
+                for artifact in prefetch["artifacts"]
+                for job_artifact in wanted)
+            deadline = time.time() + (timeout if shared else 0)
+            while (ipc_utils.IsProcessAlive(prefetch) and
+                   time.time() < deadline):
+                time.sleep(1)
+            if ipc_utils.IsProcessAlive(prefetch):
+                logging.info("Stopping the prefetching for %s.", serial)
+                _StopProcessGroup(prefetch,
+                                  common.PRESTAGE_PREEMPT_TIMEOUT_SECS)
+        store.ClearPrefetch(serial)
+        discarded.extend(
+            store.DiscardArtifacts(
+                serial,
+                keep=lambda artifact: any(
+                    _MatchArtifact(artifact, job_artifact)
+                    for job_artifact in wanted)))
+    return discarded
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from host_controller import common
+from host_controller.build import prestage
+from host_controller.utils.ipc import ipc_utils
+
+
+class _Message(object):
+    """A stand-in for the schedule config protobuf messages."""
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def _Schedule(branch, targets):
+    """Returns a schedule whose build targets run one GSI test each.
+
+    Args:
+        branch: string, the device build branch.
+        targets: a list of (build target, GSI branch) tuples.
+    """
+    return _Message(
+        manifest_branch=branch,
+        pab_account_id="1234",
+        build_storage_type=1,
+        build_target=[
+            _Message(
+                name=name,
+                test_schedule=[
+                    _Message(
+                        gsi_branch=gsi_branch,
+                        gsi_build_target="aosp_arm64_ab-userdebug",
+                        gsi_pab_account_id="",
+                        gsi_storage_type=1,
+                        gsi_vendor_version="")
+                ]) for name, gsi_branch in targets
+        ])
+
+
+class PrestageTest(unittest.TestCase):
+    """Tests for the pre-staging store and policy."""
+
+    def setUp(self):
+        """Creates a store in a temp dir."""
+        self._temp_dir = tempfile.mkdtemp()
+        self._store = prestage.PrestageStore(self._temp_dir)
+        self._store.UpdateLatestBuilds([{
+            "manifest_branch": "git_p",
+            "build_target": "walleye",
+            "build_type": "userdebug",
+            "build_id": "100",
+        }, {
+            "manifest_branch": "git_p",
+            "build_target": "walleye",
+            "build_type": "userdebug",
+            "build_id": "99",
+        }, {
+            "manifest_branch": "git_master",
+            "build_target": "aosp_arm64_ab",
+            "build_type": "userdebug",
+            "build_id": "7",
+        }, {
+            "manifest_branch": "git_gsi",
+            "build_target": "aosp_arm64_ab",
+            "build_type": "userdebug",
+            "build_id": "8",
+        }])
+        self._schedules = [
+            _Schedule("git_p", [("walleye-userdebug", "git_master"),
+                                ("taimen-userdebug", "git_master")]),
+            _Schedule("git_p", [("walleye-userdebug", "git_gsi")]),
+        ]
+
+    def tearDown(self):
+        """Deletes the temp dir."""
+        shutil.rmtree(self._temp_dir)
+
+    def testLatestBuilds(self):
+        """Tests that only the newest build IDs are kept."""
+        self._store.UpdateLatestBuilds([{
+            "manifest_branch": "git_p",
+            "build_target": "walleye",
+            "build_type": "userdebug",
+            "build_id": "98",
+        }])
+        latest_builds = self._store.GetLatestBuilds()
+        self.assertEqual("100", latest_builds["git_p|walleye-userdebug"])
+        self.assertEqual("7",
+                         latest_builds["git_master|aosp_arm64_ab-userdebug"])
+
+    def testResolveIdentity(self):
+        """Tests resolving the latest build IDs of a job."""
+        job = {
+            "manifest_branch": "git_p",
+            "build_target": ["walleye-userdebug"],
+            "build_id": "latest",
+            "gsi_branch": "git_master",
+            "gsi_build_target": "aosp_arm64_ab-userdebug",
+        }
+        identity = prestage.ResolveIdentity(job,
+                                            self._store.GetLatestBuilds())
+        self.assertEqual("walleye-userdebug", identity["build_target"])
+        self.assertEqual("100", identity["build_id"])
+        self.assertEqual("7", identity["gsi_build_id"])
+        job["gsi_branch"] = "git_unknown"
+        self.assertIsNone(
+            prestage.ResolveIdentity(job, self._store.GetLatestBuilds()))
+
+    def testPredictNextJobWithoutHistory(self):
+        """Tests that the first schedule of the product is chosen."""
+        job = prestage.PredictNextJob("walleye", self._schedules,
+                                      self._store.GetLatestBuilds(), [])
+        self.assertEqual("git_master", job["gsi_branch"])
+        self.assertEqual("100", job["build_id"])
+        self.assertEqual("7", job["gsi_build_id"])
+        self.assertEqual("1234", job["pab_account_id"])
+        self.assertIsNone(
+            prestage.PredictNextJob("taimen", self._schedules,
+                                    self._store.GetLatestBuilds(), []))
+
+    def testPredictNextJobWithHistory(self):
+        """Tests that recent jobs outweigh old ones."""
+        now = 10 * common.PRESTAGE_HISTORY_HALF_LIFE_SECS
+        for timestamp in (0, 1, 2):
+            self._store.RecordJob({
+                "manifest_branch": "git_p",
+                "build_target": ["walleye-userdebug"],
+                "gsi_branch": "git_master",
+                "gsi_build_target": "aosp_arm64_ab-userdebug",
+                "serial": ["serial1"],
+            }, timestamp=timestamp)
+        self._store.RecordJob({
+            "manifest_branch": "git_p",
+            "build_target": ["walleye-userdebug"],
+            "gsi_branch": "git_gsi",
+            "gsi_build_target": "aosp_arm64_ab-userdebug",
+        }, timestamp=now)
+        history = self._store.GetJobHistory()
+        self.assertEqual(4, len(history))
+        self.assertEqual("walleye", history[0]["product"])
+        self.assertNotIn("serial", history[0])
+
+        job = prestage.PredictNextJob("walleye", self._schedules,
+                                      self._store.GetLatestBuilds(), history,
+                                      now=now)
+        self.assertEqual("git_gsi", job["gsi_branch"])
+        self.assertEqual("8", job["gsi_build_id"])
+
+    def testClaimPrestagedDevices(self):
+        """Tests that a matching job consumes the pre-staged identity."""
+        kwargs = {
+            "manifest_branch": "git_p",
+            "build_target": ["walleye-userdebug"],
+            "build_id": "100",
+            "gsi_branch": "git_master",
+            "gsi_build_target": "aosp_arm64_ab-userdebug",
+            "serial": ["serial1"],
+        }
+        identity = prestage.ResolveIdentity(kwargs,
+                                            self._store.GetLatestBuilds())
+        fetch_info = {"build_id": "100", "gsi_build_id": "7"}
+        self._store.SetStaged("serial1", identity, fetch_info)
+        self.assertEqual(fetch_info,
+                         prestage.ClaimPrestagedDevices(kwargs, self._store))
+        self.assertIsNone(self._store.GetStaged("serial1"))
+        self.assertIsNone(prestage.ClaimPrestagedDevices(kwargs, self._store))
+
+        self._store.SetStaged("serial1", identity, fetch_info)
+        kwargs["build_id"] = "99"
+        self.assertIsNone(prestage.ClaimPrestagedDevices(kwargs, self._store))
+        self.assertIsNone(self._store.GetStaged("serial1"))
+
+    def testPreemptPrestaging(self):
+        """Tests stopping a pre-stager and its child processes."""
+        self.assertFalse(prestage.PreemptPrestaging("serial1", self._store))
+
+        process = subprocess.Popen(["sleep", "60"], preexec_fn=os.setpgrp)
+        self._store.SetActive("serial1", process.pid, "walleye", {})
+        self._store.SetStaged("serial1", {}, {})
+        self.assertTrue(self._store.GetActive("serial1"))
+        self.assertTrue(
+            prestage.PreemptPrestaging("serial1", self._store, timeout=5))
+        self.assertIsNotNone(process.wait())
+        self.assertIsNone(self._store.GetActive("serial1"))
+        self.assertIsNone(self._store.GetStaged("serial1"))
+
+    def testReusedPid(self):
+        """Tests leaving alone a process which reused a recorded pid."""
+        process = subprocess.Popen(["sleep", "60"], preexec_fn=os.setpgrp)
+        try:
+            with mock.patch.object(ipc_utils, "GetProcessStartTime",
+                                   return_value="1"):
+                self._store.SetActive("serial1", process.pid, "walleye", {})
+                self._store.SetPrefetch("serial1", process.pid, [])
+            self.assertIsNone(self._store.GetActive("serial1"))
+            self.assertFalse(self._store.GetPrefetch("serial1")["running"])
+            self.assertFalse(
+                prestage.PreemptPrestaging("serial1", self._store, timeout=1))
+            self.assertFalse(
+                prestage.CancelPrefetching("serial1", self._store, timeout=1))
+            self.assertIsNone(process.poll())
+        finally:
+            process.kill()
+            process.wait()
+
+    def _Download(self, content):
+        """Returns a download function writing the content to the path."""
+
+        def _Write(path):
+            with open(path, "w") as artifact_file:
+                artifact_file.write(content)
+            return True
+
+        return _Write
+
+    def _Job(self):
+        """Returns the attributes of a leased job."""
+        return {
+            "manifest_branch": "git_p",
+            "build_target": ["walleye-userdebug"],
+            "build_id": "100",
+            "pab_account_id": "1234",
+            "gsi_branch": "git_master",
+            "gsi_build_target": "aosp_arm64_ab-userdebug",
+            "test_name": "vts/vts",
+            "test_branch": "git_test",
+            "test_build_target": "test_suites_arm64",
+            "test_build_id": "latest",
+            "serial": ["serial1"],
+        }
+
+    def testGetJobArtifacts(self):
+        """Tests listing the artifacts fetched by a job."""
+        artifacts = prestage.GetJobArtifacts(self._Job())
+        self.assertEqual([
+            prestage.Artifact("1234", "git_p", "walleye-userdebug", "100",
+                              "walleye-img-100.zip"),
+            prestage.Artifact(common._DEFAULT_ACCOUNT_ID, "git_master",
+                              "aosp_arm64_ab-userdebug", None,
+                              "aosp_arm64_ab-img-{build_id}.zip"),
+            prestage.Artifact(common._DEFAULT_ACCOUNT_ID, "git_test",
+                              "test_suites_arm64", None, "android-vts.zip"),
+        ], artifacts)
+
+        job = self._Job()
+        job["require_signed_device_build"] = True
+        job["gsi_storage_type"] = 2
+        self.assertEqual(1, len(prestage.GetJobArtifacts(job)))
+
+    def testPredictPipelinedJob(self):
+        """Tests predicting the next job from the running one."""
+        job = self._Job()
+        job["build_target"] = ["sdm845-userdebug"]
+        next_job = prestage.PredictPipelinedJob(job, self._schedules,
+                                                self._store)
+        self.assertEqual("sdm845-userdebug", next_job["build_target"])
+        self.assertEqual("100", next_job["build_id"])
+        self.assertEqual("vts/vts", next_job["test_name"])
+        self.assertNotIn("serial", next_job)
+
+        next_job = prestage.PredictPipelinedJob(self._Job(), self._schedules,
+                                                self._store)
+        self.assertEqual("7", next_job["gsi_build_id"])
+        self.assertEqual("git_test", next_job["test_branch"])
+
+    def testFetchAndClaimArtifact(self):
+        """Tests that only complete downloads are claimed."""
+        artifact = prestage.Artifact("1", "git_p", "walleye", "100",
+                                     "walleye-img-{build_id}.zip")
+        self.assertEqual("walleye-img-100.zip", artifact["artifact_name"])
+        self.assertIsNone(
+            self._store.FetchArtifact(artifact, lambda path: False,
+                                      ["serial1"]))
+        self.assertIsNone(self._store.GetArtifact(artifact))
+        self.assertEqual([],
+                         os.listdir(os.path.join(self._temp_dir, "artifacts")))
+
+        path = self._store.FetchArtifact(artifact, self._Download("img"),
+                                         ["serial1"])
+        self.assertEqual(path, self._store.GetArtifact(artifact))
+        dest_path = os.path.join(self._temp_dir, "claimed.zip")
+        self.assertTrue(self._store.ClaimArtifact(artifact, dest_path))
+        with open(dest_path, "r") as claimed_file:
+            self.assertEqual("img", claimed_file.read())
+        self.assertIsNone(self._store.GetArtifact(artifact))
+        self.assertFalse(self._store.ClaimArtifact(artifact, dest_path))
+
+    def testDiscardExpiredArtifacts(self):
+        """Tests deleting the artifacts not claimed in time."""
+        artifact = prestage.Artifact("1", "git_p", "walleye", "100",
+                                     "walleye-img-100.zip")
+        self._store.FetchArtifact(artifact, self._Download("img"),
+                                  ["serial1"])
+        now = time.time()
+        self.assertEqual([],
+                         self._store.DiscardArtifacts(
+                             max_age_secs=60, now=now))
+        self.assertEqual([artifact],
+                         self._store.DiscardArtifacts(
+                             max_age_secs=60, now=now + 61))
+        self.assertIsNone(self._store.GetArtifact(artifact))
+
+    def testClaimPrefetchedArtifacts(self):
+        """Tests keeping only the artifacts the leased job fetches."""
+        job = self._Job()
+        matching = prestage.Artifact("1234", "git_p", "walleye-userdebug",
+                                     "100", "walleye-img-100.zip")
+        latest = prestage.Artifact(common._DEFAULT_ACCOUNT_ID, "git_test",
+                                   "test_suites_arm64", "5",
+                                   "android-vts.zip")
+        other = prestage.Artifact("1234", "git_p", "walleye-userdebug",
+                                  "99", "walleye-img-99.zip")
+        for artifact in (matching, latest, other):
+            self._store.FetchArtifact(artifact, self._Download("zip"),
+                                      ["serial1"])
+
+        process = subprocess.Popen(["sleep", "60"], preexec_fn=os.setpgrp)
+        self._store.SetPrefetch("serial1", process.pid, [other])
+        self.assertTrue(self._store.GetPrefetch("serial1")["running"])
+        self.assertEqual([other],
+                         prestage.ClaimPrefetchedArtifacts(
+                             job, self._store, timeout=5))
+        self.assertIsNotNone(process.wait())
+        self.assertIsNone(self._store.GetPrefetch("serial1"))
+        self.assertTrue(self._store.GetArtifact(matching))
+        self.assertTrue(self._store.GetArtifact(latest))
+
+        job["build_id"] = "98"
+        self.assertEqual([], prestage.ClaimPrefetchedArtifacts(
+            job, self._store))
+        self._store.SetPrefetch("serial1", process.pid, [])
+        self.assertEqual([matching],
+                         prestage.ClaimPrefetchedArtifacts(
+                             job, self._store))
+
+    def testCancelPrefetching(self):
+        """Tests stopping a prefetcher and deleting its artifacts."""
+        artifact = prestage.Artifact("1", "git_p", "walleye", "100",
+                                     "walleye-img-100.zip")
+        self._store.FetchArtifact(artifact, self._Download("img"),
+                                  ["serial1", "serial2"])
+        self.assertFalse(prestage.CancelPrefetching("serial3", self._store))
+        self.assertTrue(self._store.GetArtifact(artifact))
+
+        process = subprocess.Popen(["sleep", "60"], preexec_fn=os.setpgrp)
+        self._store.SetPrefetch("serial2", process.pid, [artifact])
+        self.assertTrue(
+            prestage.CancelPrefetching("serial2", self._store, timeout=5))
+        self.assertIsNotNone(process.wait())
+        self.assertIsNone(self._store.GetArtifact(artifact))
+
+
+if __name__ == "__main__":
+    unittest.main()
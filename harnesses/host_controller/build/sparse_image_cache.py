@@ -0,0 +1,447 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Cache of sparse image chunks shared among devices and processes."""
+
+import contextlib
+import fcntl
+import hashlib
+import logging
+import multiprocessing.pool
+import os
+import re
+import shutil
+import struct
+import tempfile
+
+from host_controller import common
+from vts.utils.python.common import cmd_utils
+
+# Magic number at the beginning of an Android sparse image.
+SPARSE_HEADER_MAGIC = 0xed26ff3a
+
+# Size of a block read when computing the digest of an image file.
+DIGEST_BLOCK_SIZE = 1024 * 1024
+
+# Name of the file listing the chunks of a cache entry, one per line.
+_MANIFEST_FILE_NAME = "chunks.list"
+
+# Prefix of the chunk files created by simg2simg.
+_CHUNK_FILE_PREFIX = "chunk"
+
+# Sub-directories of the cache directory.
+_ENTRIES_DIR = "entries"
+_DIGESTS_DIR = "digests"
+_LOCKS_DIR = "locks"
+
+
+def ParseMaxDownloadSize(getvar_output):
+    """Parses the output of `fastboot getvar max-download-size`.
+
+    Args:
+        getvar_output: string, the output of the fastboot command.
+
+    Returns:
+        int, the max download size in bytes. None if not found.
+    """
+    if not isinstance(getvar_output, basestring):
+        return None
+    match = re.search(r"max-download-size:\s*(0[xX][0-9a-fA-F]+|[0-9]+)",
+                      getvar_output)
+    if not match:
+        return None
+    value = int(match.group(1), 0)
+    return value if value > 0 else None
+
+
+def IsSparseImage(image_path):
+    """Checks whether an image file is in the Android sparse format.
+
+    Args:
+        image_path: string, path to the image file.
+
+    Returns:
+        True if the file starts with the sparse header magic number.
+    """
+    try:
+        with open(image_path, "rb") as image_file:
+            header = image_file.read(4)
+    except IOError as e:
+        logging.error(e.strerror)
+        return False
+    return (len(header) == 4
+            and struct.unpack("<I", header)[0] == SPARSE_HEADER_MAGIC)
+
+
+class SparseImageCache(object):
+    """Splits images into sparse chunks once and shares them.
+
+    Devices in a shard usually flash the same system.img and vendor.img.
+    fastboot re-reads, re-sparses and splits an image on every invocation.
+    This class does that once per (image digest, max download size) and
+    keeps the chunks under the home directory. Each cache entry is produced
+    under an exclusive file lock, so the job pool processes and the
+    processes flashing sibling devices wait for one producer instead of
+    chunking the same image in parallel.
+
+    Attributes:
+        _cache_dir: string, the root directory of the cache.
+        _max_cache_bytes: int, the cache is trimmed to this size.
+        _digests: dict, maps (path, size, mtime) to the image digest.
+    """
+
+    def __init__(self, cache_dir=None,
+                 max_cache_bytes=common.MAX_SPARSE_IMAGE_CACHE_BYTES):
+        """Initializes the cache directories.
+
+        Args:
+            cache_dir: string, the root directory of the cache. Defaults to
+                       common._SPARSE_IMAGE_CACHE_DIR under the home dir.
+            max_cache_bytes: int, the maximum total size of the chunks.
+        """
+        if cache_dir is None:
+            cache_dir = os.path.join(
+                os.path.expanduser("~"), common._SPARSE_IMAGE_CACHE_DIR)
+        self._cache_dir = cache_dir
+        self._max_cache_bytes = max_cache_bytes
+        self._digests = {}
+        for sub_dir in (_ENTRIES_DIR, _DIGESTS_DIR, _LOCKS_DIR):
+            path = os.path.join(self._cache_dir, sub_dir)
+            if not os.path.exists(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    if not os.path.isdir(path):
+                        raise
+
+    @property
+    def cache_dir(self):
+        """getter for self._cache_dir"""
+        return self._cache_dir
+
+    def GetDigest(self, image_path):
+        """Returns the SHA-256 digest of an image file.
+
+        The digest is remembered per (path, size, mtime) in memory and on
+        disk so that an unchanged image is read only once per host.
+
+        Args:
+            image_path: string, path to the image file.
+
+        Returns:
+            string, the hex digest of the file content.
+        """
+        stat = os.stat(image_path)
+        key = "%s|%d|%d" % (os.path.realpath(image_path), stat.st_size,
+                            int(stat.st_mtime))
+        if key in self._digests:
+            return self._digests[key]
+
+        digest_path = os.path.join(self._cache_dir, _DIGESTS_DIR,
+                                   hashlib.sha1(key).hexdigest())
+        try:
+            with open(digest_path, "r") as digest_file:
+                digest = digest_file.read().strip()
+            if digest:
+                self._digests[key] = digest
+                return digest
+        except IOError:
+            pass
+
+        hash_sha256 = hashlib.sha256()
+        with open(image_path, "rb") as image_file:
+            while True:
+                data_chunk = image_file.read(DIGEST_BLOCK_SIZE)
+                if not data_chunk:
+                    break
+                hash_sha256.update(data_chunk)
+        digest = hash_sha256.hexdigest()
+
+        tmp_fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.join(self._cache_dir, _DIGESTS_DIR))
+        with os.fdopen(tmp_fd, "w") as digest_file:
+            digest_file.write(digest)
+        os.rename(tmp_path, digest_path)
+        self._digests[key] = digest
+        return digest
+
+    def GetChunks(self, image_path, max_download_size):
+        """Returns the sparse chunks to flash instead of an image.
+
+        The chunks are not protected from Trim after this method returns.
+        Use Hold to keep them while flashing.
+
+        Args:
+            image_path: string, path to the image file.
+            max_download_size: int, max download size of the device.
+
+        Returns:
+            a list of strings, paths to the chunk files in flashing order.
+            [image_path] if the image fits in a single download or the
+            image could not be chunked.
+        """
+        chunks, lock_file = self._AcquireEntry(image_path, max_download_size)
+        if lock_file:
+            lock_file.close()
+        return chunks
+
+    def _AcquireEntry(self, image_path, max_download_size):
+        """Returns the chunks of an image, holding a shared entry lock.
+
+        The entry is produced under the exclusive lock and read under the
+        shared lock, so Trim cannot delete the chunks until the returned
+        lock file is closed.
+
+        Args:
+            image_path: string, path to the image file.
+            max_download_size: int, max download size of the device.
+
+        Returns:
+            a list of strings, the chunks as GetChunks returns,
+            the locked file object. None if no entry is used.
+        """
+        if not max_download_size or not os.path.isfile(image_path):
+            return [image_path], None
+        if os.path.getsize(image_path) <= max_download_size:
+            return [image_path], None
+
+        digest = self.GetDigest(image_path)
+        entry_name = "%s_%d" % (digest, max_download_size)
+        entry_dir = os.path.join(self._cache_dir, _ENTRIES_DIR, entry_name)
+        lock_path = os.path.join(self._cache_dir, _LOCKS_DIR, entry_name)
+
+        # flock is used since a lockf lock is shared by the threads of a
+        # process and released by closing any of their file descriptors.
+        lock_file = open(lock_path, "a")
+        chunks = None
+        created = False
+        try:
+            while True:
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+                chunks = self._ReadManifest(entry_dir)
+                if chunks is not None:
+                    break
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if self._ReadManifest(entry_dir) is None:
+                    if self._CreateEntry(image_path, entry_dir,
+                                         max_download_size) is None:
+                        break
+                    created = True
+        finally:
+            if chunks is None:
+                lock_file.close()
+
+        if chunks is None:
+            return [image_path], None
+        if not created:
+            logging.info("Reusing %d cached sparse chunk(s) of %s",
+                         len(chunks), image_path)
+            os.utime(entry_dir, None)
+        return chunks, lock_file
+
+    @contextlib.contextmanager
+    def Hold(self, image_paths, max_download_size):
+        """Chunks images concurrently and keeps the chunks until exit.
+
+        The cache is trimmed on exit.
+
+        Args:
+            image_paths: a list of strings, paths to the image files.
+            max_download_size: int, max download size of the device.
+
+        Yields:
+            a dict where the key is an image path and the value is the list
+            of chunks returned by GetChunks.
+        """
+        image_paths = [path for path in image_paths if path]
+        results = []
+        if image_paths:
+
+            def _AcquireEntryOrImage(image_path):
+                try:
+                    return self._AcquireEntry(image_path, max_download_size)
+                except (IOError, OSError) as e:
+                    logging.exception(e)
+                    return [image_path], None
+
+            pool = multiprocessing.pool.ThreadPool(
+                min(len(image_paths),
+                    common.MAX_SPARSE_IMAGE_CHUNKING_THREADS))
+            try:
+                results = pool.map(_AcquireEntryOrImage, image_paths)
+            finally:
+                pool.close()
+                pool.join()
+
+        try:
+            yield dict(
+                zip(image_paths, [chunks for chunks, _ in results]))
+        finally:
+            for _, lock_file in results:
+                if lock_file:
+                    lock_file.close()
+            try:
+                self.Trim()
+            except (IOError, OSError) as e:
+                logging.exception(e)
+
+    def Prepare(self, image_paths, max_download_size):
+        """Chunks multiple images concurrently.
+
+        Args:
+            image_paths: a list of strings, paths to the image files.
+            max_download_size: int, max download size of the device.
+
+        Returns:
+            a dict where the key is an image path and the value is the list
+            of chunks returned by GetChunks.
+        """
+        with self.Hold(image_paths, max_download_size) as chunks:
+            return chunks
+
+    def Trim(self):
+        """Deletes the least recently used entries over the size limit."""
+        entries_dir = os.path.join(self._cache_dir, _ENTRIES_DIR)
+        entries = []
+        total_size = 0
+        for entry_name in os.listdir(entries_dir):
+            entry_dir = os.path.join(entries_dir, entry_name)
+            if not os.path.isdir(entry_dir):
+                continue
+            entry_size = sum(
+                os.path.getsize(os.path.join(entry_dir, file_name))
+                for file_name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), entry_name,
+                            entry_size))
+            total_size += entry_size
+
+        for _, entry_name, entry_size in sorted(entries):
+            if total_size <= self._max_cache_bytes:
+                break
+            lock_path = os.path.join(self._cache_dir, _LOCKS_DIR, entry_name)
+            with open(lock_path, "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue  # being produced or flashed.
+                try:
+                    shutil.rmtree(
+                        os.path.join(entries_dir, entry_name),
+                        ignore_errors=True)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            logging.info("Evicted sparse image cache entry %s", entry_name)
+            total_size -= entry_size
+
+    def _ReadManifest(self, entry_dir):
+        """Reads the chunk list of a complete cache entry.
+
+        Args:
+            entry_dir: string, path to the cache entry directory.
+
+        Returns:
+            a list of strings, paths to the chunk files. None if the entry
+            does not exist or is incomplete.
+        """
+        manifest_path = os.path.join(entry_dir, _MANIFEST_FILE_NAME)
+        try:
+            with open(manifest_path, "r") as manifest_file:
+                names = [line.strip() for line in manifest_file
+                         if line.strip()]
+        except IOError:
+            return None
+        chunks = [os.path.join(entry_dir, name) for name in names]
+        if not chunks or not all(os.path.isfile(path) for path in chunks):
+            logging.warning("Incomplete sparse image cache entry %s",
+                            entry_dir)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        return chunks
+
+    def _CreateEntry(self, image_path, entry_dir, max_download_size):
+        """Splits an image into sparse chunks in a new cache entry.
+
+        The chunks are written to a temp dir which is renamed to entry_dir
+        once complete, so a crash never leaves a partial entry behind.
+
+        Args:
+            image_path: string, path to the image file.
+            entry_dir: string, path to the cache entry directory.
+            max_download_size: int, max size of each chunk in bytes.
+
+        Returns:
+            a list of strings, paths to the chunk files. None if failed.
+        """
+        tmp_dir = tempfile.mkdtemp(
+            dir=os.path.join(self._cache_dir, _ENTRIES_DIR),
+            prefix=".tmp_")
+        try:
+            sparse_path = image_path
+            if not IsSparseImage(image_path):
+                sparse_path = os.path.join(tmp_dir, "image.simg")
+                if not self._ExecuteTool("img2simg %s %s" %
+                                         (image_path, sparse_path)):
+                    return None
+
+            chunk_prefix = os.path.join(tmp_dir, _CHUNK_FILE_PREFIX)
+            if not self._ExecuteTool("simg2simg %s %s %d" %
+                                     (sparse_path, chunk_prefix,
+                                      max_download_size)):
+                return None
+            if sparse_path != image_path:
+                os.remove(sparse_path)
+
+            names = [
+                name for name in os.listdir(tmp_dir)
+                if name.startswith(_CHUNK_FILE_PREFIX + ".")
+                and name[len(_CHUNK_FILE_PREFIX) + 1:].isdigit()
+            ]
+            names.sort(key=lambda name: int(name.rsplit(".", 1)[1]))
+            if not names:
+                logging.error("simg2simg created no chunk for %s",
+                              image_path)
+                return None
+
+            with open(os.path.join(tmp_dir, _MANIFEST_FILE_NAME),
+                      "w") as manifest_file:
+                manifest_file.write("\n".join(names) + "\n")
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.rename(tmp_dir, entry_dir)
+            tmp_dir = None
+            logging.info("Split %s into %d sparse chunk(s) of max %d bytes",
+                         image_path, len(names), max_download_size)
+            return [os.path.join(entry_dir, name) for name in names]
+        finally:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    @staticmethod
+    def _ExecuteTool(command):
+        """Executes a sparse image tool.
+
+        Args:
+            command: string, the shell command.
+
+        Returns:
+            True if successful; False otherwise.
+        """
+        logging.info(command)
+        stdout, stderr, err_code = cmd_utils.ExecuteOneShellCommand(command)
+        if err_code:
+            logging.error("%s failed: %s %s", command.split()[0], stdout,
+                          stderr)
+            return False
+        return True
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from host_controller.build import sparse_image_cache
+
+
+def _FakeExecuteOneShellCommand(command):
+    """Emulates img2simg and simg2simg by copying and splitting files."""
+    args = command.split()
+    if args[0] == "img2simg":
+        with open(args[2], "wb") as sparse_file:
+            sparse_file.write(
+                struct.pack("<I", sparse_image_cache.SPARSE_HEADER_MAGIC))
+            with open(args[1], "rb") as image_file:
+                sparse_file.write(image_file.read())
+        return "", "", 0
+    if args[0] == "simg2simg":
+        with open(args[1], "rb") as sparse_file:
+            content = sparse_file.read()
+        max_size = int(args[3])
+        for index in range(0, (len(content) + max_size - 1) // max_size):
+            with open("%s.%d" % (args[2], index), "wb") as chunk_file:
+                chunk_file.write(
+                    content[index * max_size:(index + 1) * max_size])
+        return "", "", 0
+    return "", "unknown command", 1
+
+
+class SparseImageCacheTest(unittest.TestCase):
+    """Tests for SparseImageCache."""
+
+    def setUp(self):
+        """Creates a temp dir for the images and the cache."""
+        self._temp_dir = tempfile.mkdtemp()
+        self._cache = sparse_image_cache.SparseImageCache(
+            os.path.join(self._temp_dir, "cache"))
+        self._image_path = os.path.join(self._temp_dir, "system.img")
+        with open(self._image_path, "wb") as image_file:
+            image_file.write(b"a" * 100)
+
+    def tearDown(self):
+        """Deletes the temp dir."""
+        shutil.rmtree(self._temp_dir)
+
+    def testParseMaxDownloadSize(self):
+        """Tests parsing the output of fastboot getvar."""
+        self.assertEqual(
+            0x20000000,
+            sparse_image_cache.ParseMaxDownloadSize(
+                "max-download-size: 0x20000000\nFinished. Total time: 0s"))
+        self.assertEqual(
+            536870912,
+            sparse_image_cache.ParseMaxDownloadSize(
+                "max-download-size: 536870912"))
+        self.assertIsNone(
+            sparse_image_cache.ParseMaxDownloadSize("getvar failed"))
+        self.assertIsNone(sparse_image_cache.ParseMaxDownloadSize(None))
+
+    @mock.patch("host_controller.build.sparse_image_cache.cmd_utils")
+    def testGetChunksSmallImage(self, mock_cmd_utils):
+        """Tests that an image fitting in one download is not chunked."""
+        self.assertEqual([self._image_path],
+                         self._cache.GetChunks(self._image_path, 1000))
+        mock_cmd_utils.ExecuteOneShellCommand.assert_not_called()
+
+    @mock.patch("host_controller.build.sparse_image_cache.cmd_utils")
+    def testGetChunksReusesEntry(self, mock_cmd_utils):
+        """Tests that an image is chunked once and the chunks are reused."""
+        mock_cmd_utils.ExecuteOneShellCommand.side_effect = (
+            _FakeExecuteOneShellCommand)
+        chunks = self._cache.GetChunks(self._image_path, 40)
+        self.assertEqual(3, len(chunks))
+        self.assertEqual(["chunk.0", "chunk.1", "chunk.2"],
+                         [os.path.basename(chunk) for chunk in chunks])
+        self.assertEqual(2, mock_cmd_utils.ExecuteOneShellCommand.call_count)
+
+        other_cache = sparse_image_cache.SparseImageCache(
+            self._cache.cache_dir)
+        self.assertEqual(chunks,
+                         other_cache.GetChunks(self._image_path, 40))
+        self.assertEqual(2, mock_cmd_utils.ExecuteOneShellCommand.call_count)
+
+    @mock.patch("host_controller.build.sparse_image_cache.cmd_utils")
+    def testGetChunksToolFailure(self, mock_cmd_utils):
+        """Tests that the raw image is returned if the tools fail."""
+        mock_cmd_utils.ExecuteOneShellCommand.return_value = (
+            "", "img2simg: not found", 127)
+        self.assertEqual([self._image_path],
+                         self._cache.GetChunks(self._image_path, 40))
+        self.assertEqual([], os.listdir(
+            os.path.join(self._cache.cache_dir, "entries")))
+
+    @mock.patch("host_controller.build.sparse_image_cache.cmd_utils")
+    def testPrepareAndTrim(self, mock_cmd_utils):
+        """Tests chunking multiple images and evicting old entries."""
+        mock_cmd_utils.ExecuteOneShellCommand.side_effect = (
+            _FakeExecuteOneShellCommand)
+        vendor_path = os.path.join(self._temp_dir, "vendor.img")
+        with open(vendor_path, "wb") as image_file:
+            image_file.write(b"b" * 100)
+
+        result = self._cache.Prepare([self._image_path, vendor_path], 40)
+        self.assertEqual(3, len(result[self._image_path]))
+        self.assertEqual(3, len(result[vendor_path]))
+
+        self._cache._max_cache_bytes = 150
+        self._cache.Trim()
+        self.assertEqual(1, len(os.listdir(
+            os.path.join(self._cache.cache_dir, "entries"))))
+
+    @mock.patch("host_controller.build.sparse_image_cache.cmd_utils")
+    def testHoldKeepsChunks(self, mock_cmd_utils):
+        """Tests that the held chunks are not trimmed until released."""
+        mock_cmd_utils.ExecuteOneShellCommand.side_effect = (
+            _FakeExecuteOneShellCommand)
+        entries_dir = os.path.join(self._cache.cache_dir, "entries")
+        self._cache._max_cache_bytes = 0
+        with self._cache.Hold([self._image_path], 40) as result:
+            chunks = result[self._image_path]
+            self.assertEqual(3, len(chunks))
+            self._cache.Trim()
+            self.assertTrue(all(os.path.isfile(chunk) for chunk in chunks))
+        self.assertEqual([], os.listdir(entries_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
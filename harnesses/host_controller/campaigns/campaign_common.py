@@ -17,6 +17,8 @@
 import logging
 
 from host_controller import common
+from host_controller.campaigns import command_graph
+from host_controller.campaigns import flash_plan
 from vti.test_serving.proto import TestScheduleConfigMessage_pb2 as pb
 
 # The list of the kwargs key. can retrieve informations on the leased job.
@@ -33,6 +35,15 @@ _JOB_ATTR_LIST = [
     "test_build_target",
 ]
 
+# Reboots a device to the bootloader unless it is in fastboot mode already.
+# The flash sequences start with it since idle devices stay in Android.
+_REBOOT_BOOTLOADER_COMMAND = "dut --operation=reboot_bootloader --serial=%s"
+
+
+def GetMissingJobAttrs(**kwargs):
+    """Returns the required job attributes missing in 'kwargs'."""
+    return [key for key in _JOB_ATTR_LIST if key not in kwargs]
+
 
 def HasAttr(attr, **kwargs):
     """Returns True if 'attr' is in 'kwargs' as an arg."""
@@ -78,20 +89,45 @@ def EmitFetchCommands(**kwargs):
     This uses a given device branch information and automatically
     selects a GSI branch and a test branch.
 
+    If "prestaged" is set, the device and GSI images on the devices are
+    reused and only the test suite is fetched. If "prestaging" is set, the
+    test suite is not fetched.
+
     Args:
         kwargs: keyword argument, contains data about the leased job.
     Returns:
         list of command string.
         bool, True if GSI image is fetched. False otherwise
     """
+    groups = _EmitFetchCommandGroups(**kwargs)
+    if groups is None:
+        return None
+    image_commands, test_commands, info_commands, gsi = groups
+    return image_commands + test_commands + info_commands, gsi
+
+
+def _EmitFetchCommandGroups(**kwargs):
+    """Returns the common fetch commands grouped by what they fetch.
+
+    Args:
+        kwargs: keyword argument, contains data about the leased job.
+    Returns:
+        list of command string, fetching the device and GSI images.
+        list of command string, fetching the test suite.
+        list of command string, showing and patching the fetched images.
+        bool, True if GSI image is fetched. False otherwise
+        None if a storage type is unknown.
+    """
     result = []
+    test_commands = []
+    info_commands = []
     if isinstance(kwargs["build_target"], list):
         build_target = kwargs["build_target"][0]
     else:
         build_target = kwargs["build_target"]
     shards = int(kwargs["shards"])
-    suite_name, _ = kwargs["test_name"].split("/")
     serials = kwargs["serial"]
+    prestaged = HasAttr("prestaged", **kwargs)
 
     if HasAttr("pab_account_id", **kwargs):
         pab_account_id = kwargs["pab_account_id"]
@@ -104,7 +140,9 @@ def EmitFetchCommands(**kwargs):
     if HasAttr("build_storage_type", **kwargs):
         build_storage_type = int(kwargs["build_storage_type"])
 
-    if build_storage_type == pb.BUILD_STORAGE_TYPE_PAB:
+    if prestaged:
+        logging.info("Reusing the device images pre-staged on %s", serials)
+    elif build_storage_type == pb.BUILD_STORAGE_TYPE_PAB:
         result.append(
             "fetch --type=pab --branch=%s --target=%s --artifact_name=%s-img-%s.zip "
             "--build_id=%s --account_id=%s" %
@@ -147,7 +185,7 @@ def EmitFetchCommands(**kwargs):
     else:
         gsi_vendor_version = None
 
-    if gsi:
+    if gsi and not prestaged:
         if common.SDM845 in build_target:
             if shards > 1:
                 sub_commands = []
@@ -187,6 +225,33 @@ def EmitFetchCommands(**kwargs):
         if HasAttr("gsi_pab_account_id", **kwargs):
             result[-1] += " --account_id=%s" % kwargs["gsi_pab_account_id"]
 
+    if not HasAttr("prestaging", **kwargs):
+        test_fetch_commands = _EmitTestFetchCommands(**kwargs)
+        if test_fetch_commands is None:
+            return None
+        test_commands.extend(test_fetch_commands)
+
+    info_commands.append("info")
+    if gsi and not prestaged:
+        gsispl_command = "gsispl --version_from_path=boot.img"
+        if gsi_vendor_version:
+            gsispl_command += " --vendor_version=%s" % gsi_vendor_version
+        info_commands.append(gsispl_command)
+        info_commands.append("info")
+
+    return result, test_commands, info_commands, gsi
+
+
+def _EmitTestFetchCommands(**kwargs):
+    """Returns the commands fetching the test suite of a leased job.
+
+    Args:
+        kwargs: keyword argument, contains data about the leased job.
+    Returns:
+        list of command string. None if the storage type is unknown.
+    """
+    result = []
+    suite_name, _ = kwargs["test_name"].split("/")
     if HasAttr("test_build_id", **kwargs):
         test_build_id = kwargs["test_build_id"]
     else:
@@ -212,15 +277,7 @@ def EmitFetchCommands(**kwargs):
     if HasAttr("test_pab_account_id", **kwargs):
         result[-1] += " --account_id=%s" % kwargs["test_pab_account_id"]
 
-    result.append("info")
-    if gsi:
-        gsispl_command = "gsispl --version_from_path=boot.img"
-        if gsi_vendor_version:
-            gsispl_command += " --vendor_version=%s" % gsi_vendor_version
-        result.append(gsispl_command)
-        result.append("info")
-
-    return result, gsi
+    return result
 
 
 def EmitFlashCommands(gsi, **kwargs):
@@ -229,6 +286,11 @@ def EmitFlashCommands(gsi, **kwargs):
     This uses a given device branch information and automatically
     selects a GSI branch and a test branch.
 
+    If "prestaged" is set, the devices are booted with the pre-staged
+    images instead of being flashed. If "flash_plan" is set, the commands
+    of the devices supported by flash_plan are compiled from their desired
+    states.
+
     Args:
         gsi: bool, whether to flash GSI over vendor images or not.
         kwargs: keyword argument, contains data about the leased job.
@@ -243,6 +305,8 @@ def EmitFlashCommands(gsi, **kwargs):
         build_target = kwargs["build_target"]
     shards = int(kwargs["shards"])
     serials = kwargs["serial"]
+    prestaged = HasAttr("prestaged", **kwargs)
+    flash_plan_enabled = HasAttr("flash_plan", **kwargs)
     if gsi:
         system_version = GetVersion(kwargs["gsi_branch"])
     else:
@@ -264,8 +328,16 @@ def EmitFlashCommands(gsi, **kwargs):
         if shards <= len(serials):
             for shard_index in range(shards):
                 new_cmd_list = []
-                if (common.K39TV1_BSP in build_target
-                        or common.K39TV1_BSP_1G in build_target):
+                planned_commands = _EmitPlannedFlashCommands(
+                    serials[shard_index], build_target, gsi,
+                    flash_plan_enabled)
+                if prestaged:
+                    new_cmd_list.append("dut --operation=boot --serial=%s" %
+                                        serials[shard_index])
+                elif planned_commands is not None:
+                    new_cmd_list.extend(planned_commands)
+                elif (common.K39TV1_BSP in build_target
+                      or common.K39TV1_BSP_1G in build_target):
                     new_cmd_list.extend(
                         GenerateMt6739GsiFlashingCommands(
                             serials[shard_index], gsi))
@@ -292,8 +364,14 @@ def EmitFlashCommands(gsi, **kwargs):
                 sub_commands.append(new_cmd_list)
         result.append(sub_commands)
     else:
-        if (common.K39TV1_BSP in build_target
-                or common.K39TV1_BSP_1G in build_target):
+        planned_commands = _EmitPlannedFlashCommands(
+            serials[0], build_target, gsi, flash_plan_enabled)
+        if prestaged:
+            result.append("dut --operation=boot --serial=%s" % serials[0])
+        elif planned_commands is not None:
+            result.extend(planned_commands)
+        elif (common.K39TV1_BSP in build_target
+              or common.K39TV1_BSP_1G in build_target):
             result.extend(GenerateMt6739GsiFlashingCommands(serials[0], gsi))
         elif common.SDM845 in build_target and gsi:
             result.extend(GenerateSdm845GsiFlashingCommands(serials[0]))
@@ -318,16 +396,84 @@ def EmitFlashCommands(gsi, **kwargs):
     return result
 
 
+def _EmitPlannedFlashCommands(serial, build_target, gsi, enabled):
+    """Returns the flash commands compiled by flash_plan.
+
+    Args:
+        serial: string, the target device serial number.
+        build_target: string, build target of the device images.
+        gsi: bool, whether to flash GSI over vendor images or not.
+        enabled: bool, whether the leased job sets "flash_plan".
+    Returns:
+        list of command string. None if not enabled or the device has no
+        flash plan.
+    """
+    if not enabled:
+        return None
+    builder = flash_plan.GetFlashTargetBuilder(build_target)
+    target = builder(serial, gsi) if builder else None
+    if target is None:
+        return None
+    return flash_plan.CompileFlashPlan(serial, target)
+
+
 def EmitCommonConsoleCommands(**kwargs):
     """Runs a common VTS-on-GSI or CTS-on-GSI test.
 
     This uses a given device branch information and automatically
     selects a GSI branch and a test branch.
+
+    If "command_graph" is set, the commands are returned as a
+    command_graph.CommandGraph so that the test suite is fetched while the
+    devices are flashed, and the results are uploaded in parallel.
     """
+    if HasAttr("command_graph", **kwargs):
+        return EmitCommonConsoleCommandGraph(**kwargs)
+
+    nodes = _EmitCommonConsoleCommandNodes(**kwargs)
+    if nodes is None:
+        return None
     result = []
+    for commands, _, _ in nodes:
+        result.extend(commands)
+    return result
+
 
-    if not set(_JOB_ATTR_LIST).issubset(kwargs):
-        missing_keys = [key for key in _JOB_ATTR_LIST if key not in kwargs]
+def EmitCommonConsoleCommandGraph(**kwargs):
+    """Returns the commands of a common test as a dependency graph.
+
+    Args:
+        kwargs: keyword argument, contains data about the leased job.
+    Returns:
+        a command_graph.CommandGraph. None if the job is invalid.
+    """
+    nodes = _EmitCommonConsoleCommandNodes(**kwargs)
+    if nodes is None:
+        return None
+    graph = command_graph.CommandGraph()
+    for commands, inputs, outputs in nodes:
+        if commands:
+            graph.AddCommands(commands, inputs, outputs)
+    return graph
+
+
+def _EmitCommonConsoleCommandNodes(**kwargs):
+    """Returns the commands of a common test grouped with their resources.
+
+    The commands are in the order of running them as a flat list.
+
+    Args:
+        kwargs: keyword argument, contains data about the leased job.
+    Returns:
+        a list of (commands, inputs, outputs) tuples where the inputs and
+        the outputs are the lists of the command_graph resources read and
+        written by the commands. Both are None for a barrier.
+        None if the job is invalid.
+    """
+    nodes = []
+
+    missing_keys = GetMissingJobAttrs(**kwargs)
+    if missing_keys:
         logging.error("Leased job missing attribute(s): {}".format(
             ", ".join(missing_keys)))
         return None
@@ -339,13 +485,22 @@ def EmitCommonConsoleCommands(**kwargs):
     shards = int(kwargs["shards"])
     suite_name, plan_name = kwargs["test_name"].split("/")
     serials = kwargs["serial"]
-
-    result.append("device --set_serial=%s --from_job_pool --interval=%s" %
-                  (",".join(serials), common.DEFAULT_DEVICE_TIMEOUT_SECS))
-    fetch_commands_result, gsi = EmitFetchCommands(**kwargs)
-    result.extend(fetch_commands_result)
+    devices = [command_graph.DeviceResource(serial) for serial in serials]
+    images = [command_graph.DEVICE_IMAGE, command_graph.GSI_IMAGE]
+
+    nodes.append((["device --set_serial=%s --from_job_pool --interval=%s" %
+                   (",".join(serials), common.DEFAULT_DEVICE_TIMEOUT_SECS)],
+                  None, None))
+    image_commands, test_fetch_commands, info_commands, gsi = (
+        _EmitFetchCommandGroups(**kwargs))
+    # The SDM845 setup commands among the image fetches use the devices.
+    nodes.append((image_commands, [],
+                  images + [command_graph.FETCH_INFO] + devices))
+    nodes.append((test_fetch_commands, [],
+                  [command_graph.TEST_SUITE, command_graph.FETCH_INFO]))
+    nodes.append((info_commands, [], images))
     flash_commands_result = EmitFlashCommands(gsi, **kwargs)
-    result.extend(flash_commands_result)
+    nodes.append((flash_commands_result, images, devices))
 
     param = ""
     if HasAttr("param", **kwargs):
@@ -364,24 +519,27 @@ def EmitCommonConsoleCommands(**kwargs):
         if shards <= len(serials):
             for shard_index in range(shards):
                 test_command += " --serial %s" % serials[shard_index]
-        result.append(test_command)
+        test_commands = [test_command]
     else:
         if serials:
             serial_arg_list = []
             for serial in serials:
                 serial_arg_list.append("--serial %s" % serial)
-            result.append("test --suite %s --keep-result -- %s %s %s" %
-                          (suite_name, plan_name, " ".join(serial_arg_list),
-                           param))
+            test_commands = [
+                "test --suite %s --keep-result -- %s %s %s" %
+                (suite_name, plan_name, " ".join(serial_arg_list), param)
+            ]
         else:
-            result.append("test --suite %s --keep-result -- %s %s" %
-                          (suite_name, plan_name, param))
+            test_commands = ["test --suite %s --keep-result -- %s %s" %
+                             (suite_name, plan_name, param)]
 
     if "retry_count" in kwargs:
         retry_count = int(kwargs["retry_count"])
-        result.append(
+        test_commands.append(
             GenerateRetryCommand(build_target, test_branch, suite_name,
                                  plan_name, serials, retry_count))
+    nodes.append((test_commands, [command_graph.TEST_SUITE],
+                  devices + [command_graph.TEST_RESULT]))
 
     if HasAttr("test_build_id", **kwargs):
         test_build_id = kwargs["test_build_id"]
@@ -422,7 +580,11 @@ def EmitCommonConsoleCommands(**kwargs):
             upload_commands.append("upload --src={result_full} --dest=%s "
                                    "--clear_dest" % upload_dest)
 
-    result.extend(upload_commands)
+    for upload_command in upload_commands:
+        nodes.append(([upload_command], [
+            command_graph.TEST_RESULT, command_graph.FETCH_INFO,
+            command_graph.DEVICE_IMAGE
+        ], []))
 
     if HasAttr("report_reference_url", **kwargs):
         ref_urls = kwargs["report_reference_url"]
@@ -439,11 +601,11 @@ def EmitCommonConsoleCommands(**kwargs):
             if index < len(ref_urls):
                 sheet_command += " --ref " + ref_urls[index]
             sheet_command += " --client_secrets DATA/vtslab-gcs.json"
-            result.append(sheet_command)
+            nodes.append(([sheet_command], [command_graph.TEST_RESULT], []))
 
-    result.append("device --update=stop")
+    nodes.append((["device --update=stop"], None, None))
 
-    return result
+    return nodes
 
 
 def GenerateRetryCommand(build_target,
@@ -508,7 +670,7 @@ def GenerateSdm845SetupCommands(serial):
     Returns:
         a list of strings, each string is a console command.
     """
-    result = []
+    result = [_REBOOT_BOOTLOADER_COMMAND % serial]
 
     result.append(
         "fastboot -s %s flash bootloader {device-image[bootloader.img]}" %
@@ -570,7 +732,7 @@ def GenerateSdm845GsiFlashingCommands(serial, repacked_imageset=False):
     Returns:
         a list of strings, each string is a console command.
     """
-    result = []
+    result = [_REBOOT_BOOTLOADER_COMMAND % serial]
 
     if repacked_imageset:
         result.append(
@@ -654,7 +816,8 @@ def GenerateMt6739GsiFlashingCommands(serial,
                      "{device-image[full-zipfile-dir]}/%s")
     flash_gsi_cmd = ("fastboot --timeout=900 -s %s flash system "
                      "{device-image[system.img]}")
-    result = [
+    result = [_REBOOT_BOOTLOADER_COMMAND % serial]
+    result += [
         flash_img_cmd % (serial, partition, image)
         for partition, image in (
             ("preloader", "preloader_SBOOT_DIS.img"),
@@ -716,6 +879,7 @@ def GenerateUniversal9810GsiFlashingCommands(serial,
         a list of strings, each string is a console command.
     """
     result = [
+        _REBOOT_BOOTLOADER_COMMAND % serial,
         ("fastboot -s %s flash el3_mon "
          "{device-image[full-zipfile-dir]}/el3_mon.img" % serial),
         ("fastboot -s %s flash epbl "
@@ -0,0 +1,193 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Loads the campaign modules once and reloads them when they change.
+
+A loaded module is reused while the size and the modification time of its
+file stay the same. When they change, the file is read again, and the
+module is re-executed only if the content hash differs. The compiled code
+is kept in a directory shared by the processes on the host, keyed by the
+content hash and the Python bytecode version, so that a campaign is
+compiled once per change rather than once per job pool process.
+"""
+
+import hashlib
+import imp  # Python v2 compatibility
+import logging
+import marshal
+import os
+import tempfile
+import threading
+
+from host_controller import common
+from host_controller.utils.ipc import ipc_utils
+
+
+class _CampaignEntry(object):
+    """A loaded campaign module.
+
+    Attributes:
+        module: the module object.
+        stat_key: tuple of the size, the modification time, and the inode
+                  of the file when it was read.
+        digest: string, the SHA-1 of the source.
+    """
+
+    def __init__(self, module, stat_key, digest):
+        self.module = module
+        self.stat_key = stat_key
+        self.digest = digest
+
+
+class CampaignLoader(object):
+    """Loads and caches the campaign modules.
+
+    Attributes:
+        _bytecode_dir: string, the directory of the compiled code shared
+                       among the processes. None not to share.
+        _entries: dict, maps an absolute path to a _CampaignEntry.
+        _counters: dict, maps a counter name to its value.
+        _lock: threading.Lock protecting _entries and _counters.
+    """
+
+    def __init__(self, bytecode_dir=None):
+        if bytecode_dir is None:
+            bytecode_dir = os.path.join(
+                os.path.expanduser("~"), common._CAMPAIGN_BYTECODE_DIR)
+        self._bytecode_dir = bytecode_dir
+        self._entries = {}
+        self._counters = {"hit": 0, "load": 0, "compile": 0}
+        self._lock = threading.Lock()
+
+    def Load(self, path):
+        """Returns the module of a campaign file, loading it if changed.
+
+        A module is replaced only after its new version executes
+        successfully, so a caller gets either the previous version or the
+        new one.
+
+        Args:
+            path: string, the path to the campaign .py file.
+
+        Returns:
+            the module object.
+
+        Raises:
+            IOError if the file cannot be read, SyntaxError or any error
+            raised by executing the module if it has not been loaded
+            before.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stat_key = (stat.st_size, stat.st_mtime, stat.st_ino)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry.stat_key == stat_key:
+                self._counters["hit"] += 1
+                return entry.module
+
+        with open(path, "rb") as source_file:
+            source = source_file.read()
+        digest = hashlib.sha1(source).hexdigest()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry.digest == digest:
+                entry.stat_key = stat_key
+                self._counters["hit"] += 1
+                return entry.module
+
+        try:
+            code = self._GetCode(path, source, digest)
+            module = imp.new_module(
+                os.path.splitext(os.path.basename(path))[0])
+            module.__file__ = path
+            exec(code, module.__dict__)
+        except Exception as e:
+            if not entry:
+                raise
+            logging.exception("Keeping the previous version of %s: %s", path,
+                              e)
+            return entry.module
+
+        with self._lock:
+            self._entries[path] = _CampaignEntry(module, stat_key, digest)
+            self._counters["load"] += 1
+        if entry:
+            logging.info("Reloaded campaign %s", path)
+        return module
+
+    def _GetCode(self, path, source, digest):
+        """Returns the code object of a source, compiling it if not shared.
+
+        Args:
+            path: string, the path to the source file.
+            source: bytes, the content of the file.
+            digest: string, the SHA-1 of the source.
+
+        Returns:
+            the code object.
+        """
+        cache_path = None
+        if self._bytecode_dir:
+            cache_path = os.path.join(
+                self._bytecode_dir, "%s-%s.code" %
+                (digest, hashlib.sha1(imp.get_magic()).hexdigest()[:8]))
+            try:
+                with open(cache_path, "rb") as cache_file:
+                    return marshal.loads(cache_file.read())
+            except (IOError, EOFError, ValueError, TypeError):
+                pass
+
+        code = compile(source, path, "exec")
+        with self._lock:
+            self._counters["compile"] += 1
+        if cache_path:
+            tmp_path = None
+            try:
+                ipc_utils.MakeDirs(self._bytecode_dir)
+                fd, tmp_path = tempfile.mkstemp(dir=self._bytecode_dir)
+                with os.fdopen(fd, "wb") as tmp_file:
+                    tmp_file.write(marshal.dumps(code))
+                os.rename(tmp_path, cache_path)
+            except (IOError, OSError) as e:
+                logging.warning("Cannot cache the code of %s: %s", path, e)
+                if tmp_path and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return code
+
+    def GetStatus(self):
+        """Returns the counters of the loads.
+
+        Returns:
+            a dict with hit, load, compile, and modules which is the number
+            of the cached modules.
+        """
+        with self._lock:
+            status = dict(self._counters)
+            status["modules"] = len(self._entries)
+            return status
+
+
+_loader = None
+_loader_lock = threading.Lock()
+
+
+def GetCampaignLoader():
+    """Returns the CampaignLoader shared in the current process."""
+    global _loader
+    with _loader_lock:
+        if _loader is None:
+            _loader = CampaignLoader()
+        return _loader
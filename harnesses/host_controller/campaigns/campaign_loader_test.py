@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from host_controller.campaigns import campaign_loader
+
+_CAMPAIGN = """
+from host_controller.campaigns import campaign_common
+
+
+def EmitConsoleCommands(**kwargs):
+    return ["%s"]
+"""
+
+
+class CampaignLoaderTest(unittest.TestCase):
+    """Tests for CampaignLoader."""
+
+    def setUp(self):
+        """Creates a campaign file and a loader."""
+        self._temp_dir = tempfile.mkdtemp()
+        self._bytecode_dir = os.path.join(self._temp_dir, "cache")
+        self._path = os.path.join(self._temp_dir, "campaign.py")
+        self._loader = campaign_loader.CampaignLoader(self._bytecode_dir)
+
+    def tearDown(self):
+        """Deletes the temp dir."""
+        shutil.rmtree(self._temp_dir)
+
+    def _WriteCampaign(self, content, mtime):
+        """Writes the campaign file and sets its modification time."""
+        with open(self._path, "w") as campaign_file:
+            campaign_file.write(content)
+        os.utime(self._path, (mtime, mtime))
+
+    def testLoadCached(self):
+        """Tests reusing the module until the file changes."""
+        self._WriteCampaign(_CAMPAIGN % "device", 1000)
+        module = self._loader.Load(self._path)
+        self.assertEqual(["device"], module.EmitConsoleCommands())
+        self.assertIs(module, self._loader.Load(self._path))
+
+        self._WriteCampaign(_CAMPAIGN % "device", 2000)
+        self.assertIs(module, self._loader.Load(self._path))
+
+        self._WriteCampaign(_CAMPAIGN % "test", 3000)
+        reloaded = self._loader.Load(self._path)
+        self.assertEqual(["test"], reloaded.EmitConsoleCommands())
+        self.assertEqual(["device"], module.EmitConsoleCommands())
+        self.assertEqual({
+            "hit": 2,
+            "load": 2,
+            "compile": 2,
+            "modules": 1
+        }, self._loader.GetStatus())
+
+    def testShareCode(self):
+        """Tests loading the code compiled by another process."""
+        self._WriteCampaign(_CAMPAIGN % "device", 1000)
+        self._loader.Load(self._path)
+        self.assertEqual(1, len(os.listdir(self._bytecode_dir)))
+
+        loader = campaign_loader.CampaignLoader(self._bytecode_dir)
+        module = loader.Load(self._path)
+        self.assertEqual(["device"], module.EmitConsoleCommands())
+        self.assertEqual(0, loader.GetStatus()["compile"])
+
+    def testKeepPreviousVersion(self):
+        """Tests keeping the loaded module if the new version is broken."""
+        self._WriteCampaign("def EmitConsoleCommands(", 1000)
+        self.assertRaises(SyntaxError, self._loader.Load, self._path)
+
+        self._WriteCampaign(_CAMPAIGN % "device", 2000)
+        module = self._loader.Load(self._path)
+        self._WriteCampaign("def EmitConsoleCommands(", 3000)
+        self.assertIs(module, self._loader.Load(self._path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,6 +16,8 @@
 
 import unittest
 
+from host_controller.campaigns import campaign_common
+from host_controller.campaigns import command_graph
 from host_controller.campaigns import cts
 from host_controller.campaigns import gts
 from host_controller.campaigns import sts
@@ -70,6 +72,72 @@ class CampaignTest(unittest.TestCase):
         self.assertEqual(
             default_testcase.GenerateOutputData(test_name), results)
 
+    def testPrestagedDevices(self):
+        """Tests that pre-staged devices are booted instead of flashed."""
+        kwargs = default_testcase.GenerateInputData("vts/vts")
+        kwargs["prestaged"] = True
+        fetch_commands, gsi = campaign_common.EmitFetchCommands(**kwargs)
+        self.assertTrue(gsi)
+        self.assertEqual([
+            "fetch --type=pab --branch=my_test_branch "
+            "--target=my_test_build_target --artifact_name=android-vts.zip "
+            "--build_id=my_test_build_id "
+            "--account_id=my_test_pab_account_id", "info"
+        ], fetch_commands)
+        flash_commands = campaign_common.EmitFlashCommands(gsi, **kwargs)
+        self.assertEqual(
+            "dut --operation=boot --serial=my_serial1",
+            flash_commands[0][0][0])
+        self.assertFalse(
+            [cmd for cmds in flash_commands[0] for cmd in cmds
+             if cmd.startswith("flash")])
+
+    def testPrestagingFetchCommands(self):
+        """Tests that pre-staging does not fetch the test suite."""
+        kwargs = default_testcase.GenerateInputData("vts/vts")
+        del kwargs["test_name"]
+        kwargs["prestaging"] = True
+        kwargs["shards"] = 1
+        fetch_commands, gsi = campaign_common.EmitFetchCommands(**kwargs)
+        self.assertTrue(gsi)
+        self.assertFalse(
+            [cmd for cmd in fetch_commands if "my_test_branch" in cmd])
+        self.assertIn("gsispl --version_from_path=boot.img", fetch_commands)
+        self.assertEqual(7, len(fetch_commands))
+
+    def testFlashCommandsEnterBootloader(self):
+        """Tests that the flash sequences start from an idle device."""
+        for generate in (campaign_common.GenerateSdm845SetupCommands,
+                         campaign_common.GenerateSdm845GsiFlashingCommands,
+                         campaign_common.GenerateMt6739GsiFlashingCommands,
+                         campaign_common.
+                         GenerateUniversal9810GsiFlashingCommands):
+            self.assertEqual(
+                "dut --operation=reboot_bootloader --serial=my_serial1",
+                generate("my_serial1")[0])
+
+    def testCommandGraph(self):
+        """Tests that the graph keeps the order of the flat commands."""
+        kwargs = default_testcase.GenerateInputData("vts/vts")
+        kwargs["command_graph"] = True
+        graph = vts.EmitConsoleCommands(**kwargs)
+        self.assertIsInstance(graph, command_graph.CommandGraph)
+        self.assertEqual(
+            default_testcase.GenerateOutputData("vts/vts"),
+            graph.GetCommands())
+
+        nodes = graph.GetNodes()
+        test_fetch = [
+            node for node in nodes
+            if command_graph.TEST_SUITE in (node.outputs or [])
+        ][0]
+        flash = [
+            node for node in nodes
+            if command_graph.GSI_IMAGE in (node.inputs or [])
+        ][0]
+        self.assertNotIn(test_fetch.name, flash.deps)
+        self.assertNotIn(flash.name, test_fetch.deps)
+
 
 if __name__ == '__main__':
     unittest.main()
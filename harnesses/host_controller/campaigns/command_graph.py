@@ -0,0 +1,285 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Runs the console commands of a campaign as a dependency graph.
+
+A campaign adds the commands in the order in which they would run as a
+flat list, and declares the resources each group of commands reads and
+writes. A group waits for the last writer of every resource it uses and
+for the readers of every resource it writes, so the graph runs the groups
+with no conflicting resources concurrently while producing the same
+result as the flat list.
+"""
+
+import logging
+import threading
+import time
+
+# The resources shared among the commands of a campaign.
+DEVICE_IMAGE = "device-image"
+GSI_IMAGE = "gsi-image"
+TEST_SUITE = "test-suite"
+FETCH_INFO = "fetch-info"
+TEST_RESULT = "test-result"
+
+
+def DeviceResource(serial):
+    """Returns the resource name of a device.
+
+    Args:
+        serial: string, the device serial.
+
+    Returns:
+        string, the resource name.
+    """
+    return "device:%s" % serial
+
+
+class CommandNode(object):
+    """A group of console commands run in order.
+
+    Attributes:
+        name: string, the unique name of the node.
+        commands: a list of console commands, i.e., strings or lists of
+                  parallel command lists as accepted by Console.onecmd.
+        inputs: a set of strings, the resources read by the commands.
+                None if the node is a barrier which uses all resources.
+        outputs: a set of strings, the resources written by the commands.
+                 None if the node is a barrier.
+        deps: a set of strings, the names of the nodes to finish first.
+        start_time: float, the time the node started running.
+                    None if not started.
+        end_time: float, the time the node finished. None if not finished.
+        result: bool, True if the commands succeeded, False if failed.
+                None if not finished.
+    """
+
+    def __init__(self, name, commands, inputs, outputs, deps):
+        self.name = name
+        self.commands = commands
+        self.inputs = inputs
+        self.outputs = outputs
+        self.deps = deps
+        self.start_time = None
+        self.end_time = None
+        self.result = None
+
+    def GetDuration(self):
+        """Returns the running time of the node in seconds.
+
+        Returns:
+            float, 0 if the node has not finished.
+        """
+        if self.start_time is None or self.end_time is None:
+            return 0
+        return self.end_time - self.start_time
+
+
+class CommandGraph(object):
+    """A dependency graph of console commands.
+
+    Attributes:
+        _nodes: a list of CommandNode objects in the order of adding.
+        _nodes_by_name: dict, maps a name to the CommandNode.
+        _writers: dict, maps a resource to the name of the last node
+                  writing it.
+        _readers: dict, maps a resource to the names of the nodes reading
+                  it since the last writer.
+        _barrier: string, the name of the last barrier node.
+        _since_barrier: a list of the names of the nodes added after the
+                        last barrier.
+    """
+
+    def __init__(self):
+        self._nodes = []
+        self._nodes_by_name = {}
+        self._writers = {}
+        self._readers = {}
+        self._barrier = None
+        self._since_barrier = []
+
+    def AddCommands(self, commands, inputs=None, outputs=None, name=None,
+                    deps=None):
+        """Adds a group of commands after the ones added before.
+
+        Args:
+            commands: a list of console commands run in order.
+            inputs: a list of strings, the resources read by the commands.
+            outputs: a list of strings, the resources written by the
+                     commands. If both inputs and outputs are None, the
+                     node is a barrier which runs after all the previous
+                     nodes and before all the following ones.
+            name: string, the name of the node. None to use the first
+                  command.
+            deps: a list of strings, the names of the previously added
+                  nodes to finish first in addition to the ones derived
+                  from the resources.
+
+        Returns:
+            the added CommandNode.
+
+        Raises:
+            ValueError if the name is not unique or a dependency is not
+            added yet.
+        """
+        if name is None:
+            name = "%d:%s" % (len(self._nodes), _Describe(commands))
+        if name in self._nodes_by_name:
+            raise ValueError("Duplicate command node %s" % name)
+        node_deps = set(deps or [])
+        for dep in node_deps:
+            if dep not in self._nodes_by_name:
+                raise ValueError("Unknown dependency %s of %s" % (dep, name))
+
+        barrier = inputs is None and outputs is None
+        inputs = set(inputs or [])
+        outputs = set(outputs or [])
+        if self._barrier:
+            node_deps.add(self._barrier)
+        if barrier:
+            node_deps.update(self._since_barrier)
+            node = CommandNode(name, commands, None, None, node_deps)
+            self._writers = {}
+            self._readers = {}
+            self._barrier = name
+            self._since_barrier = []
+        else:
+            for resource in inputs | outputs:
+                if resource in self._writers:
+                    node_deps.add(self._writers[resource])
+            for resource in outputs:
+                node_deps.update(self._readers.get(resource, []))
+            node = CommandNode(name, commands, inputs, outputs, node_deps)
+            for resource in inputs - outputs:
+                self._readers.setdefault(resource, []).append(name)
+            for resource in outputs:
+                self._writers[resource] = name
+                self._readers[resource] = []
+            self._since_barrier.append(name)
+
+        self._nodes.append(node)
+        self._nodes_by_name[name] = node
+        return node
+
+    def GetNodes(self):
+        """Returns the nodes in the order of adding."""
+        return list(self._nodes)
+
+    def GetCommands(self):
+        """Returns the commands as a flat list in the order of adding."""
+        commands = []
+        for node in self._nodes:
+            commands.extend(node.commands)
+        return commands
+
+    def GetCriticalPath(self):
+        """Returns the longest chain of dependent nodes by running time.
+
+        Returns:
+            a list of CommandNode objects from the first to the last,
+            float, the sum of their running time in seconds.
+        """
+        finish = {}
+        previous = {}
+        for node in self._nodes:
+            longest_dep = None
+            for dep in node.deps:
+                if longest_dep is None or finish[dep] > finish[longest_dep]:
+                    longest_dep = dep
+            previous[node.name] = longest_dep
+            finish[node.name] = (node.GetDuration() +
+                                 (finish[longest_dep] if longest_dep else 0))
+
+        if not self._nodes:
+            return [], 0
+        last = max(self._nodes, key=lambda node: finish[node.name]).name
+        path = []
+        name = last
+        while name:
+            path.append(self._nodes_by_name[name])
+            name = previous[name]
+        path.reverse()
+        return path, finish[last]
+
+    def Run(self, execute, max_threads):
+        """Runs the nodes with their dependencies satisfied concurrently.
+
+        Once a node fails, no more nodes are started and the running ones
+        are waited for.
+
+        Args:
+            execute: a function which takes a CommandNode, runs its
+                     commands, and returns False on failure.
+            max_threads: int, the maximum number of nodes run concurrently.
+
+        Returns:
+            True if all nodes succeeded, False otherwise.
+        """
+        condition = threading.Condition()
+        pending = list(self._nodes)
+        done = set()
+        running = []
+        failed = [False]
+
+        def _RunNode(node):
+            node.start_time = time.time()
+            try:
+                result = execute(node) != False
+            except Exception as e:
+                logging.exception("Command node %s raised %s", node.name, e)
+                result = False
+            with condition:
+                node.end_time = time.time()
+                node.result = result
+                running.remove(node)
+                done.add(node.name)
+                if not result:
+                    logging.error("Command node %s failed", node.name)
+                    failed[0] = True
+                condition.notify()
+
+        start_time = time.time()
+        with condition:
+            while True:
+                if not failed[0]:
+                    for node in list(pending):
+                        if len(running) >= max_threads:
+                            break
+                        if node.deps.issubset(done):
+                            pending.remove(node)
+                            running.append(node)
+                            thread = threading.Thread(
+                                target=_RunNode, args=(node, ))
+                            thread.daemon = True
+                            thread.start()
+                if not running:
+                    break
+                condition.wait()
+
+        path, path_secs = self.GetCriticalPath()
+        logging.info(
+            "Command graph ran %d of %d nodes in %.1f secs. "
+            "Critical path %.1f secs: %s",
+            len(done), len(self._nodes), time.time() - start_time, path_secs,
+            " -> ".join("%s (%.1f)" % (node.name, node.GetDuration())
+                        for node in path))
+        return not failed[0] and not pending
+
+
+def _Describe(commands):
+    """Returns the first command of a node for its default name."""
+    while isinstance(commands, list) and commands:
+        commands = commands[0]
+    return str(commands) if commands else "empty"
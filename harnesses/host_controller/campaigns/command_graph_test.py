@@ -0,0 +1,126 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import threading
+import time
+import unittest
+
+from host_controller.campaigns import command_graph
+
+
+class CommandGraphTest(unittest.TestCase):
+    """Unit tests for the command graph."""
+
+    def _GetDeps(self, graph):
+        """Returns a dict mapping the node names to the sorted deps."""
+        return dict((node.name, sorted(node.deps))
+                    for node in graph.GetNodes())
+
+    def testDependencies(self):
+        """Tests deriving the dependencies from the resources."""
+        graph = command_graph.CommandGraph()
+        graph.AddCommands(["setup"], name="setup")
+        graph.AddCommands(["fetch device"], [], ["image", "info"],
+                          name="fetch")
+        graph.AddCommands(["fetch suite"], [], ["suite", "info"],
+                          name="suite")
+        graph.AddCommands(["flash"], ["image"], ["device"], name="flash")
+        graph.AddCommands(["test"], ["suite", "device"], ["result"],
+                          name="test")
+        graph.AddCommands(["upload 1"], ["result", "info"], [], name="up1")
+        graph.AddCommands(["upload 2"], ["result", "info"], [], name="up2")
+        graph.AddCommands(["fetch again"], [], ["info"], name="again")
+        graph.AddCommands(["stop"], name="stop")
+        self.assertEqual({
+            "setup": [],
+            "fetch": ["setup"],
+            "suite": ["fetch", "setup"],
+            "flash": ["fetch", "setup"],
+            "test": ["flash", "setup", "suite"],
+            "up1": ["setup", "suite", "test"],
+            "up2": ["setup", "suite", "test"],
+            "again": ["setup", "suite", "up1", "up2"],
+            "stop": ["again", "fetch", "flash", "setup", "suite", "test",
+                     "up1", "up2"],
+        }, self._GetDeps(graph))
+        self.assertEqual([
+            "setup", "fetch device", "fetch suite", "flash", "test",
+            "upload 1", "upload 2", "fetch again", "stop"
+        ], graph.GetCommands())
+
+    def testInvalidNodes(self):
+        """Tests adding duplicate nodes and unknown dependencies."""
+        graph = command_graph.CommandGraph()
+        graph.AddCommands(["a"], [], [], name="a")
+        self.assertRaises(ValueError, graph.AddCommands, ["a"], [], [],
+                          name="a")
+        self.assertRaises(ValueError, graph.AddCommands, ["b"], [], [],
+                          deps=["c"])
+
+    def testRunConcurrently(self):
+        """Tests running the independent nodes at the same time."""
+        graph = command_graph.CommandGraph()
+        graph.AddCommands(["slow"], [], ["a"], name="slow")
+        graph.AddCommands(["fast"], [], ["b"], name="fast")
+        graph.AddCommands(["last"], ["a", "b"], [], name="last")
+        order = []
+        lock = threading.Lock()
+
+        def _Execute(node):
+            if node.name == "slow":
+                time.sleep(0.2)
+            with lock:
+                order.append(node.name)
+            return True
+
+        self.assertTrue(graph.Run(_Execute, 4))
+        self.assertEqual(["fast", "slow", "last"], order)
+        path, secs = graph.GetCriticalPath()
+        self.assertEqual(["slow", "last"], [node.name for node in path])
+        self.assertGreaterEqual(secs, 0.2)
+
+    def testRunFailure(self):
+        """Tests that no more nodes are started after a failure."""
+        graph = command_graph.CommandGraph()
+        graph.AddCommands(["fail"], [], ["a"], name="fail")
+        graph.AddCommands(["other"], [], ["b"], name="other")
+        graph.AddCommands(["next"], ["a"], [], name="next")
+        executed = []
+
+        def _Execute(node):
+            executed.append(node.name)
+            return node.name != "fail"
+
+        self.assertFalse(graph.Run(_Execute, 1))
+        self.assertEqual(["fail"], executed)
+        nodes = graph.GetNodes()
+        self.assertFalse(nodes[0].result)
+        self.assertIsNone(nodes[1].result)
+        self.assertIsNone(nodes[2].result)
+
+    def testRunException(self):
+        """Tests that an exception fails the node."""
+        graph = command_graph.CommandGraph()
+        graph.AddCommands(["raise"], [], [], name="raise")
+
+        def _Execute(node):
+            raise IOError("error")
+
+        self.assertFalse(graph.Run(_Execute, 1))
+        self.assertFalse(graph.GetNodes()[0].result)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,441 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Compiles the desired state of a device into console commands.
+
+The compiler visits the bootloader once per flash stage, the userspace
+fastboot (fastbootd) once, and Android once per required boot, so the
+reboots and boot waits of the fixed per-SoC sequences are merged.
+"""
+
+from host_controller import common
+
+MODE_UNKNOWN = "unknown"
+MODE_ANDROID = "android"
+MODE_BOOTLOADER = "bootloader"
+MODE_FASTBOOTD = "fastbootd"
+
+WIPE_NONE = "none"
+WIPE_USERDATA = "userdata"
+WIPE_ALL = "all"
+
+# Timeout of flashing a system image in seconds.
+_SYSTEM_FLASH_TIMEOUT_SECS = 900
+
+
+class PartitionImage(object):
+    """An image to be flashed to a partition.
+
+    Attributes:
+        partition: string, the partition name.
+        image: string, the image path which may contain console variables,
+               e.g., {device-image[system.img]}.
+        stage: int, the flash stage. The stages are flashed in ascending
+               order and the bootloader is rebooted between them, so that
+               the images of the later stages are flashed by the new
+               bootloader.
+        fastbootd: bool, True if the partition is flashed in fastbootd.
+        options: string, the extra fastboot options, e.g., "-S 512M".
+        timeout: int, the timeout of the fastboot command in seconds.
+                 None for the default.
+    """
+
+    def __init__(self,
+                 partition,
+                 image,
+                 stage=0,
+                 fastbootd=False,
+                 options="",
+                 timeout=None):
+        self.partition = partition
+        self.image = image
+        self.stage = stage
+        self.fastbootd = fastbootd
+        self.options = options
+        self.timeout = timeout
+
+
+class DeviceState(object):
+    """The current state of a device.
+
+    Attributes:
+        mode: string, one of the MODE_* constants.
+        images: dict, maps a partition name to the image flashed on it.
+                The partitions whose image is unchanged are skipped.
+    """
+
+    def __init__(self, mode=MODE_UNKNOWN, images=None):
+        self.mode = mode
+        self.images = images or {}
+
+
+class FlashTarget(object):
+    """The desired end state of a device.
+
+    Attributes:
+        images: a list of PartitionImage objects. If a partition is listed
+                more than once, the last one is flashed.
+        vendor_version: string, the vendor version to patch the GSI's
+                        security patch level with before flashing system.
+                        None to skip patching.
+        wipe: string, one of the WIPE_* constants.
+        boot: bool, True to end in Android with boot completed.
+        post_boot_commands: a list of console commands run after boot.
+        reboot_after_post_boot: bool, True if the post-boot commands take
+                                effect after a reboot.
+    """
+
+    def __init__(self,
+                 images,
+                 vendor_version=None,
+                 wipe=WIPE_NONE,
+                 boot=True,
+                 post_boot_commands=None,
+                 reboot_after_post_boot=False):
+        self.images = images
+        self.vendor_version = vendor_version
+        self.wipe = wipe
+        self.boot = boot
+        self.post_boot_commands = post_boot_commands or []
+        self.reboot_after_post_boot = reboot_after_post_boot
+
+
+class _PlanBuilder(object):
+    """Emits the commands while tracking the mode of the device.
+
+    Attributes:
+        commands: a list of strings, the emitted console commands.
+        mode: string, the mode of the device after the emitted commands.
+        _serial: string, the device serial.
+    """
+
+    def __init__(self, serial, mode):
+        self.commands = []
+        self.mode = mode
+        self._serial = serial
+
+    def Fastboot(self, args, timeout=None):
+        """Emits a fastboot command.
+
+        Args:
+            args: string, the fastboot command and its arguments.
+            timeout: int, the timeout in seconds. None for the default.
+        """
+        prefix = "fastboot "
+        if timeout is not None:
+            prefix += "--timeout=%d " % timeout
+        self.commands.append(prefix + "-s %s %s" % (self._serial, args))
+
+    def EnterBootloader(self):
+        """Reboots the device to the bootloader unless it is there."""
+        if self.mode == MODE_BOOTLOADER:
+            return
+        if self.mode == MODE_FASTBOOTD:
+            self.Fastboot("-- reboot bootloader")
+        elif self.mode == MODE_ANDROID:
+            self.commands.append("adb -s %s reboot bootloader" % self._serial)
+        else:
+            # The device may be in the bootloader already.
+            self.commands.append(
+                "dut --operation=reboot_bootloader --serial=%s" % self._serial)
+        self.mode = MODE_BOOTLOADER
+
+    def RebootBootloader(self):
+        """Reboots the bootloader to load the newly flashed one."""
+        self.Fastboot("-- reboot bootloader")
+        self.mode = MODE_BOOTLOADER
+
+    def EnterFastbootd(self):
+        """Reboots the device to fastbootd unless it is there."""
+        if self.mode == MODE_FASTBOOTD:
+            return
+        if self.mode == MODE_BOOTLOADER:
+            self.Fastboot("-- reboot fastboot")
+        else:
+            self.commands.append("adb -s %s reboot fastboot" % self._serial)
+        self.mode = MODE_FASTBOOTD
+
+    def Flash(self, image):
+        """Flashes a PartitionImage."""
+        args = "flash %s %s" % (image.partition, image.image)
+        if image.options:
+            args += " -- %s" % image.options
+        self.Fastboot(args, image.timeout)
+
+    def Boot(self, wipe_all=False):
+        """Boots the device to Android and waits for boot completion.
+
+        Args:
+            wipe_all: bool, True to erase userdata and cache on reboot.
+        """
+        if self.mode in (MODE_BOOTLOADER, MODE_FASTBOOTD):
+            self.Fastboot("reboot -- -w" if wipe_all else "reboot")
+        elif self.mode == MODE_ANDROID:
+            self.commands.append("adb -s %s reboot" % self._serial)
+        self.commands.append(
+            "dut --operation=wait_for_boot --serial=%s" % self._serial)
+        self.mode = MODE_ANDROID
+
+
+def _SelectImages(target, current):
+    """Returns the images to be flashed in order.
+
+    Args:
+        target: FlashTarget object.
+        current: DeviceState object.
+
+    Returns:
+        a list of PartitionImage objects sorted by stage. The images in the
+        same stage keep the order in the target.
+    """
+    last_images = {}
+    for image in target.images:
+        last_images[image.partition] = image
+    images = []
+    for image in target.images:
+        if last_images[image.partition] is not image:
+            continue
+        if current.images.get(image.partition) == image.image:
+            continue
+        images.append(image)
+    return sorted(images, key=lambda image: (image.fastbootd, image.stage))
+
+
+def CompileFlashPlan(serial, target, current=None):
+    """Compiles a device's desired state into console commands.
+
+    The output depends only on the arguments.
+
+    Args:
+        serial: string, the device serial.
+        target: FlashTarget object, the desired end state.
+        current: DeviceState object, the current state. Defaults to a device
+                 in an unknown mode, e.g., Android, whose images are
+                 unknown. The plan then starts by rebooting to the
+                 bootloader.
+
+    Returns:
+        a list of strings, each string is a console command.
+    """
+    if current is None:
+        current = DeviceState()
+    images = _SelectImages(target, current)
+    builder = _PlanBuilder(serial, current.mode)
+
+    if target.vendor_version is not None and any(
+            image.partition == "system" for image in images):
+        gsispl_command = "gsispl --version_from_path=boot.img"
+        if target.vendor_version:
+            gsispl_command += " --vendor_version=%s" % target.vendor_version
+        builder.commands.append(gsispl_command)
+
+    last_stage = None
+    for image in images:
+        if image.fastbootd:
+            builder.EnterFastbootd()
+        else:
+            if last_stage is not None and image.stage != last_stage:
+                builder.RebootBootloader()
+            builder.EnterBootloader()
+            last_stage = image.stage
+        builder.Flash(image)
+
+    # Erasing userdata is deferred if the device goes back to the
+    # bootloader after the post-boot commands anyway.
+    defer_wipe = (target.wipe == WIPE_USERDATA
+                  and target.post_boot_commands
+                  and target.reboot_after_post_boot)
+    if target.wipe == WIPE_USERDATA and not defer_wipe:
+        if builder.mode != MODE_FASTBOOTD:
+            builder.EnterBootloader()
+        builder.Fastboot("erase userdata")
+
+    wipe_all = target.wipe == WIPE_ALL
+    if wipe_all and builder.mode != MODE_FASTBOOTD:
+        builder.EnterBootloader()
+
+    if not (target.boot or target.post_boot_commands):
+        if wipe_all:
+            builder.Fastboot("-- -w")
+        return builder.commands
+
+    if builder.mode != MODE_ANDROID or builder.commands:
+        builder.Boot(wipe_all)
+    builder.commands.extend(target.post_boot_commands)
+
+    if target.post_boot_commands and target.reboot_after_post_boot:
+        if defer_wipe:
+            builder.EnterBootloader()
+            builder.Fastboot("erase userdata")
+        builder.Boot()
+    return builder.commands
+
+
+def Sdm845FlashTarget(serial, gsi=False):
+    """Returns the desired state of an sdm845 device after flashing GSI.
+
+    Args:
+        serial: string, the target device serial number.
+        gsi: bool, whether to flash GSI over vendor images or not.
+
+    Returns:
+        FlashTarget object. None if the device images are flashed by the
+        flash command.
+    """
+    if not gsi:
+        return None
+    post_boot_commands = [
+        "adb -s %s root" % serial,
+        "adb -s %s remount" % serial,
+        "adb -s %s shell setenforce 0" % serial,
+        "adb -s %s shell mkdir /bt_firmware" % serial,
+        "adb -s %s shell chown system:system /bt_firmware" % serial,
+        "adb -s %s shell chmod 650 /bt_firmware" % serial,
+        "adb -s %s shell setenforce 1" % serial,
+    ]
+    post_boot_commands.extend([
+        "adb -s %s push {tmp_dir}/%s/%s /system/lib64" % (serial, serial,
+                                                          lib_file)
+        for lib_file in common.SDM845_LIB_LIST
+    ])
+    post_boot_commands.append(
+        ("adb -s %s push ../testcases/DATA/xml/media_profiles_vendor.xml "
+         "/vendor/etc/media_profiles_vendor.xml") % serial)
+    post_boot_commands.append("shell -- rm {tmp_dir}/%s -rf" % serial)
+    return FlashTarget(
+        [
+            PartitionImage(
+                "system",
+                "{device-image[system.img]}",
+                timeout=_SYSTEM_FLASH_TIMEOUT_SECS)
+        ],
+        wipe=WIPE_USERDATA,
+        post_boot_commands=post_boot_commands,
+        reboot_after_post_boot=True)
+
+
+def Mt6739FlashTarget(serial, gsi=False):
+    """Returns the desired state of an mt6739 device.
+
+    Args:
+        serial: string, the target device serial number.
+        gsi: bool, whether to flash GSI over vendor images or not.
+
+    Returns:
+        FlashTarget object.
+    """
+    image_dir = "{device-image[full-zipfile-dir]}/"
+    images = [
+        PartitionImage(partition, image_dir + image, stage=0)
+        for partition, image in (
+            ("preloader", "preloader_SBOOT_DIS.img"),
+            ("loader_ext1", "loader_ext.img"),
+            ("loader_ext2", "loader_ext.img"),
+            ("tee1", "tee.img"),
+            ("tee2", "tee.img"),
+            ("lk", "lk.img"),
+            ("lk2", "lk.img"),
+        )
+    ]
+    # gpt is the partition table and must be flashed first in its stage.
+    images += [
+        PartitionImage(partition, image_dir + image, stage=1)
+        for partition, image in (
+            ("gpt", "PGPT"),
+            ("md1img", "md1img.img"),
+            ("md1dsp", "md1dsp.img"),
+            ("recovery", "recovery.img"),
+            ("spmfw", "spmfw.img"),
+            ("mcupmfw", "mcupmfw.img"),
+            ("boot", "boot.img"),
+            ("dtbo", "dtbo.img"),
+            ("vendor", "vendor.img"),
+            ("cache", "cache.img"),
+            ("userdata", "userdata.img"),
+        )
+    ]
+    if gsi:
+        images.append(
+            PartitionImage(
+                "system",
+                "{device-image[system.img]}",
+                stage=1,
+                timeout=_SYSTEM_FLASH_TIMEOUT_SECS))
+    else:
+        images.append(
+            PartitionImage(
+                "system",
+                image_dir + "system.img",
+                stage=1,
+                timeout=_SYSTEM_FLASH_TIMEOUT_SECS))
+    return FlashTarget(images, wipe=WIPE_ALL if gsi else WIPE_NONE)
+
+
+def Universal9810FlashTarget(serial, gsi=False):
+    """Returns the desired state of a universal9810 device.
+
+    Args:
+        serial: string, the target device serial number.
+        gsi: bool, whether to flash GSI over vendor images or not.
+
+    Returns:
+        FlashTarget object.
+    """
+    image_dir = "{device-image[full-zipfile-dir]}/"
+    images = [
+        PartitionImage(partition, image_dir + image)
+        for partition, image in (
+            ("el3_mon", "el3_mon.img"),
+            ("epbl", "epbl.img"),
+            ("bootloader", "u-boot.img"),
+            ("dtb", "dtb.img"),
+            ("dtbo", "dtbo.img"),
+            ("kernel", "kernel.img"),
+            ("ramdisk", "ramdisk.img"),
+        )
+    ]
+    images.append(
+        PartitionImage("vendor", image_dir + "vendor.img", options="-S 300M"))
+    images.append(
+        PartitionImage(
+            "system",
+            "{device-image[system.img]}" if gsi else image_dir + "system.img",
+            options="-S 512M",
+            timeout=_SYSTEM_FLASH_TIMEOUT_SECS))
+    return FlashTarget(images, wipe=WIPE_ALL)
+
+
+FLASH_TARGET_BUILDER = {
+    common.K39TV1_BSP: Mt6739FlashTarget,
+    common.K39TV1_BSP_1G: Mt6739FlashTarget,
+    common.SDM845: Sdm845FlashTarget,
+    common.UNIVERSAL9810: Universal9810FlashTarget,
+}
+
+
+def GetFlashTargetBuilder(build_target):
+    """Returns the function building the FlashTarget of a build target.
+
+    Args:
+        build_target: string, the build target of the device images.
+
+    Returns:
+        a function which takes a serial and a gsi flag and returns a
+        FlashTarget or None. None if the build target has no flash plan.
+    """
+    for product in sorted(FLASH_TARGET_BUILDER):
+        if product in build_target:
+            return FLASH_TARGET_BUILDER[product]
+    return None
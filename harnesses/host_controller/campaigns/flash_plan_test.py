@@ -0,0 +1,151 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import unittest
+
+from host_controller import common
+from host_controller.campaigns import campaign_common
+from host_controller.campaigns import flash_plan
+
+
+class FlashPlanTest(unittest.TestCase):
+    """Unit tests for the flash plan compiler."""
+
+    def setUp(self):
+        self.maxDiff = None
+
+    def testStagesAndWipe(self):
+        """Tests that stages are separated by one bootloader reboot."""
+        target = flash_plan.FlashTarget(
+            [
+                flash_plan.PartitionImage("system", "system.img", stage=1),
+                flash_plan.PartitionImage("bootloader", "bootloader.img"),
+                flash_plan.PartitionImage("radio", "radio.img"),
+                flash_plan.PartitionImage("vendor", "vendor.img", stage=1),
+            ],
+            vendor_version="8.1.0",
+            wipe=flash_plan.WIPE_ALL)
+        self.assertEqual([
+            "gsispl --version_from_path=boot.img --vendor_version=8.1.0",
+            "adb -s serial1 reboot bootloader",
+            "fastboot -s serial1 flash bootloader bootloader.img",
+            "fastboot -s serial1 flash radio radio.img",
+            "fastboot -s serial1 -- reboot bootloader",
+            "fastboot -s serial1 flash system system.img",
+            "fastboot -s serial1 flash vendor vendor.img",
+            "fastboot -s serial1 reboot -- -w",
+            "dut --operation=wait_for_boot --serial=serial1",
+        ],
+                         flash_plan.CompileFlashPlan(
+                             "serial1", target,
+                             flash_plan.DeviceState(
+                                 flash_plan.MODE_ANDROID)))
+
+    def testSkipUnchangedImages(self):
+        """Tests that flashed images and their stage reboots are skipped."""
+        target = flash_plan.FlashTarget(
+            [
+                flash_plan.PartitionImage("bootloader", "bootloader.img"),
+                flash_plan.PartitionImage(
+                    "system", "system.img", stage=1, timeout=900),
+                flash_plan.PartitionImage(
+                    "product", "product.img", fastbootd=True),
+            ],
+            vendor_version="")
+        current = flash_plan.DeviceState(
+            flash_plan.MODE_BOOTLOADER, {"bootloader": "bootloader.img"})
+        self.assertEqual([
+            "gsispl --version_from_path=boot.img",
+            "fastboot --timeout=900 -s serial1 flash system system.img",
+            "fastboot -s serial1 -- reboot fastboot",
+            "fastboot -s serial1 flash product product.img",
+            "fastboot -s serial1 reboot",
+            "dut --operation=wait_for_boot --serial=serial1",
+        ], flash_plan.CompileFlashPlan("serial1", target, current))
+
+        current.images.update({"system": "system.img",
+                               "product": "product.img"})
+        current.mode = flash_plan.MODE_ANDROID
+        self.assertEqual([],
+                         flash_plan.CompileFlashPlan("serial1", target,
+                                                     current))
+
+    def testDeferredUserdataWipe(self):
+        """Tests that the wipe shares the reboot after post-boot commands."""
+        target = flash_plan.Sdm845FlashTarget("serial1", gsi=True)
+        commands = flash_plan.CompileFlashPlan("serial1", target)
+        self.assertEqual(
+            "dut --operation=reboot_bootloader --serial=serial1",
+            commands[0])
+        self.assertEqual(
+            "fastboot --timeout=900 -s serial1 flash system "
+            "{device-image[system.img]}", commands[1])
+        self.assertEqual(2, commands.count("fastboot -s serial1 reboot"))
+        self.assertEqual(
+            2,
+            commands.count("dut --operation=wait_for_boot --serial=serial1"))
+        self.assertEqual([
+            "adb -s serial1 reboot bootloader",
+            "fastboot -s serial1 erase userdata",
+            "fastboot -s serial1 reboot",
+            "dut --operation=wait_for_boot --serial=serial1",
+        ], commands[-4:])
+        self.assertFalse([cmd for cmd in commands if cmd.startswith("sleep")])
+
+    def testMt6739Plan(self):
+        """Tests the plan replacing the mt6739 flash sequence."""
+        target = flash_plan.Mt6739FlashTarget("serial1", gsi=True)
+        commands = flash_plan.CompileFlashPlan("serial1", target)
+        self.assertEqual(23, len(commands))
+        self.assertEqual(
+            "dut --operation=reboot_bootloader --serial=serial1",
+            commands[0])
+        self.assertEqual("fastboot -s serial1 -- reboot bootloader",
+                         commands[8])
+        self.assertEqual(
+            "fastboot -s serial1 flash gpt "
+            "{device-image[full-zipfile-dir]}/PGPT", commands[9])
+        self.assertEqual("fastboot -s serial1 reboot -- -w", commands[-2])
+
+    def testEmitFlashCommands(self):
+        """Tests that the jobs opt in to the flash plans."""
+        kwargs = {
+            "build_target": [common.UNIVERSAL9810 + "-userdebug"],
+            "manifest_branch": "git_pi-release",
+            "gsi_branch": "git_pi-release",
+            "shards": 1,
+            "serial": ["serial1"],
+        }
+        commands = campaign_common.EmitFlashCommands(True, **kwargs)
+        self.assertIn("sleep 300", commands)
+
+        kwargs["flash_plan"] = True
+        commands = campaign_common.EmitFlashCommands(True, **kwargs)
+        self.assertNotIn("sleep 300", commands)
+        self.assertIn(
+            "fastboot --timeout=900 -s serial1 flash system "
+            "{device-image[system.img]} -- -S 512M", commands)
+        self.assertEqual(
+            "dut --operation=reboot_bootloader --serial=serial1",
+            commands[0])
+        self.assertEqual("dut --operation=wait_for_boot --serial=serial1",
+                         commands[11])
+        self.assertEqual(commands, campaign_common.EmitFlashCommands(
+            True, **kwargs))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,299 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Compiles and validates the console commands of a campaign.
+
+A campaign emits its command list when a job is leased, and the commands
+are checked only when they run. The preflight resolves the command list
+for a job before anything runs, and checks that every command is known to
+the console and accepted by its argument parser, that every {var} is
+defined by the time the command runs, and that the job has the devices
+the commands use.
+"""
+
+import logging
+import os
+import re
+
+from host_controller.campaigns import campaign_common
+from host_controller.campaigns import campaign_loader
+from host_controller.campaigns import command_graph
+from host_controller.console_argument_parser import ConsoleArgumentError
+
+# The variables replaced by Console.FormatString and ReplaceVars, mapped
+# to the commands that define them. An empty tuple means always defined.
+_VARIABLE_PRODUCERS = {
+    "build_id": ("fetch", ),
+    "branch": ("fetch", ),
+    "target": ("fetch", ),
+    "account_id": ("fetch", ),
+    "result_full": ("test", "retry"),
+    "result_zip": ("test", "retry"),
+    "suite_plan": ("test", "retry"),
+    "suite_name": ("test", "retry"),
+    "repack_path": ("repack", ),
+    "device-image": ("fetch", ),
+    "tools": ("fetch", ),
+    "hc_log": (),
+    "hc_log_file": (),
+    "hc_log_upload_path": (),
+    "hostname": (),
+    "tmp_dir": (),
+}
+
+# The variables a command resolves in its own arguments.
+_SELF_RESOLVED_VARIABLES = {
+    "fetch": ("build_id", ),
+}
+
+# Options whose values are device serials.
+_SERIAL_OPTIONS = ("-s", "--serial", "--set_serial")
+
+# The attributes of a ScheduleConfigMessage, its build targets, and their
+# test schedules which are passed to a campaign as the job attributes.
+_SCHEDULE_ATTRS = ("manifest_branch", "pab_account_id", "build_storage_type")
+_BUILD_TARGET_ATTRS = ("require_signed_device_build", "has_bootloader_img",
+                       "has_radio_img")
+_TEST_SCHEDULE_ATTRS = (
+    "test_name", "shards", "param", "retry_count", "gsi_branch",
+    "gsi_build_target", "gsi_pab_account_id", "gsi_storage_type",
+    "gsi_vendor_version", "test_branch", "test_build_target",
+    "test_pab_account_id", "test_storage_type", "report_bucket",
+    "report_spreadsheet_id", "report_persistent_url",
+    "report_reference_url")
+
+
+def CompileCampaign(console, script_module, kwargs):
+    """Emits the commands of a campaign for a job and validates them.
+
+    Args:
+        console: Console object, which runs the commands.
+        script_module: the loaded campaign module.
+        kwargs: dict, the job attributes.
+
+    Returns:
+        the emitted command list or CommandGraph, None if the campaign
+        failed to emit the commands,
+        a list of strings, the errors found.
+    """
+    missing_keys = campaign_common.GetMissingJobAttrs(**kwargs)
+    if missing_keys:
+        return None, [
+            "job missing attribute(s): %s" % ", ".join(missing_keys)
+        ]
+    try:
+        commands = script_module.EmitConsoleCommands(**kwargs)
+    except Exception as e:
+        logging.exception(e)
+        return None, ["campaign raised %s: %s" % (type(e).__name__, e)]
+    if not commands:
+        return commands, ["campaign emitted no command"]
+    return commands, ValidateCommands(console, commands, kwargs)
+
+
+def _FlattenCommands(commands):
+    """Lists the command lines in the order of adding them.
+
+    Args:
+        commands: a list of console commands or a CommandGraph. The lists
+                  nested in the list run in parallel.
+
+    Returns:
+        a list of strings.
+    """
+    if isinstance(commands, command_graph.CommandGraph):
+        commands = commands.GetCommands()
+    lines = []
+    for command in commands:
+        if isinstance(command, list):
+            lines.extend(_FlattenCommands(command))
+        else:
+            lines.append(command)
+    return lines
+
+
+def ValidateCommands(console, commands, kwargs):
+    """Validates the commands emitted for a job.
+
+    Args:
+        console: Console object, which runs the commands.
+        commands: a list of console commands or a CommandGraph.
+        kwargs: dict, the job attributes.
+
+    Returns:
+        a list of strings, the errors found.
+    """
+    errors = []
+    serials = kwargs.get("serial", [])
+    try:
+        shards = int(kwargs.get("shards", 1))
+    except ValueError:
+        errors.append("invalid shards %s" % kwargs.get("shards"))
+        shards = 1
+    # The campaigns run the tests without a serial, or with fewer devices
+    # than shards, on purpose; these are not errors.
+    if not serials:
+        logging.warning("Job has no device.")
+    elif shards > len(serials):
+        logging.warning("%d shards run on %d device(s).", shards,
+                        len(serials))
+
+    ran = set()
+    for line in _FlattenCommands(commands):
+        name, arg, _ = console.parseline(line)
+        for error in _ValidateCommand(console, name, arg or "", serials,
+                                      ran):
+            errors.append("%s: %s" % (line, error))
+        ran.add(name)
+    return errors
+
+
+def _ValidateCommand(console, name, arg, serials, ran):
+    """Validates a command line.
+
+    Args:
+        console: Console object, which runs the command.
+        name: string, the command name.
+        arg: string, the arguments of the command.
+        serials: a list of strings, the serials of the job.
+        ran: set of strings, the names of the commands running before.
+
+    Returns:
+        a list of strings, the errors found.
+    """
+    if not name or not hasattr(console, "do_" + name):
+        return ["unknown command %s" % name]
+    errors = []
+    processor = console.command_processors.get(name)
+    if processor:
+        try:
+            processor.arg_parser.ParseLine(arg)
+        except ConsoleArgumentError as e:
+            errors.append(str(e))
+
+    for variable in re.findall("{([^}]+)}", arg):
+        if variable in _SELF_RESOLVED_VARIABLES.get(name, ()):
+            continue
+        error = _ValidateVariable(console, variable, ran)
+        if error:
+            errors.append(error)
+
+    tokens = arg.replace("=", " ").split()
+    for option, value in zip(tokens, tokens[1:]):
+        if option not in _SERIAL_OPTIONS:
+            continue
+        for serial in value.split(","):
+            if serial not in serials:
+                errors.append("device %s not leased by the job" % serial)
+    return errors
+
+
+def _ValidateVariable(console, variable, ran):
+    """Validates a {variable} in a command.
+
+    Args:
+        console: Console object, which replaces the variable.
+        variable: string, the text between the braces.
+        ran: set of strings, the names of the commands running before.
+
+    Returns:
+        string, the error. None if the variable is valid.
+    """
+    name = variable.split("[")[0]
+    if "timestamp" in name:
+        return None
+    if name in _VARIABLE_PRODUCERS:
+        producers = _VARIABLE_PRODUCERS[name]
+    elif "." in name and name.split(".")[0] in console.command_processors:
+        command, arg = name.split(".", 1)
+        dests = [
+            action.dest for action in
+            console.command_processors[command].arg_parser._actions
+        ]
+        if arg not in dests:
+            return "{%s} is not an argument of %s" % (variable, command)
+        producers = (command, )
+    else:
+        return "unknown variable {%s}" % variable
+    if producers and not ran.intersection(producers):
+        return "{%s} is used before %s" % (variable, " or ".join(producers))
+    return None
+
+
+def GetScheduleJobs(schedules):
+    """Lists the job attributes that the schedules can lease.
+
+    Args:
+        schedules: a list of ScheduleConfigMessage protobuf messages.
+
+    Returns:
+        a list of dicts, the job attributes with the latest builds and as
+        many placeholder devices as the shards.
+    """
+    jobs = []
+    for schedule in schedules:
+        for build_target in schedule.build_target:
+            for test_schedule in build_target.test_schedule:
+                job = {
+                    "build_target": build_target.name,
+                    "build_id": "latest",
+                    "shards": 1,
+                }
+                for message, attrs in ((schedule, _SCHEDULE_ATTRS),
+                                       (build_target, _BUILD_TARGET_ATTRS),
+                                       (test_schedule, _TEST_SCHEDULE_ATTRS)):
+                    for attr in attrs:
+                        value = getattr(message, attr, None)
+                        if not value:
+                            continue
+                        # A repeated field.
+                        if hasattr(value, "extend"):
+                            value = list(value)
+                        job[attr] = value
+                job["serial"] = [
+                    "preflight-%d" % index
+                    for index in range(max(1, int(job["shards"])))
+                ]
+                jobs.append(job)
+    return jobs
+
+
+def ValidateSchedules(console, schedules, campaign_dir):
+    """Compiles the campaigns of the jobs that the schedules can lease.
+
+    The campaign of a job is the module named after the suite of its test.
+
+    Args:
+        console: Console object, which would run the commands.
+        schedules: a list of ScheduleConfigMessage protobuf messages.
+        campaign_dir: string, the directory of the campaign modules.
+
+    Returns:
+        a list of (job, errors) tuples where job is a dict of the job
+        attributes and errors is a list of strings.
+    """
+    results = []
+    for job in GetScheduleJobs(schedules):
+        suite_name = job.get("test_name", "").split("/")[0]
+        script_path = os.path.join(campaign_dir, suite_name + ".py")
+        if not suite_name or not os.path.isfile(script_path):
+            results.append((job, ["no campaign for test %s" %
+                                  job.get("test_name")]))
+            continue
+        script_module = campaign_loader.GetCampaignLoader().Load(
+            script_path)
+        _, errors = CompileCampaign(console, script_module, job)
+        results.append((job, errors))
+    return results
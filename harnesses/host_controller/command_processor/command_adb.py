@@ -15,13 +15,25 @@
 #
 
 import logging
+import os
+import shlex
+import time
 
 from host_controller import common
 from host_controller.command_processor import base_command_processor
+from host_controller.utils.adb import adb_client
+from host_controller.utils.usb import transfer_scheduler
 from host_controller.utils.usb import usb_utils
 
 from vts.utils.python.common import cmd_utils
 
+# adb commands which send files to the device.
+_BULK_COMMANDS = ("install", "install-multiple", "push", "sync")
+
+# Characters interpreted by the host shell. The commands containing any of
+# them are run by the adb binary through the shell.
+_HOST_SHELL_METACHARACTERS = "|&;<>()$`\\*?~{}"
+
 
 class CommandAdb(base_command_processor.BaseCommandProcessor):
     """Command processor for adb command.
@@ -30,6 +42,8 @@ class CommandAdb(base_command_processor.BaseCommandProcessor):
         arg_parser: ConsoleArgumentParser object, argument parser.
         command: string, command name which this processor will handle.
         command_detail: string, detailed explanation for the command.
+        _scheduler: UsbTransferScheduler, admits the bulk transfers.
+        _adb_client: AdbClient, runs shell and push without spawning adb.
     """
 
     command = "adb"
@@ -38,6 +52,8 @@ class CommandAdb(base_command_processor.BaseCommandProcessor):
     # @Override
     def SetUp(self):
         """Initializes the parser for device command."""
+        self._scheduler = transfer_scheduler.GetTransferScheduler()
+        self._adb_client = adb_client.AdbClient()
         self.arg_parser.add_argument(
             "--serial",
             "-s",
@@ -67,14 +83,18 @@ class CommandAdb(base_command_processor.BaseCommandProcessor):
                 logging.error("Only one serial can be specified")
                 return False
             cmd_list.append("-s %s" % args.serial)
-        cmd_list.extend(self.ReplaceVars(args.command))
-        if args.timeout == 0:
-            stdout, stderr, retcode = cmd_utils.ExecuteOneShellCommand(
-                " ".join(cmd_list))
+        command = self.ReplaceVars(args.command)
+        cmd_list.extend(command)
+        if args.serial and transfer_scheduler.IsBulkCommand(
+                command, _BULK_COMMANDS):
+            with self._scheduler.Transfer(
+                    args.serial,
+                    transfer_scheduler.GetFileBytes(command)) as transfer:
+                stdout, stderr, retcode = self._Execute(
+                    cmd_list, args, command)
+                transfer.success = (retcode == 0)
         else:
-            stdout, stderr, retcode = cmd_utils.ExecuteOneShellCommand(
-                " ".join(cmd_list), args.timeout,
-                usb_utils.ResetUsbDeviceOfSerial_Callback, args.serial)
+            stdout, stderr, retcode = self._Execute(cmd_list, args, command)
         if stdout:
             logging.info(stdout)
         if stderr:
@@ -84,3 +104,75 @@ class CommandAdb(base_command_processor.BaseCommandProcessor):
                     args.serial] = common._DEVICE_STATUS_DICT["error"]
         if retcode != 0:
             return False
+
+    def _Execute(self, cmd_list, args, command=None):
+        """Executes an adb command with the timeout in args.
+
+        Args:
+            cmd_list: list of strings, the command line.
+            args: the parsed arguments of the adb command.
+            command: list of strings, the adb command and its arguments.
+                     None to always spawn adb.
+
+        Returns:
+            a tuple of (stdout, stderr, retcode).
+        """
+        # The commands without timeout are left to the adb binary, which
+        # blocks until they complete.
+        if command and args.serial and args.timeout:
+            result = self._ExecuteNative(command, args)
+            if result is not None:
+                return result
+        if args.timeout == 0:
+            return cmd_utils.ExecuteOneShellCommand(" ".join(cmd_list))
+        return cmd_utils.ExecuteOneShellCommand(
+            " ".join(cmd_list), args.timeout,
+            usb_utils.ResetUsbDeviceOfSerial_Callback, args.serial)
+
+    def _ExecuteNative(self, command, args):
+        """Executes shell and push by talking to the adb server directly.
+
+        The shell output is received with the shell v2 protocol, so the exit
+        code comes from the device, and the files are pushed with the sync
+        protocol. args.timeout is the deadline of the whole command. A
+        device not completing in time has its USB reset like the timeout of
+        the adb process. The adb binary is used instead only if the request
+        fails before the command is sent, so that no command runs twice.
+
+        Args:
+            command: list of strings, the adb command and its arguments.
+            args: the parsed arguments of the adb command.
+
+        Returns:
+            a tuple of (stdout, stderr, retcode). None if the command has to
+            be run by the adb binary, e.g., it uses the host shell syntax
+            or the adb server does not support shell v2.
+        """
+        line = " ".join(command)
+        if any(char in _HOST_SHELL_METACHARACTERS for char in line):
+            return None
+        try:
+            words = shlex.split(line)
+        except ValueError:
+            return None
+        deadline = time.time() + args.timeout
+        try:
+            if (len(words) > 1 and words[0] == "shell" and
+                    not words[1].startswith("-")):
+                return self._adb_client.ExecuteShell(
+                    args.serial, " ".join(words[1:]), deadline=deadline)
+            if (len(words) == 3 and words[0] == "push" and
+                    os.path.isfile(words[1])):
+                num_bytes = self._adb_client.Push(
+                    args.serial, words[1], words[2], deadline=deadline)
+                return ("%s: 1 file pushed. %d bytes\n" %
+                        (words[1], num_bytes), "", 0)
+        except adb_client.AdbRequestError as e:
+            logging.debug("Falling back to the adb binary: %s", e)
+        except adb_client.AdbTimeoutError as e:
+            logging.error("Device %s not responding: %s", args.serial, e)
+            usb_utils.ResetUsbDeviceOfSerial_Callback(args.serial)
+            return "", str(e), -1
+        except adb_client.AdbClientError as e:
+            return "", str(e), -1
+        return None
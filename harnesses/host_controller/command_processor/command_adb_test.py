@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from host_controller import common
+from host_controller.command_processor import command_adb
+from host_controller.utils.adb import adb_client
+
+
+@mock.patch("host_controller.command_processor.command_adb.cmd_utils")
+class CommandAdbTest(unittest.TestCase):
+    """Tests for adb command processor."""
+
+    def setUp(self):
+        """Creates CommandAdb with a mock adb client."""
+        with mock.patch.object(command_adb.transfer_scheduler,
+                               "GetTransferScheduler"):
+            self._command = command_adb.CommandAdb()
+            self._console = mock.Mock()
+            self._console.device_status = {}
+            self._command._SetUp(self._console)
+        self._client = mock.Mock()
+        self._command._adb_client = self._client
+
+    def testShell(self, mock_cmd_utils):
+        """Tests running a shell command with a deadline."""
+        self._client.ExecuteShell.return_value = ("uid=0\n", "", 0)
+        self.assertIsNone(
+            self._command._Run("-s device1 --timeout 30 shell id"))
+        self.assertEqual("id", self._client.ExecuteShell.call_args[0][1])
+        self.assertIn("deadline", self._client.ExecuteShell.call_args[1])
+        mock_cmd_utils.ExecuteOneShellCommand.assert_not_called()
+
+    def testShellWithoutTimeout(self, mock_cmd_utils):
+        """Tests that the commands without timeout spawn adb."""
+        mock_cmd_utils.ExecuteOneShellCommand.return_value = ("", "", 0)
+        self._command._Run("-s device1 --timeout 0 shell id")
+        self._client.ExecuteShell.assert_not_called()
+        mock_cmd_utils.ExecuteOneShellCommand.assert_called_with(
+            "adb -s device1 shell id")
+
+    def testFallback(self, mock_cmd_utils):
+        """Tests spawning adb only if the command was not sent."""
+        mock_cmd_utils.ExecuteOneShellCommand.return_value = ("", "", 0)
+        self._client.ExecuteShell.side_effect = adb_client.AdbRequestError(
+            "shell,v2,raw:id failed: unknown service")
+        self.assertIsNone(self._command._Run("-s device1 shell id"))
+        mock_cmd_utils.ExecuteOneShellCommand.assert_called_once()
+
+        mock_cmd_utils.ExecuteOneShellCommand.reset_mock()
+        self._client.ExecuteShell.side_effect = adb_client.AdbClientError(
+            "adb server closed the connection.")
+        self.assertFalse(self._command._Run("-s device1 shell id"))
+        mock_cmd_utils.ExecuteOneShellCommand.assert_not_called()
+        self.assertEqual({"device1": common._DEVICE_STATUS_DICT["error"]},
+                         self._console.device_status)
+
+
+if __name__ == "__main__":
+    unittest.main()
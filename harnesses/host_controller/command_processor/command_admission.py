@@ -0,0 +1,122 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+
+from host_controller import common
+from host_controller import job_admission
+from host_controller.command_processor import base_command_processor
+
+
+class _AdmissionRow(object):
+    """A row of the printed table, whose attributes are the columns."""
+
+    def __init__(self, **columns):
+        self.__dict__.update(columns)
+
+
+def _FormatPercent(value):
+    """Returns a utilization as a percentage string."""
+    return "-" if value is None else "%d%%" % (value * 100)
+
+
+class CommandAdmission(base_command_processor.BaseCommandProcessor):
+    """Command processor for admission command.
+
+    Attributes:
+        arg_parser: ConsoleArgumentParser object, argument parser.
+        console: cmd.Cmd console object.
+        command: string, command name which this processor will handle.
+        command_detail: string, detailed explanation for the command.
+    """
+
+    command = "admission"
+    command_detail = ("Shows or configures the limit of the leased jobs "
+                      "running concurrently by the host resource usage.")
+
+    # @Override
+    def SetUp(self):
+        """Initializes the parser for admission command."""
+        self.arg_parser.add_argument(
+            "--max_jobs",
+            type=int,
+            default=None,
+            help="The maximum number of jobs running concurrently. Cannot "
+            "exceed the job pool size.")
+        for resource in job_admission.RESOURCES:
+            self.arg_parser.add_argument(
+                "--max_%s" % resource,
+                type=float,
+                default=None,
+                help="The %s utilization between 0 and 1 beyond which fewer "
+                "jobs run." % resource)
+
+    # @Override
+    def Run(self, arg_line):
+        """Configures the ceilings or prints the admission metrics."""
+        args = self.arg_parser.ParseLine(arg_line)
+        controller = self.console.job_admission
+        if not controller:
+            self.console._Print("job pool not started.")
+            return False
+
+        ceilings = {}
+        for resource in job_admission.RESOURCES:
+            value = getattr(args, "max_%s" % resource)
+            if value is not None:
+                ceilings[resource] = value
+        if args.max_jobs is not None or ceilings:
+            max_jobs = args.max_jobs
+            if max_jobs is not None:
+                max_jobs = min(max_jobs, common._MAX_LEASED_JOBS)
+            controller.Configure(max_jobs, ceilings)
+            return
+
+        status = controller.GetStatus()
+        self.console._PrintObjects([
+            _AdmissionRow(
+                resource=resource,
+                usage=_FormatPercent(status["usage"][resource]),
+                ceiling=_FormatPercent(status["ceilings"][resource]))
+            for resource in job_admission.RESOURCES
+        ], ["resource", "usage", "ceiling"])
+        self.console._Print(
+            "limit %d (max %d), running %d, admitted %d, rejected %d, "
+            "increased %d, decreased %d" %
+            (status["limit"], status["max_jobs"], status["running"],
+             status["admitted"], status["rejected"],
+             status[job_admission.ACTION_INCREASE],
+             status[job_admission.ACTION_DECREASE]))
+        if self.console.lease_trigger:
+            trigger_status = self.console.lease_trigger.GetStatus()
+            self.console._Print(
+                "lease trigger %s, released devices %d, triggered %d, "
+                "leased %d" % ("running" if trigger_status["running"] else
+                               "stopped", trigger_status["released"],
+                               trigger_status["triggered"],
+                               trigger_status["leased"]))
+
+        if status["decisions"]:
+            self.console._PrintObjects([
+                _AdmissionRow(
+                    time=time.strftime("%Y-%m-%d %H:%M:%S",
+                                       time.localtime(decision["time"])),
+                    action=decision["action"],
+                    limit=decision["limit"],
+                    running=decision["running"],
+                    reason=decision["reason"])
+                for decision in status["decisions"]
+            ], ["time", "action", "limit", "running", "reason"])
@@ -23,6 +23,7 @@ import time
 from googleapiclient import errors
 
 from host_controller import common
+from host_controller.build import prestage
 from host_controller.command_processor import base_command_processor
 from host_controller.console_argument_parser import ConsoleArgumentError
 from host_controller.tradefed import remote_operation
@@ -114,6 +115,7 @@ class CommandBuild(base_command_processor.BaseCommandProcessor):
                     build["signed"] = False
                     builds.append(build)
         self.console._vti_endpoint_client.UploadBuildInfo(builds)
+        prestage.PrestageStore().UpdateLatestBuilds(builds)
 
     def UpdateBuildLoop(self, account_id, branch, target, artifact_type,
                         method, userinfo_file, noauth_local_webserver,
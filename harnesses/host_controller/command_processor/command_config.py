@@ -161,6 +161,8 @@ class CommandConfig(base_command_processor.BaseCommandProcessor):
                     ret = self.console.onecmd(command)
                     if ret == False:
                         break
+        # Updated in place, as the list is shared with the job pool processes.
+        self.console.schedules[:] = schedules_pbs
         self.console._vti_endpoint_client.UploadScheduleInfo(
             schedules_pbs, clear_schedule)
         self.console._vti_endpoint_client.UploadLabInfo(lab_pbs, clear_labinfo)
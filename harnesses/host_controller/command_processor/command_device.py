@@ -23,10 +23,14 @@ import time
 from googleapiclient import errors
 
 from host_controller import common
+from host_controller.build import prestage
 from host_controller.command_processor import base_command_processor
 from host_controller.console_argument_parser import ConsoleArgumentError
 from host_controller.tradefed import remote_operation
+from host_controller.utils.adb import device_inventory
+from host_controller.utils.adb import device_prober
 from host_controller.utils.usb import usb_utils
+from host_controller.vti_interface import device_reporter
 
 from vts.utils.python.common import cmd_utils
 
@@ -40,6 +44,11 @@ class CommandDevice(base_command_processor.BaseCommandProcessor):
         command: string, command name which this processor will handle.
         command_detail: string, detailed explanation for the command.
         update_thread: threading.Thread that updates device state regularly.
+        _probing: set of strings, the serials whose probe is running.
+        _probe_lock: threading.Lock protecting _probing and probe results.
+        _prober: DeviceProber, reads and caches the device properties.
+        _inventory: DeviceInventory, tracks the attached devices.
+        _reporter: DeviceReporter, uploads the changes of the device info.
     """
 
     command = "device"
@@ -64,7 +73,7 @@ class CommandDevice(base_command_processor.BaseCommandProcessor):
                            the availability of the devices when set.
         """
         if server_type == "vti":
-            devices = []
+            adb_serials, fastboot_serials = self.ListDevices()
 
             if from_job_pool:
                 devices_dict = {}
@@ -76,117 +85,40 @@ class CommandDevice(base_command_processor.BaseCommandProcessor):
                     device["product"] = "error"
                     devices_dict[serial] = device
 
-            stdout, stderr, returncode = cmd_utils.ExecuteOneShellCommand(
-                "adb devices")
-            lines_adb = stdout.split("\n")
-            stdout, stderr, returncode = cmd_utils.ExecuteOneShellCommand(
-                "fastboot devices")
-            lines_fastboot = stdout.split("\n")
+                for serial, state in adb_serials:
+                    if serial in devices_dict and state == "device":
+                        devices_dict[serial][
+                            "status"] = common._DEVICE_STATUS_DICT["online"]
+                        product = (self.console._vti_endpoint_client.
+                                   GetJobDeviceProductName())
+                        if product:
+                            devices_dict[serial]["product"] = product
+                for serial in fastboot_serials:
+                    if serial in devices_dict:
+                        devices_dict[serial][
+                            "status"] = common._DEVICE_STATUS_DICT["fastboot"]
+                        product = (self.console._vti_endpoint_client.
+                                   GetJobDeviceProductName())
+                        if product:
+                            devices_dict[serial]["product"] = product
 
-            for line in lines_adb:
-                if (len(line.strip()) and not (line.startswith("* ")
-                                               or line.startswith("List "))):
-                    device = {}
-                    device["serial"] = line.split()[0]
-                    serial = device["serial"]
-
-                    if from_job_pool:
-                        if (serial in devices_dict
-                                and line.split()[1] == "device"):
-                            devices_dict[serial][
-                                "status"] = common._DEVICE_STATUS_DICT[
-                                    "online"]
-                            product = (self.console._vti_endpoint_client.
-                                       GetJobDeviceProductName())
-                            if product:
-                                devices_dict[serial]["product"] = product
-                        continue
-
-                    if self.console.file_lock.LockDevice(
-                            serial, suppress_lock_warning) == False:
-                        self.console.device_status[
-                            serial] = common._DEVICE_STATUS_DICT["use"]
-                        if not suppress_lock_warning:
-                            logging.info("Device %s already locked." % serial)
-                        continue
-
-                    stdout, _, retcode = cmd_utils.ExecuteOneShellCommand(
-                        "adb -s %s reboot bootloader" % device["serial"],
-                        common.DEFAULT_DEVICE_TIMEOUT_SECS,
-                        usb_utils.ResetUsbDeviceOfSerial_Callback,
-                        device["serial"])
-                    if retcode == 0:
-                        lines_fastboot.append(line)
-
-                    self.console.file_lock.UnlockDevice(serial)
-
-            for line in lines_fastboot:
-                if len(line.strip()):
-                    device = {}
-                    device["serial"] = line.split()[0]
-                    serial = device["serial"]
-
-                    if from_job_pool:
-                        if serial in devices_dict:
-                            devices_dict[serial][
-                                "status"] = common._DEVICE_STATUS_DICT[
-                                    "fastboot"]
-                            product = (self.console._vti_endpoint_client.
-                                       GetJobDeviceProductName())
-                            if product:
-                                devices_dict[serial]["product"] = product
-                        continue
-
-                    if self.console.file_lock.LockDevice(
-                            serial, suppress_lock_warning) == False:
-                        self.console.device_status[
-                            serial] = common._DEVICE_STATUS_DICT["use"]
-                        if not suppress_lock_warning:
-                            logging.info("Device %s already locked." % serial)
-                        continue
-
-                    _, stderr, retcode = cmd_utils.ExecuteOneShellCommand(
-                        "fastboot -s %s getvar product" % device["serial"],
-                        common.DEFAULT_DEVICE_TIMEOUT_SECS,
-                        usb_utils.ResetUsbDeviceOfSerial_Callback,
-                        device["serial"])
-                    if retcode == 0:
-                        res = stderr.splitlines()[0].rstrip()
-                        if ":" in res:
-                            device["product"] = res.split(":")[1].strip()
-                        elif "waiting for %s" % serial in res:
-                            res = stderr.splitlines()[1].rstrip()
-                            device["product"] = res.split(":")[1].strip()
-                        else:
-                            device["product"] = "error"
-                        self.console.device_status[
-                            serial] = common._DEVICE_STATUS_DICT["fastboot"]
-                    else:
-                        device["product"] = "error"
-                        self.console.device_status[
-                            serial] = common._DEVICE_STATUS_DICT["no-response"]
-
-                    device["status"] = self.console.device_status[serial]
-                    devices.append(device)
-
-                    self.console.file_lock.UnlockDevice(serial)
-
-            if from_job_pool:
                 devices = devices_dict.values()
                 if devices:
                     self.console._vti_endpoint_client.UploadDeviceInfo(
                         host.hostname, devices)
                 return
 
-            self.console._vti_endpoint_client.UploadDeviceInfo(
-                host.hostname, devices)
+            device_states = [(serial, device_prober.FASTBOOT_STATE)
+                             for serial in fastboot_serials] + adb_serials
+            devices = self.ProbeDevices(device_states, suppress_lock_warning)
+            self._reporter.ReportDevices(host.hostname, devices)
 
-            if lease:
+            if lease and self.console.AdmitJob():
                 self.console._job_in_queue.put("lease")
 
             if self.console.vtslab_version:
-                self.console._vti_endpoint_client.UploadHostVersion(
-                    host.hostname, self.console.vtslab_version)
+                self._reporter.ReportHostVersion(host.hostname,
+                                                 self.console.vtslab_version)
         elif server_type == "tfc":
             devices = host.ListDevices()
             for device in devices:
@@ -198,6 +130,183 @@ class CommandDevice(base_command_processor.BaseCommandProcessor):
             logging.error("Error: unknown server_type %s for UpdateDevice",
                           server_type)
 
+    def ListDevices(self):
+        """Lists the attached devices and their states.
+
+        The device inventory is queried while it tracks the devices.
+        Otherwise, adb and fastboot are executed to list the devices.
+
+        Returns:
+            a list of (serial, adb state) tuples and a list of the serials
+            of the devices in fastboot mode.
+        """
+        if self._inventory.Start():
+            devices = self._inventory.GetDevices()
+            adb_serials = [(serial, device["state"])
+                           for serial, device in sorted(devices.items())
+                           if device["state"] != device_prober.FASTBOOT_STATE]
+            if self._inventory.IsUsbTracked():
+                return adb_serials, self._inventory.GetSerials(
+                    device_prober.FASTBOOT_STATE)
+        else:
+            stdout, _, _ = cmd_utils.ExecuteOneShellCommand("adb devices")
+            adb_serials = []
+            for line in stdout.split("\n"):
+                if (len(line.strip()) and not (line.startswith("* ")
+                                               or line.startswith("List "))):
+                    adb_serials.append((line.split()[0], line.split()[1]))
+
+        stdout, _, _ = cmd_utils.ExecuteOneShellCommand("fastboot devices")
+        fastboot_serials = [
+            line.split()[0] for line in stdout.split("\n") if len(line.strip())
+        ]
+        return adb_serials, fastboot_serials
+
+    def ProbeDevices(self, device_states, suppress_lock_warning=True):
+        """Probes the devices concurrently and merges the results.
+
+        Each device is probed in its own thread without changing its state.
+        A device whose probe does not finish within
+        common.DEVICE_PROBE_TIMEOUT_SECS, or is still running from a
+        previous cycle, is reported as no-response without delaying the
+        other devices.
+
+        Args:
+            device_states: list of (serial, state) tuples where state is an
+                           adb state or device_prober.FASTBOOT_STATE.
+            suppress_lock_warning: bool, True to suppress the warning msg
+                                   from file_lock.
+
+        Returns:
+            a list of dicts, the device info to be uploaded, in the order of
+            device_states.
+        """
+        prestage_store = prestage.PrestageStore()
+        results = {}
+        threads = {}
+        serials = []
+        for serial, state in device_states:
+            if serial in serials:
+                continue
+            serials.append(serial)
+            with self._probe_lock:
+                if serial in self._probing:
+                    logging.warning("Device %s is still being probed.",
+                                    serial)
+                    continue
+                self._probing.add(serial)
+            thread = threading.Thread(
+                target=self._ProbeDeviceThread,
+                args=(serial, state, suppress_lock_warning, prestage_store,
+                      results))
+            thread.daemon = True
+            thread.start()
+            threads[serial] = thread
+
+        self._prober.Retain(serials)
+        deadline = time.time() + common.DEVICE_PROBE_TIMEOUT_SECS
+        for serial in serials:
+            if serial in threads:
+                threads[serial].join(max(0, deadline - time.time()))
+
+        devices = []
+        with self._probe_lock:
+            results = dict(results)
+        for serial in serials:
+            if serial in results:
+                status, device = results[serial]
+            else:
+                logging.error("Device %s did not respond to the probe.",
+                              serial)
+                status = common._DEVICE_STATUS_DICT["no-response"]
+                device = {
+                    "serial": serial,
+                    "product": self.console._device_products.get(
+                        serial, "error"),
+                }
+            if status is None:
+                continue
+            self.console.device_status[serial] = status
+            if device is None:
+                continue
+            device["status"] = status
+            if device["product"] != "error":
+                self.console._device_products[serial] = device["product"]
+            devices.append(device)
+        return devices
+
+    def _ProbeDeviceThread(self, serial, state, suppress_lock_warning,
+                           prestage_store, results):
+        """Probes a device and stores the result.
+
+        Args:
+            serial: string, the device serial.
+            state: string, the adb state or device_prober.FASTBOOT_STATE.
+            suppress_lock_warning: bool, True to suppress the warning msg
+                                   from file_lock.
+            prestage_store: PrestageStore object.
+            results: dict, maps a serial to the result of ProbeDevice.
+        """
+        try:
+            result = self.ProbeDevice(serial, state, suppress_lock_warning,
+                                      prestage_store)
+            with self._probe_lock:
+                results[serial] = result
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            with self._probe_lock:
+                self._probing.discard(serial)
+
+    def ProbeDevice(self, serial, state, suppress_lock_warning,
+                    prestage_store):
+        """Probes the state and product name of a device.
+
+        Args:
+            serial: string, the device serial.
+            state: string, the adb state or device_prober.FASTBOOT_STATE.
+            suppress_lock_warning: bool, True to suppress the warning msg
+                                   from file_lock.
+            prestage_store: PrestageStore object.
+
+        Returns:
+            a tuple of (status, device). status is an integer in
+            _DEVICE_STATUS_DICT, or None to keep the status unchanged.
+            device is a dict with serial and product, or None if the device
+            is not reported.
+        """
+        active = prestage_store.GetActive(serial)
+        if active:
+            # A pre-staging device is rebooting or being flashed.
+            return (common._DEVICE_STATUS_DICT["fastboot"], {
+                "serial": serial,
+                "product": active["product"],
+            })
+
+        if state not in (device_prober.ADB_STATE_DEVICE,
+                         device_prober.FASTBOOT_STATE):
+            return None, None
+
+        if self.console.file_lock.LockDevice(
+                serial, suppress_lock_warning) == False:
+            if not suppress_lock_warning:
+                logging.info("Device %s already locked." % serial)
+            return common._DEVICE_STATUS_DICT["use"], None
+
+        try:
+            props = self._prober.Probe(serial, state)
+        finally:
+            self.console.file_lock.UnlockDevice(serial)
+
+        device = {"serial": serial}
+        if props is None:
+            device["product"] = "error"
+            return common._DEVICE_STATUS_DICT["no-response"], device
+        device["product"] = props["product"]
+        if state == device_prober.FASTBOOT_STATE:
+            return common._DEVICE_STATUS_DICT["fastboot"], device
+        return common._DEVICE_STATUS_DICT["online"], device
+
     def UpdateDeviceRepeat(self,
                            server_type,
                            host,
@@ -265,6 +374,12 @@ class CommandDevice(base_command_processor.BaseCommandProcessor):
     def SetUp(self):
         """Initializes the parser for device command."""
         self.update_thread = None
+        self._probing = set()
+        self._probe_lock = threading.Lock()
+        self._prober = device_prober.DeviceProber()
+        self._inventory = device_inventory.GetDeviceInventory()
+        self._reporter = device_reporter.DeviceReporter(
+            self.console._vti_endpoint_client)
         self.arg_parser.add_argument(
             "--set_serial",
             default="",
@@ -348,7 +463,10 @@ class CommandDevice(base_command_processor.BaseCommandProcessor):
                     ))
                 self.update_thread.daemon = True
                 self.update_thread.start()
+                if args.lease and args.server_type == "vti":
+                    self.console.StartLeaseTrigger()
             elif args.update == "stop":
                 self.update_thread.keep_running = False
+                self.console.StopLeaseTrigger()
                 if self.console.GetSerials():
                     self.console.ResetSerials()
@@ -16,6 +16,7 @@
 #
 
 import re
+import threading
 import unittest
 
 try:
@@ -42,41 +43,159 @@ def cmd_util_side_effect(value, timeout=0, callback_on_timeout=None, *args):
 class CommandDeviceTest(unittest.TestCase):
     """Tests for device command processor"""
 
+    def setUp(self):
+        """Lists the devices with adb and fastboot by default."""
+        self._inventory_patcher = mock.patch(
+            "host_controller.command_processor.command_device."
+            "device_inventory")
+        self._mock_inventory = (
+            self._inventory_patcher.start().GetDeviceInventory.return_value)
+        self._mock_inventory.Start.return_value = False
+
+    def tearDown(self):
+        """Stops the device inventory patcher."""
+        self._inventory_patcher.stop()
+
     @mock.patch("host_controller.console.Console")
     @mock.patch("host_controller.command_processor.command_device.cmd_utils")
     def testUpdateDevice(self, mock_cmd_utils, mock_console):
         command = command_device.CommandDevice()
         command._SetUp(mock_console)
+        command._prober = mock.Mock()
+        command._prober.Probe.return_value = {"product": "somefish"}
         mock_host = mock.Mock()
         mock_host.hostname = "vtslab-001"
         mock_cmd_utils.ExecuteOneShellCommand.side_effect = cmd_util_side_effect
         command.UpdateDevice("vti", mock_host, False)
         mock_console._vti_endpoint_client.UploadDeviceInfo.assert_called_with(
             "vtslab-001", [{
-                "status": mock.ANY,
+                "status": common._DEVICE_STATUS_DICT["fastboot"],
                 "serial": "device3",
                 "product": "somefish"
             }, {
-                "status": mock.ANY,
+                "status": common._DEVICE_STATUS_DICT["online"],
                 "serial": "device1",
                 "product": "somefish"
             }, {
-                "status": mock.ANY,
+                "status": common._DEVICE_STATUS_DICT["online"],
                 "serial": "device2",
                 "product": "somefish"
             }])
+        command._prober.Probe.assert_any_call("device3", "fastboot")
+        command._prober.Probe.assert_any_call("device1", "device")
+        command._prober.Retain.assert_called_with(
+            ["device3", "device1", "device2"])
+        for call in mock_cmd_utils.ExecuteOneShellCommand.call_args_list:
+            self.assertNotIn("reboot", call[0][0])
+
+    @mock.patch("host_controller.console.Console")
+    @mock.patch("host_controller.command_processor.command_device.cmd_utils")
+    def testUpdateDeviceUnchanged(self, mock_cmd_utils, mock_console):
+        """Tests that the unchanged device info is not uploaded again."""
+        command = command_device.CommandDevice()
+        command._SetUp(mock_console)
+        command._prober = mock.Mock()
+        command._prober.Probe.return_value = {"product": "somefish"}
+        mock_host = mock.Mock()
+        mock_host.hostname = "vtslab-001"
+        mock_cmd_utils.ExecuteOneShellCommand.side_effect = cmd_util_side_effect
+        command.UpdateDevice("vti", mock_host, False)
+        command.UpdateDevice("vti", mock_host, False)
+        client = mock_console._vti_endpoint_client
+        self.assertEqual(1, client.UploadDeviceInfo.call_count)
+        self.assertEqual(1, client.UploadHostVersion.call_count)
+
+    @mock.patch("host_controller.console.Console")
+    @mock.patch("host_controller.command_processor.command_device.cmd_utils")
+    def testUpdateDeviceTrackedDevices(self, mock_cmd_utils, mock_console):
+        command = command_device.CommandDevice()
+        command._SetUp(mock_console)
+        command._prober = mock.Mock()
+        command._prober.Probe.return_value = {"product": "somefish"}
+        self._mock_inventory.Start.return_value = True
+        self._mock_inventory.IsUsbTracked.return_value = True
+        self._mock_inventory.GetDevices.return_value = {
+            "device1": {"state": "device"},
+            "device2": {"state": "offline"},
+            "device3": {"state": "fastboot"},
+        }
+        self._mock_inventory.GetSerials.return_value = ["device3"]
+        mock_host = mock.Mock()
+        mock_host.hostname = "vtslab-001"
+        command.UpdateDevice("vti", mock_host, False)
+        mock_console._vti_endpoint_client.UploadDeviceInfo.assert_called_with(
+            "vtslab-001", [{
+                "status": common._DEVICE_STATUS_DICT["fastboot"],
+                "serial": "device3",
+                "product": "somefish"
+            }, {
+                "status": common._DEVICE_STATUS_DICT["online"],
+                "serial": "device1",
+                "product": "somefish"
+            }])
+        mock_cmd_utils.ExecuteOneShellCommand.assert_not_called()
 
     @mock.patch("host_controller.console.Console")
     @mock.patch("host_controller.command_processor.command_device.cmd_utils")
     def testUpdateDeviceLeaseJob(self, mock_cmd_utils, mock_console):
         command = command_device.CommandDevice()
         command._SetUp(mock_console)
+        command._prober = mock.Mock()
+        command._prober.Probe.return_value = {"product": "somefish"}
         mock_host = mock.Mock()
         mock_host.hostname = "vtslab-001"
         mock_cmd_utils.ExecuteOneShellCommand.side_effect = cmd_util_side_effect
         command.UpdateDevice("vti", mock_host, True)
         mock_console._job_in_queue.put.assert_called_with("lease")
 
+    @mock.patch("host_controller.console.Console")
+    @mock.patch("host_controller.command_processor.command_device.cmd_utils")
+    def testUpdateDeviceProbeTimeout(self, mock_cmd_utils, mock_console):
+        """Tests that a wedged device does not hold up the others."""
+        release = threading.Event()
+
+        def probe_side_effect(serial, state):
+            if serial == "device2":
+                release.wait()
+            return {"product": "somefish"}
+
+        mock_console._device_products = {"device2": "walleye"}
+        command = command_device.CommandDevice()
+        command._SetUp(mock_console)
+        command._prober = mock.Mock()
+        command._prober.Probe.side_effect = probe_side_effect
+        mock_host = mock.Mock()
+        mock_host.hostname = "vtslab-001"
+        mock_cmd_utils.ExecuteOneShellCommand.side_effect = cmd_util_side_effect
+        with mock.patch.object(common, "DEVICE_PROBE_TIMEOUT_SECS", 0.5):
+            command.UpdateDevice("vti", mock_host, False)
+            mock_console._vti_endpoint_client.UploadDeviceInfo.assert_called_with(
+                "vtslab-001", [{
+                    "status": common._DEVICE_STATUS_DICT["fastboot"],
+                    "serial": "device3",
+                    "product": "somefish"
+                }, {
+                    "status": common._DEVICE_STATUS_DICT["online"],
+                    "serial": "device1",
+                    "product": "somefish"
+                }, {
+                    "status": common._DEVICE_STATUS_DICT["no-response"],
+                    "serial": "device2",
+                    "product": "walleye"
+                }])
+
+            # The device still being probed is not probed again.
+            command.UpdateDevice("vti", mock_host, False)
+            probe_calls = [
+                call for call in command._prober.Probe.call_args_list
+                if call[0][0] == "device2"
+            ]
+            self.assertEqual(1, len(probe_calls))
+        release.set()
+        for thread in threading.enumerate():
+            if thread.name != threading.current_thread().name:
+                thread.join(5)
+
     @mock.patch("host_controller.console.Console")
     @mock.patch("host_controller.command_processor.command_device.cmd_utils")
     def testUpdateDeviceFromJobPool(self, mock_cmd_utils, mock_console):
@@ -144,6 +263,20 @@ class CommandDeviceTest(unittest.TestCase):
         self.assertIsNone(ret)
         self.assertFalse(mock_thread.keep_running)
 
+    @mock.patch("host_controller.console.Console")
+    @mock.patch("host_controller.command_processor.command_device.threading")
+    def testCommandDeviceUpdateLeaseTrigger(self, mock_threading,
+                                            mock_console):
+        command = command_device.CommandDevice()
+        command._SetUp(mock_console)
+        command._Run("")
+        mock_console.StartLeaseTrigger.assert_not_called()
+        command._Run("--update=stop")
+        command._Run("--lease=True")
+        mock_console.StartLeaseTrigger.assert_called_once_with()
+        command._Run("--update=stop")
+        self.assertEqual(2, mock_console.StopLeaseTrigger.call_count)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -18,11 +18,28 @@ import logging
 
 from host_controller import common
 from host_controller.command_processor import base_command_processor
+from host_controller.utils.adb import adb_client
+from host_controller.utils.adb import boot_watcher
+from host_controller.utils.adb import device_inventory
+from host_controller.utils.adb import device_prober
+from host_controller.utils.adb import package_installer
+from host_controller.utils.adb import shell_session
 
 from vts.utils.python.common import cmd_utils
 from vts.utils.python.controllers import adb
 from vts.utils.python.controllers import android_device
 
+# Maximum time to wait for the device to boot in seconds.
+BOOT_COMPLETION_TIMEOUT_SECS = 900
+
+# The APK connecting the device to an access point, and its package name.
+WIFI_UTIL_APK_PATH = "../testcases/DATA/app/WifiUtil/WifiUtil.apk"
+WIFI_UTIL_PACKAGE = "com.android.tradefed.utils.wifi"
+
+# Maximum time to connect to an access point in seconds. The instrumentation
+# prints nothing until the association finishes.
+WIFI_CONNECT_TIMEOUT_SECS = 300
+
 # Default index of setStreamVolume() from IAudioService.aidl (1 based)
 SETSTREAMVOLUME_INDEX_DEFAULT = 3
 
@@ -58,7 +75,8 @@ class CommandDUT(base_command_processor.BaseCommandProcessor):
         """Initializes the parser for dut command."""
         self.arg_parser.add_argument(
             "--operation",
-            choices=("wifi_on", "wifi_off", 'volume_mute', 'volume_max'),
+            choices=("wifi_on", "wifi_off", 'volume_mute', 'volume_max',
+                     'wait_for_boot', 'boot', 'reboot_bootloader'),
             default="",
             required=True,
             help="Operation to perform.")
@@ -84,9 +102,27 @@ class CommandDUT(base_command_processor.BaseCommandProcessor):
     def Run(self, arg_line):
         """Performs the requested operation on the selected DUT."""
         args = self.arg_parser.ParseLine(arg_line)
-        device = android_device.AndroidDevice(
-            args.serial, device_callback_port=-1)
-        boot_complete = device.waitForBootCompletion()
+        if args.operation == "reboot_bootloader":
+            if args.serial in self._GetFastbootSerials():
+                return
+            _, stderr, retcode = cmd_utils.ExecuteOneShellCommand(
+                "adb -s %s reboot bootloader" % args.serial)
+            if retcode != 0:
+                logging.error("Failed to reboot %s to bootloader: %s",
+                              args.serial, stderr)
+                return False
+            return
+        if args.operation == "boot":
+            if args.serial in self._GetFastbootSerials():
+                cmd_utils.ExecuteOneShellCommand(
+                    "fastboot -s %s reboot" % args.serial)
+        boot_complete = boot_watcher.WaitForBootCompletion(
+            args.serial, BOOT_COMPLETION_TIMEOUT_SECS)
+        if boot_complete is None:
+            device = android_device.AndroidDevice(
+                args.serial, device_callback_port=-1)
+            boot_complete = device.waitForBootCompletion(
+                timeout=BOOT_COMPLETION_TIMEOUT_SECS)
         if not boot_complete:
             logging.error("Device %s failed to bootup.", args.serial)
             self.console.device_status[
@@ -94,48 +130,65 @@ class CommandDUT(base_command_processor.BaseCommandProcessor):
             self.console.vti_endpoint_client.SetJobStatusFromLeasedTo(
                 "bootup-err")
             return False
+        if args.operation in ("wait_for_boot", "boot"):
+            return
 
         adb_proxy = adb.AdbProxy(serial=args.serial)
         adb_proxy.root()
+        session = shell_session.GetShellSessionManager().Get(args.serial)
         try:
             if args.operation == "wifi_on":
-                adb_proxy.shell("svc wifi enable")
+                session.RunBatch(["svc wifi enable"], check=True)
                 if args.ap:
-                    adb_proxy.install(
-                        "../testcases/DATA/app/WifiUtil/WifiUtil.apk")
-                    adb_proxy.shell(
+                    package_installer.GetPackageInstaller().Install(
+                        args.serial, WIFI_UTIL_APK_PATH, WIFI_UTIL_PACKAGE)
+                    session.RunBatch([
                         "am instrument -e method \"connectToNetwork\" "
-                        "-e ssid %s "
-                        "-w com.android.tradefed.utils.wifi/.WifiUtil" %
-                        args.ap)
+                        "-e ssid %s -w %s/.WifiUtil" %
+                        (args.ap, WIFI_UTIL_PACKAGE)
+                    ], check=True, timeout=WIFI_CONNECT_TIMEOUT_SECS)
             elif args.operation == "wifi_off":
-                adb_proxy.shell("svc wifi disable")
+                session.RunBatch(["svc wifi disable"], check=True)
             elif args.operation == "volume_mute":
-                for _ in range(args.volume_levels):
-                    adb_proxy.shell("input keyevent 25")
-                self.SetOtherVolumes(adb_proxy, 0, args.version)
+                session.RunBatch(
+                    ["input keyevent 25"] * args.volume_levels +
+                    self.GetOtherVolumeCommands(0, args.version),
+                    check=True)
             elif args.operation == "volume_max":
-                for _ in range(args.volume_levels):
-                    adb_proxy.shell("input keyevent 24")
-                self.SetOtherVolumes(adb_proxy, args.volume_levels,
-                                     args.version)
-        except adb.AdbError as e:
+                session.RunBatch(
+                    ["input keyevent 24"] * args.volume_levels +
+                    self.GetOtherVolumeCommands(args.volume_levels,
+                                                args.version),
+                    check=True)
+        except (adb.AdbError, adb_client.AdbClientError,
+                EnvironmentError) as e:
             logging.exception(e)
             return False
 
-    def SetOtherVolumes(self, adb_proxy, volume_level, version=None):
-        """Sets device's call/media/alarm volumes a certain level.
+    def _GetFastbootSerials(self):
+        """Returns the serials of the devices in fastboot mode."""
+        inventory = device_inventory.GetDeviceInventory()
+        if inventory.Start() and inventory.IsUsbTracked():
+            return inventory.GetSerials(device_prober.FASTBOOT_STATE)
+        stdout, _, _ = cmd_utils.ExecuteOneShellCommand("fastboot devices")
+        return stdout.split()
+
+    def GetOtherVolumeCommands(self, volume_level, version=None):
+        """Returns the commands setting call/media/alarm volumes to a level.
 
         Args:
-            adb_proxy: AdbProxy, used for interacting with the device via adb.
             volume_level: int, volume level value.
             version: float, Android system version value. The index of
                      setStreamVolume() depends on the Android version.
+
+        Returns:
+            a list of strings, the shell commands.
         """
         setStreamVolume_index = SETSTREAMVOLUME_INDEX_DEFAULT
         if version and version >= 9.0:
             setStreamVolume_index = 7
-        for stream_type in STREAM_TYPE_LIST:
-            adb_volume_command = "service call audio %s i32 %s i32 %s i32 1" % (
-                setStreamVolume_index, stream_type, volume_level)
-            adb_proxy.shell(adb_volume_command)
+        return [
+            "service call audio %s i32 %s i32 %s i32 1" %
+            (setStreamVolume_index, stream_type, volume_level)
+            for stream_type in STREAM_TYPE_LIST
+        ]
@@ -35,33 +35,56 @@ class CommandDUTTest(unittest.TestCase):
         mock_console = mock.Mock()
         mock_console.device_status = {}
         self._command._SetUp(mock_console)
+        # Falls back to AndroidDevice.waitForBootCompletion as if no adb
+        # server is running on the host.
+        self._boot_watcher_patcher = mock.patch(
+            "host_controller.command_processor.command_dut.boot_watcher")
+        self._mock_boot_watcher = self._boot_watcher_patcher.start()
+        self._mock_boot_watcher.WaitForBootCompletion.return_value = None
+        # Lists the devices with fastboot as if the devices are not tracked.
+        self._inventory_patcher = mock.patch(
+            "host_controller.command_processor.command_dut.device_inventory")
+        self._mock_inventory = (
+            self._inventory_patcher.start().GetDeviceInventory.return_value)
+        self._mock_inventory.Start.return_value = False
+        # Runs the shell commands in a mock session.
+        self._shell_session_patcher = mock.patch(
+            "host_controller.command_processor.command_dut.shell_session")
+        self._mock_session = (self._shell_session_patcher.start().
+                              GetShellSessionManager.return_value.Get.
+                              return_value)
+        self._package_installer_patcher = mock.patch(
+            "host_controller.command_processor.command_dut.package_installer")
+        self._mock_installer = (self._package_installer_patcher.start().
+                                GetPackageInstaller.return_value)
 
-    def testSetOtherVolumesWithoutVersionInfo(self):
-        mock_adb_proxy = mock.Mock()
-        self._command.SetOtherVolumes(mock_adb_proxy, 5)
-        self.assertEqual(mock_adb_proxy.shell.mock_calls, [
-            mock.call("service call audio 3 i32 0 i32 5 i32 1"),
-            mock.call("service call audio 3 i32 2 i32 5 i32 1"),
-            mock.call("service call audio 3 i32 3 i32 5 i32 1"),
-            mock.call("service call audio 3 i32 4 i32 5 i32 1"),
+    def tearDown(self):
+        """Stops the patchers."""
+        self._boot_watcher_patcher.stop()
+        self._inventory_patcher.stop()
+        self._shell_session_patcher.stop()
+        self._package_installer_patcher.stop()
+
+    def testGetOtherVolumeCommandsWithoutVersionInfo(self):
+        self.assertEqual(self._command.GetOtherVolumeCommands(5), [
+            "service call audio 3 i32 0 i32 5 i32 1",
+            "service call audio 3 i32 2 i32 5 i32 1",
+            "service call audio 3 i32 3 i32 5 i32 1",
+            "service call audio 3 i32 4 i32 5 i32 1",
         ])
 
-    def testSetOtherVolumesWithVersionInfo(self):
-        mock_adb_proxy = mock.Mock()
-        self._command.SetOtherVolumes(mock_adb_proxy, 0, 8.1)
-        self.assertEqual(mock_adb_proxy.shell.mock_calls, [
-            mock.call("service call audio 3 i32 0 i32 0 i32 1"),
-            mock.call("service call audio 3 i32 2 i32 0 i32 1"),
-            mock.call("service call audio 3 i32 3 i32 0 i32 1"),
-            mock.call("service call audio 3 i32 4 i32 0 i32 1"),
+    def testGetOtherVolumeCommandsWithVersionInfo(self):
+        self.assertEqual(self._command.GetOtherVolumeCommands(0, 8.1), [
+            "service call audio 3 i32 0 i32 0 i32 1",
+            "service call audio 3 i32 2 i32 0 i32 1",
+            "service call audio 3 i32 3 i32 0 i32 1",
+            "service call audio 3 i32 4 i32 0 i32 1",
         ])
-        mock_adb_proxy.shell.mock_calls = []
-        self._command.SetOtherVolumes(mock_adb_proxy, 10, 9.0)
-        self.assertEqual(mock_adb_proxy.shell.mock_calls, [
-            mock.call("service call audio 7 i32 0 i32 10 i32 1"),
-            mock.call("service call audio 7 i32 2 i32 10 i32 1"),
-            mock.call("service call audio 7 i32 3 i32 10 i32 1"),
-            mock.call("service call audio 7 i32 4 i32 10 i32 1"),
+        self.assertEqual(self._command.GetOtherVolumeCommands(10, 9.0), [
+            "service call audio 7 i32 0 i32 10 i32 1",
+            "service call audio 7 i32 2 i32 10 i32 1",
+            "service call audio 7 i32 3 i32 10 i32 1",
+            "service call audio 7 i32 4 i32 10 i32 1",
         ])
 
     @mock.patch("host_controller.command_processor.command_dut.android_device")
@@ -86,8 +109,9 @@ class CommandDUTTest(unittest.TestCase):
         ret = self._command._Run("--serial device1 --operation wifi_on")
         self.assertIsNone(ret)
         mock_adb_proxy.root.assert_called_once()
-        mock_adb_proxy.shell.assert_called_with("svc wifi enable")
-        mock_adb_proxy.install.assert_not_called()
+        self._mock_session.RunBatch.assert_called_with(["svc wifi enable"],
+                                                       check=True)
+        self._mock_installer.Install.assert_not_called()
 
     @mock.patch("host_controller.command_processor.command_dut.android_device")
     @mock.patch("host_controller.command_processor.command_dut.adb")
@@ -101,12 +125,15 @@ class CommandDUTTest(unittest.TestCase):
                                  % common._DEFAULT_WIFI_AP)
         self.assertIsNone(ret)
         mock_adb_proxy.root.assert_called_once()
-        mock_adb_proxy.shell.assert_any_call("svc wifi enable")
-        mock_adb_proxy.install.assert_called_with(
-            "../testcases/DATA/app/WifiUtil/WifiUtil.apk")
-        mock_adb_proxy.shell.assert_called_with(
+        self._mock_session.RunBatch.assert_any_call(["svc wifi enable"],
+                                                    check=True)
+        self._mock_installer.Install.assert_called_with(
+            "device1", "../testcases/DATA/app/WifiUtil/WifiUtil.apk",
+            "com.android.tradefed.utils.wifi")
+        self._mock_session.RunBatch.assert_called_with([
             "am instrument -e method \"connectToNetwork\" -e ssid GoogleGuest "
-            "-w com.android.tradefed.utils.wifi/.WifiUtil")
+            "-w com.android.tradefed.utils.wifi/.WifiUtil"
+        ], check=True, timeout=command_dut.WIFI_CONNECT_TIMEOUT_SECS)
 
     @mock.patch("host_controller.command_processor.command_dut.android_device")
     @mock.patch("host_controller.command_processor.command_dut.adb")
@@ -119,12 +146,12 @@ class CommandDUTTest(unittest.TestCase):
         ret = self._command._Run("--serial device1 --operation wifi_off")
         self.assertIsNone(ret)
         mock_adb_proxy.root.assert_called_once()
-        mock_adb_proxy.shell.assert_any_call("svc wifi disable")
+        self._mock_session.RunBatch.assert_called_once_with(
+            ["svc wifi disable"], check=True)
 
     @mock.patch("host_controller.command_processor.command_dut.android_device")
     @mock.patch("host_controller.command_processor.command_dut.adb")
     def testCommandDUTVolumeMute(self, mock_adb, mock_android_device):
-        self._command.SetOtherVolumes = mock.Mock()
         mock_adb_proxy = mock.Mock()
         mock_adb.AdbProxy.return_value = mock_adb_proxy
         mock_device = mock.Mock()
@@ -133,14 +160,14 @@ class CommandDUTTest(unittest.TestCase):
         ret = self._command._Run("--serial device1 --operation volume_mute")
         self.assertIsNone(ret)
         mock_adb_proxy.root.assert_called_once()
-        self.assertEqual(mock_adb_proxy.shell.mock_calls,
-                         [mock.call("input keyevent 25")] * 30)
-        self._command.SetOtherVolumes.assert_called_with(mock.ANY, 0, 8.0)
+        self._mock_session.RunBatch.assert_called_once_with(
+            ["input keyevent 25"] * 30 +
+            self._command.GetOtherVolumeCommands(0, 8.0),
+            check=True)
 
     @mock.patch("host_controller.command_processor.command_dut.android_device")
     @mock.patch("host_controller.command_processor.command_dut.adb")
     def testCommandDUTVolumeMax(self, mock_adb, mock_android_device):
-        self._command.SetOtherVolumes = mock.Mock()
         mock_adb_proxy = mock.Mock()
         mock_adb.AdbProxy.return_value = mock_adb_proxy
         mock_device = mock.Mock()
@@ -150,10 +177,84 @@ class CommandDUTTest(unittest.TestCase):
             "--serial device1 --operation volume_max --version 9.0")
         self.assertIsNone(ret)
         mock_adb_proxy.root.assert_called_once()
-        self.assertEqual(mock_adb_proxy.shell.mock_calls,
-                         [mock.call("input keyevent 24")] * 30)
-        self._command.SetOtherVolumes.assert_called_with(mock.ANY, 30, 9.0)
+        self._mock_session.RunBatch.assert_called_once_with(
+            ["input keyevent 24"] * 30 +
+            self._command.GetOtherVolumeCommands(30, 9.0),
+            check=True)
+
+    @mock.patch("host_controller.command_processor.command_dut.android_device")
+    @mock.patch("host_controller.command_processor.command_dut.adb")
+    def testCommandDUTShellFail(self, mock_adb, mock_android_device):
+        mock_device = mock.Mock()
+        mock_device.waitForBootCompletion.return_value = True
+        mock_android_device.AndroidDevice.return_value = mock_device
+        self._mock_session.RunBatch.side_effect = (
+            command_dut.adb_client.AdbClientError("device offline"))
+        self.assertFalse(
+            self._command._Run("--serial device1 --operation wifi_off"))
+
+    @mock.patch("host_controller.command_processor.command_dut.android_device")
+    @mock.patch("host_controller.command_processor.command_dut.adb")
+    def testCommandDUTWaitForBoot(self, mock_adb, mock_android_device):
+        self._mock_boot_watcher.WaitForBootCompletion.return_value = True
+        ret = self._command._Run(
+            "--serial device1 --operation wait_for_boot")
+        self.assertIsNone(ret)
+        self._mock_boot_watcher.WaitForBootCompletion.assert_called_with(
+            "device1", command_dut.BOOT_COMPLETION_TIMEOUT_SECS)
+        mock_android_device.AndroidDevice.assert_not_called()
+        mock_adb.AdbProxy.assert_not_called()
+
+    @mock.patch("host_controller.command_processor.command_dut.cmd_utils")
+    @mock.patch("host_controller.command_processor.command_dut.adb")
+    def testCommandDUTBoot(self, mock_adb, mock_cmd_utils):
+        self._mock_boot_watcher.WaitForBootCompletion.return_value = True
+        mock_cmd_utils.ExecuteOneShellCommand.return_value = (
+            "device1\tfastboot\n", "", 0)
+        ret = self._command._Run("--serial device1 --operation boot")
+        self.assertIsNone(ret)
+        mock_cmd_utils.ExecuteOneShellCommand.assert_called_with(
+            "fastboot -s device1 reboot")
+        mock_adb.AdbProxy.assert_not_called()
+
+    @mock.patch("host_controller.command_processor.command_dut.cmd_utils")
+    def testCommandDUTBootTrackedDevice(self, mock_cmd_utils):
+        self._mock_boot_watcher.WaitForBootCompletion.return_value = True
+        self._mock_inventory.Start.return_value = True
+        self._mock_inventory.IsUsbTracked.return_value = True
+        self._mock_inventory.GetSerials.return_value = ["device1"]
+        self._command._Run("--serial device1 --operation boot")
+        self._mock_inventory.GetSerials.assert_called_with("fastboot")
+        mock_cmd_utils.ExecuteOneShellCommand.assert_called_once_with(
+            "fastboot -s device1 reboot")
+
+
+    @mock.patch("host_controller.command_processor.command_dut.cmd_utils")
+    def testCommandDUTRebootBootloader(self, mock_cmd_utils):
+        mock_cmd_utils.ExecuteOneShellCommand.return_value = (
+            "device2\tfastboot\n", "", 0)
+        self.assertIsNone(
+            self._command._Run("--serial device1 --operation "
+                               "reboot_bootloader"))
+        mock_cmd_utils.ExecuteOneShellCommand.assert_called_with(
+            "adb -s device1 reboot bootloader")
+        self._mock_boot_watcher.WaitForBootCompletion.assert_not_called()
+
+        mock_cmd_utils.ExecuteOneShellCommand.return_value = (
+            "", "error: device 'device1' not found", 1)
+        self.assertFalse(
+            self._command._Run("--serial device1 --operation "
+                               "reboot_bootloader"))
 
+    @mock.patch("host_controller.command_processor.command_dut.cmd_utils")
+    def testCommandDUTRebootBootloaderInFastboot(self, mock_cmd_utils):
+        mock_cmd_utils.ExecuteOneShellCommand.return_value = (
+            "device1\tfastboot\n", "", 0)
+        self.assertIsNone(
+            self._command._Run("--serial device1 --operation "
+                               "reboot_bootloader"))
+        mock_cmd_utils.ExecuteOneShellCommand.assert_called_once_with(
+            "fastboot devices")
 
 if __name__ == "__main__":
     unittest.main()
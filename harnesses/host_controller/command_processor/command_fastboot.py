@@ -15,14 +15,20 @@
 #
 
 import logging
+import os
 
 from host_controller import common
 from host_controller.command_processor import base_command_processor
-from host_controller.utils.ipc import file_lock_semaphore
+from host_controller.utils.fastboot import fastboot_client
+from host_controller.utils.ipc import fair_semaphore
+from host_controller.utils.usb import transfer_scheduler
 from host_controller.utils.usb import usb_utils
 
 from vts.utils.python.common import cmd_utils
 
+# fastboot commands which send images to the device.
+_BULK_COMMANDS = ("boot", "flash", "flashall", "update")
+
 
 class CommandFastboot(base_command_processor.BaseCommandProcessor):
     """Command processor for fastboot command.
@@ -31,6 +37,11 @@ class CommandFastboot(base_command_processor.BaseCommandProcessor):
         arg_parser: ConsoleArgumentParser object, argument parser.
         command: string, command name which this processor will handle.
         command_detail: string, detailed explanation for the command.
+        sem_fastboot: FairSemaphore, limits the concurrent fastboot
+                      commands other than the bulk transfers.
+        _scheduler: UsbTransferScheduler, admits the bulk transfers.
+        _clients: dict, maps a "tcp:" serial to the FastbootClient kept
+                  connected across the commands.
     """
 
     command = "fastboot"
@@ -39,7 +50,9 @@ class CommandFastboot(base_command_processor.BaseCommandProcessor):
     # @Override
     def SetUp(self):
         """Initializes the parser for device command."""
-        self.sem_fastboot = file_lock_semaphore.FileLockSemaphore("fastboot")
+        self.sem_fastboot = fair_semaphore.FairSemaphore("fastboot")
+        self._scheduler = transfer_scheduler.GetTransferScheduler()
+        self._clients = {}
         self.arg_parser.add_argument(
             "--serial",
             "-s",
@@ -75,17 +88,22 @@ class CommandFastboot(base_command_processor.BaseCommandProcessor):
                 logging.error("Only one serial can be specified")
                 return False
             cmd_list.append("-s %s" % args.serial)
-        cmd_list.extend(self.ReplaceVars(args.command))
+        command = self.ReplaceVars(args.command)
+        cmd_list.extend(command)
         cmd = " ".join(cmd_list)
+        bulk = transfer_scheduler.IsBulkCommand(command, _BULK_COMMANDS)
         for _ in range(args.retry + 1):
-            self.sem_fastboot.Acquire()
-            if args.timeout == 0:
-                stdout, stderr, retcode = cmd_utils.ExecuteOneShellCommand(cmd)
+            if bulk:
+                with self._scheduler.Transfer(
+                        args.serial,
+                        transfer_scheduler.GetFileBytes(command)) as transfer:
+                    stdout, stderr, retcode = self._Execute(
+                        cmd, args, command)
+                    transfer.success = (retcode == 0)
             else:
-                stdout, stderr, retcode = cmd_utils.ExecuteOneShellCommand(
-                    cmd, args.timeout,
-                    usb_utils.ResetUsbDeviceOfSerial_Callback, args.serial)
-            self.sem_fastboot.Release()
+                with self.sem_fastboot:
+                    stdout, stderr, retcode = self._Execute(
+                        cmd, args, command)
             if stdout:
                 logging.info(stdout)
             if stderr:
@@ -98,3 +116,92 @@ class CommandFastboot(base_command_processor.BaseCommandProcessor):
             self.console.device_status[
                 args.serial] = common._DEVICE_STATUS_DICT["error"]
         return False
+
+    # @Override
+    def TearDown(self):
+        """Closes the fastboot connections."""
+        for client in self._clients.values():
+            client.Close()
+        self._clients.clear()
+
+    def _Execute(self, cmd, args, command=None):
+        """Executes a fastboot command with the timeout in args.
+
+        Args:
+            cmd: string, the command line.
+            args: the parsed arguments of the fastboot command.
+            command: list of strings, the fastboot command and its
+                     arguments. None to always spawn fastboot.
+
+        Returns:
+            a tuple of (stdout, stderr, retcode).
+        """
+        if command and args.serial.startswith(
+                fastboot_client.TCP_SERIAL_PREFIX):
+            result = self._ExecuteNative(command, args)
+            if result is not None:
+                return result
+        if args.timeout == 0:
+            return cmd_utils.ExecuteOneShellCommand(cmd)
+        return cmd_utils.ExecuteOneShellCommand(
+            cmd, args.timeout, usb_utils.ResetUsbDeviceOfSerial_Callback,
+            args.serial)
+
+    def _ExecuteNative(self, command, args):
+        """Executes a command on a device reached over TCP without fastboot.
+
+        The connection is kept open for the following commands until the
+        device reboots or the connection fails.
+
+        Args:
+            command: list of strings, the fastboot command and its
+                     arguments.
+            args: the parsed arguments of the fastboot command.
+
+        Returns:
+            a tuple of (stdout, stderr, retcode). None if the command has to
+            be run by the fastboot binary, e.g., flashall or an image
+            larger than max-download-size.
+        """
+        name = command[0]
+        if (name, len(command)) not in (("getvar", 2), ("flash", 3),
+                                        ("erase", 2), ("reboot", 1),
+                                        ("reboot", 2),
+                                        ("reboot-bootloader", 1),
+                                        ("continue", 1)):
+            return None
+        client = self._clients.get(args.serial)
+        try:
+            if not client:
+                client = fastboot_client.OpenFastbootClient(
+                    args.serial, args.timeout or None)
+                self._clients[args.serial] = client
+            if name == "getvar":
+                return ("%s: %s\n" % (command[1], client.GetVar(command[1])),
+                        "", 0)
+            if name == "flash":
+                max_size = client.GetMaxDownloadSize()
+                if (not os.path.isfile(command[2]) or
+                    (max_size is not None and
+                     os.path.getsize(command[2]) > max_size)):
+                    return None
+                num_bytes = client.Flash(command[1], command[2])
+                return ("Flashed %s: %d bytes\n" % (command[1], num_bytes),
+                        "", 0)
+            if name == "erase":
+                client.Erase(command[1])
+                return "Erased %s\n" % command[1], "", 0
+            if name == "continue":
+                client.Continue()
+            else:
+                client.Reboot("bootloader" if name == "reboot-bootloader"
+                              else command[1] if len(command) == 2 else None)
+            self._clients.pop(args.serial).Close()
+            return "", "", 0
+        except fastboot_client.FastbootError as e:
+            if args.serial in self._clients:
+                self._clients.pop(args.serial).Close()
+            if client is None:
+                logging.debug("Falling back to the fastboot binary: %s", e)
+                return None
+            return "", str(e), 1
@@ -113,6 +113,9 @@ class CommandFetch(base_command_processor.BaseCommandProcessor):
             return False
 
         provider = self.console._build_provider[args.type]
+        # Applied to the console at once, as the fetch commands of a
+        # command graph run concurrently.
+        fetch_info = {}
         if args.type == "pab":
             # do we want this somewhere else? No harm in doing multiple times
             provider.Authenticate(args.userinfo_file,
@@ -127,7 +130,7 @@ class CommandFetch(base_command_processor.BaseCommandProcessor):
                      build_id=args.build_id,
                      method=args.method,
                      full_device_images=args.full_device_images)
-                self.console.fetch_info["fetch_signed_build"] = False
+                fetch_info["fetch_signed_build"] = False
             else:
                 (device_images, test_suites, fetch_environment,
                  _) = provider.GetSignedBuildArtifact(
@@ -138,17 +141,17 @@ class CommandFetch(base_command_processor.BaseCommandProcessor):
                      build_id=args.build_id,
                      method=args.method,
                      full_device_images=args.full_device_images)
-                self.console.fetch_info["fetch_signed_build"] = True
+                fetch_info["fetch_signed_build"] = True
 
-            self.console.fetch_info["build_id"] = fetch_environment["build_id"]
+            fetch_info["build_id"] = fetch_environment["build_id"]
         elif args.type == "local_fs":
             device_images, test_suites = provider.Fetch(
                 args.path, args.full_device_images)
-            self.console.fetch_info["build_id"] = None
+            fetch_info["build_id"] = None
         elif args.type == "gcs":
             device_images, test_suites, tools = provider.Fetch(
                 args.path, args.full_device_images, args.set_suite_as)
-            self.console.fetch_info["build_id"] = None
+            fetch_info["build_id"] = None
         elif args.type == "ab":
             device_images, test_suites, fetch_environment = provider.Fetch(
                 branch=args.branch,
@@ -156,7 +159,7 @@ class CommandFetch(base_command_processor.BaseCommandProcessor):
                 artifact_name=args.artifact_name,
                 build_id=args.build_id,
                 full_device_images=args.full_device_images)
-            self.console.fetch_info["build_id"] = fetch_environment["build_id"]
+            fetch_info["build_id"] = fetch_environment["build_id"]
         else:
             logging.error("ERROR: unknown fetch type %s", args.type)
             return False
@@ -175,30 +178,32 @@ class CommandFetch(base_command_processor.BaseCommandProcessor):
 
         if args.type == "gcs":
             gcs_path, filename = os.path.split(args.path)
-            self.console.fetch_info["branch"] = gcs_path
-            self.console.fetch_info["target"] = filename
-            self.console.fetch_info["build_id"] = "latest"
-            self.console.fetch_info["account_id"] = ""
+            fetch_info["branch"] = gcs_path
+            fetch_info["target"] = filename
+            fetch_info["build_id"] = "latest"
+            fetch_info["account_id"] = ""
         else:
-            self.console.fetch_info["branch"] = args.branch
-            self.console.fetch_info["target"] = args.target
-            self.console.fetch_info["account_id"] = args.account_id
-
-        self.console.UpdateFetchInfo(provider.GetFetchedArtifactType())
-
-        self.console.device_image_info.update(device_images)
-        self.console.test_suite_info.update(test_suites)
-        self.console.tools_info.update(provider.GetAdditionalFile())
-
-        if self.console.device_image_info:
-            logging.info("device images:\n%s", "\n".join(
-                image + ": " + path
-                for image, path in self.console.device_image_info.iteritems()))
-        if self.console.test_suite_info:
-            logging.info("test suites:\n%s", "\n".join(
-                suite + ": " + path
-                for suite, path in self.console.test_suite_info.iteritems()))
-        if self.console.tools_info:
-            logging.info("additional files:\n%s", "\n".join(
-                rel_path + ": " + full_path for rel_path, full_path in
-                self.console.tools_info.iteritems()))
+            fetch_info["branch"] = args.branch
+            fetch_info["target"] = args.target
+            fetch_info["account_id"] = args.account_id
+
+        with self.console.state_lock:
+            self.console.fetch_info.update(fetch_info)
+            self.console.UpdateFetchInfo(provider.GetFetchedArtifactType())
+
+            self.console.device_image_info.update(device_images)
+            self.console.test_suite_info.update(test_suites)
+            self.console.tools_info.update(provider.GetAdditionalFile())
+
+            if self.console.device_image_info:
+                logging.info("device images:\n%s", "\n".join(
+                    image + ": " + path for image, path in
+                    self.console.device_image_info.iteritems()))
+            if self.console.test_suite_info:
+                logging.info("test suites:\n%s", "\n".join(
+                    suite + ": " + path for suite, path in
+                    self.console.test_suite_info.iteritems()))
+            if self.console.tools_info:
+                logging.info("additional files:\n%s", "\n".join(
+                    rel_path + ": " + full_path for rel_path, full_path in
+                    self.console.tools_info.iteritems()))
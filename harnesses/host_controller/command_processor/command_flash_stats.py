@@ -0,0 +1,129 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+
+from host_controller.build import flash_telemetry
+from host_controller.command_processor import base_command_processor
+
+# Seconds in a day.
+_SECS_PER_DAY = 24 * 60 * 60
+
+
+class _StatRow(object):
+    """A row of the printed table, whose attributes are the columns."""
+
+    def __init__(self, **columns):
+        self.__dict__.update(columns)
+
+
+class CommandFlashStats(base_command_processor.BaseCommandProcessor):
+    """Command processor for flash_stats command.
+
+    Attributes:
+        arg_parser: ConsoleArgumentParser object, argument parser.
+        console: cmd.Cmd console object.
+        command: string, command name which this processor will handle.
+        command_detail: string, detailed explanation for the command.
+    """
+
+    command = "flash_stats"
+    command_detail = ("Shows percentiles of the flash duration and "
+                      "throughput recorded on this host.")
+
+    # @Override
+    def SetUp(self):
+        """Initializes the parser for flash_stats command."""
+        self.arg_parser.add_argument(
+            "--group_by",
+            default="product,partition",
+            help="Comma-separated columns to group the records by. "
+            "Choices: %s" % ", ".join(flash_telemetry.KEY_COLUMNS))
+        self.arg_parser.add_argument(
+            "--percentiles",
+            default=",".join(
+                str(p) for p in flash_telemetry.DEFAULT_PERCENTILES),
+            help="Comma-separated percentiles to report.")
+        self.arg_parser.add_argument(
+            "--days",
+            type=float,
+            default=7,
+            help="Number of days of the records to aggregate. 0 for all.")
+        for column in flash_telemetry.KEY_COLUMNS:
+            self.arg_parser.add_argument(
+                "--%s" % column,
+                default="",
+                help="Only counts the records whose %s matches." % column)
+        self.arg_parser.add_argument(
+            "--db_path",
+            default=None,
+            help="Path to the telemetry database. Defaults to the one "
+            "under the home directory.")
+
+    # @Override
+    def Run(self, arg_line):
+        """Prints the flash statistics."""
+        args = self.arg_parser.ParseLine(arg_line)
+        group_by = [
+            column.strip() for column in args.group_by.split(",")
+            if column.strip()
+        ]
+        unknown = [
+            column for column in group_by
+            if column not in flash_telemetry.KEY_COLUMNS
+        ]
+        if unknown:
+            self.console._Print("unknown columns: %s" % ", ".join(unknown))
+            return False
+        try:
+            percentiles = [
+                float(p) for p in args.percentiles.split(",") if p.strip()
+            ]
+        except ValueError:
+            self.console._Print("invalid percentiles: %s" % args.percentiles)
+            return False
+
+        filters = dict((column, getattr(args, column))
+                       for column in flash_telemetry.KEY_COLUMNS)
+        since = time.time() - args.days * _SECS_PER_DAY if args.days else None
+        telemetry = flash_telemetry.FlashTelemetry(args.db_path)
+        stats = telemetry.GetStats(
+            group_by=group_by, percentiles=percentiles, since=since,
+            **filters)
+        if not stats:
+            self.console._Print("no flash record found.")
+            return
+
+        attr_names = list(group_by) + ["count", "MB"]
+        for percentile in percentiles:
+            attr_names.append("sec_p%g" % percentile)
+        for percentile in percentiles:
+            attr_names.append("MBps_p%g" % percentile)
+
+        rows = []
+        for stat in stats:
+            columns = dict((column, stat[column]) for column in group_by)
+            columns["count"] = stat["count"]
+            columns["MB"] = "%.1f" % (stat["bytes"] / 1e6)
+            for percentile in percentiles:
+                duration = stat["duration_p%g" % percentile]
+                throughput = stat["throughput_p%g" % percentile]
+                columns["sec_p%g" % percentile] = "%.1f" % duration
+                columns["MBps_p%g" % percentile] = (
+                    "%.2f" % (throughput / 1e6)
+                    if throughput is not None else "-")
+            rows.append(_StatRow(**columns))
+        self.console._PrintObjects(rows, attr_names)
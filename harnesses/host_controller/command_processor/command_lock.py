@@ -0,0 +1,145 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import time
+
+from host_controller.command_processor import base_command_processor
+
+
+class _LockRow(object):
+    """A row of the printed table, whose attributes are the columns."""
+
+    def __init__(self, **columns):
+        self.__dict__.update(columns)
+
+
+class CommandLock(base_command_processor.BaseCommandProcessor):
+    """Command processor for lock command.
+
+    Attributes:
+        arg_parser: ConsoleArgumentParser object, argument parser.
+        console: cmd.Cmd console object.
+        command: string, command name which this processor will handle.
+        command_detail: string, detailed explanation for the command.
+    """
+
+    command = "lock"
+    command_detail = ("Lists the device leases on this host, breaks a "
+                      "stale lease, or shows the audit log.")
+
+    # @Override
+    def SetUp(self):
+        """Initializes the parser for lock command."""
+        self.arg_parser.add_argument(
+            "--serial",
+            default=None,
+            help="Serial number of the device to list. Lists all by "
+            "default.")
+        self.arg_parser.add_argument(
+            "--break",
+            dest="break_serial",
+            default=None,
+            help="Serial number of the device whose lease is forcibly "
+            "released.")
+        self.arg_parser.add_argument(
+            "--reason",
+            default="",
+            help="Reason for breaking the lease, recorded in the audit log.")
+        self.arg_parser.add_argument(
+            "--audit",
+            action="store_true",
+            help="Shows the audit log of the expired, reclaimed and broken "
+            "leases.")
+        self.arg_parser.add_argument(
+            "--limit",
+            type=int,
+            default=20,
+            help="Number of the latest audit records to show.")
+
+    # @Override
+    def Run(self, arg_line):
+        """Lists, breaks, or audits the device leases."""
+        args = self.arg_parser.ParseLine(arg_line)
+        client = self.console.file_lock.client
+        if args.break_serial:
+            lease = client.Break(args.break_serial, args.reason)
+            if not lease:
+                self.console._Print("%s is not locked." % args.break_serial)
+                return False
+            self.console._Print("broke the lease of %s held by pid %s (%s)." %
+                                (args.break_serial, lease["pid"],
+                                 lease["command"]))
+            return
+        if args.audit:
+            self._PrintAuditLog(client.GetAuditLog(args.limit))
+            return
+        self._PrintLeases(client.Query(args.serial))
+
+    def _PrintLeases(self, leases):
+        """Prints the holders and the waiters of the leases.
+
+        Args:
+            leases: list of dicts returned by LeaseClient.Query.
+        """
+        if not leases:
+            self.console._Print("no device is locked.")
+            return
+        now = time.time()
+        rows = []
+        for lease in leases:
+            holder = lease["holder"] or {}
+            rows.append(
+                _LockRow(
+                    serial=lease["name"],
+                    pid=holder.get("pid", "-"),
+                    job_id=holder.get("job_id") or "-",
+                    held_secs=("%d" % (now - holder["acquired_time"])
+                               if holder else "-"),
+                    expires_in=("%d" % (holder["expiry_time"] - now)
+                                if holder else "-"),
+                    waiters=len(lease["waiters"]),
+                    command=holder.get("command", "-")))
+        self.console._PrintObjects(rows, [
+            "serial", "pid", "job_id", "held_secs", "expires_in", "waiters",
+            "command"
+        ])
+
+    def _PrintAuditLog(self, records):
+        """Prints the audit records.
+
+        Args:
+            records: list of dicts returned by LeaseClient.GetAuditLog.
+        """
+        if not records:
+            self.console._Print("no audit record found.")
+            return
+        rows = []
+        for record in records:
+            holder = record["holder"]
+            rows.append(
+                _LockRow(
+                    time=time.strftime("%Y-%m-%d %H:%M:%S",
+                                       time.localtime(record["time"])),
+                    action=record["action"],
+                    serial=record["name"],
+                    pid=holder.get("pid"),
+                    job_id=holder.get("job_id") or "-",
+                    by=("%s(%s)" % (record["by_user"], record["by_pid"])),
+                    reason=record.get("reason", "")))
+        self.console._PrintObjects(
+            rows,
+            ["time", "action", "serial", "pid", "job_id", "by", "reason"])
@@ -0,0 +1,122 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import os
+
+from google.protobuf import text_format
+
+from host_controller.campaigns import preflight
+from host_controller.command_processor import base_command_processor
+
+from vti.test_serving.proto import TestScheduleConfigMessage_pb2 as SchedCfgMsg
+
+
+class _JobRow(object):
+    """A row of the printed table, whose attributes are the columns."""
+
+    def __init__(self, **columns):
+        self.__dict__.update(columns)
+
+
+class CommandPreflight(base_command_processor.BaseCommandProcessor):
+    """Command processor for preflight command.
+
+    Attributes:
+        arg_parser: ConsoleArgumentParser object, argument parser.
+        console: cmd.Cmd console object.
+        command: string, command name which this processor will handle.
+        command_detail: string, detailed explanation for the command.
+    """
+
+    command = "preflight"
+    command_detail = ("Compiles the campaign commands of every job in the "
+                      "schedule configs and validates them without running.")
+
+    # @Override
+    def SetUp(self):
+        """Initializes the parser for preflight command."""
+        self.arg_parser.add_argument(
+            "--config_path",
+            default=None,
+            help="The directory of the .schedule_config files. The "
+            "schedules last uploaded by the config command if not given.")
+        self.arg_parser.add_argument(
+            "--campaign_dir",
+            default=os.path.join(os.getcwd(), "host_controller", "campaigns"),
+            help="The directory of the campaign modules.")
+
+    def LoadSchedules(self, path):
+        """Loads the schedule configs in a directory.
+
+        Args:
+            path: string, the directory of the .schedule_config files.
+
+        Returns:
+            a list of ScheduleConfigMessage protobuf messages, None if a
+            file cannot be parsed.
+        """
+        schedules = []
+        for root, dirs, files in os.walk(path):
+            for config_file in sorted(files):
+                if not config_file.endswith(".schedule_config"):
+                    continue
+                full_path = os.path.join(root, config_file)
+                try:
+                    with open(full_path, "r") as fd:
+                        schedule = SchedCfgMsg.ScheduleConfigMessage()
+                        text_format.Merge(fd.read(), schedule)
+                        schedules.append(schedule)
+                except text_format.ParseError as e:
+                    logging.error("Config parsing error in %s: %s",
+                                  full_path, e)
+                    return None
+        return schedules
+
+    # @Override
+    def Run(self, arg_line):
+        """Validates the campaigns of the scheduled jobs."""
+        args = self.arg_parser.ParseLine(arg_line)
+        if args.config_path:
+            schedules = self.LoadSchedules(args.config_path)
+            if schedules is None:
+                return False
+        else:
+            schedules = self.console.schedules[:]
+        if not schedules:
+            self.console._Print("no schedule found.")
+            return False
+
+        results = preflight.ValidateSchedules(self.console, schedules,
+                                              args.campaign_dir)
+        rows = []
+        for job, errors in results:
+            for error in errors:
+                logging.error("Preflight of %s %s failed: %s",
+                              job["build_target"], job.get("test_name"),
+                              error)
+            rows.append(
+                _JobRow(
+                    build_target=job["build_target"],
+                    test_name=job.get("test_name"),
+                    devices=len(job["serial"]),
+                    errors=len(errors),
+                    first_error=errors[0] if errors else ""))
+        self.console._PrintObjects(
+            rows,
+            ["build_target", "test_name", "devices", "errors", "first_error"])
+        if any(errors for _, errors in results):
+            return False
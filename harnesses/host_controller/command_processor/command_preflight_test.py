@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+try:
+    import StringIO as string_io_module
+except ImportError:
+    import io as string_io_module
+
+from host_controller import console
+from host_controller.campaigns import cts
+from host_controller.campaigns import gts
+from host_controller.campaigns import preflight
+from host_controller.campaigns import sts
+from host_controller.campaigns import vts
+
+from host_controller.campaigns.testdata import default_testcase
+
+
+class CommandPreflightTest(unittest.TestCase):
+    """Tests for the campaign preflight and the preflight command."""
+
+    def setUp(self):
+        """Creates the console."""
+        self._out_file = string_io_module.StringIO()
+        self._console = console.Console(
+            mock.Mock(),
+            mock.Mock(),
+            mock.Mock(), [mock.Mock()],
+            None,
+            out_file=self._out_file)
+
+    def tearDown(self):
+        """Closes the output file."""
+        self._out_file.close()
+
+    def _Compile(self, commands, **kwargs):
+        """Compiles a campaign emitting the commands for a job."""
+        job = default_testcase.GenerateInputData("vts/vts")
+        job.update(kwargs)
+        script_module = mock.Mock()
+        script_module.EmitConsoleCommands.return_value = commands
+        return preflight.CompileCampaign(self._console, script_module, job)
+
+    def testCampaigns(self):
+        """Tests that the campaigns pass the preflight."""
+        for test_name, script_module in (("vts/vts", vts), ("cts/cts", cts),
+                                         ("cts/cts-on-gsi", cts),
+                                         ("gts/gts", gts), ("sts/sts", sts)):
+            job = default_testcase.GenerateInputData(test_name)
+            commands, errors = preflight.CompileCampaign(
+                self._console, script_module, job)
+            self.assertEqual(
+                default_testcase.GenerateOutputData(test_name), commands)
+            self.assertEqual([], errors)
+
+            job["command_graph"] = True
+            _, errors = preflight.CompileCampaign(self._console,
+                                                  script_module, job)
+            self.assertEqual([], errors)
+
+    def testInvalidCommands(self):
+        """Tests finding the errors in the commands."""
+        _, errors = self._Compile([
+            "upload --src={result_full} --dest=gs://bucket/{build_id}",
+            "fetchh --type=pab",
+            "fetch --type=pab --bulid_id=123",
+            ["adb -s my_serial1 reboot", "adb -s other_serial reboot"],
+            "test --suite vts -- vts {suite}",
+        ])
+        self.assertEqual(6, len(errors))
+        self.assertIn("{result_full} is used before test or retry",
+                      errors[0])
+        self.assertIn("{build_id} is used before fetch", errors[1])
+        self.assertIn("unknown command fetchh", errors[2])
+        self.assertIn("--bulid_id", errors[3])
+        self.assertIn("device other_serial not leased", errors[4])
+        self.assertIn("unknown variable {suite}", errors[5])
+
+    @mock.patch("host_controller.campaigns.preflight.logging")
+    def testDevices(self, mock_logging):
+        """Tests that fewer devices than shards are not errors."""
+        _, errors = self._Compile(["device --update=stop"],
+                                  serial=["my_serial1"])
+        self.assertEqual([], errors)
+        mock_logging.warning.assert_called_with(
+            "%d shards run on %d device(s).", 3, 1)
+
+        _, errors = self._Compile(["device --update=stop"], serial=[])
+        self.assertEqual([], errors)
+        mock_logging.warning.assert_called_with("Job has no device.")
+
+    def testInvalidJob(self):
+        """Tests failing the jobs which the campaign cannot compile."""
+        job = default_testcase.GenerateInputData("vts/vts")
+        del job["test_branch"]
+        commands, errors = preflight.CompileCampaign(self._console, vts, job)
+        self.assertIsNone(commands)
+        self.assertEqual(["job missing attribute(s): test_branch"], errors)
+
+        job = default_testcase.GenerateInputData("vts/vts")
+        job["test_name"] = "vts"
+        commands, errors = preflight.CompileCampaign(self._console, vts, job)
+        self.assertIsNone(commands)
+        self.assertIn("ValueError", errors[0])
+
+    def _CreateSchedule(self, *test_names):
+        """Creates a schedule with a test schedule per test name."""
+        test_schedule_attrs = dict(
+            test_name="vts/vts",
+            shards=2,
+            param=[],
+            retry_count=0,
+            gsi_branch="git_gsi",
+            gsi_build_target="aosp_arm64_ab-userdebug",
+            gsi_pab_account_id="",
+            gsi_storage_type=0,
+            gsi_vendor_version="",
+            test_branch="git_test",
+            test_build_target="test_suites_arm64",
+            test_pab_account_id="",
+            test_storage_type=0,
+            report_bucket=[],
+            report_spreadsheet_id=[],
+            report_persistent_url=[],
+            report_reference_url=[])
+        test_schedules = []
+        for test_name in test_names:
+            test_schedule_attrs["test_name"] = test_name
+            test_schedules.append(mock.Mock(**test_schedule_attrs))
+        build_target = mock.Mock(
+            require_signed_device_build=False,
+            has_bootloader_img=True,
+            has_radio_img=False,
+            test_schedule=test_schedules)
+        build_target.name = "sailfish-userdebug"
+        return mock.Mock(
+            manifest_branch="git_device",
+            pab_account_id="",
+            build_storage_type=0,
+            build_target=[build_target])
+
+    def testValidateSchedules(self):
+        """Tests compiling the jobs of the schedule configs."""
+        schedule = self._CreateSchedule("vts/vts", "unknown/unknown")
+        results = preflight.ValidateSchedules(
+            self._console, [schedule], os.path.dirname(vts.__file__))
+        self.assertEqual(2, len(results))
+        job, errors = results[0]
+        self.assertEqual(["preflight-0", "preflight-1"], job["serial"])
+        self.assertEqual("git_device", job["manifest_branch"])
+        self.assertTrue(job["has_bootloader_img"])
+        self.assertNotIn("has_radio_img", job)
+        self.assertEqual([], errors)
+        self.assertEqual(["no campaign for test unknown/unknown"],
+                         results[1][1])
+
+    def testCommandPreflight(self):
+        """Tests validating the uploaded schedules by the command."""
+        campaign_dir = os.path.dirname(vts.__file__)
+        self._console.schedules = [self._CreateSchedule("vts/vts")]
+        self.assertIsNone(
+            self._console.onecmd("preflight --campaign_dir=%s" %
+                                 campaign_dir))
+        self.assertIn("vts/vts", self._out_file.getvalue())
+
+        self._console.schedules = [self._CreateSchedule("cts")]
+        self.assertFalse(
+            self._console.onecmd("preflight --campaign_dir=%s" %
+                                 campaign_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
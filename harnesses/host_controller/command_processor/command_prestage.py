@@ -0,0 +1,206 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import threading
+import time
+
+from host_controller import common
+from host_controller.build import prestage
+from host_controller.command_processor import base_command_processor
+from host_controller.console_argument_parser import ConsoleArgumentError
+
+# Device states in which a device is not leased.
+_IDLE_DEVICE_STATUS = (
+    common._DEVICE_STATUS_DICT["fastboot"],
+    common._DEVICE_STATUS_DICT["online"],
+    common._DEVICE_STATUS_DICT["ready"],
+)
+
+
+class _PrestageRow(object):
+    """A row of the printed table, whose attributes are the columns."""
+
+    def __init__(self, **columns):
+        self.__dict__.update(columns)
+
+
+class CommandPrestage(base_command_processor.BaseCommandProcessor):
+    """Command processor for prestage command.
+
+    Flashes idle devices with the build combination most likely leased next,
+    so that a matching job skips fetching and flashing the images.
+
+    Attributes:
+        arg_parser: ConsoleArgumentParser object, argument parser.
+        console: cmd.Cmd console object.
+        command: string, command name which this processor will handle.
+        command_detail: string, detailed explanation for the command.
+        prestage_thread: threading.Thread that pre-stages devices regularly.
+        _idle_since: dict, maps a serial to the time when the device was
+                     first seen idle.
+    """
+
+    command = "prestage"
+    command_detail = "Pre-stages idle devices with the predicted next build."
+
+    def PrestageIdleDevices(self, min_idle_secs, now=None):
+        """Starts pre-staging the devices which have been idle long enough.
+
+        Args:
+            min_idle_secs: int, number of seconds a device has to stay idle
+                           before being pre-staged.
+            now: float, the current time. Defaults to time.time().
+
+        Returns:
+            a list of strings, the serials of the devices started.
+        """
+        if now is None:
+            now = time.time()
+        running = self.console.ReapPrestageProcesses()
+        schedules = self.console.schedules[:]
+        if not schedules:
+            logging.debug("No schedule to predict the next jobs from.")
+            return []
+
+        store = prestage.PrestageStore()
+        latest_builds = store.GetLatestBuilds()
+        history = store.GetJobHistory()
+        started = []
+        for serial, product in sorted(self.console.device_products.items()):
+            if self.console.device_status[serial] not in _IDLE_DEVICE_STATUS:
+                self._idle_since.pop(serial, None)
+                continue
+            idle_since = self._idle_since.setdefault(serial, now)
+            if now - idle_since < min_idle_secs:
+                continue
+            if serial in running or store.GetActive(serial):
+                continue
+
+            job = prestage.PredictNextJob(product, schedules, latest_builds,
+                                          history, now)
+            if job is None:
+                continue
+            staged = store.GetStaged(serial)
+            if (staged and staged["identity"] ==
+                    prestage.ResolveIdentity(job, latest_builds)):
+                continue
+            logging.info("Pre-staging %s with %s", serial, job)
+            if self.console.StartPrestaging(serial, job, store):
+                started.append(serial)
+        return started
+
+    def PrestageLoop(self, min_idle_secs, update_interval):
+        """Regularly pre-stages the idle devices.
+
+        Args:
+            min_idle_secs: int, number of seconds a device has to stay idle
+                           before being pre-staged.
+            update_interval: int, number of seconds before repeating.
+        """
+        thread = threading.currentThread()
+        while getattr(thread, 'keep_running', True):
+            try:
+                self.PrestageIdleDevices(min_idle_secs)
+            except (IOError, OSError) as e:
+                logging.exception(e)
+            time.sleep(update_interval)
+
+    def PrintStatus(self):
+        """Prints the pre-staged and pre-staging devices."""
+        store = prestage.PrestageStore()
+        rows = []
+        for serial, product in sorted(self.console.device_products.items()):
+            active = store.GetActive(serial)
+            staged = store.GetStaged(serial)
+            if active:
+                state = "prestaging"
+                identity = active["identity"]
+            elif staged:
+                state = "prestaged"
+                identity = staged["identity"]
+            else:
+                state = "-"
+                identity = {}
+            rows.append(
+                _PrestageRow(
+                    serial=serial,
+                    product=product,
+                    state=state,
+                    build_id=(identity or {}).get("build_id", ""),
+                    gsi_build_id=(identity or {}).get("gsi_build_id", "")))
+        self.console._PrintObjects(
+            rows, ["serial", "product", "state", "build_id", "gsi_build_id"])
+
+    # @Override
+    def SetUp(self):
+        """Initializes the parser for prestage command."""
+        self.prestage_thread = None
+        self._idle_since = {}
+        self.arg_parser.add_argument(
+            "--update",
+            choices=("single", "start", "stop", "status"),
+            default="start",
+            help="Pre-stage once, start or stop pre-staging regularly, or "
+            "show the pre-staged devices.")
+        self.arg_parser.add_argument(
+            "--interval",
+            type=int,
+            default=common.DEFAULT_PRESTAGE_INTERVAL_SECS,
+            help="Interval (seconds) to repeat pre-staging.")
+        self.arg_parser.add_argument(
+            "--min_idle_secs",
+            type=int,
+            default=common.DEFAULT_PRESTAGE_MIN_IDLE_SECS,
+            help="Number of seconds a device has to stay idle before being "
+            "pre-staged.")
+        self.arg_parser.add_argument(
+            "--preempt",
+            default="",
+            help="Comma-separated serials whose pre-staging is stopped.")
+
+    # @Override
+    def Run(self, arg_line):
+        """Pre-stages idle devices."""
+        args = self.arg_parser.ParseLine(arg_line)
+        if args.preempt:
+            store = prestage.PrestageStore()
+            for serial in args.preempt.split(","):
+                prestage.PreemptPrestaging(serial, store)
+            return
+
+        if args.update == "single":
+            started = self.PrestageIdleDevices(args.min_idle_secs)
+            self.console._Print("started pre-staging: %s" %
+                                (", ".join(started) or "none"))
+        elif args.update == "status":
+            self.PrintStatus()
+        elif args.update == "start":
+            if args.interval <= 0:
+                raise ConsoleArgumentError("update interval must be positive")
+            if self.prestage_thread is not None and not hasattr(
+                    self.prestage_thread, 'keep_running'):
+                logging.warning('prestage already running. '
+                                'run prestage --update stop first.')
+                return
+            self.prestage_thread = threading.Thread(
+                target=self.PrestageLoop,
+                args=(args.min_idle_secs, args.interval))
+            self.prestage_thread.daemon = True
+            self.prestage_thread.start()
+        elif args.update == "stop":
+            if self.prestage_thread is not None:
+                self.prestage_thread.keep_running = False
@@ -31,7 +31,7 @@ _DEVICE_CLEANUP_COMMAND_LIST = [
     "adb -s {serial} reboot bootloader",
     "fastboot -s {serial} erase metadata -- -w",
     "fastboot -s {serial} reboot",
-    "adb -s {serial} wait-for-device",
+    "dut --operation=wait_for_boot --serial={serial}",
     "dut --operation=wifi_on --serial={serial} --ap=" +
     common._DEFAULT_WIFI_AP,
 ]
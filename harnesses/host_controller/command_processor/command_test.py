@@ -176,6 +176,10 @@ class CommandTest(base_command_processor.BaseCommandProcessor):
                 self.console.test_suite_info[args.suite], args.command,
                 serials, result_dir)
 
+            # The devices are committed to the test, so the artifacts of
+            # the next job can be fetched meanwhile.
+            self.console.StartPrefetching(serials)
+
             logging.info("Command: %s", cmd)
             self._ExecuteCommand(cmd)
 
@@ -0,0 +1,84 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from host_controller.command_processor import base_command_processor
+from host_controller.utils.usb import transfer_scheduler
+
+
+class _SegmentRow(object):
+    """A row of the printed table, whose attributes are the columns."""
+
+    def __init__(self, **columns):
+        self.__dict__.update(columns)
+
+
+class CommandTransferStats(base_command_processor.BaseCommandProcessor):
+    """Command processor for transfer_stats command.
+
+    Attributes:
+        arg_parser: ConsoleArgumentParser object, argument parser.
+        console: cmd.Cmd console object.
+        command: string, command name which this processor will handle.
+        command_detail: string, detailed explanation for the command.
+    """
+
+    command = "transfer_stats"
+    command_detail = ("Shows the bulk transfers, queue depth and wait times "
+                      "per USB bus segment on this host.")
+
+    # @Override
+    def SetUp(self):
+        """Initializes the parser for transfer_stats command."""
+        self.arg_parser.add_argument(
+            "--serial",
+            default=None,
+            help="Only shows the segments which the device's transfers go "
+            "through.")
+
+    # @Override
+    def Run(self, arg_line):
+        """Prints the status of the USB bus segments."""
+        args = self.arg_parser.ParseLine(arg_line)
+        scheduler = transfer_scheduler.GetTransferScheduler()
+        segments = scheduler.GetStatus()
+        if args.serial:
+            device_segments = scheduler.GetDeviceSegments(args.serial)
+            segments = [
+                segment for segment in segments
+                if segment["segment"] in device_segments
+            ]
+        if not segments:
+            self.console._Print("no transfer record found.")
+            return
+
+        rows = []
+        for segment in segments:
+            rows.append(
+                _SegmentRow(
+                    segment=segment["segment"],
+                    running=segment["transfers"],
+                    queued=segment["queued"],
+                    limit=segment["limit"],
+                    admitted=segment["admitted"],
+                    wait_avg="%.1f" % segment["wait_avg"],
+                    wait_max="%.1f" % segment["wait_max"],
+                    MBps=("%.1f" % segment["mbps"]
+                          if segment["mbps"] is not None else "-")))
+        self.console._PrintObjects(rows, [
+            "segment", "running", "queued", "limit", "admitted", "wait_avg",
+            "wait_max", "MBps"
+        ])
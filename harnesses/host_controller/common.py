@@ -77,7 +77,8 @@ _STORAGE_TYPE_DICT_REVERSE = {
 # Default SPL date, used for gsispl command
 _SPL_DEFAULT_DAY = 5
 
-# Maximum number of leased jobs per host.
+# Maximum number of leased jobs per host. The number of concurrently running
+# jobs is adapted below it to the host resource utilization.
 _MAX_LEASED_JOBS = 14
 
 # Defualt access point for dut wifi_on command.
@@ -205,8 +206,140 @@ _DEVLOCK_DIR = ".devlock"
 # Default timeout for "adb reboot/fastboot getvar" command in secs.
 DEFAULT_DEVICE_TIMEOUT_SECS = 300
 
+# Maximum time to wait for the devices to be probed in one device update
+# cycle, in seconds. Devices not probed in time are reported as no-response.
+DEVICE_PROBE_TIMEOUT_SECS = 120
+
+# Number of seconds the probed properties of a device are cached unless the
+# device changes its state.
+DEVICE_PROPERTY_TTL_SECS = 600
+
 # Maximum number of concurrent adb/fastboot processes.
 MAX_ADB_FASTBOOT_PROCESS = 2
 
 # Default number of the actual retry runs for the "retry" command.
-DEFAULT_RETRY_COUNT = 30
\ No newline at end of file
+DEFAULT_RETRY_COUNT = 30
+
+# Directory relative to the home directory, in which the sparse image chunks
+# shared among the devices and the job pool processes are cached.
+_SPARSE_IMAGE_CACHE_DIR = ".vtslab/sparse_image_cache"
+
+# Partitions whose images are split into sparse chunks once and then reused.
+SPARSE_IMAGE_PARTITIONS = ["system", "vendor"]
+
+# Maximum number of images being digested and chunked concurrently.
+MAX_SPARSE_IMAGE_CHUNKING_THREADS = 4
+
+# Maximum total size of the cached sparse image chunks in bytes.
+MAX_SPARSE_IMAGE_CACHE_BYTES = 32 * 1024 * 1024 * 1024
+
+# Path relative to the home directory, of the database recording the time
+# and bytes of each flash operation.
+_FLASH_TELEMETRY_DB = ".vtslab/flash_telemetry.db"
+
+# Number of days for which the flash telemetry records are kept.
+FLASH_TELEMETRY_RETENTION_DAYS = 90
+
+# Directory relative to the home directory, in which the pre-staging state
+# (staged builds, running pre-stagers, latest builds and job history) is kept.
+_PRESTAGE_DIR = ".vtslab/prestage"
+
+# Default interval between the checks for idle devices to pre-stage in secs.
+DEFAULT_PRESTAGE_INTERVAL_SECS = 300
+
+# Minimum time a device has to stay idle before it is pre-staged in secs.
+DEFAULT_PRESTAGE_MIN_IDLE_SECS = 600
+
+# Half-life of the weight of a past job when predicting the next one in secs.
+PRESTAGE_HISTORY_HALF_LIFE_SECS = 7 * 24 * 60 * 60
+
+# Maximum number of past jobs kept for the prediction.
+PRESTAGE_MAX_JOB_HISTORY = 1000
+
+# Maximum time to wait for a preempted pre-stager to exit in secs.
+PRESTAGE_PREEMPT_TIMEOUT_SECS = 30
+
+# Maximum time a pre-stager waits to be recorded as active in secs.
+PRESTAGE_START_TIMEOUT_SECS = 60
+
+# Directory relative to the home directory, in which the state and the wait
+# queues of the host-wide semaphores are kept.
+_SEMAPHORE_DIR = ".vtslab/semaphore"
+
+# Interval at which a semaphore waiter checks for crashed holders in secs.
+SEMAPHORE_LIVENESS_CHECK_SECS = 5
+
+# Directory relative to the home directory, in which the device leases and
+# their audit log are kept.
+_DEVICE_LEASE_DIR = ".vtslab/lease"
+
+# Number of seconds a device lease lasts unless renewed. The holders renew
+# their leases every third of it.
+DEVICE_LEASE_TTL_SECS = 300
+
+# Maximum number of devices whose status is kept in the status table shared
+# with the job pool processes.
+MAX_DEVICE_STATUS_RECORDS = 256
+
+# Interval between the full snapshots of the device info and the host
+# version uploaded for reconciliation, in seconds. Only the changed records
+# are uploaded in between.
+DEVICE_REPORT_FULL_SNAPSHOT_SECS = 600
+
+# Minimum interval between two uploads of a device's changes in seconds.
+# The changes of a flapping device within it are coalesced into the latest.
+DEVICE_REPORT_FLAP_WINDOW_SECS = 60
+
+# Directory relative to the home directory, in which the state of the USB
+# transfer scheduler is kept.
+_USB_TRANSFER_DIR = ".vtslab/usb_transfer"
+
+# Maximum number of concurrent bulk transfers on a USB bus segment, i.e.,
+# a host controller, a root hub, or a hub.
+USB_SEGMENT_MAX_TRANSFERS = 8
+
+# Minimum relative gain in the aggregate throughput of a USB bus segment
+# for which one more concurrent transfer is admitted.
+USB_SEGMENT_MIN_GAIN = 0.1
+
+# Number of seconds a throughput measurement of a USB bus segment is used.
+# The segment is probed again with more transfers once it expires.
+USB_SEGMENT_SAMPLE_TTL_SECS = 24 * 60 * 60
+
+# Maximum number of the worker processes running the command lists of a
+# console in parallel. The lists beyond it wait for a free worker.
+MAX_COMMAND_LIST_WORKERS = 16
+
+# Maximum number of the nodes of a campaign's command graph run concurrently.
+MAX_COMMAND_GRAPH_THREADS = 4
+
+# Maximum time a leased job waits for the prefetching of its artifacts,
+# started while the previous job tested, to finish in secs.
+PREFETCH_WAIT_SECS = 600
+
+# Number of seconds a prefetched artifact is kept unless claimed by a job.
+PREFETCH_ARTIFACT_TTL_SECS = 12 * 60 * 60
+
+# Maximum utilization of each host resource, between 0 and 1, beyond which
+# the number of concurrently running leased jobs is decreased.
+JOB_ADMISSION_CEILINGS = {
+    "cpu": 0.9,
+    "memory": 0.9,
+    "disk": 0.9,
+    "network": 0.8,
+}
+
+# Fraction of the ceilings below which all resources have to be for the
+# number of concurrently running leased jobs to be increased.
+JOB_ADMISSION_HEADROOM = 0.8
+
+# Number of the recent job admission decisions kept for the metrics.
+JOB_ADMISSION_HISTORY = 100
+
+# Time to wait for more devices to be released before leasing a job for
+# the released devices in secs.
+LEASE_TRIGGER_DEBOUNCE_SECS = 2
+
+# Directory relative to the home directory, in which the compiled code of the
+# campaign modules is shared among the job pool processes.
+_CAMPAIGN_BYTECODE_DIR = ".vtslab/campaign_cache"
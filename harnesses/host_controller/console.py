@@ -15,6 +15,7 @@
 #
 
 import cmd
+import copy
 import ctypes
 import datetime
 import imp  # Python v2 compatibility
@@ -22,6 +23,7 @@ import logging
 import multiprocessing
 import multiprocessing.pool
 import os
+import Queue
 import re
 import shutil
 import signal
@@ -33,7 +35,10 @@ import time
 import urlparse
 
 from host_controller import common
+from host_controller import job_admission
+from host_controller import lease_trigger
 from host_controller.command_processor import command_adb
+from host_controller.command_processor import command_admission
 from host_controller.command_processor import command_build
 from host_controller.command_processor import command_config
 from host_controller.command_processor import command_config_local
@@ -44,11 +49,15 @@ from host_controller.command_processor import command_exit
 from host_controller.command_processor import command_fastboot
 from host_controller.command_processor import command_fetch
 from host_controller.command_processor import command_flash
+from host_controller.command_processor import command_flash_stats
 from host_controller.command_processor import command_gsispl
 from host_controller.command_processor import command_info
 from host_controller.command_processor import command_lease
 from host_controller.command_processor import command_list
+from host_controller.command_processor import command_lock
 from host_controller.command_processor import command_password
+from host_controller.command_processor import command_preflight
+from host_controller.command_processor import command_prestage
 from host_controller.command_processor import command_release
 from host_controller.command_processor import command_retry
 from host_controller.command_processor import command_request
@@ -57,6 +66,7 @@ from host_controller.command_processor import command_sheet
 from host_controller.command_processor import command_shell
 from host_controller.command_processor import command_sleep
 from host_controller.command_processor import command_test
+from host_controller.command_processor import command_transfer_stats
 from host_controller.command_processor import command_reproduce
 from host_controller.command_processor import command_upload
 from host_controller.build import build_info
@@ -64,14 +74,21 @@ from host_controller.build import build_provider_ab
 from host_controller.build import build_provider_gcs
 from host_controller.build import build_provider_local_fs
 from host_controller.build import build_provider_pab
-from host_controller.utils.ipc import file_lock
-from host_controller.utils.ipc import shared_dict
+from host_controller.build import prestage
+from host_controller.campaigns import campaign_common
+from host_controller.campaigns import campaign_loader
+from host_controller.campaigns import command_graph
+from host_controller.campaigns import preflight
+from host_controller.utils.ipc import device_lease
+from host_controller.utils.ipc import shared_status_table
+from host_controller.utils.ipc import worker_pool
 from host_controller.vti_interface import vti_endpoint_client
 from vts.runners.host import logger
 from vts.utils.python.common import cmd_utils
 
 COMMAND_PROCESSORS = [
     command_adb.CommandAdb,
+    command_admission.CommandAdmission,
     command_build.CommandBuild,
     command_config.CommandConfig,
     command_config_local.CommandConfigLocal,
@@ -82,11 +99,15 @@ COMMAND_PROCESSORS = [
     command_fastboot.CommandFastboot,
     command_fetch.CommandFetch,
     command_flash.CommandFlash,
+    command_flash_stats.CommandFlashStats,
     command_gsispl.CommandGsispl,
     command_info.CommandInfo,
     command_lease.CommandLease,
     command_list.CommandList,
+    command_lock.CommandLock,
     command_password.CommandPassword,
+    command_preflight.CommandPreflight,
+    command_prestage.CommandPrestage,
     command_release.CommandRelease,
     command_retry.CommandRetry,
     command_request.CommandRequest,
@@ -95,10 +116,29 @@ COMMAND_PROCESSORS = [
     command_shell.CommandShell,
     command_sleep.CommandSleep,
     command_test.CommandTest,
+    command_transfer_stats.CommandTransferStats,
     command_reproduce.CommandReproduce,
     command_upload.CommandUpload,
 ]
 
+# Attributes of the console handed over to the command lists running in the
+# worker processes. The other attributes keep the values from the time the
+# worker was forked.
+_WORKER_STATE_ATTRS = (
+    "fetch_info",
+    "_detailed_fetch_info",
+    "device_image_info",
+    "test_suite_info",
+    "tools_info",
+    "test_result",
+    "test_results",
+    "repack_dest_path",
+    "_serials",
+    "_tmpdir_default",
+    "_logfile_upload_path",
+    "_leased_job",
+)
+
 
 class NonDaemonizedProcess(multiprocessing.Process):
     """Process class which is not daemonized."""
@@ -118,7 +158,15 @@ class NonDaemonizedPool(multiprocessing.pool.Pool):
     Process = NonDaemonizedProcess
 
 
-def JobMain(vti_address, in_queue, out_queue, device_status, password, hosts):
+def JobMain(vti_address,
+            in_queue,
+            out_queue,
+            device_status,
+            password,
+            hosts,
+            running_jobs=None,
+            flash_plan=False,
+            schedules=None):
     """Main() for a child process that executes a leased job.
 
     Currently, lease jobs must use VTI (not TFC).
@@ -127,13 +175,19 @@ def JobMain(vti_address, in_queue, out_queue, device_status, password, hosts):
         vti_client: VtiEndpointClient needed to create Console.
         in_queue: Queue to get new jobs.
         out_queue: Queue to put execution results.
-        device_status: SharedDict, contains device status information.
-                       shared between processes.
+        device_status: SharedStatusTable, contains device status
+                       information. shared between processes.
         password: multiprocessing.managers.ValueProxy, a proxy instance of a
                   string(ctypes.c_char_p) represents the password which is
                   to be passed to the prompt when executing certain command
                   as root user.
         hosts: A list of HostController objects. Needed for the device command.
+        running_jobs: multiprocessing.Value, the number of the jobs being
+                      leased or run by the pool processes.
+        flash_plan: bool, whether to set "flash_plan" in the leased jobs so
+                    that their flash commands are compiled by flash_plan.
+        schedules: multiprocessing.managers.ListProxy, the schedules last
+                   uploaded by the config command of the main console.
     """
 
     def SigTermHandler(signum, frame):
@@ -149,60 +203,209 @@ def JobMain(vti_address, in_queue, out_queue, device_status, password, hosts):
     console = Console(vti_client, None, None, hosts, job_pool=True)
     console.device_status = device_status
     console.password = password
+    if schedules is not None:
+        console._schedules = schedules
     multiprocessing.util.Finalize(console, console.__exit__, exitpriority=0)
+    # The devices of the last job, which may be prefetching the next one.
+    last_serials = []
 
     while True:
         command = in_queue.get()
         if command == "exit":
+            # No job will claim what is prefetched by this process.
+            for serial in last_serials:
+                prestage.CancelPrefetching(serial)
             break
         elif command == "lease":
-            filepath, kwargs = vti_client.LeaseJob(socket.gethostname(), True)
-            logging.debug("Job %s -> %s" % (os.getpid(), kwargs))
-            if filepath is not None:
-                # TODO: redirect console output and add
-                # console command to access them.
-
-                console._build_provider[
-                    "pab"] = build_provider_pab.BuildProviderPAB()
-                console._build_provider[
-                    "gcs"] = build_provider_gcs.BuildProviderGCS()
-
-                for serial in kwargs["serial"]:
-                    console.ChangeDeviceState(
-                        serial, common._DEVICE_STATUS_DICT["use"])
-                print_to_console = True
-                if not print_to_console:
-                    sys.stdout = out
-                    sys.stderr = err
-
-                ret, gcs_log_url = console.ProcessConfigurableScript(
-                    os.path.join(os.getcwd(), "host_controller", "campaigns",
-                                 filepath), **kwargs)
-                if ret:
-                    job_status = "complete"
-                else:
-                    job_status = "infra-err"
+            if running_jobs is not None:
+                with running_jobs.get_lock():
+                    running_jobs.value += 1
+            try:
+                filepath, kwargs = vti_client.LeaseJob(
+                    socket.gethostname(), True)
+                logging.debug("Job %s -> %s" % (os.getpid(), kwargs))
+                if filepath is not None:
+                    # TODO: redirect console output and add
+                    # console command to access them.
+
+                    console._build_provider[
+                        "pab"] = build_provider_pab.BuildProviderPAB()
+                    console._build_provider[
+                        "gcs"] = build_provider_gcs.BuildProviderGCS()
+
+                    # The pre-stagers are stopped first as they hold the
+                    # device locks. The devices are marked in use before
+                    # the prefetching is settled, which may take minutes.
+                    prestage_store = prestage.PrestageStore()
+                    prestage_store.RecordJob(kwargs)
+                    prestaged_fetch_info = prestage.ClaimPrestagedDevices(
+                        kwargs, prestage_store)
+                    for serial in kwargs["serial"]:
+                        console.ChangeDeviceState(
+                            serial, common._DEVICE_STATUS_DICT["use"],
+                            job_id=kwargs.get("test_name"))
+                    prestage.ClaimPrefetchedArtifacts(kwargs, prestage_store)
+                    if prestaged_fetch_info:
+                        # The pre-staged devices skip the device fetch.
+                        kwargs["prestaged"] = True
+                        console._detailed_fetch_info.update(
+                            prestaged_fetch_info)
+                    if flash_plan:
+                        kwargs["flash_plan"] = True
+                    print_to_console = True
+                    if not print_to_console:
+                        sys.stdout = out
+                        sys.stderr = err
+
+                    console.SetLeasedJob(kwargs)
+                    last_serials = kwargs["serial"]
+                    ret = False
+                    try:
+                        ret, gcs_log_url = console.ProcessConfigurableScript(
+                            os.path.join(os.getcwd(), "host_controller",
+                                         "campaigns", filepath), **kwargs)
+                    finally:
+                        console.SetLeasedJob(None)
+                        if not ret:
+                            # The failed devices may not run the predicted
+                            # job.
+                            for serial in kwargs["serial"]:
+                                prestage.CancelPrefetching(
+                                    serial, prestage_store)
+                    if ret:
+                        job_status = "complete"
+                    else:
+                        job_status = "infra-err"
+
+                    vti_client.StopHeartbeat(job_status, gcs_log_url)
+                    logging.info("Job execution complete. "
+                                 "Setting job status to {}".format(job_status))
+
+                    if not print_to_console:
+                        sys.stdout = sys.__stdout__
+                        sys.stderr = sys.__stderr__
+
+                    for serial in kwargs["serial"]:
+                        console.ChangeDeviceState(
+                            serial, common._DEVICE_STATUS_DICT["ready"])
+
+                    del console._build_provider["pab"]
+                    del console._build_provider["gcs"]
+                    console.fetch_info = {}
+                    console._detailed_fetch_info = {}
+            finally:
+                if running_jobs is not None:
+                    with running_jobs.get_lock():
+                        running_jobs.value -= 1
+        else:
+            logging.error("Unknown job command %s", command)
 
-                vti_client.StopHeartbeat(job_status, gcs_log_url)
-                logging.info("Job execution complete. "
-                             "Setting job status to {}".format(job_status))
+    out_queue.put("exit")
 
-                if not print_to_console:
-                    sys.stdout = sys.__stdout__
-                    sys.stderr = sys.__stderr__
 
-                for serial in kwargs["serial"]:
-                    console.ChangeDeviceState(
-                        serial, common._DEVICE_STATUS_DICT["ready"])
+def PrestageMain(vti_address, hosts, serial, job, store_dir, started):
+    """Main() for a child process that pre-stages an idle device.
 
-                del console._build_provider["pab"]
-                del console._build_provider["gcs"]
-                console.fetch_info = {}
-                console._detailed_fetch_info = {}
-        else:
-            logging.error("Unknown job command %s", command)
+    Fetches and flashes the predicted device images and GSI in the same way
+    as a leased job and records their identity on success. The process
+    leads its own process group so that the whole group can be terminated
+    when a job leases the device. The device is locked while pre-staging.
 
-    out_queue.put("exit")
+    Args:
+        vti_address: string, VTI service URI.
+        hosts: A list of HostController objects.
+        serial: string, the device serial.
+        job: dict, the predicted job attributes.
+        store_dir: string, the directory of the PrestageStore.
+        started: multiprocessing.Event, set by the parent after recording
+                 this process as the active pre-stager.
+    """
+    os.setpgrp()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    store = prestage.PrestageStore(store_dir)
+    if not started.wait(common.PRESTAGE_START_TIMEOUT_SECS):
+        logging.error("Pre-staging %s is not recorded as active.", serial)
+        return
+    try:
+        vti_client = vti_endpoint_client.VtiEndpointClient(vti_address)
+        console = Console(vti_client, None, None, hosts, job_pool=True)
+        if not console.file_lock.LockDevice(
+                serial, suppress_lock_warning=True, job_id="prestage"):
+            logging.info("Device %s is in use. Pre-staging skipped.", serial)
+            return
+        try:
+            store.ClearStaged(serial)
+            console.device_status = {}
+            console._build_provider[
+                "pab"] = build_provider_pab.BuildProviderPAB()
+            console._build_provider[
+                "gcs"] = build_provider_gcs.BuildProviderGCS()
+
+            kwargs = dict(job)
+            kwargs["serial"] = [serial]
+            kwargs["shards"] = 1
+            kwargs["prestaging"] = True
+            commands, gsi = campaign_common.EmitFetchCommands(**kwargs)
+            commands.extend(campaign_common.EmitFlashCommands(gsi, **kwargs))
+            for command in commands:
+                if console.onecmd(command) == False:
+                    logging.error("Pre-staging %s failed at %s", serial,
+                                  command)
+                    return
+
+            identity = prestage.ResolveIdentity(job, {})
+            store.SetStaged(serial, identity, console.detailed_fetch_info)
+            logging.info("Pre-staged %s with %s", serial, identity)
+        finally:
+            console.file_lock.UnlockDevice(serial)
+    finally:
+        store.ClearActive(serial, os.getpid())
+
+
+def PrefetchMain(job, serials, store_dir):
+    """Main() for a child process that prefetches the artifacts of a job.
+
+    Downloads the artifacts the job fetches from PAB into the PrestageStore
+    while the devices run the previous job's test. The process leads its
+    own process group so that it can be stopped when a different job
+    leases the devices.
+
+    Args:
+        job: dict, the predicted job attributes.
+        serials: a list of strings, the device serials.
+        store_dir: string, the directory of the PrestageStore.
+    """
+    os.setpgrp()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    store = prestage.PrestageStore(store_dir)
+    provider = build_provider_pab.BuildProviderPAB()
+    provider.Authenticate()
+    for artifact in prestage.GetJobArtifacts(job):
+        build_id = artifact["build_id"]
+        if build_id is None:
+            build_id = provider.GetLatestBuildId(
+                account_id=artifact["account_id"],
+                branch=artifact["branch"],
+                target=artifact["target"])
+        artifact = prestage.Artifact(
+            artifact["account_id"], artifact["branch"], artifact["target"],
+            build_id, artifact["artifact_name"])
+        if store.GetArtifact(artifact):
+            continue
+        url = provider.GetArtifactURL(
+            account_id=artifact["account_id"],
+            build_id=build_id,
+            target=artifact["target"],
+            artifact_name=artifact["artifact_name"],
+            branch=artifact["branch"],
+            internal=False)
+        logging.info("Prefetching %s for %s", artifact, serials)
+        if not store.FetchArtifact(
+                artifact, lambda path: provider.DownloadArtifact(url, path),
+                serials):
+            logging.error("Failed to prefetch %s", artifact)
 
 
 class Console(cmd.Cmd):
@@ -227,7 +430,7 @@ class Console(cmd.Cmd):
         _in_file: The input file object.
         _out_file: The output file object.
         _serials: A list of string where each string is a device serial.
-        _device_status: SharedDict, shared with process pool.
+        _device_status: SharedStatusTable, shared with process pool.
                         contains status data on each devices.
         _job_pool: bool, True if Console is created from job pool process
                    context.
@@ -241,8 +444,30 @@ class Console(cmd.Cmd):
                          (<git commit timestamp>:<git commit hash value>)
         _detailed_fetch_info: A nested dict, holds the branch and target value
                               of the device, gsi, or test suite artifact.
-        _file_lock: FileLock, an instance used for synchronizing the devices'
+        _state_lock: threading.RLock, guarding the fetched build info and
+                     the test results shared by the command graph threads.
+        _file_lock: DeviceLock, an instance used for synchronizing the devices'
                     use when the automated self-update happens.
+        _device_products: dict, maps a serial to the product name probed
+                          by FlashImgPackage or the device command in this
+                          session.
+        _schedules: list of ScheduleConfigMessage, the schedules last
+                    uploaded by the config command. A ListProxy shared
+                    with the job pool processes unless in a job pool.
+        _prestage_processes: dict, maps a serial to the multiprocessing.Process
+                             pre-staging the device.
+        _leased_job: dict, the attributes of the job run by this job pool
+                     console. None if no job is running.
+        _prefetch_process: multiprocessing.Process, prefetching the
+                           artifacts of the job predicted next on the
+                           leased devices. None if not started.
+        _running_jobs: multiprocessing.Value, the number of the jobs being
+                       leased or run by the job pool processes.
+        _job_admission: JobAdmissionController, limiting the leased jobs
+                        by the host resource utilization. None if the job
+                        pool is not started.
+        _lease_trigger: LeaseTrigger, leasing a job when devices are
+                        released. None if not started.
     """
 
     def __init__(self,
@@ -267,7 +492,7 @@ class Console(cmd.Cmd):
                 "local_fs"] = build_provider_local_fs.BuildProviderLocalFS()
             self._build_provider["ab"] = build_provider_ab.BuildProviderAB()
             self._manager = multiprocessing.Manager()
-            self._device_status = shared_dict.SharedDict(self._manager)
+            self._device_status = shared_status_table.SharedStatusTable()
             self._password = self._manager.Value(ctypes.c_char_p, password)
             try:
                 with open(common._VTSLAB_VERSION_TXT, "r") as file:
@@ -297,8 +522,20 @@ class Console(cmd.Cmd):
         self.fetch_info = {}
         self._detailed_fetch_info = {}
         self.test_results = {}
-        self._file_lock = file_lock.FileLock()
+        self._file_lock = device_lease.DeviceLock()
+        self._state_lock = threading.RLock()
         self.repack_dest_path = ""
+        self._device_products = {}
+        # Shared with the job pool processes like the password.
+        self._schedules = [] if self._job_pool else self._manager.list()
+        self._prestage_processes = {}
+        self._leased_job = None
+        self._prefetch_process = None
+        self._running_jobs = None
+        self._job_admission = None
+        self._lease_trigger = None
+        self._worker_pool = None
+        self._worker_pool_lock = threading.Lock()
 
         if common._ANDROID_SERIAL in os.environ:
             self._serials = [os.environ[common._ANDROID_SERIAL]]
@@ -319,6 +556,8 @@ class Console(cmd.Cmd):
 
     def __exit__(self):
         """Finalizes the build provider attributes explicitly when exited."""
+        if self._worker_pool:
+            self._worker_pool.Close()
         for bp in self._build_provider:
             self._build_provider[bp].__del__()
         if os.path.exists(self._tmp_logdir):
@@ -388,6 +627,171 @@ class Console(cmd.Cmd):
     def detailed_fetch_info(self):
         return self._detailed_fetch_info
 
+    @property
+    def device_products(self):
+        """getter for self._device_products"""
+        return self._device_products
+
+    @property
+    def schedules(self):
+        """getter for self._schedules"""
+        return self._schedules
+
+    @schedules.setter
+    def schedules(self, schedules):
+        """setter for self._schedules"""
+        self._schedules[:] = schedules
+
+    @property
+    def job_admission(self):
+        """getter for self._job_admission"""
+        return self._job_admission
+
+    def AdmitJob(self):
+        """Decides whether to lease one more job for the job pool.
+
+        Returns:
+            True if the host resources allow one more job to run.
+        """
+        if not self._job_admission:
+            return True
+        try:
+            pending = self._job_in_queue.qsize()
+        except NotImplementedError:
+            pending = 0
+        return self._job_admission.Admit(self._running_jobs.value + pending)
+
+    @property
+    def lease_trigger(self):
+        """getter for self._lease_trigger"""
+        return self._lease_trigger
+
+    def StartLeaseTrigger(self):
+        """Starts leasing a job as soon as devices are released.
+
+        Returns:
+            True if started; False if the job pool is not started or the
+            trigger is already running.
+        """
+        if not self._job_admission:
+            return False
+        if not self._lease_trigger:
+            self._lease_trigger = lease_trigger.LeaseTrigger(
+                self._device_status, self._LeaseForReleasedDevices)
+        return self._lease_trigger.Start()
+
+    def StopLeaseTrigger(self):
+        """Stops leasing a job when devices are released."""
+        if self._lease_trigger:
+            self._lease_trigger.Stop()
+
+    def _LeaseForReleasedDevices(self, serials):
+        """Requests the job pool to lease a job for released devices.
+
+        Args:
+            serials: a list of strings, the released serials which are idle.
+
+        Returns:
+            True if a lease is requested.
+        """
+        if not self.AdmitJob():
+            return False
+        self._job_in_queue.put("lease")
+        return True
+
+    def SetLeasedJob(self, leased_job):
+        """Sets the job run by this job pool console.
+
+        Args:
+            leased_job: dict, the job attributes. None if the job ended.
+        """
+        self._leased_job = leased_job
+        self._prefetch_process = None
+
+    def StartPrefetching(self, serials):
+        """Starts prefetching the artifacts of the job leased next.
+
+        Called when the leased job starts testing, so that the downloads
+        do not compete with its own fetching and flashing.
+
+        Args:
+            serials: a list of strings, the serials of the tested devices.
+
+        Returns:
+            True if started; False if no job is leased or the prefetching
+            has been started for the job.
+        """
+        if not self._leased_job or self._prefetch_process or not serials:
+            return False
+        store = prestage.PrestageStore()
+        store.DiscardArtifacts(
+            max_age_secs=common.PREFETCH_ARTIFACT_TTL_SECS)
+        job = prestage.PredictPipelinedJob(self._leased_job,
+                                           self.schedules[:], store)
+        artifacts = prestage.GetJobArtifacts(job)
+        # Another console of the job, e.g., in a worker process, may have
+        # started prefetching the same artifacts for some of the devices.
+        serials = [
+            serial for serial in serials
+            if (store.GetPrefetch(serial) or {}).get("artifacts") != artifacts
+        ]
+        if not artifacts or not serials:
+            return False
+        logging.info("Prefetching %s for %s", job, serials)
+        process = multiprocessing.Process(
+            target=PrefetchMain, args=(job, serials, store.store_dir))
+        process.start()
+        for serial in serials:
+            store.SetPrefetch(serial, process.pid, artifacts)
+        self._prefetch_process = process
+        return True
+
+    def StartPrestaging(self, serial, job, store):
+        """Starts a process pre-staging an idle device.
+
+        Args:
+            serial: string, the device serial.
+            job: dict, the predicted job attributes.
+            store: PrestageStore object.
+
+        Returns:
+            True if started; False if the device is being pre-staged.
+        """
+        process = self._prestage_processes.get(serial)
+        if process and process.is_alive():
+            return False
+        # The child waits for the event before touching the device, so that
+        # the device is recorded as active before it is rebooted or flashed.
+        started = multiprocessing.Event()
+        process = multiprocessing.Process(
+            target=PrestageMain,
+            args=(self._vti_address, self._hosts, serial, job,
+                  store.store_dir, started))
+        process.start()
+        try:
+            store.SetActive(serial, process.pid,
+                            prestage.GetProduct(job["build_target"]),
+                            prestage.ResolveIdentity(job, {}))
+        except (IOError, OSError):
+            process.terminate()
+            process.join()
+            raise
+        started.set()
+        self._prestage_processes[serial] = process
+        return True
+
+    def ReapPrestageProcesses(self):
+        """Joins the exited pre-staging processes.
+
+        Returns:
+            a list of strings, the serials being pre-staged.
+        """
+        for serial, process in self._prestage_processes.items():
+            if not process.is_alive():
+                process.join()
+                del self._prestage_processes[serial]
+        return self._prestage_processes.keys()
+
     def UpdateFetchInfo(self, artifact_type):
         if artifact_type in common._ARTIFACT_TYPE_LIST:
             self._detailed_fetch_info[artifact_type] = {}
@@ -400,19 +804,25 @@ class Console(cmd.Cmd):
         """getter for self._file_lock"""
         return self._file_lock
 
-    def ChangeDeviceState(self, serial, state):
+    @property
+    def state_lock(self):
+        """getter for self._state_lock"""
+        return self._state_lock
+
+    def ChangeDeviceState(self, serial, state, job_id=None):
         """Changes a device's state and (un)locks the file lock if necessary.
 
         Args:
             serial: string, serial number of a device.
             state: int, devices' status value pre-defined in
                    common._DEVICE_STATUS_DICT.
+            job_id: string, the job recorded as the holder of the lock.
         Returns:
             True if the state change and locking/unlocking are successful.
             False otherwise.
         """
         if state == common._DEVICE_STATUS_DICT["use"]:
-            ret = self._file_lock.LockDevice(serial)
+            ret = self._file_lock.LockDevice(serial, job_id=job_id)
             if ret == False:
                 return False
 
@@ -589,18 +999,29 @@ class Console(cmd.Cmd):
             % kwargs["build_target"])
         self._logfile_upload_path = dest
 
-        script_module = imp.load_source('script_module', script_file_path)
+        script_module = campaign_loader.GetCampaignLoader().Load(
+            script_file_path)
 
-        commands = script_module.EmitConsoleCommands(**kwargs)
-        logging.info("Command list: %s", commands)
-        if commands:
-            logging.info("Console commands: %s", commands)
-            for command in commands:
-                ret = self.onecmd(command)
-                if ret == False:
-                    break
-        else:
+        commands, errors = preflight.CompileCampaign(self, script_module,
+                                                     kwargs)
+        if errors:
+            for error in errors:
+                logging.error("Preflight of %s failed: %s", script_file_path,
+                              error)
             ret = False
+        elif isinstance(commands, command_graph.CommandGraph):
+            logging.info("Command graph: %s", commands.GetCommands())
+            ret = self.RunCommandGraph(commands)
+        else:
+            logging.info("Command list: %s", commands)
+            if commands:
+                logging.info("Console commands: %s", commands)
+                for command in commands:
+                    ret = self.onecmd(command)
+                    if ret == False:
+                        break
+            else:
+                ret = False
 
         file_handler.flush()
         infra_log_upload_command = "upload"
@@ -739,41 +1160,37 @@ class Console(cmd.Cmd):
             'campaign_common',
             os.path.join(os.getcwd(), "host_controller", "campaigns",
                          "campaign_common.py"))
-        flash_command_list = []
 
+        # Each device is probed and flashed in its own process so that a
+        # device starts flashing as soon as its own probe completes.
+        result_queue = multiprocessing.Queue()
+        jobs = []
         for serial in self._serials:
-            flash_commands = []
-            cmd_utils.ExecuteOneShellCommand(
-                "adb -s %s reboot bootloader" % serial)
-            _, stderr, retcode = cmd_utils.ExecuteOneShellCommand(
-                "fastboot -s %s getvar product" % serial)
-            if retcode == 0:
-                res = stderr.splitlines()[0].rstrip()
-                if ":" in res:
-                    product = res.split(":")[1].strip()
-                elif "waiting for %s" % serial in res:
-                    res = stderr.splitlines()[1].rstrip()
-                    product = res.split(":")[1].strip()
-                else:
-                    product = "error"
-            else:
-                product = "error"
-            logging.info("Device %s product type: %s", serial, product)
-            if product in campaign_common.FLASH_COMMAND_EMITTER:
-                flash_commands.append(
-                    campaign_common.FLASH_COMMAND_EMITTER[product](
-                        serial, repacked_imageset=True))
-            elif product != "error":
-                flash_commands.append(
-                    "flash --current --serial %s --skip-vbmeta=True" % serial)
-            else:
-                logging.error(
-                    "Device %s does not exist. Omitting the flashing "
-                    "to the device.", serial)
+            p = multiprocessing.Process(
+                target=self._ProbeAndFlashDevice,
+                args=(serial, campaign_common, result_queue))
+            jobs.append(p)
+            p.start()
+
+        results = {}
+        while len(results) < len(jobs):
+            if not any(job.is_alive() for job in jobs) and result_queue.empty():
+                break
+            try:
+                serial, product, ret_device = result_queue.get(timeout=1)
+            except Queue.Empty:
                 continue
-            flash_command_list.append(flash_commands)
-
-        ret = self.onecmd(flash_command_list)
+            results[serial] = ret_device
+            if product != "error":
+                self._device_products[serial] = product
+        for job in jobs:
+            job.join()
+
+        # A child killed or crashed before putting its result is a failure.
+        ret = None
+        if (False in results.values() or len(results) < len(jobs)
+                or any(job.exitcode != 0 for job in jobs)):
+            ret = False
         if ret == False:
             logging.error("Flash failed on device %s.", self._serials)
         else:
@@ -781,6 +1198,72 @@ class Console(cmd.Cmd):
 
         return ret
 
+    def _ProbeProduct(self, serial):
+        """Reboots a device to bootloader and reads its product name.
+
+        The product is read from the device only once per session.
+
+        Args:
+            serial: string, the device serial.
+
+        Returns:
+            string, the product name. "error" if failed.
+        """
+        cmd_utils.ExecuteOneShellCommand("adb -s %s reboot bootloader" % serial)
+        if serial in self._device_products:
+            return self._device_products[serial]
+
+        _, stderr, retcode = cmd_utils.ExecuteOneShellCommand(
+            "fastboot -s %s getvar product" % serial)
+        if retcode == 0:
+            res = stderr.splitlines()[0].rstrip()
+            if ":" in res:
+                product = res.split(":")[1].strip()
+            elif "waiting for %s" % serial in res:
+                res = stderr.splitlines()[1].rstrip()
+                product = res.split(":")[1].strip()
+            else:
+                product = "error"
+        else:
+            product = "error"
+        return product
+
+    def _ProbeAndFlashDevice(self, serial, campaign_common, result_queue):
+        """Probes the product of a device and runs its flash commands.
+
+        Runs in a child process of FlashImgPackage.
+
+        Args:
+            serial: string, the device serial.
+            campaign_common: module, the loaded campaign_common module.
+            result_queue: multiprocessing.Queue, to which the tuple of
+                          (serial, product, result) is put. The result is
+                          False if flashing failed, None otherwise.
+        """
+        product = self._ProbeProduct(serial)
+        logging.info("Device %s product type: %s", serial, product)
+        flash_commands = []
+        if product in campaign_common.FLASH_COMMAND_EMITTER:
+            flash_commands.extend(
+                campaign_common.FLASH_COMMAND_EMITTER[product](
+                    serial, repacked_imageset=True))
+        elif product != "error":
+            flash_commands.append(
+                "flash --current --serial %s --skip-vbmeta=True" % serial)
+        else:
+            logging.error(
+                "Device %s does not exist. Omitting the flashing "
+                "to the device.", serial)
+            result_queue.put((serial, product, None))
+            return
+        flash_commands.append(
+            "dut --operation=wait_for_boot --serial=%s" % serial)
+
+        ret_queue = Queue.Queue()
+        self.onecmd(flash_commands, 2, ret_queue)
+        result_queue.put((serial, product,
+                          False if not ret_queue.empty() else None))
+
     def GetSerials(self):
         """Returns the serial numbers saved in the console.
 
@@ -804,14 +1287,23 @@ class Console(cmd.Cmd):
             self._job_pool.terminate()
             self._job_pool.join()
 
-    def StartJobThreadAndProcessPool(self):
-        """Starts a background thread to control leased jobs."""
+    def StartJobThreadAndProcessPool(self, flash_plan=False):
+        """Starts a background thread to control leased jobs.
+
+        Args:
+            flash_plan: bool, whether the leased jobs compile their flash
+                        commands with flash_plan.
+        """
         self._job_in_queue = multiprocessing.Queue()
         self._job_out_queue = multiprocessing.Queue()
+        self._running_jobs = multiprocessing.Value("i", 0)
+        self._job_admission = job_admission.JobAdmissionController(
+            common._MAX_LEASED_JOBS)
         self._job_pool = NonDaemonizedPool(
             common._MAX_LEASED_JOBS, JobMain,
             (self._vti_address, self._job_in_queue, self._job_out_queue,
-             self._device_status, self._password, self._hosts))
+             self._device_status, self._password, self._hosts,
+             self._running_jobs, flash_plan, self._schedules))
 
         self._job_thread = threading.Thread(target=self.JobThread)
         self._job_thread.daemon = True
@@ -819,6 +1311,7 @@ class Console(cmd.Cmd):
 
     def StopJobThreadAndProcessPool(self):
         """Terminates the thread and processes that runs the leased job."""
+        self.StopLeaseTrigger()
         if hasattr(self, "_job_thread"):
             self._job_thread.keep_running = False
             self._job_thread.join()
@@ -850,26 +1343,23 @@ class Console(cmd.Cmd):
             return
 
         if type(line) == list:
-            if depth == 1:  # 1 to use multi-threading
-                jobs = []
-                ret_queue = multiprocessing.Queue()
-                for sub_command in line:
-                    p = multiprocessing.Process(
-                        target=self.onecmd,
-                        args=(
-                            sub_command,
-                            depth + 1,
-                            ret_queue,
-                        ))
-                    jobs.append(p)
-                    p.start()
-                for job in jobs:
-                    job.join()
-
+            if depth == 1:  # 1 to run in the worker processes
+                state = self._GetWorkerState()
+                with self._worker_pool_lock:
+                    if not self._worker_pool:
+                        self._worker_pool = worker_pool.WorkerPool(
+                            self._RunCommandList,
+                            common.MAX_COMMAND_LIST_WORKERS)
+                    results = self._worker_pool.Run(
+                        [(state, sub_command) for sub_command in line])
                 ret_cmd_list = True
-                while not ret_queue.empty():
-                    ret_from_subprocess = ret_queue.get()
-                    ret_cmd_list = ret_cmd_list and ret_from_subprocess
+                for sub_command, result in zip(line, results):
+                    if (result.status != worker_pool.TASK_DONE or
+                            result.value is False):
+                        logging.error("Command list %s %s: %s", sub_command,
+                                      result.status, result.value or
+                                      result.exit_code)
+                        ret_cmd_list = False
                 if ret_cmd_list == False:
                     return False
             else:
@@ -892,6 +1382,96 @@ class Console(cmd.Cmd):
                 ret_out_queue.put(False)
             return False
 
+    def RunCommandGraph(self, graph):
+        """Runs the nodes of a command graph concurrently.
+
+        Args:
+            graph: a command_graph.CommandGraph object.
+
+        Returns:
+            True if all commands succeeded, False otherwise.
+        """
+        return graph.Run(self._RunCommandNode,
+                         common.MAX_COMMAND_GRAPH_THREADS)
+
+    def _RunCommandNode(self, node):
+        """Runs the commands of a command graph node in order.
+
+        Args:
+            node: a command_graph.CommandNode object.
+
+        Returns:
+            False if any command failed, True otherwise.
+        """
+        for command in node.commands:
+            if self.onecmd(command) == False:
+                return False
+        return True
+
+    def _GetWorkerState(self):
+        """Returns the state handed over to a command list in a worker.
+
+        Returns:
+            a dict, maps the names in _WORKER_STATE_ATTRS to the values
+            and "_build_provider" to a dict of the provider classes.
+        """
+        # The copy is pickled by the queue in another thread, while the
+        # command graph threads may modify the state.
+        with self._state_lock:
+            state = copy.deepcopy(
+                dict((name, getattr(self, name))
+                     for name in _WORKER_STATE_ATTRS if hasattr(self, name)))
+        # The providers own temporary directories, so the worker creates
+        # its own ones of the same types.
+        state["_build_provider"] = dict(
+            (name, type(provider))
+            for name, provider in self._build_provider.items())
+        return state
+
+    def _RunCommandList(self, task):
+        """Runs a command list in a worker process.
+
+        The state of the parent console is restored first, so that the
+        worker runs as if it were forked just now.
+
+        Args:
+            task: a tuple of (state, command list) where the state is from
+                  _GetWorkerState.
+
+        Returns:
+            False if any command failed, True otherwise.
+        """
+        state, sub_command = task
+        state = dict(state)
+        # The inherited lock may have been held by another thread at fork.
+        self._state_lock = threading.RLock()
+        provider_types = state.pop("_build_provider", {})
+        for name, value in state.items():
+            if isinstance(value, build_info.BuildInfo):
+                # Bypasses BuildInfo.__setitem__ which deletes the files
+                # of the replaced items.
+                restored = build_info.BuildInfo()
+                dict.update(restored, value)
+                value = restored
+            setattr(self, name, value)
+        # The prefetcher of the parent is not a child of this process. The
+        # prefetch store tells whether the artifacts are being prefetched.
+        self._prefetch_process = None
+        # The inherited providers are kept aside rather than deleted, as
+        # deleting them would remove the directories of the parent.
+        inherited_providers = self._build_provider
+        self._build_provider = dict(
+            (name, provider_type())
+            for name, provider_type in provider_types.items())
+        try:
+            ret_queue = Queue.Queue()
+            self.onecmd(sub_command, 2, ret_queue)
+            return ret_queue.empty()
+        finally:
+            for provider in self._build_provider.values():
+                provider.__del__()
+            self._build_provider = inherited_providers
+
     # @Override
     def emptyline(self):
         """Ignores empty lines."""
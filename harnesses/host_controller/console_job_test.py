@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+try:
+    import StringIO as string_io_module
+except ImportError:
+    import io as string_io_module
+
+from host_controller.campaigns import command_graph
+from host_controller import common
+from host_controller import console
+
+
+class _FakeBuildProvider(object):
+    """A build provider which records whether it is deleted."""
+
+    def __init__(self):
+        self.deleted = False
+
+    def __del__(self):
+        self.deleted = True
+
+
+class ConsoleJobTest(unittest.TestCase):
+    """Tests for the paths of console.Console that run the leased jobs.
+
+    Attribute:
+        _out_file: The console output buffer.
+        _console: The console being tested.
+    """
+
+    def setUp(self):
+        """Creates the console."""
+        self._out_file = string_io_module.StringIO()
+        self._console = console.Console(
+            mock.Mock(),
+            mock.Mock(),
+            mock.Mock(), [mock.Mock()],
+            None,
+            out_file=self._out_file)
+        self._console.device_image_info = {}
+
+    def tearDown(self):
+        """Closes the output file."""
+        self._out_file.close()
+
+    @mock.patch('host_controller.console.cmd_utils')
+    def testProbeProductCached(self, mock_cmd_utils):
+        mock_cmd_utils.ExecuteOneShellCommand.return_value = (
+            "", "product: walleye\nFinished. Total time: 0.001s", 0)
+        self.assertEqual("walleye", self._console._ProbeProduct("ABC001"))
+        self._console._device_products["ABC001"] = "walleye"
+        mock_cmd_utils.ExecuteOneShellCommand.reset_mock()
+        self.assertEqual("walleye", self._console._ProbeProduct("ABC001"))
+        mock_cmd_utils.ExecuteOneShellCommand.assert_called_once_with(
+            "adb -s ABC001 reboot bootloader")
+
+    def testProbeAndFlashDevice(self):
+        campaign_common = mock.Mock()
+        campaign_common.FLASH_COMMAND_EMITTER = {
+            "sdm845": lambda serial, repacked_imageset: [
+                "fastboot -s %s reboot" % serial]
+        }
+        self._console._ProbeProduct = mock.Mock(return_value="sdm845")
+        self._console.onecmd = mock.Mock()
+        result_queue = mock.Mock()
+        self._console._ProbeAndFlashDevice("ABC001", campaign_common,
+                                           result_queue)
+        self._console.onecmd.assert_called_once_with(
+            ["fastboot -s ABC001 reboot",
+             "dut --operation=wait_for_boot --serial=ABC001"], 2, mock.ANY)
+        result_queue.put.assert_called_with(("ABC001", "sdm845", None))
+
+    @mock.patch("host_controller.console.imp")
+    @mock.patch("host_controller.console.multiprocessing")
+    def testFlashImgPackageChildCrashed(self, mock_multiprocessing,
+                                        mock_imp):
+        """Tests that a child exiting without a result fails the flash."""
+        result_queue = console.Queue.Queue()
+        mock_multiprocessing.Queue.return_value = result_queue
+        processes = [
+            mock.Mock(exitcode=0, is_alive=mock.Mock(return_value=False)),
+            mock.Mock(exitcode=-9, is_alive=mock.Mock(return_value=False))
+        ]
+        mock_multiprocessing.Process.side_effect = processes
+        processes[0].start.side_effect = (
+            lambda: result_queue.put(("ABC001", "walleye", None)))
+        self._console.onecmd = mock.Mock()
+        self._console.device_image_info = {common.FULL_ZIPFILE: "img.zip"}
+        self._console._serials = ["ABC001", "ABC002"]
+        self.assertFalse(self._console.FlashImgPackage("gs://img.zip"))
+
+        processes[1].exitcode = 0
+        mock_multiprocessing.Process.side_effect = processes
+        self.assertFalse(self._console.FlashImgPackage("gs://img.zip"))
+
+        processes[1].start.side_effect = (
+            lambda: result_queue.put(("ABC002", "walleye", None)))
+        mock_multiprocessing.Process.side_effect = processes
+        self.assertIsNone(self._console.FlashImgPackage("gs://img.zip"))
+
+    @mock.patch("host_controller.console.prestage")
+    @mock.patch("host_controller.console.multiprocessing")
+    def testStartPrestaging(self, mock_multiprocessing, mock_prestage):
+        """Tests recording the pre-stager before it touches the device."""
+        calls = mock.Mock()
+        store = calls.store
+        mock_multiprocessing.Event.return_value = calls.started
+        mock_multiprocessing.Process.return_value = calls.process
+        calls.process.pid = 1234
+        mock_prestage.GetProduct.return_value = "walleye"
+        mock_prestage.ResolveIdentity.return_value = {"build_id": "1"}
+        self.assertTrue(
+            self._console.StartPrestaging(
+                "ABC001", {"build_target": "walleye-userdebug"}, store))
+        self.assertEqual([
+            mock.call.process.start(),
+            mock.call.store.SetActive("ABC001", 1234, "walleye",
+                                      {"build_id": "1"}),
+            mock.call.started.set()
+        ], [call for call in calls.mock_calls if call[0] != "process.pid"])
+        self.assertIs(calls.started,
+                      mock_multiprocessing.Process.call_args[1]["args"][-1])
+
+    @mock.patch("host_controller.console.campaign_common")
+    @mock.patch("host_controller.console.vti_endpoint_client")
+    @mock.patch("host_controller.console.Console")
+    @mock.patch("host_controller.console.prestage")
+    @mock.patch("host_controller.console.signal")
+    @mock.patch("host_controller.console.os.setpgrp")
+    def testPrestageMainDeviceLocked(self, mock_setpgrp, mock_signal,
+                                     mock_prestage, mock_console_class,
+                                     mock_vti_endpoint_client,
+                                     mock_campaign_common):
+        """Tests that a pre-stager does not touch a locked device."""
+        mock_console = mock_console_class.return_value
+        mock_console.file_lock.LockDevice.return_value = False
+        store = mock_prestage.PrestageStore.return_value
+        started = mock.Mock()
+        console.PrestageMain("vti", [], "ABC001", {}, "store_dir", started)
+        started.wait.assert_called_once_with(
+            common.PRESTAGE_START_TIMEOUT_SECS)
+        mock_console.onecmd.assert_not_called()
+        mock_console.file_lock.UnlockDevice.assert_not_called()
+        store.ClearActive.assert_called_once_with("ABC001", mock.ANY)
+
+        mock_console.file_lock.LockDevice.return_value = True
+        mock_campaign_common.EmitFetchCommands.return_value = (["fetch"],
+                                                               None)
+        mock_campaign_common.EmitFlashCommands.return_value = ["flash"]
+        mock_console.onecmd.return_value = None
+        console.PrestageMain("vti", [], "ABC001", {}, "store_dir", started)
+        mock_console.onecmd.assert_has_calls(
+            [mock.call("fetch"), mock.call("flash")])
+        mock_console.file_lock.UnlockDevice.assert_called_once_with(
+            "ABC001")
+
+    @mock.patch("host_controller.console.worker_pool.WorkerPool")
+    def testCommandListsInWorkerPool(self, mock_pool_class):
+        """Tests running the command lists in the worker pool."""
+        pool = mock_pool_class.return_value
+        pool.Run.return_value = [
+            console.worker_pool.TaskResult(console.worker_pool.TASK_DONE,
+                                           True, 0),
+            console.worker_pool.TaskResult(console.worker_pool.TASK_CRASHED,
+                                           None, -9)
+        ]
+        self._console._serials = ["ABC001"]
+        result = self._console.onecmd([["info"], ["info"]])
+        self.assertFalse(result)
+        tasks = pool.Run.call_args[0][0]
+        self.assertEqual([["info"], ["info"]], [task[1] for task in tasks])
+        self.assertEqual(["ABC001"], tasks[0][0]["_serials"])
+
+        pool.Run.return_value[1] = console.worker_pool.TaskResult(
+            console.worker_pool.TASK_DONE, True, 0)
+        self.assertNotEqual(False,
+                            self._console.onecmd([["info"], ["info"]]))
+        mock_pool_class.assert_called_once_with(
+            self._console._RunCommandList, common.MAX_COMMAND_LIST_WORKERS)
+
+    def testRunCommandList(self):
+        """Tests restoring the state and running a command list."""
+        self._console.onecmd = mock.Mock(
+            side_effect=lambda line, depth, queue: queue.put(False))
+        result = self._console._RunCommandList(({
+            "_serials": ["ABC002"]
+        }, ["info"]))
+        self.assertFalse(result)
+        self.assertEqual(["ABC002"], self._console._serials)
+        self._console.onecmd.assert_called_once_with(["info"], 2, mock.ANY)
+
+    def testRunCommandListWithNewProviders(self):
+        """Tests running a command list with the providers of the task."""
+        inherited_provider = _FakeBuildProvider()
+        self._console._build_provider = {"pab": inherited_provider}
+        self._console._prefetch_process = mock.Mock()
+        state = self._console._GetWorkerState()
+        self.assertEqual({"pab": _FakeBuildProvider},
+                         state["_build_provider"])
+
+        providers = []
+
+        def _RecordProvider(line, depth, queue):
+            providers.append(self._console._build_provider["pab"])
+            self.assertIsNone(self._console._prefetch_process)
+
+        self._console.onecmd = mock.Mock(side_effect=_RecordProvider)
+        self.assertTrue(self._console._RunCommandList((state, ["info"])))
+        self.assertTrue(self._console._RunCommandList((state, ["info"])))
+        self.assertEqual(2, len(set(providers)))
+        self.assertNotIn(inherited_provider, providers)
+        self.assertTrue(all(provider.deleted for provider in providers))
+        self.assertFalse(inherited_provider.deleted)
+        self.assertEqual({"pab": inherited_provider},
+                         self._console._build_provider)
+
+    def testRunCommandGraph(self):
+        """Tests running the nodes of a command graph."""
+        graph = command_graph.CommandGraph()
+        graph.AddCommands(["fetch a", "fetch b"], [], ["image"])
+        graph.AddCommands(["flash"], ["image"], [])
+        self._console.onecmd = mock.Mock(return_value=None)
+        self.assertTrue(self._console.RunCommandGraph(graph))
+        self.assertEqual(
+            [mock.call("fetch a"), mock.call("fetch b"), mock.call("flash")],
+            self._console.onecmd.call_args_list)
+
+        self._console.onecmd = mock.Mock(return_value=False)
+        self.assertFalse(self._console.RunCommandGraph(graph))
+        self._console.onecmd.assert_called_once_with("fetch a")
+
+    def testGetWorkerStateSnapshot(self):
+        """Tests that the worker state is not shared with the console."""
+        self._console.fetch_info = {"build_id": "1"}
+        self._console.device_image_info = console.build_info.BuildInfo()
+        dict.__setitem__(self._console.device_image_info, "system.img",
+                         "/tmp/system.img")
+        state = self._console._GetWorkerState()
+        self._console.fetch_info["build_id"] = "2"
+        dict.__setitem__(self._console.device_image_info, "vendor.img",
+                         "/tmp/vendor.img")
+        self.assertEqual({"build_id": "1"}, state["fetch_info"])
+        self.assertEqual({"system.img": "/tmp/system.img"},
+                         state["device_image_info"])
+        self.assertIsInstance(state["device_image_info"],
+                              console.build_info.BuildInfo)
+
+    @mock.patch("host_controller.console.multiprocessing.Process")
+    @mock.patch("host_controller.console.prestage")
+    def testStartPrefetching(self, mock_prestage, mock_process_class):
+        """Tests prefetching the next job once per leased job."""
+        self.assertFalse(self._console.StartPrefetching(["ABC001"]))
+
+        job = {"build_target": ["sailfish-userdebug"]}
+        mock_prestage.GetJobArtifacts.return_value = [{"branch": "git_p"}]
+        mock_process_class.return_value.pid = 1234
+        self._console.SetLeasedJob(job)
+        self.assertTrue(self._console.StartPrefetching(["ABC001"]))
+        self.assertFalse(self._console.StartPrefetching(["ABC001"]))
+        mock_process_class.return_value.start.assert_called_once_with()
+        store = mock_prestage.PrestageStore.return_value
+        store.SetPrefetch.assert_called_once_with(
+            "ABC001", 1234, [{"branch": "git_p"}])
+        mock_prestage.PredictPipelinedJob.assert_called_once_with(
+            job, [], store)
+
+        self._console.SetLeasedJob(job)
+        mock_prestage.GetJobArtifacts.return_value = []
+        self.assertFalse(self._console.StartPrefetching(["ABC001"]))
+
+    @mock.patch("host_controller.console.multiprocessing.util")
+    @mock.patch("host_controller.console.signal")
+    @mock.patch("host_controller.console.prestage")
+    @mock.patch("host_controller.console.vti_endpoint_client")
+    @mock.patch("host_controller.console.Console")
+    def testJobMainCancelsPrefetching(self, mock_console_class,
+                                      mock_vti_endpoint_client,
+                                      mock_prestage, mock_signal,
+                                      mock_util):
+        """Tests cancelling the prefetching which no job will claim."""
+        mock_console = mock_console_class.return_value
+        mock_console._build_provider = {}
+        mock_console.ProcessConfigurableScript.return_value = (False, "url")
+        vti_client = mock_vti_endpoint_client.VtiEndpointClient.return_value
+        vti_client.LeaseJob.return_value = ("job.py", {"serial": ["ABC001"]})
+        mock_prestage.ClaimPrestagedDevices.return_value = {}
+        store = mock_prestage.PrestageStore.return_value
+        in_queue = mock.Mock()
+        in_queue.get.side_effect = ["lease", "exit"]
+        schedules = [mock.Mock()]
+        console.JobMain("vti", in_queue, mock.Mock(), {}, mock.Mock(), [],
+                        schedules=schedules)
+        self.assertIs(schedules, mock_console._schedules)
+        self.assertEqual(
+            [mock.call("ABC001", store), mock.call("ABC001")],
+            mock_prestage.CancelPrefetching.call_args_list)
+        mock_console.SetLeasedJob.assert_called_with(None)
+
+    @mock.patch("host_controller.console.multiprocessing.util")
+    @mock.patch("host_controller.console.signal")
+    @mock.patch("host_controller.console.prestage")
+    @mock.patch("host_controller.console.vti_endpoint_client")
+    @mock.patch("host_controller.console.Console")
+    def testJobMainPrestagedWithoutFlashPlan(self, mock_console_class,
+                                             mock_vti_endpoint_client,
+                                             mock_prestage, mock_signal,
+                                             mock_util):
+        """Tests the fetch info of a pre-staged job without flash_plan."""
+        mock_console = mock_console_class.return_value
+        mock_console._build_provider = {}
+        mock_console._detailed_fetch_info = {}
+        vti_client = mock_vti_endpoint_client.VtiEndpointClient.return_value
+        vti_client.LeaseJob.return_value = ("job.py", {"serial": ["ABC001"]})
+        prestaged_fetch_info = {
+            common._ARTIFACT_TYPE_DEVICE: {
+                "branch": "git_p",
+                "build_id": "1"
+            }
+        }
+        mock_prestage.ClaimPrestagedDevices.return_value = (
+            prestaged_fetch_info)
+        in_queue = mock.Mock()
+        in_queue.get.side_effect = ["lease", "exit"]
+        detailed_fetch_info = []
+        mock_console.ProcessConfigurableScript.side_effect = (
+            lambda path, **kwargs: detailed_fetch_info.append(
+                dict(mock_console._detailed_fetch_info)) or (True, "url"))
+        console.JobMain("vti", in_queue, mock.Mock(), {}, mock.Mock(), [])
+        self.assertEqual([prestaged_fetch_info], detailed_fetch_info)
+        kwargs = mock_console.ProcessConfigurableScript.call_args[1]
+        self.assertTrue(kwargs["prestaged"])
+        self.assertNotIn("flash_plan", kwargs)
+
+    @mock.patch("host_controller.console.multiprocessing.util")
+    @mock.patch("host_controller.console.signal")
+    @mock.patch("host_controller.console.prestage")
+    @mock.patch("host_controller.console.vti_endpoint_client")
+    @mock.patch("host_controller.console.Console")
+    def testJobMainMarksDevicesBeforePrefetching(self, mock_console_class,
+                                                 mock_vti_endpoint_client,
+                                                 mock_prestage, mock_signal,
+                                                 mock_util):
+        """Tests marking the devices in use before waiting for prefetching."""
+        mock_console = mock_console_class.return_value
+        mock_console._build_provider = {}
+        mock_console.ProcessConfigurableScript.return_value = (True, "url")
+        vti_client = mock_vti_endpoint_client.VtiEndpointClient.return_value
+        vti_client.LeaseJob.return_value = ("job.py", {
+            "serial": ["ABC001"],
+            "test_name": "vts/vts"
+        })
+        mock_prestage.ClaimPrestagedDevices.return_value = {}
+        store = mock_prestage.PrestageStore.return_value
+        manager = mock.Mock()
+        manager.attach_mock(mock_prestage, "prestage")
+        manager.attach_mock(mock_console.ChangeDeviceState,
+                            "ChangeDeviceState")
+        in_queue = mock.Mock()
+        in_queue.get.side_effect = ["lease", "exit"]
+        console.JobMain("vti", in_queue, mock.Mock(), {}, mock.Mock(), [])
+        calls = [
+            call for call in manager.mock_calls
+            if call[0] in ("prestage.ClaimPrestagedDevices",
+                           "ChangeDeviceState",
+                           "prestage.ClaimPrefetchedArtifacts")
+        ]
+        kwargs = vti_client.LeaseJob.return_value[1]
+        self.assertEqual([
+            mock.call.prestage.ClaimPrestagedDevices(kwargs, store),
+            mock.call.ChangeDeviceState(
+                "ABC001", common._DEVICE_STATUS_DICT["use"],
+                job_id="vts/vts"),
+            mock.call.prestage.ClaimPrefetchedArtifacts(kwargs, store),
+        ], calls[:3])
+
+    @mock.patch("host_controller.console.multiprocessing.Process")
+    @mock.patch("host_controller.console.prestage")
+    def testStartPrefetchingOncePerDevice(self, mock_prestage,
+                                          mock_process_class):
+        """Tests skipping the devices prefetched by another console."""
+        artifacts = [{"branch": "git_p"}]
+        mock_prestage.GetJobArtifacts.return_value = artifacts
+        mock_process_class.return_value.pid = 1234
+        store = mock_prestage.PrestageStore.return_value
+        store.GetPrefetch.side_effect = lambda serial: {
+            "ABC001": {"pid": 1000, "artifacts": artifacts, "running": True},
+            "ABC002": {"pid": 1000, "artifacts": [], "running": False},
+        }.get(serial)
+        self._console.SetLeasedJob({"build_target": ["sailfish-userdebug"]})
+        self.assertFalse(self._console.StartPrefetching(["ABC001"]))
+        mock_process_class.assert_not_called()
+
+        self.assertTrue(
+            self._console.StartPrefetching(["ABC001", "ABC002", "ABC003"]))
+        self.assertEqual(
+            (mock_prestage.PredictPipelinedJob.return_value,
+             ["ABC002", "ABC003"], store.store_dir),
+            mock_process_class.call_args[1]["args"])
+        store.SetPrefetch.assert_has_calls([
+            mock.call("ABC002", 1234, artifacts),
+            mock.call("ABC003", 1234, artifacts)
+        ])
+
+    def testAdmitJob(self):
+        """Tests counting the queued leases as running jobs."""
+        self.assertTrue(self._console.AdmitJob())
+
+        self._console._job_admission = mock.Mock()
+        self._console._job_admission.Admit.return_value = False
+        self._console._running_jobs = mock.Mock(value=2)
+        self._console._job_in_queue = mock.Mock()
+        self._console._job_in_queue.qsize.return_value = 1
+        self.assertFalse(self._console.AdmitJob())
+        self._console._job_admission.Admit.assert_called_once_with(3)
+
+    @mock.patch("host_controller.console.lease_trigger")
+    def testLeaseForReleasedDevices(self, mock_lease_trigger):
+        """Tests leasing a job when the trigger fires."""
+        self.assertFalse(self._console.StartLeaseTrigger())
+
+        self._console._job_admission = mock.Mock()
+        self._console._job_admission.Admit.return_value = True
+        self._console._running_jobs = mock.Mock(value=0)
+        self._console._job_in_queue = mock.Mock()
+        self._console._job_in_queue.qsize.return_value = 0
+        self._console.StartLeaseTrigger()
+        mock_trigger = mock_lease_trigger.LeaseTrigger.return_value
+        mock_trigger.Start.assert_called_once_with()
+
+        lease = mock_lease_trigger.LeaseTrigger.call_args[0][1]
+        self.assertTrue(lease(["serial1"]))
+        self._console._job_in_queue.put.assert_called_once_with("lease")
+        self._console.StopLeaseTrigger()
+        mock_trigger.Stop.assert_called_once_with()
+
+
+if __name__ == "__main__":
+    unittest.main()
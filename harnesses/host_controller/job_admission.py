@@ -0,0 +1,348 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from host_controller import common
+
+# The host resources whose utilization limits the leased jobs.
+RESOURCE_CPU = "cpu"
+RESOURCE_MEMORY = "memory"
+RESOURCE_DISK = "disk"
+RESOURCE_NETWORK = "network"
+RESOURCES = (RESOURCE_CPU, RESOURCE_MEMORY, RESOURCE_DISK, RESOURCE_NETWORK)
+
+ACTION_INCREASE = "increase"
+ACTION_DECREASE = "decrease"
+ACTION_HOLD = "hold"
+
+# Prefixes of the block devices which are not physical disks.
+_VIRTUAL_DISK_PREFIXES = ("loop", "ram", "zram", "dm-", "md", "sr")
+
+
+class ResourceSampler(object):
+    """Measures the utilization of the host resources from procfs.
+
+    CPU, disk and network utilization are averaged over the time since the
+    previous sample, so they are None in the first sample.
+
+    Attributes:
+        _proc_root: string, the mount point of procfs.
+        _sys_root: string, the mount point of sysfs.
+        _clock: function returning the current time in seconds.
+        _last_time: float, the time of the previous sample.
+        _last_cpu: tuple of (busy, total) CPU ticks of the previous sample.
+        _last_disk: dict, maps a disk name to the milliseconds it has spent
+                    doing I/O at the previous sample.
+        _last_network: dict, maps an interface to its (received, sent)
+                       bytes at the previous sample.
+    """
+
+    def __init__(self, proc_root="/proc", sys_root="/sys", clock=time.time):
+        self._proc_root = proc_root
+        self._sys_root = sys_root
+        self._clock = clock
+        self._last_time = None
+        self._last_cpu = None
+        self._last_disk = None
+        self._last_network = None
+
+    def _ReadLines(self, root, *path):
+        """Returns the lines of a file. An empty list if unreadable."""
+        try:
+            with open(os.path.join(root, *path), "r") as proc_file:
+                return proc_file.read().splitlines()
+        except IOError:
+            return []
+
+    def _ReadCpu(self):
+        """Returns the busy and the total CPU ticks."""
+        for line in self._ReadLines(self._proc_root, "stat"):
+            fields = line.split()
+            if fields and fields[0] == "cpu":
+                ticks = [int(field) for field in fields[1:]]
+                # idle and iowait
+                idle = sum(ticks[3:5])
+                return sum(ticks) - idle, sum(ticks)
+        return None
+
+    def _ReadMemory(self):
+        """Returns the fraction of the memory not available."""
+        meminfo = {}
+        for line in self._ReadLines(self._proc_root, "meminfo"):
+            fields = line.replace(":", " ").split()
+            if len(fields) >= 2:
+                meminfo[fields[0]] = int(fields[1])
+        total = meminfo.get("MemTotal")
+        available = meminfo.get("MemAvailable", meminfo.get("MemFree"))
+        if not total or available is None:
+            return None
+        return 1.0 - float(available) / total
+
+    def _ReadDisks(self):
+        """Returns a dict mapping a physical disk to its I/O milliseconds."""
+        disks = {}
+        for line in self._ReadLines(self._proc_root, "diskstats"):
+            fields = line.split()
+            if len(fields) < 13 or fields[2].startswith(
+                    _VIRTUAL_DISK_PREFIXES):
+                continue
+            # Partitions are not listed in sysfs block class.
+            if not os.path.isdir(
+                    os.path.join(self._sys_root, "block", fields[2])):
+                continue
+            disks[fields[2]] = int(fields[12])
+        return disks
+
+    def _ReadNetwork(self):
+        """Returns a dict mapping an interface to its received/sent bytes."""
+        interfaces = {}
+        for line in self._ReadLines(self._proc_root, "net", "dev"):
+            if ":" not in line:
+                continue
+            name, counters = line.split(":", 1)
+            name = name.strip()
+            fields = counters.split()
+            if name == "lo" or len(fields) < 9:
+                continue
+            interfaces[name] = (int(fields[0]), int(fields[8]))
+        return interfaces
+
+    def _GetLinkBytesPerSec(self, interface):
+        """Returns the link speed of an interface. None if unknown."""
+        lines = self._ReadLines(self._sys_root, "class", "net", interface,
+                                "speed")
+        try:
+            speed_mbps = int(lines[0])
+        except (IndexError, ValueError):
+            return None
+        return speed_mbps * 1000000 / 8.0 if speed_mbps > 0 else None
+
+    def Sample(self):
+        """Measures the resource utilization.
+
+        Returns:
+            a dict mapping each of RESOURCES to the utilization between 0
+            and 1, or None if not measurable. The disk and network
+            utilization is of the busiest disk and interface.
+        """
+        now = self._clock()
+        cpu = self._ReadCpu()
+        disks = self._ReadDisks()
+        network = self._ReadNetwork()
+        usage = dict((resource, None) for resource in RESOURCES)
+        usage[RESOURCE_MEMORY] = self._ReadMemory()
+
+        elapsed = now - self._last_time if self._last_time else 0
+        if elapsed > 0:
+            if cpu and self._last_cpu and cpu[1] > self._last_cpu[1]:
+                usage[RESOURCE_CPU] = (float(cpu[0] - self._last_cpu[0]) /
+                                       (cpu[1] - self._last_cpu[1]))
+            disk_usage = [
+                (ticks - self._last_disk[name]) / (elapsed * 1000.0)
+                for name, ticks in disks.items() if name in self._last_disk
+            ]
+            if disk_usage:
+                usage[RESOURCE_DISK] = min(1.0, max(disk_usage))
+            network_usage = []
+            for name, counters in network.items():
+                link_bytes = self._GetLinkBytesPerSec(name)
+                if name not in self._last_network or not link_bytes:
+                    continue
+                last_counters = self._last_network[name]
+                network_usage.append(
+                    max(counters[0] - last_counters[0],
+                        counters[1] - last_counters[1]) / elapsed /
+                    link_bytes)
+            if network_usage:
+                usage[RESOURCE_NETWORK] = min(1.0, max(network_usage))
+
+        self._last_time = now
+        self._last_cpu = cpu
+        self._last_disk = disks
+        self._last_network = network
+        return usage
+
+
+class JobAdmissionController(object):
+    """Adapts the number of concurrently running leased jobs to the host.
+
+    The limit is raised by one while the running jobs reach it and every
+    resource has headroom below its ceiling, and lowered by one below the
+    running jobs while any resource is over its ceiling.
+
+    Attributes:
+        max_jobs: int, the ceiling of the number of running jobs.
+        min_jobs: int, the floor of the number of running jobs.
+        ceilings: dict, maps each of RESOURCES to the maximum utilization
+                  between 0 and 1.
+        _sampler: ResourceSampler object.
+        _limit: int, the current number of jobs allowed to run.
+        _usage: dict, the last sampled utilization.
+        _running: int, the number of running jobs at the last update.
+        _counters: dict, maps a counter name to its value.
+        _decisions: deque of dicts, the recent changes of the limit.
+        _lock: threading.Lock protecting the attributes.
+    """
+
+    def __init__(self,
+                 max_jobs,
+                 min_jobs=1,
+                 ceilings=None,
+                 initial_jobs=None,
+                 sampler=None):
+        self.max_jobs = max_jobs
+        self.min_jobs = min_jobs
+        self.ceilings = dict(common.JOB_ADMISSION_CEILINGS)
+        self.ceilings.update(ceilings or {})
+        self._sampler = sampler or ResourceSampler()
+        if initial_jobs is None:
+            initial_jobs = multiprocessing.cpu_count() // 2
+        self._limit = max(min_jobs, min(max_jobs, initial_jobs))
+        self._usage = dict((resource, None) for resource in RESOURCES)
+        self._running = 0
+        self._counters = {
+            "admitted": 0,
+            "rejected": 0,
+            ACTION_INCREASE: 0,
+            ACTION_DECREASE: 0,
+        }
+        self._decisions = collections.deque(
+            maxlen=common.JOB_ADMISSION_HISTORY)
+        self._lock = threading.Lock()
+
+    def Configure(self, max_jobs=None, ceilings=None):
+        """Changes the ceilings.
+
+        Args:
+            max_jobs: int, the ceiling of the number of running jobs.
+                      None to keep.
+            ceilings: dict, maps some of RESOURCES to the new ceilings.
+        """
+        with self._lock:
+            if max_jobs is not None:
+                self.max_jobs = max(self.min_jobs, max_jobs)
+                self._limit = min(self._limit, self.max_jobs)
+            self.ceilings.update(ceilings or {})
+            logging.info("Job admission ceilings: max_jobs=%d %s",
+                         self.max_jobs, self.ceilings)
+
+    def Update(self, running_jobs):
+        """Samples the resources and adjusts the limit.
+
+        Args:
+            running_jobs: int, the number of jobs running or being leased.
+
+        Returns:
+            int, the new limit.
+        """
+        usage = self._sampler.Sample()
+        with self._lock:
+            self._usage = usage
+            self._running = running_jobs
+            over = sorted(
+                resource for resource, value in usage.items()
+                if value is not None and value > self.ceilings[resource])
+            busy = sorted(
+                resource for resource, value in usage.items()
+                if value is not None and value >
+                self.ceilings[resource] * common.JOB_ADMISSION_HEADROOM)
+            limit = self._limit
+            if over:
+                action = ACTION_DECREASE
+                limit = max(self.min_jobs, min(limit, running_jobs) - 1)
+                reason = "%s over the ceiling" % ", ".join(over)
+            elif busy:
+                action = ACTION_HOLD
+                reason = "%s near the ceiling" % ", ".join(busy)
+            elif running_jobs >= limit:
+                action = ACTION_INCREASE
+                limit = min(self.max_jobs, limit + 1)
+                reason = "all resources have headroom"
+            else:
+                action = ACTION_HOLD
+                reason = "the limit is not reached"
+
+            if limit != self._limit:
+                self._counters[action] += 1
+                self._decisions.append({
+                    "time": time.time(),
+                    "action": action,
+                    "limit": limit,
+                    "running": running_jobs,
+                    "reason": reason,
+                    "usage": usage,
+                })
+                logging.info("Job limit %s from %d to %d (%d running): %s. "
+                             "Utilization %s", action, self._limit, limit,
+                             running_jobs, reason, _FormatUsage(usage))
+            else:
+                logging.debug("Job limit %d held (%d running): %s", limit,
+                              running_jobs, reason)
+            self._limit = limit
+            return limit
+
+    def Admit(self, running_jobs):
+        """Decides whether one more job can be leased.
+
+        Args:
+            running_jobs: int, the number of jobs running or being leased.
+
+        Returns:
+            True if the job can be leased.
+        """
+        limit = self.Update(running_jobs)
+        with self._lock:
+            admitted = running_jobs < limit
+            self._counters["admitted" if admitted else "rejected"] += 1
+        if not admitted:
+            logging.info("Not leasing a job; %d of %d jobs running.",
+                         running_jobs, limit)
+        return admitted
+
+    def GetStatus(self):
+        """Returns the metrics of the controller.
+
+        Returns:
+            a dict with limit, max_jobs, min_jobs, running, usage,
+            ceilings, the counters, and decisions which is a list of the
+            recent changes of the limit, oldest first.
+        """
+        with self._lock:
+            status = {
+                "limit": self._limit,
+                "max_jobs": self.max_jobs,
+                "min_jobs": self.min_jobs,
+                "running": self._running,
+                "usage": dict(self._usage),
+                "ceilings": dict(self.ceilings),
+                "decisions": list(self._decisions),
+            }
+            status.update(self._counters)
+            return status
+
+
+def _FormatUsage(usage):
+    """Returns the utilization as a string of percentages."""
+    return " ".join(
+        "%s=%s" % (resource, "-" if usage.get(resource) is None else
+                   "%d%%" % (usage[resource] * 100))
+        for resource in RESOURCES)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from host_controller import job_admission
+
+_NET_DEV_HEADER = (
+    "Inter-|   Receive                            |  Transmit\n"
+    " face |bytes    packets errs drop fifo frame compressed multicast"
+    "|bytes    packets errs drop fifo colls carrier compressed\n")
+
+
+class JobAdmissionTest(unittest.TestCase):
+    """Tests for ResourceSampler and JobAdmissionController."""
+
+    def setUp(self):
+        """Creates fake procfs and sysfs."""
+        self._temp_dir = tempfile.mkdtemp()
+        self._proc = os.path.join(self._temp_dir, "proc")
+        self._sys = os.path.join(self._temp_dir, "sys")
+        os.makedirs(os.path.join(self._proc, "net"))
+        os.makedirs(os.path.join(self._sys, "block", "sda"))
+        os.makedirs(os.path.join(self._sys, "class", "net", "eth0"))
+        self._WriteFile(self._sys, "class/net/eth0/speed", "1000\n")
+        self._time = 100.0
+        self._sampler = job_admission.ResourceSampler(
+            self._proc, self._sys, clock=lambda: self._time)
+
+    def tearDown(self):
+        """Deletes the temp dir."""
+        shutil.rmtree(self._temp_dir)
+
+    def _WriteFile(self, root, path, content):
+        """Writes a file in the fake file system."""
+        with open(os.path.join(root, path), "w") as fake_file:
+            fake_file.write(content)
+
+    def _WriteProc(self, busy, idle, available, io_ms, sent):
+        """Writes the fake procfs counters."""
+        self._WriteFile(self._proc, "stat",
+                        "cpu  %d 0 0 %d 0 0 0 0 0 0\ncpu0 1 0 0 1\n" %
+                        (busy, idle))
+        self._WriteFile(self._proc, "meminfo",
+                        "MemTotal:  1000 kB\nMemFree:  100 kB\n"
+                        "MemAvailable:  %d kB\n" % available)
+        self._WriteFile(
+            self._proc, "diskstats",
+            "   8  0 sda 1 0 0 0 1 0 0 0 0 %d %d\n"
+            "   8  1 sda1 1 0 0 0 1 0 0 0 0 9999 9999\n"
+            "   7  0 loop0 1 0 0 0 1 0 0 0 0 9999 9999\n" % (io_ms, io_ms))
+        self._WriteFile(
+            self._proc, "net/dev", _NET_DEV_HEADER +
+            "    lo: 9999 0 0 0 0 0 0 0 9999 0 0 0 0 0 0 0\n"
+            "  eth0: 0 0 0 0 0 0 0 0 %d 0 0 0 0 0 0 0\n" % sent)
+
+    def testSample(self):
+        """Tests the utilization computed from two samples."""
+        self._WriteProc(busy=100, idle=100, available=500, io_ms=0, sent=0)
+        usage = self._sampler.Sample()
+        self.assertEqual(0.5, usage[job_admission.RESOURCE_MEMORY])
+        self.assertIsNone(usage[job_admission.RESOURCE_CPU])
+        self.assertIsNone(usage[job_admission.RESOURCE_DISK])
+
+        self._time += 2
+        self._WriteProc(
+            busy=175, idle=125, available=250, io_ms=1000, sent=125000000)
+        usage = self._sampler.Sample()
+        self.assertEqual(0.75, usage[job_admission.RESOURCE_CPU])
+        self.assertEqual(0.75, usage[job_admission.RESOURCE_MEMORY])
+        self.assertEqual(0.5, usage[job_admission.RESOURCE_DISK])
+        self.assertEqual(0.5, usage[job_admission.RESOURCE_NETWORK])
+
+    def _CreateController(self, usage, **kwargs):
+        """Creates a controller whose sampler returns the usage."""
+        sampler = mock.Mock()
+        sampler.Sample.return_value = usage
+        return job_admission.JobAdmissionController(
+            4, initial_jobs=2, sampler=sampler, **kwargs)
+
+    def testAdmitIncrease(self):
+        """Tests raising the limit while the resources have headroom."""
+        controller = self._CreateController({"cpu": 0.1, "memory": 0.2})
+        self.assertTrue(controller.Admit(1))
+        self.assertTrue(controller.Admit(2))
+        self.assertTrue(controller.Admit(3))
+        self.assertFalse(controller.Admit(4))
+        status = controller.GetStatus()
+        self.assertEqual(4, status["limit"])
+        self.assertEqual(3, status["admitted"])
+        self.assertEqual(1, status["rejected"])
+        self.assertEqual(2, status[job_admission.ACTION_INCREASE])
+        self.assertEqual([3, 4],
+                         [decision["limit"]
+                          for decision in status["decisions"]])
+
+    def testAdmitDecrease(self):
+        """Tests lowering the limit while a resource is over its ceiling."""
+        controller = self._CreateController({"cpu": 0.1, "disk": 0.95})
+        self.assertFalse(controller.Admit(2))
+        self.assertFalse(controller.Admit(1))
+        status = controller.GetStatus()
+        self.assertEqual(1, status["limit"])
+        self.assertIn("disk", status["decisions"][0]["reason"])
+
+        controller.Configure(ceilings={"disk": 1.0})
+        self.assertEqual(1, controller.Update(1))
+        self.assertEqual(1, controller.GetStatus()["limit"])
+
+    def testConfigure(self):
+        """Tests lowering the maximum number of jobs."""
+        controller = self._CreateController({"cpu": 0.1})
+        controller.Configure(max_jobs=1, ceilings={"cpu": 0.05})
+        status = controller.GetStatus()
+        self.assertEqual(1, status["limit"])
+        self.assertEqual(0.05, status["ceilings"]["cpu"])
+        self.assertTrue(controller.Admit(0))
+        self.assertFalse(controller.Admit(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import threading
+import time
+
+from host_controller import common
+
+# The device status values in which a device can be leased for a job.
+IDLE_STATUS = (
+    common._DEVICE_STATUS_DICT["online"],
+    common._DEVICE_STATUS_DICT["ready"],
+)
+
+
+class LeaseTrigger(object):
+    """Leases a job as soon as devices are released.
+
+    Watches the device status table shared with the job pool processes. A
+    device is released when its status changes to idle from any other
+    status, e.g., when a job ends, a locked device is unlocked, or a device
+    recovers or is attached. The releases within the debounce time after
+    the first one are coalesced into one lease attempt, which is made only
+    if any of the released devices is still idle. The periodic device
+    update keeps leasing as the fallback.
+
+    Attributes:
+        _device_status: SharedStatusTable, the device status.
+        _lease: function, called with the list of the released serials to
+                lease a job. Returns True if a lease is requested.
+        _debounce_secs: float, the time to wait for more releases.
+        _poll_secs: float, the interval at which the thread checks whether
+                    to stop.
+        _thread: threading.Thread watching the device status.
+        _counters: dict, maps a counter name to its value.
+        _lock: threading.Lock protecting _counters.
+    """
+
+    def __init__(self,
+                 device_status,
+                 lease,
+                 debounce_secs=common.LEASE_TRIGGER_DEBOUNCE_SECS,
+                 poll_secs=1):
+        self._device_status = device_status
+        self._lease = lease
+        self._debounce_secs = debounce_secs
+        self._poll_secs = poll_secs
+        self._thread = None
+        self._counters = {"released": 0, "triggered": 0, "leased": 0}
+        self._lock = threading.Lock()
+
+    def IsRunning(self):
+        """Returns whether the thread is watching the device status."""
+        return bool(self._thread and self._thread.is_alive())
+
+    def Start(self):
+        """Starts watching the device status.
+
+        Returns:
+            True if started; False if already running.
+        """
+        if self.IsRunning():
+            return False
+        version = self._device_status.version
+        self._thread = threading.Thread(
+            target=self._WatchDeviceStatus,
+            args=(version, dict(self._device_status.items())))
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def Stop(self):
+        """Stops watching the device status and waits for the thread."""
+        if self._thread:
+            self._thread.keep_running = False
+            self._thread.join()
+            self._thread = None
+
+    def _WatchDeviceStatus(self, version, last_status):
+        """Main function of the thread which watches the device status.
+
+        Args:
+            version: int, the version of the device status at start.
+            last_status: dict, maps a serial to its status at start.
+        """
+        thread = threading.currentThread()
+        released = set()
+        deadline = None
+        while getattr(thread, "keep_running", True):
+            timeout = self._poll_secs
+            if deadline is not None:
+                timeout = max(0, min(timeout, deadline - time.time()))
+            new_version = self._device_status.WaitForChange(version, timeout)
+            if new_version != version:
+                changes = self._device_status.GetChanges(version)
+                version = new_version
+                for serial, status in changes.items():
+                    if (status in IDLE_STATUS
+                            and last_status.get(serial) not in IDLE_STATUS):
+                        released.add(serial)
+                    last_status[serial] = status
+                if released and deadline is None:
+                    deadline = time.time() + self._debounce_secs
+            if deadline is not None and time.time() >= deadline:
+                self._Trigger(sorted(released))
+                released = set()
+                deadline = None
+
+    def _Trigger(self, serials):
+        """Leases a job if any of the released devices is still idle.
+
+        Args:
+            serials: a list of strings, the released serials.
+        """
+        idle_serials = [
+            serial for serial in serials
+            if self._device_status.get(serial) in IDLE_STATUS
+        ]
+        with self._lock:
+            self._counters["released"] += len(serials)
+            if not idle_serials:
+                return
+            self._counters["triggered"] += 1
+        try:
+            leased = self._lease(idle_serials)
+        except Exception as e:
+            logging.exception("Lease triggered by %s failed: %s",
+                              idle_serials, e)
+            return
+        logging.info("Devices %s released; %s a job.", idle_serials,
+                     "leasing" if leased else "not leasing")
+        if leased:
+            with self._lock:
+                self._counters["leased"] += 1
+
+    def GetStatus(self):
+        """Returns the counters of the released devices and the leases.
+
+        Returns:
+            a dict with running, released, triggered, and leased.
+        """
+        with self._lock:
+            status = dict(self._counters)
+        status["running"] = self.IsRunning()
+        return status
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import threading
+import time
+import unittest
+
+from host_controller import common
+from host_controller import lease_trigger
+from host_controller.utils.ipc import shared_status_table
+
+_ONLINE = common._DEVICE_STATUS_DICT["online"]
+_READY = common._DEVICE_STATUS_DICT["ready"]
+_USE = common._DEVICE_STATUS_DICT["use"]
+
+
+class LeaseTriggerTest(unittest.TestCase):
+    """Tests for LeaseTrigger."""
+
+    def setUp(self):
+        """Creates a trigger watching a table with two devices in use."""
+        self._table = shared_status_table.SharedStatusTable(capacity=16)
+        self._table["serial1"] = _USE
+        self._table["serial2"] = _USE
+        self._leases = []
+        self._leased = threading.Event()
+        self._trigger = lease_trigger.LeaseTrigger(
+            self._table, self._Lease, debounce_secs=0.5, poll_secs=0.05)
+        self._trigger.Start()
+
+    def tearDown(self):
+        """Stops the trigger."""
+        self._trigger.Stop()
+
+    def _Lease(self, serials):
+        """Records the lease."""
+        self._leases.append(serials)
+        self._leased.set()
+        return True
+
+    def testTriggerOnRelease(self):
+        """Tests coalescing the devices released together."""
+        self._table["serial1"] = _READY
+        self._table["serial2"] = _READY
+        self._table["serial2"] = _ONLINE
+        self.assertTrue(self._leased.wait(5))
+        self._trigger.Stop()
+        self.assertEqual([["serial1", "serial2"]], self._leases)
+        self.assertEqual({
+            "running": False,
+            "released": 2,
+            "triggered": 1,
+            "leased": 1
+        }, self._trigger.GetStatus())
+
+    def testNoTriggerIfReused(self):
+        """Tests skipping the devices used again within the debounce time."""
+        self._table["serial1"] = _READY
+        time.sleep(0.2)
+        self._table["serial1"] = _USE
+        self.assertFalse(self._leased.wait(1))
+        self.assertEqual(1, self._trigger.GetStatus()["released"])
+        self.assertEqual(0, self._trigger.GetStatus()["triggered"])
+
+
+if __name__ == "__main__":
+    unittest.main()
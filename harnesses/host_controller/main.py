@@ -133,6 +133,11 @@ def main():
                         default=None,
                         help="GCS URL to an img package. Fetches and flashes "
                              "the device(s) given as the '--serial' flag.")
+    parser.add_argument("--flash-plan", action="store_true",
+                        help="Whether the leased jobs compile the flash "
+                             "commands of the devices supported by "
+                             "campaigns/flash_plan.py from their desired "
+                             "states.")
     args = parser.parse_args()
     if args.config_file:
         config_json = json.load(args.config_file)
@@ -197,7 +202,7 @@ def main():
                                        vti_address=args.vti,
                                        password=args.password)
         if args.vti:
-            main_console.StartJobThreadAndProcessPool()
+            main_console.StartJobThreadAndProcessPool(args.flash_plan)
         else:
             logging.warning("vti address is not set. example : "
                             "$ run --vti=<url>")
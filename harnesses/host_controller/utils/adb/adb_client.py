@@ -0,0 +1,717 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Client talking to the adb server over its smart socket protocol."""
+
+import os
+import socket
+import stat
+import struct
+import time
+
+# Default address of the adb server.
+DEFAULT_ADB_SERVER_HOST = "127.0.0.1"
+DEFAULT_ADB_SERVER_PORT = 5037
+
+# Environment variable overriding the port of the adb server.
+_ADB_SERVER_PORT_ENV = "ANDROID_ADB_SERVER_PORT"
+
+# Default timeout for connecting and receiving a response in seconds.
+DEFAULT_SOCKET_TIMEOUT_SECS = 10
+
+# Response status words of the adb server.
+_STATUS_OKAY = b"OKAY"
+_STATUS_FAIL = b"FAIL"
+
+# Stream ids of the shell v2 protocol.
+SHELL_STDIN = 0
+SHELL_STDOUT = 1
+SHELL_STDERR = 2
+SHELL_EXIT = 3
+
+# Maximum size of a DATA packet of the sync protocol.
+_SYNC_DATA_MAX = 64 * 1024
+
+
+class AdbClientError(Exception):
+    """Raised when the adb server rejects a request or is unreachable."""
+    pass
+
+
+class AdbTimeoutError(AdbClientError):
+    """Raised when the adb server or the device does not respond in time."""
+    pass
+
+
+class AdbRequestError(AdbClientError):
+    """Raised when a request fails before the service is run, e.g., the adb
+    server is unreachable or rejects the service."""
+    pass
+
+
+def ParseDeviceList(payload):
+    """Parses the device list from host:devices and host:track-devices.
+
+    Args:
+        payload: string, lines of "<serial>\t<state>".
+
+    Returns:
+        a dict where the key is a serial and the value is its state string,
+        e.g., "device", "offline", "recovery", "unauthorized".
+    """
+    devices = {}
+    for line in payload.splitlines():
+        fields = line.strip().split("\t")
+        if len(fields) >= 2 and fields[0]:
+            devices[fields[0]] = fields[1]
+    return devices
+
+
+class AdbConnection(object):
+    """A socket connected to the adb server.
+
+    Attributes:
+        _socket: socket object, the connection.
+        _timeout: float, the socket timeout in seconds. None to block.
+        _deadline: float, the time.time() after which the operations time
+                   out regardless of the socket timeout. None if unlimited.
+    """
+
+    def __init__(self, host, port, timeout):
+        """Connects to the adb server.
+
+        Args:
+            host: string, the address of the adb server.
+            port: int, the port of the adb server.
+            timeout: float, the socket timeout in seconds. None to block.
+
+        Raises:
+            AdbRequestError if the server is unreachable.
+        """
+        try:
+            self._socket = socket.create_connection((host, port), timeout)
+        except (socket.error, socket.timeout) as e:
+            raise AdbRequestError("Failed to connect to adb server at %s:%d: "
+                                  "%s" % (host, port, e))
+        self._socket.settimeout(timeout)
+        self._timeout = timeout
+        self._deadline = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+    def Close(self):
+        """Closes the connection."""
+        try:
+            self._socket.close()
+        except socket.error:
+            pass
+
+    def Shutdown(self):
+        """Shuts down the connection to unblock a pending read."""
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def SetTimeout(self, timeout):
+        """Sets the timeout of the following socket operations.
+
+        Args:
+            timeout: float, the timeout in seconds. None to block.
+        """
+        self._socket.settimeout(timeout)
+        self._timeout = timeout
+
+    def SetDeadline(self, deadline):
+        """Sets the time by which the following operations must complete.
+
+        Args:
+            deadline: float, the time.time() after which the operations
+                      raise AdbTimeoutError. None if unlimited.
+        """
+        self._deadline = deadline
+
+    def _ApplyDeadline(self):
+        """Shortens the socket timeout to the time left to the deadline.
+
+        Raises:
+            AdbTimeoutError if the deadline has passed.
+        """
+        if self._deadline is None:
+            return
+        remaining = self._deadline - time.time()
+        if remaining <= 0:
+            raise AdbTimeoutError("Deadline exceeded.")
+        if self._timeout is not None:
+            remaining = min(remaining, self._timeout)
+        self._socket.settimeout(remaining)
+
+    def SendRequest(self, request):
+        """Sends a request and checks the status of the response.
+
+        Args:
+            request: string, the service name, e.g., "host:devices".
+
+        Raises:
+            AdbRequestError if the request is not sent or the server
+            responds with FAIL. AdbClientError or AdbTimeoutError if the
+            response cannot be read, in which case the service may be
+            running.
+        """
+        payload = request.encode("utf-8")
+        self._ApplyDeadline()
+        try:
+            self._socket.sendall(b"%04x" % len(payload) + payload)
+        except (socket.error, socket.timeout) as e:
+            raise AdbRequestError("Failed to send %s: %s" % (request, e))
+        status = self.ReadExactly(4)
+        if status == _STATUS_FAIL:
+            raise AdbRequestError("%s failed: %s" %
+                                  (request, self.ReadLengthPrefixed()))
+        if status != _STATUS_OKAY:
+            raise AdbClientError("Unexpected response to %s: %r" %
+                                 (request, status))
+
+    def ReadExactly(self, length):
+        """Reads the given number of bytes.
+
+        Args:
+            length: int, the number of bytes.
+
+        Returns:
+            bytes, the data.
+
+        Raises:
+            AdbClientError if the connection is closed or timed out.
+        """
+        data = b""
+        while len(data) < length:
+            self._ApplyDeadline()
+            try:
+                chunk = self._socket.recv(length - len(data))
+            except socket.timeout:
+                raise AdbTimeoutError("Timed out reading from adb server.")
+            except socket.error as e:
+                raise AdbClientError("Failed to read from adb server: %s" % e)
+            if not chunk:
+                raise AdbClientError("adb server closed the connection.")
+            data += chunk
+        return data
+
+    def ReadLengthPrefixed(self):
+        """Reads a string prefixed with its length in 4 hex digits.
+
+        Returns:
+            string, the decoded data.
+        """
+        length = int(self.ReadExactly(4), 16)
+        return self.ReadExactly(length).decode("utf-8", "replace")
+
+    def SendAll(self, data):
+        """Sends raw data on the connection after a service is opened.
+
+        Args:
+            data: bytes, the data.
+
+        Raises:
+            AdbClientError if the connection is broken or timed out.
+        """
+        self._ApplyDeadline()
+        try:
+            self._socket.sendall(data)
+        except socket.timeout:
+            raise AdbTimeoutError("Timed out writing to adb server.")
+        except socket.error as e:
+            raise AdbClientError("Failed to write to adb server: %s" % e)
+
+    def ReadChunk(self, size=4096):
+        """Reads the data available on the connection.
+
+        Args:
+            size: int, the maximum number of bytes.
+
+        Returns:
+            bytes, the data. Empty if the server closed the connection.
+        """
+        self._ApplyDeadline()
+        try:
+            return self._socket.recv(size)
+        except socket.timeout:
+            raise AdbTimeoutError("Timed out reading from adb server.")
+        except socket.error as e:
+            raise AdbClientError("Failed to read from adb server: %s" % e)
+
+    def ReadAll(self):
+        """Reads until the server closes the connection.
+
+        Returns:
+            string, the decoded data.
+        """
+        chunks = []
+        while True:
+            self._ApplyDeadline()
+            try:
+                chunk = self._socket.recv(4096)
+            except socket.timeout:
+                raise AdbTimeoutError("Timed out reading from adb server.")
+            except socket.error as e:
+                raise AdbClientError("Failed to read from adb server: %s" % e)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks).decode("utf-8", "replace")
+
+
+class SyncConnection(object):
+    """A connection in the sync mode of adbd, transferring files.
+
+    One connection transfers any number of files one after another.
+
+    Attributes:
+        _conn: AdbConnection object.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+    def Close(self):
+        """Leaves the sync mode and closes the connection."""
+        try:
+            self._SendRequest(b"QUIT", b"")
+        except AdbClientError:
+            pass
+        self._conn.Close()
+
+    def _SendRequest(self, request_id, payload):
+        """Sends a request of the sync protocol.
+
+        Args:
+            request_id: bytes, the 4-byte request id, e.g., b"STAT".
+            payload: bytes, the path or the data.
+        """
+        self._conn.SendAll(request_id + struct.pack("<I", len(payload)) +
+                           payload)
+
+    def _ReadResponse(self):
+        """Reads the id and the 4-byte argument of a response."""
+        header = self._conn.ReadExactly(8)
+        return header[:4], struct.unpack("<I", header[4:])[0]
+
+    def _CheckResponse(self, request):
+        """Reads an OKAY response, raising AdbClientError on FAIL."""
+        response_id, length = self._ReadResponse()
+        if response_id == _STATUS_FAIL:
+            raise AdbClientError(
+                "%s failed: %s" %
+                (request, self._conn.ReadExactly(length).decode(
+                    "utf-8", "replace")))
+        if response_id != _STATUS_OKAY:
+            raise AdbClientError("Unexpected response to %s: %r" %
+                                 (request, response_id))
+
+    def Stat(self, remote_path):
+        """Returns the mode, size and mtime of a file on the device.
+
+        Args:
+            remote_path: string, the path on the device.
+
+        Returns:
+            a tuple of (mode, size, mtime). All zeros if the file does
+            not exist.
+        """
+        self._SendRequest(b"STAT", remote_path.encode("utf-8"))
+        data = self._conn.ReadExactly(16)
+        if data[:4] != b"STAT":
+            raise AdbClientError("Unexpected response to STAT %s: %r" %
+                                 (remote_path, data[:4]))
+        return struct.unpack("<III", data[4:])
+
+    def Push(self, local_path, remote_path, mode=None):
+        """Sends a local file to the device.
+
+        Args:
+            local_path: string, the local file.
+            remote_path: string, the path on the device.
+            mode: int, the permission bits. Defaults to the local file's.
+
+        Returns:
+            int, the number of bytes sent.
+        """
+        local_stat = os.stat(local_path)
+        if mode is None:
+            mode = stat.S_IMODE(local_stat.st_mode)
+        self._SendRequest(
+            b"SEND", ("%s,%d" % (remote_path, stat.S_IFREG | mode)).encode(
+                "utf-8"))
+        num_bytes = 0
+        with open(local_path, "rb") as local_file:
+            while True:
+                data = local_file.read(_SYNC_DATA_MAX)
+                if not data:
+                    break
+                self._SendRequest(b"DATA", data)
+                num_bytes += len(data)
+        self._conn.SendAll(b"DONE" + struct.pack("<I", int(
+            local_stat.st_mtime)))
+        self._CheckResponse("push %s" % remote_path)
+        return num_bytes
+
+    def Pull(self, remote_path, local_path):
+        """Receives a file from the device.
+
+        Args:
+            remote_path: string, the path on the device.
+            local_path: string, the local file to write.
+
+        Returns:
+            int, the number of bytes received.
+        """
+        self._SendRequest(b"RECV", remote_path.encode("utf-8"))
+        num_bytes = 0
+        with open(local_path, "wb") as local_file:
+            while True:
+                response_id, length = self._ReadResponse()
+                if response_id == b"DONE":
+                    return num_bytes
+                data = self._conn.ReadExactly(length)
+                if response_id == _STATUS_FAIL:
+                    raise AdbClientError(
+                        "pull %s failed: %s" %
+                        (remote_path, data.decode("utf-8", "replace")))
+                if response_id != b"DATA":
+                    raise AdbClientError("Unexpected response to pull %s: "
+                                         "%r" % (remote_path, response_id))
+                local_file.write(data)
+                num_bytes += length
+
+
+class AdbClient(object):
+    """Client sending requests to the adb server without spawning adb.
+
+    Attributes:
+        _host: string, the address of the adb server.
+        _port: int, the port of the adb server.
+        _timeout: float, the socket timeout in seconds.
+    """
+
+    def __init__(self, host=DEFAULT_ADB_SERVER_HOST, port=None,
+                 timeout=DEFAULT_SOCKET_TIMEOUT_SECS):
+        if port is None:
+            port = int(
+                os.environ.get(_ADB_SERVER_PORT_ENV, DEFAULT_ADB_SERVER_PORT))
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+
+    def Connect(self, timeout=None, deadline=None):
+        """Opens a new connection to the adb server.
+
+        Args:
+            timeout: float, the socket timeout. Defaults to self._timeout,
+                     or to no timeout after connecting if deadline is set.
+            deadline: float, the time.time() by which the operations on the
+                      connection must complete. None if unlimited.
+
+        Returns:
+            an AdbConnection object.
+        """
+        conn = AdbConnection(self._host, self._port,
+                             self._timeout if timeout is None else timeout)
+        if deadline is not None:
+            conn.SetTimeout(timeout)
+            conn.SetDeadline(deadline)
+        return conn
+
+    def GetVersion(self):
+        """Returns the version of the adb server.
+
+        Returns:
+            int, the version number.
+        """
+        with self.Connect() as conn:
+            conn.SendRequest("host:version")
+            return int(conn.ReadLengthPrefixed(), 16)
+
+    def GetDevices(self):
+        """Returns the devices known to the adb server.
+
+        Returns:
+            a dict where the key is a serial and the value is its state.
+        """
+        with self.Connect() as conn:
+            conn.SendRequest("host:devices")
+            return ParseDeviceList(conn.ReadLengthPrefixed())
+
+    def TrackDevices(self):
+        """Subscribes to the device list updates of the adb server.
+
+        The server sends the whole device list once on connection and
+        again whenever a device is attached, detached or changes its state.
+
+        Returns:
+            an AdbConnection object on which ReadDeviceList() is called to
+            block until the next update. The caller closes the connection.
+        """
+        conn = self.Connect()
+        try:
+            conn.SendRequest("host:track-devices")
+        except AdbClientError:
+            conn.Close()
+            raise
+        conn.SetTimeout(None)
+        return conn
+
+    @staticmethod
+    def ReadDeviceList(conn):
+        """Reads a device list update from a tracking connection.
+
+        Args:
+            conn: AdbConnection returned by TrackDevices().
+
+        Returns:
+            a dict where the key is a serial and the value is its state.
+        """
+        return ParseDeviceList(conn.ReadLengthPrefixed())
+
+    def Shell(self, serial, command, deadline=None):
+        """Runs a shell command on a device and returns its output.
+
+        Args:
+            serial: string, the device serial.
+            command: string, the shell command.
+            deadline: float, the time.time() by which the command must
+                      complete. None to apply the client's timeout to each
+                      read instead.
+
+        Returns:
+            string, the output of the command.
+        """
+        with self.Connect(deadline=deadline) as conn:
+            conn.SendRequest("host:transport:%s" % serial)
+            conn.SendRequest("shell:%s" % command)
+            return conn.ReadAll()
+
+    def OpenShell(self, serial, command="", timeout=None, deadline=None):
+        """Opens a shell v2 connection to a device.
+
+        Args:
+            serial: string, the device serial.
+            command: string, the shell command. Empty to start an
+                     interactive shell reading the commands from stdin.
+            timeout: float, the socket timeout. Defaults to the client's.
+            deadline: float, the time.time() by which the shell must
+                      complete. None if unlimited.
+
+        Returns:
+            an AdbConnection object on which ReadShellPacket and
+            WriteShellPacket are called. The caller closes it.
+
+        Raises:
+            AdbRequestError if the device does not support shell v2.
+        """
+        conn = self.Connect(timeout, deadline)
+        try:
+            conn.SendRequest("host:transport:%s" % serial)
+            conn.SendRequest("shell,v2,raw:%s" % command)
+        except AdbClientError:
+            conn.Close()
+            raise
+        return conn
+
+    @staticmethod
+    def ReadShellPacket(conn):
+        """Reads a packet from a shell v2 connection.
+
+        Args:
+            conn: AdbConnection returned by OpenShell().
+
+        Returns:
+            a tuple of (stream id, data). The data of SHELL_EXIT is the int
+            exit code; the others are bytes.
+        """
+        header = conn.ReadExactly(5)
+        stream_id = ord(header[:1])
+        data = conn.ReadExactly(struct.unpack("<I", header[1:])[0])
+        if stream_id == SHELL_EXIT:
+            return SHELL_EXIT, ord(data[:1]) if data else 0
+        return stream_id, data
+
+    @staticmethod
+    def WriteShellPacket(conn, stream_id, data):
+        """Writes a packet to a shell v2 connection.
+
+        Args:
+            conn: AdbConnection returned by OpenShell().
+            stream_id: int, e.g., SHELL_STDIN.
+            data: bytes, the payload.
+        """
+        conn.SendAll(struct.pack("<BI", stream_id, len(data)) + data)
+
+    def StreamShell(self, serial, command, timeout=None, deadline=None):
+        """Runs a shell command with the shell v2 protocol.
+
+        The output is yielded as soon as the device sends it.
+
+        Args:
+            serial: string, the device serial.
+            command: string, the shell command.
+            timeout: float, the maximum time to wait for the output in
+                     seconds. None to use the client's timeout.
+            deadline: float, the time.time() by which the command must
+                      complete. None if unlimited.
+
+        Yields:
+            tuples of (stream id, data). The stream id is SHELL_STDOUT or
+            SHELL_STDERR with bytes data, and lastly SHELL_EXIT with the
+            int exit code.
+
+        Raises:
+            AdbRequestError if the device does not support shell v2.
+            AdbClientError if the connection is broken. AdbTimeoutError if
+            the device does not respond in time.
+        """
+        conn = self.OpenShell(serial, command, timeout, deadline)
+        try:
+            while True:
+                stream_id, data = self.ReadShellPacket(conn)
+                if stream_id == SHELL_EXIT:
+                    yield SHELL_EXIT, data
+                    return
+                if stream_id in (SHELL_STDOUT, SHELL_STDERR):
+                    yield stream_id, data
+        finally:
+            conn.Close()
+
+    def ExecuteShell(self,
+                     serial,
+                     command,
+                     timeout=None,
+                     callback=None,
+                     deadline=None):
+        """Runs a shell command and returns its output and exit code.
+
+        Args:
+            serial: string, the device serial.
+            command: string, the shell command.
+            timeout: float, the maximum time to wait for the output in
+                     seconds. None to use the client's timeout.
+            callback: function called with (stream id, bytes) as the output
+                      arrives. None to only collect the output.
+            deadline: float, the time.time() by which the command must
+                      complete. None if unlimited.
+
+        Returns:
+            a tuple of (stdout, stderr, exit code) like
+            cmd_utils.ExecuteOneShellCommand.
+        """
+        outputs = {SHELL_STDOUT: [], SHELL_STDERR: []}
+        exit_code = None
+        for stream_id, data in self.StreamShell(serial, command, timeout,
+                                                deadline):
+            if stream_id == SHELL_EXIT:
+                exit_code = data
+                break
+            outputs[stream_id].append(data)
+            if callback:
+                callback(stream_id, data)
+        return (b"".join(outputs[SHELL_STDOUT]).decode("utf-8", "replace"),
+                b"".join(outputs[SHELL_STDERR]).decode("utf-8", "replace"),
+                exit_code)
+
+    def OpenSync(self, serial, timeout=None, deadline=None):
+        """Opens a connection transferring files to and from a device.
+
+        Args:
+            serial: string, the device serial.
+            timeout: float, the socket timeout. Defaults to the client's.
+            deadline: float, the time.time() by which the transfers must
+                      complete. None if unlimited.
+
+        Returns:
+            a SyncConnection object, which the caller closes.
+        """
+        conn = self.Connect(timeout, deadline)
+        try:
+            conn.SendRequest("host:transport:%s" % serial)
+            conn.SendRequest("sync:")
+        except AdbClientError:
+            conn.Close()
+            raise
+        return SyncConnection(conn)
+
+    def Push(self,
+             serial,
+             local_path,
+             remote_path,
+             mode=None,
+             timeout=None,
+             deadline=None):
+        """Sends a local file to a device.
+
+        Args:
+            serial: string, the device serial.
+            local_path: string, the local file.
+            remote_path: string, the path on the device. If it is a
+                         directory, the file is pushed into it.
+            mode: int, the permission bits. Defaults to the local file's.
+            timeout: float, the socket timeout. Defaults to the client's.
+            deadline: float, the time.time() by which the transfer must
+                      complete. None if unlimited.
+
+        Returns:
+            int, the number of bytes sent.
+        """
+        with self.OpenSync(serial, timeout, deadline) as sync:
+            if stat.S_ISDIR(sync.Stat(remote_path)[0]):
+                remote_path = "%s/%s" % (remote_path.rstrip("/"),
+                                         os.path.basename(local_path))
+            return sync.Push(local_path, remote_path, mode)
+
+    def Pull(self, serial, remote_path, local_path, timeout=None):
+        """Receives a file from a device.
+
+        Args:
+            serial: string, the device serial.
+            remote_path: string, the path on the device.
+            local_path: string, the local file to write.
+            timeout: float, the socket timeout. Defaults to the client's.
+
+        Returns:
+            int, the number of bytes received.
+        """
+        with self.OpenSync(serial, timeout) as sync:
+            return sync.Pull(remote_path, local_path)
+
+    def GetProp(self, serial, name):
+        """Returns a system property of a device.
+
+        Args:
+            serial: string, the device serial.
+            name: string, the property name.
+
+        Returns:
+            string, the property value stripped of whitespace.
+        """
+        return self.Shell(serial, "getprop %s" % name).strip()
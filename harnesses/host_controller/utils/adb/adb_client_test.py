@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+from host_controller.utils.adb import adb_client
+from host_controller.utils.adb import fake_adb_server
+
+
+class AdbClientTest(unittest.TestCase):
+    """Tests for AdbClient against a fake adb server."""
+
+    def setUp(self):
+        """Starts a fake adb server with a device."""
+        self._server = fake_adb_server.FakeAdbServer()
+        self._server.SetDevice("serial1", "device")
+        self._client = adb_client.AdbClient(port=self._server.port)
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Stops the fake adb server."""
+        self._server.Close()
+        shutil.rmtree(self._temp_dir)
+
+    def testStreamShell(self):
+        """Tests streaming the output and the exit code of shell v2."""
+        self._server.SetShellOutput("serial1", "ls /data", "a\nb\nc\n",
+                                    "denied\n", 1)
+        packets = list(self._client.StreamShell("serial1", "ls /data"))
+        self.assertEqual([(adb_client.SHELL_STDOUT, b"a\nb"),
+                          (adb_client.SHELL_STDOUT, b"\nc\n"),
+                          (adb_client.SHELL_STDERR, b"denied\n"),
+                          (adb_client.SHELL_EXIT, 1)], packets)
+
+    def testExecuteShell(self):
+        """Tests collecting the output with a callback."""
+        self._server.SetShellOutput("serial1", "id", "uid=0\n")
+        received = []
+        self.assertEqual(("uid=0\n", "", 0),
+                         self._client.ExecuteShell(
+                             "serial1", "id",
+                             callback=lambda *args: received.append(args)))
+        self.assertEqual(b"uid=0\n",
+                         b"".join(data for _, data in received))
+        self.assertEqual([("serial1", "id")], self._server.shell_commands)
+
+    def testUnknownDevice(self):
+        """Tests the error on a device unknown to the server."""
+        with self.assertRaises(adb_client.AdbRequestError):
+            self._client.ExecuteShell("serial2", "id")
+
+    def testDeadline(self):
+        """Tests that a command producing output slowly times out."""
+        self._server.SetShellOutput(
+            "serial1", "slow", "a\nb\n", "c\n", interval=0.2)
+        start_time = time.time()
+        with self.assertRaises(adb_client.AdbTimeoutError):
+            self._client.ExecuteShell(
+                "serial1", "slow", timeout=1, deadline=time.time() + 0.5)
+        self.assertLess(time.time() - start_time, 0.7)
+        self.assertEqual(("a\nb\n", "c\n", 0),
+                         self._client.ExecuteShell(
+                             "serial1", "slow", deadline=time.time() + 5))
+
+    def testPushPull(self):
+        """Tests the round trip of a file larger than a sync packet."""
+        data = os.urandom(150 * 1024)
+        local_path = os.path.join(self._temp_dir, "local.bin")
+        with open(local_path, "wb") as local_file:
+            local_file.write(data)
+        self._server.SetFile("serial1", "/data/local/tmp", None, 0o777)
+
+        self.assertEqual(len(data),
+                         self._client.Push("serial1", local_path,
+                                           "/data/local/tmp", 0o600))
+        mode, pushed, _ = self._server.GetFile("serial1",
+                                               "/data/local/tmp/local.bin")
+        self.assertEqual(stat.S_IFREG | 0o600, mode)
+        self.assertEqual(data, pushed)
+
+        pulled_path = os.path.join(self._temp_dir, "pulled.bin")
+        self.assertEqual(len(data),
+                         self._client.Pull("serial1",
+                                           "/data/local/tmp/local.bin",
+                                           pulled_path))
+        with open(pulled_path, "rb") as pulled_file:
+            self.assertEqual(data, pulled_file.read())
+
+    def testPullMissingFile(self):
+        """Tests the error on pulling a nonexistent file."""
+        with self.assertRaises(adb_client.AdbClientError):
+            self._client.Pull("serial1", "/missing",
+                              os.path.join(self._temp_dir, "missing"))
+
+    def testSyncConnectionReuse(self):
+        """Tests transferring several files on one connection."""
+        local_path = os.path.join(self._temp_dir, "local.txt")
+        with open(local_path, "wb") as local_file:
+            local_file.write(b"content")
+        connections = self._server.connections
+        with self._client.OpenSync("serial1") as sync:
+            for index in range(3):
+                sync.Push(local_path, "/sdcard/file%d" % index)
+            self.assertEqual(len(b"content"),
+                             sync.Stat("/sdcard/file2")[1])
+            self.assertEqual((0, 0, 0), sync.Stat("/sdcard/file3"))
+        self.assertEqual(connections + 1, self._server.connections)
+        for index in range(3):
+            self.assertEqual(b"content",
+                             self._server.GetFile("serial1",
+                                                  "/sdcard/file%d" %
+                                                  index)[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,260 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Event-driven detection of the boot completion of the devices."""
+
+import logging
+import os
+import threading
+import time
+
+from host_controller.utils.adb import adb_client
+
+# adb state of a device whose adbd is online.
+_ADB_STATE_DEVICE = "device"
+
+# Initial and maximum interval between sys.boot_completed checks in secs.
+MIN_POLL_INTERVAL_SECS = 0.5
+MAX_POLL_INTERVAL_SECS = 5
+
+# Factor by which the interval grows after each check.
+POLL_BACKOFF_FACTOR = 1.5
+
+_instance = None
+_instance_lock = threading.Lock()
+
+
+class BootWatcher(object):
+    """Tracks the devices through the adb server and detects boot completion.
+
+    A tracker thread keeps one host:track-devices connection and wakes up
+    the waiters whenever a device changes its adb state. While a device is
+    online, sys.boot_completed is checked with an exponential backoff which
+    is reset on every state transition. Waiters on the same device share
+    the checks; only one of them talks to the device at a time.
+
+    Attributes:
+        _client: AdbClient, the client of the adb server.
+        _start_lock: threading.Lock, serializes connecting the tracker so
+                     that _cond is not held while connecting.
+        _cond: threading.Condition, guards the fields below and is notified
+               on state transitions and check results.
+        _tracker: threading.Thread, the thread reading the device updates.
+        _states: dict, maps a serial to its adb state.
+        _generations: dict, maps a serial to the number of its transitions.
+        _results: dict, maps a serial to (time, bool), the latest check.
+        _checking: set of serials whose boot_completed is being checked.
+        _intervals: dict, maps a serial to its current check interval.
+        _next_check_times: dict, maps a serial to the earliest time of its
+                           next check.
+    """
+
+    def __init__(self,
+                 client=None,
+                 min_poll_interval=MIN_POLL_INTERVAL_SECS,
+                 max_poll_interval=MAX_POLL_INTERVAL_SECS,
+                 backoff_factor=POLL_BACKOFF_FACTOR):
+        self._client = client or adb_client.AdbClient()
+        self._min_poll_interval = min_poll_interval
+        self._max_poll_interval = max_poll_interval
+        self._backoff_factor = backoff_factor
+        self._start_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._tracker = None
+        self._states = {}
+        self._generations = {}
+        self._results = {}
+        self._checking = set()
+        self._intervals = {}
+        self._next_check_times = {}
+
+    def GetState(self, serial):
+        """Returns the latest adb state of a device.
+
+        Args:
+            serial: string, the device serial.
+
+        Returns:
+            string, the adb state. None if the device is not attached.
+        """
+        with self._cond:
+            return self._states.get(serial)
+
+    def StartTracking(self):
+        """Starts the tracker thread if it is not running.
+
+        Returns:
+            True if the devices are being tracked; False if the adb server
+            is unreachable.
+        """
+        with self._start_lock:
+            with self._cond:
+                if self._tracker and self._tracker.is_alive():
+                    return True
+            try:
+                conn = self._client.TrackDevices()
+                devices = self._client.ReadDeviceList(conn)
+            except adb_client.AdbClientError as e:
+                logging.debug("Device tracking unavailable: %s", e)
+                return False
+            with self._cond:
+                self._UpdateStates(devices)
+                self._tracker = threading.Thread(
+                    target=self._TrackDevices, args=(conn, ))
+                self._tracker.daemon = True
+                self._tracker.start()
+            return True
+
+    def _TrackDevices(self, conn):
+        """Reads the device updates until the connection is closed.
+
+        Args:
+            conn: AdbConnection, the host:track-devices connection.
+        """
+        try:
+            while True:
+                devices = self._client.ReadDeviceList(conn)
+                with self._cond:
+                    self._UpdateStates(devices)
+        except adb_client.AdbClientError as e:
+            logging.warning("Device tracking stopped: %s", e)
+        finally:
+            conn.Close()
+            with self._cond:
+                self._cond.notify_all()
+
+    def _UpdateStates(self, devices):
+        """Records the state transitions and wakes up the waiters.
+
+        Must be called with self._cond held.
+
+        Args:
+            devices: dict, maps a serial to its adb state.
+        """
+        for serial in set(self._states) | set(devices):
+            state = devices.get(serial)
+            if self._states.get(serial) == state:
+                continue
+            logging.debug("Device %s: %s -> %s", serial,
+                          self._states.get(serial), state)
+            if state is None:
+                del self._states[serial]
+            else:
+                self._states[serial] = state
+            self._generations[serial] = self._generations.get(serial, 0) + 1
+            self._results.pop(serial, None)
+            self._intervals.pop(serial, None)
+            self._next_check_times.pop(serial, None)
+        self._cond.notify_all()
+
+    def _CheckBootCompleted(self, serial):
+        """Reads sys.boot_completed from a device.
+
+        Args:
+            serial: string, the device serial.
+
+        Returns:
+            True if the device has completed booting.
+        """
+        try:
+            return self._client.GetProp(serial, "sys.boot_completed") == "1"
+        except adb_client.AdbClientError as e:
+            logging.debug("Boot check on %s failed: %s", serial, e)
+            return False
+
+    def WaitForBootCompletion(self, serial, timeout):
+        """Waits until a device completes booting.
+
+        Only a check made after this method is called counts, so that a
+        stale result from before a reboot is never returned.
+
+        Args:
+            serial: string, the device serial.
+            timeout: float, the maximum time to wait in seconds.
+
+        Returns:
+            True if the device has booted, False if timed out, None if the
+            adb server is unreachable and the caller should fall back to
+            polling on its own.
+        """
+        start_time = time.time()
+        deadline = start_time + timeout
+        while True:
+            if not self.StartTracking():
+                return None
+
+            with self._cond:
+                result = self._results.get(serial)
+                if result and result[0] >= start_time and result[1]:
+                    return True
+                now = time.time()
+                remaining = deadline - now
+                if remaining <= 0:
+                    logging.error("Timed out waiting for %s to boot.", serial)
+                    return False
+                if (self._states.get(serial) != _ADB_STATE_DEVICE
+                        or serial in self._checking):
+                    self._cond.wait(min(self._max_poll_interval, remaining))
+                    continue
+                next_check_time = self._next_check_times.get(serial, 0)
+                if now < next_check_time:
+                    self._cond.wait(min(next_check_time - now, remaining))
+                    continue
+                generation = self._generations.get(serial, 0)
+                self._checking.add(serial)
+
+            check_time = time.time()
+            booted = self._CheckBootCompleted(serial)
+            with self._cond:
+                self._checking.discard(serial)
+                if self._generations.get(serial, 0) == generation:
+                    self._results[serial] = (check_time, booted)
+                    interval = self._intervals.get(serial,
+                                                   self._min_poll_interval)
+                    self._next_check_times[serial] = time.time() + interval
+                    self._intervals[serial] = min(
+                        interval * self._backoff_factor,
+                        self._max_poll_interval)
+                self._cond.notify_all()
+
+
+def GetBootWatcher():
+    """Returns the BootWatcher shared in the current process.
+
+    A new watcher is created after fork since the tracker thread does not
+    survive in the child process.
+
+    Returns:
+        a BootWatcher object.
+    """
+    global _instance
+    with _instance_lock:
+        if _instance is None or _instance[0] != os.getpid():
+            _instance = (os.getpid(), BootWatcher())
+        return _instance[1]
+
+
+def WaitForBootCompletion(serial, timeout):
+    """Waits for a device to boot using the shared BootWatcher.
+
+    Args:
+        serial: string, the device serial.
+        timeout: float, the maximum time to wait in seconds.
+
+    Returns:
+        True if booted, False if timed out, None if the adb server is
+        unreachable.
+    """
+    return GetBootWatcher().WaitForBootCompletion(serial, timeout)
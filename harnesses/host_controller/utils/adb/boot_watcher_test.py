@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import threading
+import time
+import unittest
+
+from host_controller.utils.adb import adb_client
+from host_controller.utils.adb import boot_watcher
+from host_controller.utils.adb import fake_adb_server
+
+
+class BootWatcherTest(unittest.TestCase):
+    """Tests for BootWatcher against a fake adb server."""
+
+    def setUp(self):
+        """Starts a fake adb server and a watcher connected to it."""
+        self._server = fake_adb_server.FakeAdbServer()
+        self._client = adb_client.AdbClient(port=self._server.port)
+        self._watcher = boot_watcher.BootWatcher(
+            self._client, min_poll_interval=0.05, max_poll_interval=0.2)
+
+    def tearDown(self):
+        """Stops the fake adb server and waits for the tracker to exit."""
+        self._server.Close()
+        if self._watcher._tracker:
+            self._watcher._tracker.join(5)
+
+    def testAdbClient(self):
+        """Tests the basic requests of AdbClient."""
+        self._server.SetDevice("serial1", "device")
+        self._server.SetDevice("serial2", "offline")
+        self._server.SetProp("serial1", "ro.product.name", "walleye")
+        self.assertEqual(0x29, self._client.GetVersion())
+        self.assertEqual({"serial1": "device", "serial2": "offline"},
+                         self._client.GetDevices())
+        self.assertEqual("walleye",
+                         self._client.GetProp("serial1", "ro.product.name"))
+        with self.assertRaises(adb_client.AdbClientError):
+            self._client.GetProp("serial2", "ro.product.name")
+
+    def testAlreadyBooted(self):
+        """Tests that a booted device is detected without waiting."""
+        self._server.SetDevice("serial1", "device")
+        self._server.SetProp("serial1", "sys.boot_completed", "1")
+        self.assertTrue(self._watcher.WaitForBootCompletion("serial1", 5))
+        self.assertEqual(1, len(self._server.shell_commands))
+
+    def testWaitForReboot(self):
+        """Tests that many waiters share the checks during a reboot."""
+        self._server.SetDevice("serial1", "device")
+        results = []
+
+        def _Wait():
+            results.append(
+                self._watcher.WaitForBootCompletion("serial1", 10))
+
+        threads = [threading.Thread(target=_Wait) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.3)
+        self._server.SetDevice("serial1", None)
+        time.sleep(0.1)
+        self.assertIsNone(self._watcher.GetState("serial1"))
+        checks_while_detached = len(self._server.shell_commands)
+        time.sleep(0.3)
+        self.assertEqual(checks_while_detached,
+                         len(self._server.shell_commands))
+
+        self._server.SetDevice("serial1", "device")
+        self._server.SetProp("serial1", "sys.boot_completed", "1")
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual([True] * 5, results)
+        # Backoff bounds the checks well below one per waiter per interval.
+        self.assertLess(len(self._server.shell_commands), 20)
+
+    def testTimeout(self):
+        """Tests that the wait times out on a device that never boots."""
+        self._server.SetDevice("serial1", "device")
+        self.assertFalse(self._watcher.WaitForBootCompletion("serial1", 0.5))
+
+    def testServerUnavailable(self):
+        """Tests that None is returned if the adb server is unreachable."""
+        self._server.Close()
+        self.assertIsNone(self._watcher.WaitForBootCompletion("serial1", 1))
+
+    def testStateReadableWhileConnecting(self):
+        """Tests that connecting the tracker does not block the readers."""
+        connecting = threading.Event()
+        resume = threading.Event()
+        track_devices = self._client.TrackDevices
+
+        def _SlowTrackDevices():
+            connecting.set()
+            resume.wait(5)
+            return track_devices()
+
+        self._client.TrackDevices = _SlowTrackDevices
+        thread = threading.Thread(target=self._watcher.StartTracking)
+        thread.start()
+        try:
+            self.assertTrue(connecting.wait(5))
+            states = []
+            reader = threading.Thread(
+                target=lambda: states.append(self._watcher.GetState("serial1")))
+            reader.start()
+            reader.join(1)
+            self.assertEqual([None], states)
+        finally:
+            resume.set()
+            thread.join(5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,502 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Event-driven inventory of the devices attached to the host."""
+
+import logging
+import os
+import socket
+import threading
+
+from host_controller.utils.adb import adb_client
+from host_controller.utils.adb import device_prober
+from host_controller.utils.usb import usb_utils
+
+# State of a device which exposes the adb interface over USB but is not
+# listed by the adb server yet.
+STATE_OFFLINE = "offline"
+
+# Netlink protocol and multicast group of the kernel uevents.
+NETLINK_KOBJECT_UEVENT = 15
+_UEVENT_KERNEL_GROUP = 1
+_UEVENT_BUFFER_SIZE = 64 * 1024
+
+# Interval in seconds to check whether the uevent source is stopped.
+_UEVENT_RECV_TIMEOUT_SECS = 1
+
+# Root of sysfs.
+_SYSFS_ROOT = "/sys"
+
+_instance = None
+_instance_lock = threading.Lock()
+
+
+def ParseUevent(data):
+    """Parses a kernel uevent message.
+
+    Args:
+        data: bytes, "<action>@<devpath>" followed by NUL-separated
+              "<key>=<value>" pairs.
+
+    Returns:
+        a dict of the keys and values, e.g., ACTION, DEVPATH, SUBSYSTEM and
+        DEVTYPE. None if the message is not a kernel uevent.
+    """
+    fields = data.decode("utf-8", "replace").split("\0")
+    if "@" not in fields[0]:
+        # e.g., the messages rebroadcast by udevd start with "libudev".
+        return None
+    env = {}
+    for field in fields[1:]:
+        if "=" in field:
+            key, value = field.split("=", 1)
+            env[key] = value
+    return env
+
+
+class AdbTrackSource(object):
+    """Feeds the device list of the adb server into an inventory.
+
+    Attributes:
+        _client: AdbClient, the client of the adb server.
+        _conn: AdbConnection, the host:track-devices connection.
+        _thread: threading.Thread, reads the device list updates.
+        _stopped: bool, whether Stop has been called.
+    """
+
+    def __init__(self, client=None):
+        self._client = client or adb_client.AdbClient()
+        self._conn = None
+        self._thread = None
+        self._stopped = False
+
+    def IsRunning(self):
+        """Returns whether the device list is being tracked."""
+        return bool(self._thread and self._thread.is_alive())
+
+    def Start(self, inventory):
+        """Reads the current device list and starts tracking the updates.
+
+        Args:
+            inventory: DeviceInventory, receives the device lists.
+
+        Returns:
+            True if started; False if the adb server is unreachable.
+        """
+        try:
+            conn = self._client.TrackDevices()
+            devices = self._client.ReadDeviceList(conn)
+        except adb_client.AdbClientError as e:
+            logging.debug("adb device tracking unavailable: %s", e)
+            return False
+        self._stopped = False
+        self._conn = conn
+        inventory.UpdateAdbDevices(devices)
+        self._thread = threading.Thread(
+            target=self._Run, args=(inventory, conn))
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def Stop(self):
+        """Stops tracking and waits for the thread to exit."""
+        self._stopped = True
+        if self._conn:
+            self._conn.Shutdown()
+        if self._thread:
+            self._thread.join()
+
+    def _Run(self, inventory, conn):
+        """Reads the device list updates until the connection is closed.
+
+        The adb states are cleared when the connection is lost, since they
+        can no longer be trusted.
+        """
+        try:
+            while True:
+                inventory.UpdateAdbDevices(self._client.ReadDeviceList(conn))
+        except adb_client.AdbClientError as e:
+            if not self._stopped:
+                logging.warning("adb device tracking stopped: %s", e)
+        finally:
+            conn.Close()
+            inventory.UpdateAdbDevices({})
+
+
+class UeventSource(object):
+    """Feeds the USB hotplug events of the kernel into an inventory.
+
+    The events are read from the kernel uevent netlink socket, so that the
+    devices are re-read from sysfs only when they are attached, detached or
+    bound to a new interface, e.g., when rebooting into the bootloader.
+
+    Attributes:
+        _sysfs_root: string, the path where sysfs is mounted.
+        _sock: socket object receiving the uevent messages.
+        _resolver: UsbDeviceResolver whose cache is invalidated by the
+                   events, or None.
+        _thread: threading.Thread, reads the uevent messages.
+        _stopped: bool, whether Stop has been called.
+    """
+
+    def __init__(self, sysfs_root=_SYSFS_ROOT, sock=None, resolver=None):
+        """Initializes the source.
+
+        Args:
+            sysfs_root: string, the path where sysfs is mounted.
+            sock: socket object delivering the uevent messages. Defaults to
+                  a netlink socket subscribed to the kernel uevents.
+            resolver: UsbDeviceResolver reading the same sysfs, whose cache
+                      is kept while the events are received.
+        """
+        self._sysfs_root = sysfs_root
+        self._sock = sock
+        self._resolver = resolver
+        self._thread = None
+        self._stopped = False
+
+    def IsRunning(self):
+        """Returns whether the hotplug events are being received."""
+        return bool(self._thread and self._thread.is_alive())
+
+    def Start(self, inventory):
+        """Reads the attached USB devices and starts receiving events.
+
+        Args:
+            inventory: DeviceInventory, receives the USB devices.
+
+        Returns:
+            True if started; False if the uevents are not available.
+        """
+        if self._sock is None:
+            try:
+                sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                     NETLINK_KOBJECT_UEVENT)
+                sock.bind((0, _UEVENT_KERNEL_GROUP))
+            except (AttributeError, socket.error) as e:
+                logging.debug("USB hotplug events unavailable: %s", e)
+                return False
+            self._sock = sock
+        self._sock.settimeout(_UEVENT_RECV_TIMEOUT_SECS)
+        self._stopped = False
+        # Subscribed before scanning, so that no device is missed.
+        if self._resolver:
+            self._resolver.SetHotplugTracked(True)
+        inventory.UpdateUsbDevices(usb_utils.ScanUsbDevices(self._sysfs_root))
+        self._thread = threading.Thread(target=self._Run, args=(inventory, ))
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def Stop(self):
+        """Stops receiving events and waits for the thread to exit."""
+        self._stopped = True
+        if self._thread:
+            self._thread.join()
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+    def _Run(self, inventory):
+        """Receives the uevent messages until stopped."""
+        while not self._stopped:
+            try:
+                data = self._sock.recv(_UEVENT_BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                logging.warning("USB hotplug events stopped: %s", e)
+                break
+            if not data:
+                break
+            env = ParseUevent(data)
+            if env and env.get("SUBSYSTEM") == "usb":
+                if self._resolver:
+                    self._resolver.Invalidate()
+                self._HandleUevent(inventory, env)
+        if self._resolver:
+            self._resolver.SetHotplugTracked(False)
+        inventory.UpdateUsbDevices({})
+
+    def _HandleUevent(self, inventory, env):
+        """Updates the inventory with a USB uevent.
+
+        Args:
+            inventory: DeviceInventory object.
+            env: dict, the parsed uevent.
+        """
+        action = env.get("ACTION")
+        devpath = env.get("DEVPATH", "")
+        devtype = env.get("DEVTYPE")
+        if devtype == "usb_interface":
+            # The interfaces appear after the device; re-read its mode.
+            if action in ("add", "bind"):
+                devpath = os.path.dirname(devpath)
+                device = usb_utils.ReadUsbDevice(self._sysfs_root, devpath)
+                if device:
+                    inventory.AddUsbDevice(devpath, device)
+        elif devtype == "usb_device":
+            if action == "remove":
+                inventory.RemoveUsbDevice(devpath)
+            elif action in ("add", "bind", "change"):
+                device = usb_utils.ReadUsbDevice(self._sysfs_root, devpath)
+                if device:
+                    inventory.AddUsbDevice(devpath, device)
+
+
+class DeviceInventory(object):
+    """Authoritative map of the attached devices, updated by events.
+
+    The adb states come from an AdbTrackSource and the USB devices from a
+    UeventSource. Each device is presented as a dict with "state",
+    "usb_path", "port_path" and "product". A device in fastboot mode is
+    in device_prober.FASTBOOT_STATE; a device exposing the adb interface
+    before the adb server lists it is in STATE_OFFLINE. The product names
+    are read once per device when it comes online or enters fastboot mode.
+
+    Subscribers are called with (serial, old, new) for every change, where
+    old and new are the device dicts or None, in the order of the events.
+
+    Attributes:
+        _adb_source: AdbTrackSource object.
+        _usb_source: UeventSource object.
+        _prober: DeviceProber reading the product names, or None.
+        _lock: threading.Lock, guards the fields below.
+        _dispatch_lock: threading.Lock, serializes the updates and the
+                        subscriber calls.
+        _adb_states: dict, maps a serial to its adb state.
+        _usb_devices: dict, maps a USB device path to the attributes.
+        _products: dict, maps a serial to its product name.
+        _devices: dict, maps a serial to its device dict.
+        _subscribers: list of callback functions.
+    """
+
+    def __init__(self, adb_source=None, usb_source=None, prober=None):
+        self._adb_source = adb_source or AdbTrackSource()
+        self._usb_source = usb_source or UeventSource(
+            resolver=usb_utils.GetUsbDeviceResolver())
+        self._prober = prober
+        self._lock = threading.Lock()
+        self._dispatch_lock = threading.Lock()
+        self._adb_states = {}
+        self._usb_devices = {}
+        self._products = {}
+        self._devices = {}
+        self._subscribers = []
+
+    def Start(self):
+        """Starts the event sources which are not running.
+
+        Returns:
+            True if the adb states are being tracked. The USB devices are
+            tracked on a best-effort basis; see IsUsbTracked.
+        """
+        if not self._usb_source.IsRunning():
+            self._usb_source.Start(self)
+        if not self._adb_source.IsRunning():
+            return self._adb_source.Start(self)
+        return True
+
+    def Stop(self):
+        """Stops the event sources."""
+        self._adb_source.Stop()
+        self._usb_source.Stop()
+
+    def IsUsbTracked(self):
+        """Returns whether the devices in fastboot mode are being tracked."""
+        return self._usb_source.IsRunning()
+
+    def Subscribe(self, callback):
+        """Registers a function called on every device change.
+
+        Args:
+            callback: function taking serial, old device dict and new
+                      device dict. It must not update the inventory.
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def Unsubscribe(self, callback):
+        """Unregisters a function added by Subscribe."""
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def GetDevices(self):
+        """Returns a copy of the device map.
+
+        Returns:
+            a dict, maps a serial to its device dict.
+        """
+        with self._lock:
+            return dict((serial, dict(device))
+                        for serial, device in self._devices.items())
+
+    def GetDevice(self, serial):
+        """Returns a device dict, or None if the device is not attached."""
+        with self._lock:
+            device = self._devices.get(serial)
+            return dict(device) if device else None
+
+    def GetSerials(self, state=None):
+        """Returns the sorted serials of the devices.
+
+        Args:
+            state: string, the state to filter by. None for all devices.
+        """
+        with self._lock:
+            return sorted(serial for serial, device in self._devices.items()
+                          if state is None or device["state"] == state)
+
+    def UpdateAdbDevices(self, devices):
+        """Replaces the adb states.
+
+        Args:
+            devices: dict, maps a serial to its adb state.
+        """
+        def _Update():
+            self._adb_states = dict(devices)
+
+        self._Apply(_Update)
+
+    def UpdateUsbDevices(self, devices):
+        """Replaces the USB devices.
+
+        Args:
+            devices: dict, maps a USB device path to the attributes.
+        """
+        def _Update():
+            self._usb_devices = dict(devices)
+
+        self._Apply(_Update)
+
+    def AddUsbDevice(self, devpath, device):
+        """Adds or updates a USB device.
+
+        Args:
+            devpath: string, the device path in sysfs.
+            device: dict, the attributes returned by ReadUsbDevice.
+        """
+        self._Apply(lambda: self._usb_devices.__setitem__(devpath, device))
+
+    def RemoveUsbDevice(self, devpath):
+        """Removes a USB device.
+
+        Args:
+            devpath: string, the device path in sysfs.
+        """
+        self._Apply(lambda: self._usb_devices.pop(devpath, None))
+
+    def _SetProduct(self, serial, product):
+        """Records the product name of a device."""
+        self._Apply(lambda: self._products.__setitem__(serial, product))
+
+    def _BuildDevices(self):
+        """Merges the adb states and the USB devices. Called with the lock.
+
+        Returns:
+            a dict, maps a serial to its device dict.
+        """
+        usb_by_serial = dict(
+            (usb["serial"], usb) for usb in self._usb_devices.values())
+        devices = {}
+        for serial in set(self._adb_states) | set(usb_by_serial):
+            usb = usb_by_serial.get(serial, {})
+            if usb.get("mode") == usb_utils.USB_MODE_FASTBOOT:
+                state = device_prober.FASTBOOT_STATE
+            elif serial in self._adb_states:
+                state = self._adb_states[serial]
+            elif usb.get("mode") == usb_utils.USB_MODE_ADB:
+                state = STATE_OFFLINE
+            else:
+                continue
+            devices[serial] = {
+                "state": state,
+                "usb_path": usb.get("usb_path"),
+                "port_path": usb.get("port_path"),
+                "product": self._products.get(serial),
+            }
+        return devices
+
+    def _Apply(self, update):
+        """Applies an update and notifies the subscribers of the changes.
+
+        Args:
+            update: function modifying the fields, called with the lock.
+        """
+        with self._dispatch_lock:
+            with self._lock:
+                old_devices = self._devices
+                update()
+                self._devices = self._BuildDevices()
+                subscribers = list(self._subscribers)
+            for serial in sorted(set(old_devices) | set(self._devices)):
+                old = old_devices.get(serial)
+                new = self._devices.get(serial)
+                if old == new:
+                    continue
+                logging.debug("Device %s: %s -> %s", serial, old, new)
+                self._ResolveProduct(serial, old, new)
+                for callback in subscribers:
+                    try:
+                        callback(serial, old and dict(old), new and dict(new))
+                    except Exception as e:
+                        logging.exception(e)
+
+    def _ResolveProduct(self, serial, old, new):
+        """Starts reading the product name of a device coming online.
+
+        Args:
+            serial: string, the device serial.
+            old: dict, the device before the change, or None.
+            new: dict, the device after the change, or None.
+        """
+        if (self._prober is None or new is None or new["product"]
+                or new["state"] not in (device_prober.ADB_STATE_DEVICE,
+                                        device_prober.FASTBOOT_STATE)
+                or (old and old["state"] == new["state"])):
+            return
+        thread = threading.Thread(
+            target=self._ReadProduct, args=(serial, new["state"]))
+        thread.daemon = True
+        thread.start()
+
+    def _ReadProduct(self, serial, state):
+        """Reads and records the product name of a device."""
+        try:
+            props = self._prober.Probe(serial, state)
+        except Exception as e:
+            logging.exception(e)
+            return
+        if props and props.get("product", "error") != "error":
+            self._SetProduct(serial, props["product"])
+
+
+def GetDeviceInventory():
+    """Returns the DeviceInventory shared in the current process.
+
+    A new inventory is created after fork since the source threads do not
+    survive in the child process. The caller calls Start before querying.
+
+    Returns:
+        a DeviceInventory object.
+    """
+    global _instance
+    with _instance_lock:
+        if _instance is None or _instance[0] != os.getpid():
+            _instance = (os.getpid(),
+                         DeviceInventory(
+                             prober=device_prober.DeviceProber()))
+        return _instance[1]
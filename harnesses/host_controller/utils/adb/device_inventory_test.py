@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from host_controller.utils.adb import adb_client
+from host_controller.utils.adb import device_inventory
+from host_controller.utils.adb import fake_adb_server
+
+_USB_ROOT = "/devices/pci0000:00/0000:00:14.0/usb1"
+
+
+class DeviceInventoryTest(unittest.TestCase):
+    """Tests for DeviceInventory with simulated adb and USB events."""
+
+    def setUp(self):
+        """Starts a fake adb server, a fake sysfs and a uevent socket."""
+        self._server = fake_adb_server.FakeAdbServer()
+        self._sysfs = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self._sysfs, "bus", "usb", "devices"))
+        self._uevent_sender, uevent_receiver = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._prober = mock.Mock()
+        self._prober.Probe.side_effect = (
+            lambda serial, state: {"product": "walleye"})
+        self._inventory = device_inventory.DeviceInventory(
+            device_inventory.AdbTrackSource(
+                adb_client.AdbClient(port=self._server.port)),
+            device_inventory.UeventSource(self._sysfs, uevent_receiver),
+            self._prober)
+        self._changes = queue.Queue()
+        self._inventory.Subscribe(
+            lambda serial, old, new: self._changes.put((serial, old, new)))
+
+    def tearDown(self):
+        """Stops the inventory, the fake adb server and the fake sysfs."""
+        self._inventory.Stop()
+        self._uevent_sender.close()
+        self._server.Close()
+        shutil.rmtree(self._sysfs)
+
+    def _AddUsbDevice(self, port, serial, devnum, interface):
+        """Creates a USB device in the fake sysfs.
+
+        Args:
+            port: string, the port path, e.g., "1-2".
+            serial: string, the device serial.
+            devnum: int, the device number on bus 1.
+            interface: string, "<class> <subclass> <protocol>".
+
+        Returns:
+            string, the device path.
+        """
+        devpath = "%s/%s" % (_USB_ROOT, port)
+        dev_dir = os.path.join(self._sysfs, devpath.lstrip("/"))
+        interface_dir = os.path.join(dev_dir, "%s:1.0" % port)
+        os.makedirs(interface_dir)
+        for name, value in (("serial", serial), ("busnum", "1"),
+                            ("devnum", str(devnum))):
+            with open(os.path.join(dev_dir, name), "w") as attr_file:
+                attr_file.write(value + "\n")
+        for name, value in zip(("bInterfaceClass", "bInterfaceSubClass",
+                                "bInterfaceProtocol"), interface.split()):
+            with open(os.path.join(interface_dir, name), "w") as attr_file:
+                attr_file.write(value + "\n")
+        os.symlink(
+            os.path.relpath(dev_dir,
+                            os.path.join(self._sysfs, "bus", "usb", "devices")),
+            os.path.join(self._sysfs, "bus", "usb", "devices", port))
+        return devpath
+
+    def _SendUevent(self, action, devpath, devtype="usb_device"):
+        """Sends a kernel uevent message to the inventory."""
+        fields = ["%s@%s" % (action, devpath), "ACTION=" + action,
+                  "DEVPATH=" + devpath, "SUBSYSTEM=usb", "DEVTYPE=" + devtype]
+        self._uevent_sender.send("\0".join(fields).encode("utf-8"))
+
+    def _WaitForState(self, serial, state):
+        """Waits until a device changes to a state.
+
+        Args:
+            serial: string, the device serial.
+            state: string, the expected state. None to wait for removal.
+
+        Returns:
+            the device dict after the change.
+        """
+        while True:
+            changed_serial, _, new = self._changes.get(timeout=5)
+            if (changed_serial == serial
+                    and (new["state"] if new else None) == state):
+                return new
+
+    def testParseUevent(self):
+        """Tests parsing the kernel uevents and ignoring the udev ones."""
+        self.assertEqual({
+            "ACTION": "add",
+            "DEVPATH": "/devices/usb1/1-2",
+        }, device_inventory.ParseUevent(
+            b"add@/devices/usb1/1-2\0ACTION=add\0DEVPATH=/devices/usb1/1-2"))
+        self.assertIsNone(device_inventory.ParseUevent(b"libudev\0\0\0"))
+
+    def testInitialDevices(self):
+        """Tests merging the adb states and the USB devices on start."""
+        self._server.SetDevice("serial1", "device")
+        self._server.SetDevice("emulator-5554", "device")
+        self._AddUsbDevice("1-1", "serial1", 3, "ff 42 01")
+        self._AddUsbDevice("1-2", "serial2", 4, "ff 42 03")
+        self._AddUsbDevice("1-3", "keyboard", 5, "03 01 01")
+        self.assertTrue(self._inventory.Start())
+        self.assertTrue(self._inventory.IsUsbTracked())
+
+        self.assertEqual(["emulator-5554", "serial1", "serial2"],
+                         self._inventory.GetSerials())
+        self.assertEqual(["serial2"],
+                         self._inventory.GetSerials("fastboot"))
+        serial1 = self._inventory.GetDevice("serial1")
+        self.assertEqual("device", serial1["state"])
+        self.assertEqual("/dev/bus/usb/001/003", serial1["usb_path"])
+        self.assertEqual("1-1", serial1["port_path"])
+        self.assertIsNone(
+            self._inventory.GetDevice("emulator-5554")["usb_path"])
+
+        products = set()
+        while len(products) < 3:
+            serial, _, new = self._changes.get(timeout=5)
+            if new["product"]:
+                products.add(serial)
+        self.assertEqual("walleye",
+                         self._inventory.GetDevice("serial2")["product"])
+
+    def testHotplugEvents(self):
+        """Tests that a reboot into the bootloader is pushed as events."""
+        self.assertTrue(self._inventory.Start())
+        self.assertEqual([], self._inventory.GetSerials())
+
+        devpath = self._AddUsbDevice("1-2", "serial1", 3, "ff 42 01")
+        self._SendUevent("add", devpath)
+        self._WaitForState("serial1", device_inventory.STATE_OFFLINE)
+        self._server.SetDevice("serial1", "device")
+        self._WaitForState("serial1", "device")
+        self.assertEqual("walleye",
+                         self._WaitForState("serial1", "device")["product"])
+
+        self._server.SetDevice("serial1", None)
+        self._WaitForState("serial1", device_inventory.STATE_OFFLINE)
+        self._SendUevent("remove", devpath)
+        self._WaitForState("serial1", None)
+
+        shutil.rmtree(os.path.join(self._sysfs, devpath.lstrip("/")))
+        os.remove(os.path.join(self._sysfs, "bus", "usb", "devices", "1-2"))
+        devpath = self._AddUsbDevice("1-2", "serial1", 4, "ff 42 03")
+        self._SendUevent("add", devpath)
+        new = self._WaitForState("serial1", "fastboot")
+        self.assertEqual("/dev/bus/usb/001/004", new["usb_path"])
+        self.assertEqual("walleye", new["product"])
+        self.assertEqual(1, self._prober.Probe.call_count)
+
+    def testAdbServerLost(self):
+        """Tests that the adb states are cleared without the adb server."""
+        self._server.SetDevice("serial1", "device")
+        self.assertTrue(self._inventory.Start())
+        self.assertEqual(["serial1"], self._inventory.GetSerials())
+        self._server.Close()
+        self._WaitForState("serial1", None)
+        self.assertFalse(self._inventory.Start())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,243 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Non-destructive probing of the device properties."""
+
+import logging
+import re
+import socket
+import threading
+import time
+
+from host_controller import common
+from host_controller.utils.adb import adb_client
+from host_controller.utils.usb import usb_utils
+
+from vts.utils.python.common import cmd_utils
+
+# adb state of a device whose adbd is online.
+ADB_STATE_DEVICE = "device"
+
+# State of a device listed by "fastboot devices".
+FASTBOOT_STATE = "fastboot"
+
+# System properties holding the product name, in order of preference. The
+# vendor properties are kept when a GSI replaces the system image.
+_PRODUCT_PROPS = ("ro.product.vendor.device", "ro.vendor.product.device",
+                  "ro.product.device", "ro.build.product")
+
+# Maps the keys of the probed properties to the system properties.
+_PROPS = {
+    "serial": "ro.serialno",
+    "fingerprint": "ro.build.fingerprint",
+}
+
+_GETPROP_LINE = re.compile(r"^\[(.*?)\]: \[(.*)\]$")
+_DUMPSYS_LINE = re.compile(r"^\s*([\w ]+):\s*(-?\d+)\s*$")
+
+
+def ParseGetprop(output):
+    """Parses the output of getprop without arguments.
+
+    Args:
+        output: string, lines in the format of "[name]: [value]".
+
+    Returns:
+        a dict, maps a property name to its value.
+    """
+    props = {}
+    for line in output.splitlines():
+        match = _GETPROP_LINE.match(line.strip())
+        if match:
+            props[match.group(1)] = match.group(2)
+    return props
+
+
+def ParseDumpsysBattery(output):
+    """Parses the output of dumpsys battery.
+
+    Args:
+        output: string, the output of "dumpsys battery".
+
+    Returns:
+        a dict with "battery_level" in percent and "battery_temperature"
+        in degrees Celsius, if found.
+    """
+    values = {}
+    for line in output.splitlines():
+        match = _DUMPSYS_LINE.match(line)
+        if match:
+            values[match.group(1).strip()] = int(match.group(2))
+    result = {}
+    if "level" in values:
+        result["battery_level"] = values["level"]
+    if "temperature" in values:
+        # dumpsys reports the temperature in tenths of a degree.
+        result["battery_temperature"] = values["temperature"] / 10.0
+    return result
+
+
+def ParseFastbootProduct(stderr, serial):
+    """Parses the output of "fastboot getvar product".
+
+    Args:
+        stderr: string, the stderr of the command.
+        serial: string, the device serial.
+
+    Returns:
+        string, the product name. "error" if not found.
+    """
+    lines = stderr.splitlines()
+    if not lines:
+        return "error"
+    res = lines[0].rstrip()
+    if ":" in res:
+        return res.split(":")[1].strip()
+    elif "waiting for %s" % serial in res and len(lines) > 1:
+        return lines[1].rstrip().split(":")[1].strip()
+    return "error"
+
+
+class DeviceProber(object):
+    """Reads the device properties without changing the device state.
+
+    Online devices are queried through the adb server with getprop and
+    dumpsys. fastboot getvar is used only for the devices which are already
+    in fastboot mode. The product name the bootloader reported is kept for
+    the lifetime of the serial and preferred to the system properties of
+    the online device. The results are cached per device until the TTL
+    expires or the device changes its state.
+
+    Attributes:
+        _client: AdbClient, the client of the adb server.
+        _ttl: float, the number of seconds a cached result is valid.
+        _clock: function returning the current time in seconds.
+        _cache: dict, maps a serial to (state, expiry time, properties).
+        _products: dict, maps a serial to its product read in fastboot
+                   mode. Not dropped by Retain, as the devices leave the
+                   list while they reboot.
+        _lock: threading.Lock, guards _cache and _products.
+    """
+
+    def __init__(self,
+                 client=None,
+                 ttl=common.DEVICE_PROPERTY_TTL_SECS,
+                 clock=time.time):
+        self._client = client or adb_client.AdbClient()
+        self._ttl = ttl
+        self._clock = clock
+        self._cache = {}
+        self._products = {}
+        self._lock = threading.Lock()
+
+    def Probe(self, serial, state):
+        """Returns the properties of a device.
+
+        Args:
+            serial: string, the device serial.
+            state: string, the adb state, or FASTBOOT_STATE.
+
+        Returns:
+            a dict with "product", "serial", and for online devices
+            "fingerprint", "battery_level" and "battery_temperature" if
+            available. None if the device cannot be probed in its state.
+        """
+        now = self._clock()
+        with self._lock:
+            entry = self._cache.get(serial)
+            if entry and entry[0] == state and entry[1] > now:
+                return dict(entry[2])
+
+        if state == ADB_STATE_DEVICE:
+            props = self._ProbeAdb(serial)
+        elif state == FASTBOOT_STATE:
+            props = self._ProbeFastboot(serial)
+        else:
+            props = None
+
+        with self._lock:
+            if props is None:
+                self._cache.pop(serial, None)
+                return None
+            self._cache[serial] = (state, now + self._ttl, props)
+        return dict(props)
+
+    def Invalidate(self, serial):
+        """Drops the cached properties of a device.
+
+        Args:
+            serial: string, the device serial.
+        """
+        with self._lock:
+            self._cache.pop(serial, None)
+
+    def Retain(self, serials):
+        """Drops the cached properties of the devices not in the list.
+
+        Args:
+            serials: list of strings, the serials of the attached devices.
+        """
+        with self._lock:
+            for serial in list(self._cache):
+                if serial not in serials:
+                    del self._cache[serial]
+
+    def _ProbeAdb(self, serial):
+        """Reads the properties of an online device through adb.
+
+        Returns:
+            a dict of the properties. None if the device does not respond.
+        """
+        try:
+            sys_props = ParseGetprop(self._client.Shell(serial, "getprop"))
+            battery = ParseDumpsysBattery(
+                self._client.Shell(serial, "dumpsys battery"))
+        except (adb_client.AdbClientError, socket.error) as e:
+            logging.error("Failed to probe %s: %s", serial, e)
+            return None
+
+        with self._lock:
+            props = {"product": self._products.get(serial, "error")}
+        if props["product"] == "error":
+            for name in _PRODUCT_PROPS:
+                if sys_props.get(name):
+                    props["product"] = sys_props[name]
+                    break
+        for key, name in _PROPS.items():
+            props[key] = sys_props.get(name, "")
+        props["serial"] = props["serial"] or serial
+        props.update(battery)
+        return props
+
+    def _ProbeFastboot(self, serial):
+        """Reads the product name of a device in fastboot mode.
+
+        Returns:
+            a dict of the properties. None if the device does not respond.
+        """
+        _, stderr, retcode = cmd_utils.ExecuteOneShellCommand(
+            "fastboot -s %s getvar product" % serial,
+            common.DEFAULT_DEVICE_TIMEOUT_SECS,
+            usb_utils.ResetUsbDeviceOfSerial_Callback, serial)
+        if retcode != 0:
+            return None
+        product = ParseFastbootProduct(stderr, serial)
+        if product != "error":
+            with self._lock:
+                self._products[serial] = product
+        return {
+            "product": product,
+            "serial": serial,
+        }
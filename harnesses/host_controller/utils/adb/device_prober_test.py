@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from host_controller.utils.adb import adb_client
+from host_controller.utils.adb import device_prober
+from host_controller.utils.adb import fake_adb_server
+
+_DUMPSYS_BATTERY = """Current Battery Service state:
+  AC powered: false
+  USB powered: true
+  status: 2
+  level: 87
+  scale: 100
+  temperature: 312
+  technology: Li-ion
+"""
+
+
+class DeviceProberTest(unittest.TestCase):
+    """Tests for DeviceProber against a fake adb server."""
+
+    def setUp(self):
+        """Starts a fake adb server and a prober connected to it."""
+        self._server = fake_adb_server.FakeAdbServer()
+        self._now = 1000.0
+        self._prober = device_prober.DeviceProber(
+            adb_client.AdbClient(port=self._server.port),
+            ttl=60,
+            clock=lambda: self._now)
+        self._server.SetDevice("serial1", "device")
+        self._server.SetProp("serial1", "ro.product.device", "walleye")
+        self._server.SetProp("serial1", "ro.serialno", "serial1")
+        self._server.SetProp("serial1", "ro.build.fingerprint", "google/fp")
+        self._server.SetShellOutput("serial1", "dumpsys battery",
+                                    _DUMPSYS_BATTERY)
+
+    def tearDown(self):
+        """Stops the fake adb server."""
+        self._server.Close()
+
+    def testParseFastbootProduct(self):
+        """Tests parsing the getvar output."""
+        self.assertEqual(
+            "walleye",
+            device_prober.ParseFastbootProduct("product: walleye\n", "s1"))
+        self.assertEqual(
+            "taimen",
+            device_prober.ParseFastbootProduct(
+                "< waiting for s1 >\nproduct: taimen\n", "s1"))
+        self.assertEqual("error",
+                         device_prober.ParseFastbootProduct("", "s1"))
+
+    def testProbeOnlineDevice(self):
+        """Tests reading the properties over adb."""
+        self.assertEqual({
+            "product": "walleye",
+            "serial": "serial1",
+            "fingerprint": "google/fp",
+            "battery_level": 87,
+            "battery_temperature": 31.2,
+        }, self._prober.Probe("serial1", "device"))
+        self.assertIsNone(self._prober.Probe("serial2", "device"))
+        self.assertIsNone(self._prober.Probe("serial1", "unauthorized"))
+
+    @mock.patch("host_controller.utils.adb.device_prober.cmd_utils")
+    def testProductAfterGsi(self, mock_cmd_utils):
+        """Tests the product of a device whose system image is a GSI."""
+        self._server.SetProp("serial1", "ro.product.device", "generic_arm64")
+        self._server.SetProp("serial1", "ro.product.vendor.device",
+                             "walleye")
+        self.assertEqual("walleye",
+                         self._prober.Probe("serial1", "device")["product"])
+        mock_cmd_utils.ExecuteOneShellCommand.assert_not_called()
+
+        mock_cmd_utils.ExecuteOneShellCommand.return_value = (
+            "", "product: walleye_bl\nfinished.", 0)
+        self._prober.Probe("serial1", "fastboot")
+        # The device leaves the list while it reboots.
+        self._prober.Retain([])
+        self.assertEqual("walleye_bl",
+                         self._prober.Probe("serial1", "device")["product"])
+        self.assertEqual(1, mock_cmd_utils.ExecuteOneShellCommand.call_count)
+
+    def testCache(self):
+        """Tests the TTL and the invalidation on state change."""
+        self._prober.Probe("serial1", "device")
+        self._prober.Probe("serial1", "device")
+        self.assertEqual(2, len(self._server.shell_commands))
+
+        self._now += 61
+        self._prober.Probe("serial1", "device")
+        self.assertEqual(4, len(self._server.shell_commands))
+
+        with mock.patch(
+                "host_controller.utils.adb.device_prober.cmd_utils"
+        ) as mock_cmd_utils:
+            mock_cmd_utils.ExecuteOneShellCommand.return_value = (
+                "", "product: walleye\nfinished.", 0)
+            self.assertEqual({"product": "walleye", "serial": "serial1"},
+                             self._prober.Probe("serial1", "fastboot"))
+            self._prober.Probe("serial1", "fastboot")
+            self.assertEqual(
+                1, mock_cmd_utils.ExecuteOneShellCommand.call_count)
+
+        self._prober.Probe("serial1", "device")
+        self.assertEqual(6, len(self._server.shell_commands))
+        self._prober.Retain([])
+        self._prober.Probe("serial1", "device")
+        self.assertEqual(8, len(self._server.shell_commands))
+
+if __name__ == "__main__":
+    unittest.main()
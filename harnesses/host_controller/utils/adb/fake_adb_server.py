@@ -0,0 +1,427 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""In-process fake of the adb server for the unit tests."""
+
+import socket
+import stat
+import struct
+import threading
+import time
+
+
+class FakeAdbServer(object):
+    """Serves a subset of the adb smart socket protocol on localhost.
+
+    Supported services are host:version, host:devices, host:track-devices,
+    host:transport:<serial>, sync: with STAT, SEND, RECV and QUIT, and
+    shell: and shell,v2,raw: running getprop [<name>] and the shell
+    commands whose output is set by SetShellOutput. shell,v2,raw: without
+    a command starts an interactive shell as used by ShellSession.
+
+    Attributes:
+        port: int, the port on which the server listens.
+        shell_commands: list of (serial, command) tuples received.
+        connections: int, the number of the connections accepted.
+        _devices: dict, maps a serial to its adb state.
+        _props: dict, maps a serial to a dict of system properties.
+        _shell_outputs: dict, maps (serial, command) to a tuple of (stdout,
+                        stderr, exit code).
+        _shell_intervals: dict, maps (serial, command) to the seconds
+                          between the shell v2 packets.
+        _files: dict, maps (serial, path) to a tuple of (mode, data,
+                mtime).
+        _trackers: list of sockets subscribed to host:track-devices.
+        _shells: list of sockets of the interactive shells.
+        _lock: threading.Lock, guards the fields above.
+    """
+
+    def __init__(self):
+        self._devices = {}
+        self._props = {}
+        self._shell_outputs = {}
+        self._shell_intervals = {}
+        self._files = {}
+        self._trackers = []
+        self._shells = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self.shell_commands = []
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("127.0.0.1", 0))
+        self._server.listen(16)
+        self.port = self._server.getsockname()[1]
+        self._closed = False
+        self._thread = threading.Thread(target=self._Serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def Close(self):
+        """Stops the server and closes the tracking connections."""
+        self._closed = True
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._server.close()
+        self._thread.join()
+        with self._lock:
+            for tracker in self._trackers:
+                tracker.close()
+            self._trackers = []
+
+    def SetDevice(self, serial, state):
+        """Attaches a device or changes its state.
+
+        Args:
+            serial: string, the device serial.
+            state: string, the adb state. None to detach the device.
+        """
+        with self._lock:
+            if state is None:
+                self._devices.pop(serial, None)
+                self._props.pop(serial, None)
+            else:
+                self._devices[serial] = state
+            self._NotifyTrackers()
+
+    def SetProp(self, serial, name, value):
+        """Sets a system property of a device.
+
+        Args:
+            serial: string, the device serial.
+            name: string, the property name.
+            value: string, the property value.
+        """
+        with self._lock:
+            self._props.setdefault(serial, {})[name] = value
+
+    def SetShellOutput(self,
+                       serial,
+                       command,
+                       output,
+                       stderr="",
+                       exit_code=0,
+                       interval=0):
+        """Sets the output of a shell command on a device.
+
+        Args:
+            serial: string, the device serial.
+            command: string, the shell command.
+            output: string, the stdout.
+            stderr: string, the stderr, sent only with shell v2.
+            exit_code: int, the exit code, sent only with shell v2.
+            interval: float, the seconds to wait before each shell v2
+                      packet of the command, as if it ran slowly.
+        """
+        with self._lock:
+            self._shell_outputs[(serial, command)] = (output, stderr,
+                                                      exit_code)
+            self._shell_intervals[(serial, command)] = interval
+
+    def KillShells(self):
+        """Closes the interactive shells as if adbd restarted."""
+        with self._lock:
+            for shell in self._shells:
+                try:
+                    shell.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            self._shells = []
+
+    def SetFile(self, serial, path, data, mode=0o644):
+        """Creates a file on a device.
+
+        Args:
+            serial: string, the device serial.
+            path: string, the path on the device.
+            data: bytes, the content. None to create a directory.
+            mode: int, the permission bits.
+        """
+        with self._lock:
+            if data is None:
+                mode |= stat.S_IFDIR
+            else:
+                mode |= stat.S_IFREG
+            self._files[(serial, path)] = (mode, data, int(time.time()))
+
+    def GetFile(self, serial, path):
+        """Returns (mode, data, mtime) of a file on a device, or None."""
+        with self._lock:
+            return self._files.get((serial, path))
+
+    def _DeviceListPayload(self):
+        """Returns the length-prefixed device list. Called with the lock."""
+        payload = "".join("%s\t%s\n" % (serial, state)
+                          for serial, state in sorted(self._devices.items()))
+        return ("%04x" % len(payload) + payload).encode("utf-8")
+
+    def _NotifyTrackers(self):
+        """Sends the device list to the trackers. Called with the lock."""
+        payload = self._DeviceListPayload()
+        for tracker in list(self._trackers):
+            try:
+                tracker.sendall(payload)
+            except socket.error:
+                self._trackers.remove(tracker)
+
+    def _Serve(self):
+        """Accepts the connections."""
+        while not self._closed:
+            try:
+                conn, _ = self._server.accept()
+            except socket.error:
+                return
+            with self._lock:
+                self.connections += 1
+            thread = threading.Thread(target=self._Handle, args=(conn, ))
+            thread.daemon = True
+            thread.start()
+
+    @staticmethod
+    def _ReadRequest(conn):
+        """Reads a length-prefixed request.
+
+        Returns:
+            string, the request. None if the connection is closed.
+        """
+        data = b""
+        while len(data) < 4:
+            chunk = conn.recv(4 - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        length = int(data, 16)
+        data = b""
+        while len(data) < length:
+            chunk = conn.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data.decode("utf-8")
+
+    @staticmethod
+    def _Fail(conn, message):
+        """Sends a FAIL response and closes the connection."""
+        conn.sendall(("FAIL%04x%s" % (len(message), message)).encode("utf-8"))
+        conn.close()
+
+    def _RunShell(self, serial, command):
+        """Returns (stdout, stderr, exit code) of a shell command."""
+        with self._lock:
+            self.shell_commands.append((serial, command))
+            props = self._props.get(serial, {})
+            if command == "getprop":
+                return "".join("[%s]: [%s]\n" % item
+                               for item in sorted(props.items())), "", 0
+            if command.startswith("getprop "):
+                return props.get(command.split()[1], "") + "\n", "", 0
+            return self._shell_outputs.get((serial, command), ("", "", 0))
+
+    @staticmethod
+    def _ReadExactly(conn, length):
+        """Reads the given number of bytes. None if the peer closed."""
+        data = b""
+        while len(data) < length:
+            chunk = conn.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    @staticmethod
+    def _SendShellPacket(conn, stream_id, data):
+        """Sends a shell v2 packet unless the data is empty."""
+        if data:
+            conn.sendall(struct.pack("<BI", stream_id, len(data)) + data)
+
+    def _HandleInteractiveShell(self, conn, serial):
+        """Serves an interactive shell v2 session until exit or EOF.
+
+        The shell understands the lines "{ <command>", which runs a command
+        set by SetShellOutput, and "} ...; echo <text> [>&2]; ...", which
+        echoes the text with $? replaced by the last exit code, as sent by
+        ShellSession.
+        """
+        exit_code = 0
+        buf = b""
+        while True:
+            header = self._ReadExactly(conn, 5)
+            if header is None:
+                return
+            data = self._ReadExactly(conn,
+                                     struct.unpack("<I", header[1:])[0])
+            if data is None:
+                return
+            if ord(header[:1]) != 0:
+                continue
+            buf += data
+            while b"\n" in buf:
+                line, buf = buf.split(b"\n", 1)
+                line = line.decode("utf-8")
+                if line == "exit":
+                    conn.sendall(struct.pack("<BIB", 3, 1, exit_code))
+                    return
+                if line.startswith("{ "):
+                    stdout, stderr, exit_code = self._RunShell(
+                        serial, line[2:])
+                    with self._lock:
+                        interval = self._shell_intervals.get(
+                            (serial, line[2:]), 0)
+                    time.sleep(interval)
+                    self._SendShellPacket(conn, 1, stdout.encode("utf-8"))
+                    self._SendShellPacket(conn, 2, stderr.encode("utf-8"))
+                    continue
+                for part in line.split("; ")[1:]:
+                    if not part.startswith("echo "):
+                        continue
+                    text = part[len("echo "):]
+                    stream_id = 1
+                    if text.endswith(" >&2"):
+                        text, stream_id = text[:-len(" >&2")], 2
+                    text = text.strip('"').replace("$?", str(exit_code))
+                    self._SendShellPacket(conn, stream_id,
+                                          (text + "\n").encode("utf-8"))
+
+    def _HandleSync(self, conn, serial):
+        """Serves the sync requests of a device until QUIT."""
+        while True:
+            header = self._ReadExactly(conn, 8)
+            if header is None:
+                return
+            request_id = header[:4]
+            length = struct.unpack("<I", header[4:])[0]
+            payload = self._ReadExactly(conn, length) if request_id not in (
+                b"QUIT", ) else b""
+            if request_id == b"QUIT" or payload is None:
+                return
+            path = payload.decode("utf-8")
+            if request_id == b"STAT":
+                entry = self.GetFile(serial, path)
+                mode, data, mtime = entry if entry else (0, b"", 0)
+                conn.sendall(b"STAT" + struct.pack(
+                    "<III", mode, len(data or b""), mtime))
+            elif request_id == b"SEND":
+                path, mode = path.rsplit(",", 1)
+                chunks = []
+                while True:
+                    header = self._ReadExactly(conn, 8)
+                    if header is None:
+                        return
+                    value = struct.unpack("<I", header[4:])[0]
+                    if header[:4] == b"DONE":
+                        break
+                    chunks.append(self._ReadExactly(conn, value))
+                with self._lock:
+                    self._files[(serial, path)] = (int(mode),
+                                                   b"".join(chunks), value)
+                conn.sendall(b"OKAY" + struct.pack("<I", 0))
+            elif request_id == b"RECV":
+                entry = self.GetFile(serial, path)
+                if entry is None or entry[1] is None:
+                    message = b"No such file or directory"
+                    conn.sendall(b"FAIL" + struct.pack("<I", len(message)) +
+                                 message)
+                    continue
+                data = entry[1]
+                for offset in range(0, len(data), 64 * 1024):
+                    chunk = data[offset:offset + 64 * 1024]
+                    conn.sendall(b"DATA" + struct.pack("<I", len(chunk)) +
+                                 chunk)
+                conn.sendall(b"DONE" + struct.pack("<I", 0))
+            else:
+                message = b"unknown sync request"
+                conn.sendall(b"FAIL" + struct.pack("<I", len(message)) +
+                             message)
+                return
+
+    def _Handle(self, conn):
+        """Handles the requests on a connection."""
+        serial = None
+        try:
+            while True:
+                request = self._ReadRequest(conn)
+                if request is None:
+                    conn.close()
+                    return
+                if request == "host:version":
+                    conn.sendall(b"OKAY00040029")
+                    conn.close()
+                    return
+                if request == "host:devices":
+                    with self._lock:
+                        conn.sendall(b"OKAY" + self._DeviceListPayload())
+                    conn.close()
+                    return
+                if request == "host:track-devices":
+                    with self._lock:
+                        conn.sendall(b"OKAY" + self._DeviceListPayload())
+                        self._trackers.append(conn)
+                    return
+                if request.startswith("host:transport:"):
+                    serial = request[len("host:transport:"):]
+                    with self._lock:
+                        online = self._devices.get(serial) == "device"
+                    if not online:
+                        self._Fail(conn, "device '%s' not found" % serial)
+                        return
+                    conn.sendall(b"OKAY")
+                    continue
+                if request.startswith("shell:") and serial:
+                    stdout, _, _ = self._RunShell(serial,
+                                                  request[len("shell:"):])
+                    conn.sendall(b"OKAY" + stdout.encode("utf-8"))
+                    conn.close()
+                    return
+                if request == "shell,v2,raw:" and serial:
+                    conn.sendall(b"OKAY")
+                    with self._lock:
+                        self._shells.append(conn)
+                    self._HandleInteractiveShell(conn, serial)
+                    conn.close()
+                    return
+                if request.startswith("shell,v2,raw:") and serial:
+                    command = request[len("shell,v2,raw:"):]
+                    stdout, stderr, exit_code = self._RunShell(
+                        serial, command)
+                    with self._lock:
+                        interval = self._shell_intervals.get(
+                            (serial, command), 0)
+                    conn.sendall(b"OKAY")
+                    # Splits stdout to exercise the streaming.
+                    stdout = stdout.encode("utf-8")
+                    half = len(stdout) // 2
+                    for stream_id, data in ((1, stdout[:half]),
+                                            (1, stdout[half:]),
+                                            (2, stderr.encode("utf-8"))):
+                        if data:
+                            time.sleep(interval)
+                            conn.sendall(
+                                struct.pack("<BI", stream_id, len(data)) +
+                                data)
+                    time.sleep(interval)
+                    conn.sendall(struct.pack("<BIB", 3, 1, exit_code))
+                    conn.close()
+                    return
+                if request == "sync:" and serial:
+                    conn.sendall(b"OKAY")
+                    self._HandleSync(conn, serial)
+                    conn.close()
+                    return
+                self._Fail(conn, "unknown service %s" % request)
+                return
+        except socket.error:
+            conn.close()
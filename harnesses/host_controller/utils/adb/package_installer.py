@@ -0,0 +1,224 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Installs APKs on devices unless the identical APK is already installed."""
+
+import hashlib
+import logging
+import os
+import threading
+
+from host_controller.utils.adb import adb_client
+from host_controller.utils.adb import shell_session
+from host_controller.utils.usb import transfer_scheduler
+
+# Directory on the device to which the APKs are pushed before installation.
+_REMOTE_TMP_DIR = "/data/local/tmp"
+
+# File whose content changes on every boot of the device.
+_BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+
+# Maximum time to install an APK in seconds. "pm install" prints nothing
+# while it runs dexopt, which may take minutes on older devices.
+_INSTALL_TIMEOUT_SECS = 600
+
+
+class PackageInstallError(adb_client.AdbClientError):
+    """Raised when the package manager fails to install an APK."""
+    pass
+
+
+def _ParsePmPath(output):
+    """Returns the path of the base APK from "pm path", or None."""
+    for line in output.splitlines():
+        if line.startswith("package:"):
+            return line[len("package:"):].strip()
+    return None
+
+
+class PackageInstaller(object):
+    """Installs APKs, skipping the devices which have them installed.
+
+    An installed package is compared with the host-side APK by the SHA-256
+    of its base.apk, which covers both the version and the signature. The
+    digest on a device is cached with the device's boot id and the path of
+    the installed APK, which changes whenever the package is reinstalled,
+    so that an unchanged package is verified by one shell round trip.
+
+    Attributes:
+        _client: AdbClient, pushes the APKs.
+        _sessions: ShellSessionManager, runs the package manager commands.
+        _scheduler: UsbTransferScheduler, admits the pushes.
+        _lock: threading.Lock, guards the caches.
+        _apk_digests: dict, maps an APK path to (size, mtime, digest).
+        _installed: dict, maps (serial, package) to (boot id, path, digest).
+    """
+
+    def __init__(self, client=None, sessions=None, scheduler=None):
+        self._client = client or adb_client.AdbClient()
+        self._sessions = sessions or shell_session.GetShellSessionManager()
+        self._scheduler = (scheduler or
+                           transfer_scheduler.GetTransferScheduler())
+        self._lock = threading.Lock()
+        self._apk_digests = {}
+        self._installed = {}
+
+    def GetApkDigest(self, apk_path):
+        """Returns the SHA-256 of an APK, computed once per modification."""
+        apk_stat = os.stat(apk_path)
+        key = (apk_stat.st_size, apk_stat.st_mtime)
+        with self._lock:
+            cached = self._apk_digests.get(apk_path)
+        if cached and cached[:2] == key:
+            return cached[2]
+        sha256 = hashlib.sha256()
+        with open(apk_path, "rb") as apk_file:
+            for chunk in iter(lambda: apk_file.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        with self._lock:
+            self._apk_digests[apk_path] = key + (digest, )
+        return digest
+
+    def _GetInstalled(self, serial, package):
+        """Returns the boot id, the path and the digest of a package.
+
+        Args:
+            serial: string, the device serial.
+            package: string, the package name.
+
+        Returns:
+            a tuple of (boot id, path, digest). The path and the digest
+            are None if the package is not installed.
+        """
+        session = self._sessions.Get(serial)
+        boot_id, pm_path = session.RunBatch(
+            ["cat %s" % _BOOT_ID_PATH, "pm path %s" % package])
+        boot_id = boot_id[0].strip()
+        path = _ParsePmPath(pm_path[0])
+        if not path:
+            return boot_id, None, None
+
+        with self._lock:
+            cached = self._installed.get((serial, package))
+        if cached and cached[:2] == (boot_id, path):
+            return cached
+        stdout, _, exit_code = session.Run("sha256sum %s" % path)
+        digest = stdout.split()[0] if exit_code == 0 and stdout else None
+        installed = (boot_id, path, digest)
+        with self._lock:
+            self._installed[(serial, package)] = installed
+        return installed
+
+    def IsInstalled(self, serial, apk_path, package):
+        """Returns whether a device has the identical APK installed."""
+        digest = self._GetInstalled(serial, package)[2]
+        return digest is not None and digest == self.GetApkDigest(apk_path)
+
+    def Install(self, serial, apk_path, package, grant_permissions=True):
+        """Installs an APK on a device unless it is already installed.
+
+        Args:
+            serial: string, the device serial.
+            apk_path: string, the local APK file.
+            package: string, the package name of the APK.
+            grant_permissions: bool, whether to grant all runtime
+                               permissions, like "adb install -g".
+
+        Returns:
+            True if the APK was installed; False if it was up to date.
+
+        Raises:
+            AdbClientError if the device is unreachable.
+            PackageInstallError if the package manager fails.
+        """
+        apk_digest = self.GetApkDigest(apk_path)
+        boot_id, _, digest = self._GetInstalled(serial, package)
+        if digest == apk_digest:
+            logging.info("%s is up to date on %s.", package, serial)
+            return False
+
+        remote_path = "%s/%s" % (_REMOTE_TMP_DIR, os.path.basename(apk_path))
+        num_bytes = os.path.getsize(apk_path)
+        with self._scheduler.Transfer(serial, num_bytes) as transfer:
+            self._client.Push(serial, apk_path, remote_path)
+            transfer.success = True
+        session = self._sessions.Get(serial)
+        install, _, pm_path = session.RunBatch([
+            "pm install -r %s%s" % ("-g " if grant_permissions else "",
+                                    remote_path),
+            "rm -f %s" % remote_path,
+            "pm path %s" % package,
+        ], timeout=_INSTALL_TIMEOUT_SECS)
+        if install[2] != 0 or "Success" not in install[0]:
+            with self._lock:
+                self._installed.pop((serial, package), None)
+            raise PackageInstallError(
+                "Failed to install %s on %s: %s" %
+                (apk_path, serial, (install[0] + install[1]).strip()))
+        with self._lock:
+            self._installed[(serial, package)] = (
+                boot_id, _ParsePmPath(pm_path[0]), apk_digest)
+        logging.info("Installed %s on %s.", package, serial)
+        return True
+
+    def InstallOnDevices(self, serials, apk_path, package,
+                         grant_permissions=True):
+        """Installs an APK on devices concurrently.
+
+        Args:
+            serials: list of strings, the device serials.
+            apk_path: string, the local APK file.
+            package: string, the package name of the APK.
+            grant_permissions: bool, whether to grant the permissions.
+
+        Returns:
+            a dict, maps a serial to True if the APK is installed on the
+            device, either now or before, and False on failure.
+        """
+        results = {}
+
+        def _Install(serial):
+            try:
+                self.Install(serial, apk_path, package, grant_permissions)
+                results[serial] = True
+            except (adb_client.AdbClientError, EnvironmentError) as e:
+                logging.error("Failed to install %s on %s: %s", package,
+                              serial, e)
+                results[serial] = False
+
+        threads = [
+            threading.Thread(target=_Install, args=(serial, ))
+            for serial in serials
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+
+_installer = None
+_installer_lock = threading.Lock()
+
+
+def GetPackageInstaller():
+    """Returns the PackageInstaller shared in the current process."""
+    global _installer
+    with _installer_lock:
+        if _installer is None:
+            _installer = PackageInstaller()
+        return _installer
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from host_controller.utils.adb import adb_client
+from host_controller.utils.adb import fake_adb_server
+from host_controller.utils.adb import package_installer
+from host_controller.utils.adb import shell_session
+
+_PACKAGE = "com.android.tradefed.utils.wifi"
+_INSTALLED_PATH = "/data/app/WifiUtil-1/base.apk"
+_INSTALL = "pm install -r -g /data/local/tmp/WifiUtil.apk"
+
+
+class PackageInstallerTest(unittest.TestCase):
+    """Tests for PackageInstaller against a fake adb server."""
+
+    def setUp(self):
+        """Starts a fake adb server and writes an APK."""
+        self._temp_dir = tempfile.mkdtemp()
+        self._apk = os.path.join(self._temp_dir, "WifiUtil.apk")
+        with open(self._apk, "wb") as apk_file:
+            apk_file.write(b"apk content")
+        self._digest = hashlib.sha256(b"apk content").hexdigest()
+
+        self._server = fake_adb_server.FakeAdbServer()
+        client = adb_client.AdbClient(port=self._server.port)
+        for serial in ("serial1", "serial2"):
+            self._server.SetDevice(serial, "device")
+            self._server.SetShellOutput(
+                serial, "cat /proc/sys/kernel/random/boot_id", "boot1\n")
+            self._server.SetShellOutput(serial, "pm path %s" % _PACKAGE,
+                                        "", "", 1)
+            self._server.SetShellOutput(serial, _INSTALL, "Success\n")
+        self._sessions = shell_session.ShellSessionManager(client)
+        self._scheduler = mock.MagicMock()
+        self._installer = package_installer.PackageInstaller(
+            client, self._sessions, self._scheduler)
+
+    def tearDown(self):
+        """Stops the fake adb server."""
+        self._sessions.CloseAll()
+        self._server.Close()
+        shutil.rmtree(self._temp_dir)
+
+    def _SetInstalled(self, serial, digest):
+        """Makes a device report the package as installed."""
+        self._server.SetShellOutput(serial, "pm path %s" % _PACKAGE,
+                                    "package:%s\n" % _INSTALLED_PATH)
+        self._server.SetShellOutput(serial, "sha256sum %s" % _INSTALLED_PATH,
+                                    "%s  %s\n" % (digest, _INSTALLED_PATH))
+
+    def _GetCommands(self, serial):
+        """Returns the shell commands run on a device."""
+        return [c for s, c in self._server.shell_commands if s == serial]
+
+    def testInstall(self):
+        """Tests installing a package missing on the device."""
+        self.assertTrue(
+            self._installer.Install("serial1", self._apk, _PACKAGE))
+        self.assertEqual(
+            b"apk content",
+            self._server.GetFile("serial1",
+                                 "/data/local/tmp/WifiUtil.apk")[1])
+        self.assertIn(_INSTALL, self._GetCommands("serial1"))
+        self._scheduler.Transfer.assert_called_with("serial1", 11)
+
+    def testSlowInstall(self):
+        """Tests an install silent for longer than the socket timeout."""
+        self._server.SetShellOutput("serial1", _INSTALL, "Success\n",
+                                    interval=0.5)
+        self._sessions.Get("serial1")._timeout = 0.2
+        self.assertTrue(
+            self._installer.Install("serial1", self._apk, _PACKAGE))
+
+    def testSkipIdenticalPackage(self):
+        """Tests skipping and caching an identical installed package."""
+        self._SetInstalled("serial1", self._digest)
+        self.assertFalse(
+            self._installer.Install("serial1", self._apk, _PACKAGE))
+        self.assertFalse(
+            self._installer.Install("serial1", self._apk, _PACKAGE))
+        commands = self._GetCommands("serial1")
+        self.assertNotIn(_INSTALL, commands)
+        self.assertEqual(1, commands.count("sha256sum %s" % _INSTALLED_PATH))
+        self.assertIsNone(self._server.GetFile(
+            "serial1", "/data/local/tmp/WifiUtil.apk"))
+
+        # A reboot invalidates the cached digest.
+        self._server.SetShellOutput(
+            "serial1", "cat /proc/sys/kernel/random/boot_id", "boot2\n")
+        self.assertTrue(
+            self._installer.IsInstalled("serial1", self._apk, _PACKAGE))
+        self.assertEqual(2,
+                         self._GetCommands("serial1").count(
+                             "sha256sum %s" % _INSTALLED_PATH))
+
+    def testReplaceDifferentPackage(self):
+        """Tests installing over a package with a different digest."""
+        self._SetInstalled("serial1", "0" * 64)
+        self.assertTrue(
+            self._installer.Install("serial1", self._apk, _PACKAGE))
+        self.assertIn(_INSTALL, self._GetCommands("serial1"))
+
+    def testInstallFailure(self):
+        """Tests the error from the package manager."""
+        self._server.SetShellOutput(
+            "serial1", _INSTALL,
+            "Failure [INSTALL_FAILED_UPDATE_INCOMPATIBLE]\n", "", 1)
+        with self.assertRaises(package_installer.PackageInstallError):
+            self._installer.Install("serial1", self._apk, _PACKAGE)
+
+    def testInstallOnDevices(self):
+        """Tests installing on several devices concurrently."""
+        self._SetInstalled("serial2", self._digest)
+        self.assertEqual({
+            "serial1": True,
+            "serial2": True,
+            "serial3": False
+        }, self._installer.InstallOnDevices(
+            ["serial1", "serial2", "serial3"], self._apk, _PACKAGE))
+        self.assertIn(_INSTALL, self._GetCommands("serial1"))
+        self.assertNotIn(_INSTALL, self._GetCommands("serial2"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,288 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Persistent device shells running batches of commands in one round trip."""
+
+import logging
+import re
+import threading
+import time
+import uuid
+
+from host_controller.utils.adb import adb_client
+
+
+class ShellCommandError(adb_client.AdbClientError):
+    """Raised when a command in a checked batch exits with non-zero code.
+
+    Attributes:
+        command: string, the failed command.
+        result: tuple of (stdout, stderr, exit code) of the command.
+    """
+
+    def __init__(self, serial, command, result):
+        super(ShellCommandError, self).__init__(
+            "%s on %s exited with %d: %s" %
+            (command, serial, result[2], result[1].strip()))
+        self.command = command
+        self.result = result
+
+
+class ShellSession(object):
+    """An interactive shell on a device kept open across the batches.
+
+    The commands of a batch are written to the shell's stdin at once, each
+    followed by an echo of a marker and its exit code on stdout and of the
+    marker on stderr, so that the output is split per command as it is
+    read back. The commands read stdin from /dev/null so that they cannot
+    consume the rest of the batch.
+
+    The shell is reopened when its connection is found broken before any
+    command of a batch has run, e.g., after the device rebooted or adbd
+    restarted as root. If the device does not support shell v2, a batch is
+    sent as one legacy shell command whose stderr is merged into stdout.
+
+    Attributes:
+        serial: string, the device serial.
+        _client: AdbClient object.
+        _timeout: float, the maximum time to wait for output in seconds,
+                  unless a batch sets its own timeout.
+        _marker: string, separates the output of the commands.
+        _stdout_end: compiled regex matching the end of a command's stdout.
+        _stderr_end: compiled regex matching the end of a command's stderr.
+        _conn: AdbConnection of the open shell, or None.
+        _lock: threading.Lock, serializes the batches.
+    """
+
+    def __init__(self, serial, client=None,
+                 timeout=adb_client.DEFAULT_SOCKET_TIMEOUT_SECS):
+        self.serial = serial
+        self._client = client or adb_client.AdbClient()
+        self._timeout = timeout
+        self._marker = "__HC_SHELL_%s__" % uuid.uuid4().hex
+        self._stdout_end = re.compile(
+            re.escape(self._marker) + r" (\d+) (\d+)\n")
+        self._stderr_end = re.compile(re.escape(self._marker) + r" (\d+)\n")
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+    def Close(self):
+        """Exits the shell."""
+        with self._lock:
+            self._Disconnect()
+
+    def _Disconnect(self):
+        """Closes the connection of the shell, if any."""
+        if self._conn:
+            try:
+                self._client.WriteShellPacket(self._conn,
+                                              adb_client.SHELL_STDIN,
+                                              b"exit\n")
+            except adb_client.AdbClientError:
+                pass
+            self._conn.Close()
+            self._conn = None
+
+    def _Script(self, commands, legacy):
+        """Returns the script running the commands with the markers."""
+        lines = []
+        for index, command in enumerate(commands):
+            if legacy:
+                lines.append('{ %s\n} </dev/null 2>&1; echo "%s %d $?"' %
+                             (command, self._marker, index))
+            else:
+                lines.append('{ %s\n} </dev/null; echo "%s %d $?"; '
+                             'echo "%s %d" >&2' %
+                             (command, self._marker, index, self._marker,
+                              index))
+        return "\n".join(lines) + "\n"
+
+    def Run(self, command, check=False, timeout=None):
+        """Runs a command.
+
+        Returns:
+            a tuple of (stdout, stderr, exit code).
+        """
+        return self.RunBatch([command], check, timeout)[0]
+
+    def RunBatch(self, commands, check=False, timeout=None):
+        """Runs commands one after another in one round trip.
+
+        Args:
+            commands: list of strings, the shell commands.
+            check: bool, whether to raise ShellCommandError if a command
+                   exits with non-zero code. All commands run regardless.
+            timeout: float, the time the batch may take in seconds, for
+                     the commands which print nothing for a long time.
+                     None to limit each read to the session's timeout.
+
+        Returns:
+            a list of (stdout, stderr, exit code) tuples, one per command.
+
+        Raises:
+            AdbClientError if the device is unreachable or the connection
+            breaks in the middle of the batch.
+        """
+        if not commands:
+            return []
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            results = self._RunBatch(commands, deadline)
+        if check:
+            for command, result in zip(commands, results):
+                if result[2] != 0:
+                    raise ShellCommandError(self.serial, command, result)
+        return results
+
+    def _RunBatch(self, commands, deadline):
+        """Runs a batch, reopening a broken shell once."""
+        for attempt in range(2):
+            if not self._conn:
+                try:
+                    self._conn = self._client.OpenShell(
+                        self.serial, timeout=self._timeout)
+                except adb_client.AdbTimeoutError:
+                    raise
+                except adb_client.AdbClientError as e:
+                    if attempt:
+                        raise
+                    logging.info("Shell v2 unavailable on %s (%s). Using "
+                                 "the legacy shell.", self.serial, e)
+                    return self._RunLegacyBatch(commands, deadline)
+            results = []
+            try:
+                self._conn.SetTimeout(
+                    self._timeout if deadline is None else None)
+                self._conn.SetDeadline(deadline)
+                self._client.WriteShellPacket(
+                    self._conn, adb_client.SHELL_STDIN,
+                    self._Script(commands, False).encode("utf-8"))
+                self._ReadResults(len(commands), results)
+                return results
+            except adb_client.AdbClientError as e:
+                self._conn.Close()
+                self._conn = None
+                if results or attempt or isinstance(
+                        e, adb_client.AdbTimeoutError):
+                    raise adb_client.AdbClientError(
+                        "Shell on %s broke after %d of %d commands: %s" %
+                        (self.serial, len(results), len(commands), e))
+                logging.info("Reopening the shell on %s: %s", self.serial, e)
+
+    def _ReadResults(self, count, results):
+        """Reads the output of the commands until all markers arrive.
+
+        Args:
+            count: int, the number of the commands.
+            results: list to which the results are appended as they
+                     complete, so that the caller sees the progress.
+        """
+        stdout = stderr = ""
+        stdouts = []
+        stderrs = []
+        while len(results) < count:
+            stream_id, data = self._client.ReadShellPacket(self._conn)
+            if stream_id == adb_client.SHELL_EXIT:
+                raise adb_client.AdbClientError("Shell exited with %d." %
+                                                data)
+            if stream_id == adb_client.SHELL_STDOUT:
+                stdout += data.decode("utf-8", "replace")
+                match = self._stdout_end.search(stdout)
+                while match:
+                    stdouts.append((stdout[:match.start()],
+                                    int(match.group(2))))
+                    stdout = stdout[match.end():]
+                    match = self._stdout_end.search(stdout)
+            elif stream_id == adb_client.SHELL_STDERR:
+                stderr += data.decode("utf-8", "replace")
+                match = self._stderr_end.search(stderr)
+                while match:
+                    stderrs.append(stderr[:match.start()])
+                    stderr = stderr[match.end():]
+                    match = self._stderr_end.search(stderr)
+            while len(results) < min(len(stdouts), len(stderrs)):
+                index = len(results)
+                results.append((stdouts[index][0], stderrs[index],
+                                stdouts[index][1]))
+
+    def _RunLegacyBatch(self, commands, deadline):
+        """Runs a batch as one legacy shell command."""
+        output = self._client.Shell(self.serial,
+                                    self._Script(commands, True), deadline)
+        results = []
+        match = self._stdout_end.search(output)
+        while match:
+            results.append((output[:match.start()], "",
+                            int(match.group(2))))
+            output = output[match.end():]
+            match = self._stdout_end.search(output)
+        if len(results) != len(commands):
+            raise adb_client.AdbClientError(
+                "Shell on %s returned %d of %d results." %
+                (self.serial, len(results), len(commands)))
+        return results
+
+
+class ShellSessionManager(object):
+    """Keeps one ShellSession per device in the process.
+
+    Attributes:
+        _client: AdbClient shared by the sessions.
+        _sessions: dict, maps a serial to its ShellSession.
+        _lock: threading.Lock, guards _sessions.
+    """
+
+    def __init__(self, client=None):
+        self._client = client
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def Get(self, serial):
+        """Returns the session of a device, creating it on first use."""
+        with self._lock:
+            session = self._sessions.get(serial)
+            if not session:
+                session = ShellSession(serial, self._client)
+                self._sessions[serial] = session
+            return session
+
+    def Close(self, serial):
+        """Exits the session of a device, if any."""
+        with self._lock:
+            session = self._sessions.pop(serial, None)
+        if session:
+            session.Close()
+
+    def CloseAll(self):
+        """Exits all sessions."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.Close()
+
+
+_manager = ShellSessionManager()
+
+
+def GetShellSessionManager():
+    """Returns the ShellSessionManager shared in the current process."""
+    return _manager
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from host_controller.utils.adb import adb_client
+from host_controller.utils.adb import fake_adb_server
+from host_controller.utils.adb import shell_session
+
+
+class ShellSessionTest(unittest.TestCase):
+    """Tests for ShellSession against a fake adb server."""
+
+    def setUp(self):
+        """Starts a fake adb server and a session."""
+        self._server = fake_adb_server.FakeAdbServer()
+        self._server.SetDevice("serial1", "device")
+        self._server.SetShellOutput("serial1", "svc wifi enable", "")
+        self._server.SetShellOutput("serial1", "dumpsys wifi", "enabled")
+        self._server.SetShellOutput("serial1", "am instrument", "",
+                                    "not found\n", 1)
+        self._client = adb_client.AdbClient(port=self._server.port)
+        self._session = shell_session.ShellSession("serial1", self._client)
+
+    def tearDown(self):
+        """Closes the session and stops the fake adb server."""
+        self._session.Close()
+        self._server.Close()
+
+    def testRunBatch(self):
+        """Tests splitting the output and the exit codes per command."""
+        connections = self._server.connections
+        self.assertEqual([("", "", 0), ("enabled", "", 0),
+                          ("", "not found\n", 1)],
+                         self._session.RunBatch([
+                             "svc wifi enable", "dumpsys wifi",
+                             "am instrument"
+                         ]))
+        self.assertEqual([("enabled", "", 0)] * 30,
+                         self._session.RunBatch(["dumpsys wifi"] * 30))
+        self.assertEqual(connections + 1, self._server.connections)
+        self.assertEqual(33, len(self._server.shell_commands))
+
+    def testCheck(self):
+        """Tests raising on a failed command after running the batch."""
+        with self.assertRaises(shell_session.ShellCommandError) as context:
+            self._session.RunBatch(["am instrument", "dumpsys wifi"],
+                                   check=True)
+        self.assertEqual("am instrument", context.exception.command)
+        self.assertEqual(("", "not found\n", 1), context.exception.result)
+        self.assertEqual(2, len(self._server.shell_commands))
+
+    def testSilentCommand(self):
+        """Tests a command silent for longer than the socket timeout."""
+        self._server.SetShellOutput("serial1", "am instrument -w", "OK",
+                                    interval=0.5)
+        session = shell_session.ShellSession("serial1", self._client,
+                                             timeout=0.2)
+        try:
+            with self.assertRaises(adb_client.AdbClientError):
+                session.Run("am instrument -w")
+            self.assertEqual(("OK", "", 0),
+                             session.Run("am instrument -w", timeout=5))
+            self.assertEqual(("enabled", "", 0),
+                             session.Run("dumpsys wifi"))
+            with self.assertRaises(adb_client.AdbClientError):
+                session.Run("am instrument -w", timeout=0.3)
+        finally:
+            session.Close()
+
+    def testReopenAfterReboot(self):
+        """Tests reopening the shell after adbd restarted."""
+        self.assertEqual(("enabled", "", 0),
+                         self._session.Run("dumpsys wifi"))
+        connections = self._server.connections
+        self._server.KillShells()
+        self.assertEqual(("enabled", "", 0),
+                         self._session.Run("dumpsys wifi"))
+        self.assertEqual(connections + 1, self._server.connections)
+
+    def testDeviceOffline(self):
+        """Tests the error on a device unknown to the server."""
+        self._server.SetDevice("serial1", "offline")
+        with self.assertRaises(adb_client.AdbClientError):
+            self._session.Run("dumpsys wifi")
+
+    def testLegacyShell(self):
+        """Tests running a batch as one command without shell v2."""
+        client = mock.Mock()
+        client.OpenShell.side_effect = adb_client.AdbClientError("closed")
+        session = shell_session.ShellSession("serial1", client)
+        client.Shell.return_value = "a\n%s 0 0\nb%s 1 2\n" % (
+            session._marker, session._marker)
+        self.assertEqual([("a\n", "", 0), ("b", "", 2)],
+                         session.RunBatch(["echo a", "printf b; false"]))
+        client.Shell.assert_called_once_with("serial1", mock.ANY, None)
+
+    def testManager(self):
+        """Tests that the manager keeps one session per device."""
+        manager = shell_session.ShellSessionManager(self._client)
+        session = manager.Get("serial1")
+        self.assertIs(session, manager.Get("serial1"))
+        self.assertIsNot(session, manager.Get("serial2"))
+        manager.CloseAll()
+        self.assertIsNot(session, manager.Get("serial1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""In-process fake of a bootloader serving fastboot over TCP for the tests."""
+
+import socket
+import struct
+import threading
+
+
+class FakeFastbootServer(object):
+    """Serves a subset of the fastboot protocol on localhost.
+
+    Supported commands are getvar, download, flash, erase, reboot,
+    reboot-<target> and continue.
+
+    Attributes:
+        port: int, the port on which the server listens.
+        serial: string, the serial to pass to OpenFastbootClient.
+        connections: int, the number of the connections accepted.
+        commands: list of the commands received.
+        partitions: dict, maps a partition name to the flashed bytes.
+        _vars: dict, maps a variable name to its value.
+        _failures: dict, maps a command to its FAIL message.
+        _lock: threading.Lock, guards the fields above.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._vars = {"max-download-size": "0x10000000"}
+        self._failures = {}
+        self.connections = 0
+        self.commands = []
+        self.partitions = {}
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("127.0.0.1", 0))
+        self._server.listen(4)
+        self.port = self._server.getsockname()[1]
+        self.serial = "tcp:127.0.0.1:%d" % self.port
+        self._thread = threading.Thread(target=self._Serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def Close(self):
+        """Stops the server."""
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._server.close()
+        self._thread.join()
+
+    def SetVar(self, name, value):
+        """Sets the value of a bootloader variable."""
+        with self._lock:
+            self._vars[name] = value
+
+    def SetFailure(self, command, message):
+        """Makes a command fail with the message."""
+        with self._lock:
+            self._failures[command] = message
+
+    def _Serve(self):
+        """Accepts connections until the server socket is closed."""
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except socket.error:
+                return
+            with self._lock:
+                self.connections += 1
+            thread = threading.Thread(target=self._Handle, args=(conn, ))
+            thread.daemon = True
+            thread.start()
+
+    @staticmethod
+    def _ReadExactly(conn, length):
+        """Reads the given number of bytes. None if the peer closed."""
+        data = b""
+        while len(data) < length:
+            chunk = conn.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _Read(self, conn):
+        """Reads a length-prefixed message. None if the peer closed."""
+        header = self._ReadExactly(conn, 8)
+        if header is None:
+            return None
+        return self._ReadExactly(conn, struct.unpack(">Q", header)[0])
+
+    @staticmethod
+    def _Write(conn, message):
+        """Sends a length-prefixed message."""
+        conn.sendall(struct.pack(">Q", len(message)) + message)
+
+    def _Handle(self, conn):
+        """Serves the commands of a connection until the peer closes it."""
+        try:
+            if self._ReadExactly(conn, 4) != b"FB01":
+                return
+            conn.sendall(b"FB01")
+            download = b""
+            while True:
+                command = self._Read(conn)
+                if command is None:
+                    return
+                command = command.decode("utf-8")
+                with self._lock:
+                    self.commands.append(command)
+                    failure = self._failures.get(command)
+                    value = self._vars.get(command[len("getvar:"):], "")
+                if failure is not None:
+                    self._Write(conn, b"FAIL" + failure.encode("utf-8"))
+                    continue
+                if command.startswith("download:"):
+                    size = int(command[len("download:"):], 16)
+                    self._Write(conn, b"DATA%08x" % size)
+                    chunks = []
+                    received = 0
+                    while received < size:
+                        chunk = self._Read(conn)
+                        if chunk is None:
+                            return
+                        chunks.append(chunk)
+                        received += len(chunk)
+                    download = b"".join(chunks)
+                    self._Write(conn, b"OKAY")
+                elif command.startswith("flash:"):
+                    self._Write(conn, b"INFOwriting")
+                    with self._lock:
+                        self.partitions[command[len("flash:"):]] = download
+                    self._Write(conn, b"OKAY")
+                elif command.startswith("getvar:"):
+                    self._Write(conn, b"OKAY" + value.encode("utf-8"))
+                elif command.startswith("erase:"):
+                    with self._lock:
+                        self.partitions.pop(command[len("erase:"):], None)
+                    self._Write(conn, b"OKAY")
+                elif command.startswith("reboot") or command == "continue":
+                    self._Write(conn, b"OKAY")
+                else:
+                    self._Write(conn, b"FAILunknown command")
+        except socket.error:
+            pass
+        finally:
+            conn.close()
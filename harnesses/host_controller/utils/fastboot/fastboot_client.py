@@ -0,0 +1,411 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Client talking to the bootloader over the fastboot protocol."""
+
+import ctypes
+import fcntl
+import logging
+import os
+import socket
+import struct
+
+from host_controller.utils.usb import usb_utils
+
+# Default port of fastboot over TCP.
+DEFAULT_FASTBOOT_TCP_PORT = 5554
+
+# Prefix of the serials of the devices reached over TCP.
+TCP_SERIAL_PREFIX = "tcp:"
+
+# Default timeout for a response of the bootloader in seconds.
+DEFAULT_FASTBOOT_TIMEOUT_SECS = 30
+
+# Handshake of fastboot over TCP, i.e., protocol version 1.
+_TCP_HANDSHAKE = b"FB01"
+
+# Maximum size of a response packet.
+_MAX_RESPONSE_BYTES = 256
+
+# Size of the data written in one USB bulk transfer.
+_USB_CHUNK_BYTES = 1024 * 1024
+
+# Size of the data read from a file and sent at a time.
+_DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
+
+class FastbootError(Exception):
+    """Raised when the bootloader fails a command or is unreachable."""
+    pass
+
+
+class TcpTransport(object):
+    """A connection to the bootloader over TCP.
+
+    Every message is prefixed by its length as an 8-byte big-endian
+    integer. The connection is kept open for any number of commands.
+
+    Attributes:
+        _socket: socket object, the connection.
+    """
+
+    def __init__(self, host, port=DEFAULT_FASTBOOT_TCP_PORT,
+                 timeout=DEFAULT_FASTBOOT_TIMEOUT_SECS):
+        """Connects to the bootloader and exchanges the handshake.
+
+        Args:
+            host: string, the address of the device.
+            port: int, the fastboot port of the device.
+            timeout: float, the socket timeout in seconds.
+
+        Raises:
+            FastbootError if the device is unreachable.
+        """
+        try:
+            self._socket = socket.create_connection((host, port), timeout)
+            self._socket.settimeout(timeout)
+            self._socket.sendall(_TCP_HANDSHAKE)
+            handshake = self._ReadExactly(len(_TCP_HANDSHAKE))
+        except (socket.error, socket.timeout) as e:
+            raise FastbootError("Failed to connect to %s:%d: %s" %
+                                (host, port, e))
+        if handshake[:2] != _TCP_HANDSHAKE[:2]:
+            self.Close()
+            raise FastbootError("Unexpected handshake from %s:%d: %r" %
+                                (host, port, handshake))
+
+    def _ReadExactly(self, length):
+        """Reads the given number of bytes from the socket."""
+        data = b""
+        while len(data) < length:
+            chunk = self._socket.recv(length - len(data))
+            if not chunk:
+                raise FastbootError("Connection closed by the device.")
+            data += chunk
+        return data
+
+    def Write(self, data):
+        """Sends a message.
+
+        Args:
+            data: bytes, the message.
+        """
+        try:
+            self._socket.sendall(struct.pack(">Q", len(data)) + data)
+        except (socket.error, socket.timeout) as e:
+            raise FastbootError("Failed to send to the device: %s" % e)
+
+    def Read(self):
+        """Reads a message.
+
+        Returns:
+            bytes, the message.
+        """
+        try:
+            length = struct.unpack(">Q", self._ReadExactly(8))[0]
+            return self._ReadExactly(length)
+        except (socket.error, socket.timeout) as e:
+            raise FastbootError("Failed to read from the device: %s" % e)
+
+    def Close(self):
+        """Closes the connection."""
+        try:
+            self._socket.close()
+        except socket.error:
+            pass
+
+
+class _UsbBulkTransfer(ctypes.Structure):
+    """struct usbdevfs_bulktransfer of linux/usbdevice_fs.h."""
+    _fields_ = [
+        ("ep", ctypes.c_uint),
+        ("len", ctypes.c_uint),
+        ("timeout", ctypes.c_uint),
+        ("data", ctypes.c_void_p),
+    ]
+
+
+def _IOC(direction, number, size):
+    """Returns the request code of a usbdevfs ioctl."""
+    return direction << 30 | size << 16 | ord("U") << 8 | number
+
+
+# _IOR('U', 15, unsigned int), _IOR('U', 16, unsigned int) and
+# _IOWR('U', 2, struct usbdevfs_bulktransfer).
+USBDEVFS_CLAIMINTERFACE = _IOC(2, 15, ctypes.sizeof(ctypes.c_uint))
+USBDEVFS_RELEASEINTERFACE = _IOC(2, 16, ctypes.sizeof(ctypes.c_uint))
+USBDEVFS_BULK = _IOC(3, 2, ctypes.sizeof(_UsbBulkTransfer))
+
+
+class UsbTransport(object):
+    """A connection to the bootloader over the USB device file.
+
+    The fastboot interface is claimed through usbdevfs, so no fastboot
+    process has to be spawned. A message is one bulk transfer.
+
+    Attributes:
+        _fd: int, the file descriptor of the USB device file.
+        _interface: int, the interface number.
+        _ep_in: int, the bulk in endpoint.
+        _ep_out: int, the bulk out endpoint.
+        _timeout_ms: int, the timeout of a transfer in milliseconds.
+    """
+
+    def __init__(self, serial, timeout=DEFAULT_FASTBOOT_TIMEOUT_SECS,
+                 resolver=None):
+        """Opens the device file and claims the fastboot interface.
+
+        Args:
+            serial: string, the device serial.
+            timeout: float, the timeout of a transfer in seconds.
+            resolver: UsbDeviceResolver. None to use the shared one.
+
+        Raises:
+            FastbootError if the device is not in fastboot mode or cannot
+            be opened.
+        """
+        resolver = resolver or usb_utils.GetUsbDeviceResolver()
+        interface = resolver.GetBulkInterface(serial,
+                                              usb_utils.USB_MODE_FASTBOOT)
+        if not interface:
+            raise FastbootError("%s is not attached in fastboot mode." %
+                                serial)
+        usb_path, self._interface, self._ep_in, self._ep_out = interface
+        self._timeout_ms = int(timeout * 1000)
+        try:
+            self._fd = os.open(usb_path, os.O_RDWR)
+        except OSError as e:
+            raise FastbootError("Failed to open %s: %s" % (usb_path, e))
+        try:
+            fcntl.ioctl(self._fd, USBDEVFS_CLAIMINTERFACE,
+                        struct.pack("I", self._interface))
+        except IOError as e:
+            os.close(self._fd)
+            raise FastbootError("Failed to claim the interface of %s: %s" %
+                                (serial, e))
+
+    def _Bulk(self, endpoint, buf, length):
+        """Runs a bulk transfer.
+
+        Returns:
+            int, the number of bytes transferred.
+        """
+        transfer = _UsbBulkTransfer(endpoint, length, self._timeout_ms,
+                                    ctypes.cast(buf, ctypes.c_void_p))
+        try:
+            return fcntl.ioctl(self._fd, USBDEVFS_BULK, transfer)
+        except IOError as e:
+            raise FastbootError("USB bulk transfer failed: %s" % e)
+
+    def Write(self, data):
+        """Sends a message.
+
+        Args:
+            data: bytes, the message.
+        """
+        for offset in range(0, max(len(data), 1), _USB_CHUNK_BYTES):
+            chunk = data[offset:offset + _USB_CHUNK_BYTES]
+            buf = ctypes.create_string_buffer(chunk, len(chunk))
+            self._Bulk(self._ep_out, buf, len(chunk))
+
+    def Read(self):
+        """Reads a message.
+
+        Returns:
+            bytes, the message.
+        """
+        buf = ctypes.create_string_buffer(_MAX_RESPONSE_BYTES)
+        length = self._Bulk(self._ep_in, buf, _MAX_RESPONSE_BYTES)
+        return buf.raw[:length]
+
+    def Close(self):
+        """Releases the interface and closes the device file."""
+        try:
+            fcntl.ioctl(self._fd, USBDEVFS_RELEASEINTERFACE,
+                        struct.pack("I", self._interface))
+        except IOError:
+            pass
+        os.close(self._fd)
+
+
+class FastbootClient(object):
+    """Sends the fastboot commands over a transport.
+
+    One client runs any number of commands on one connection, e.g.,
+    getvar, download and flash for every partition of a build.
+
+    Attributes:
+        _transport: TcpTransport or UsbTransport.
+        _max_download_size: int, the cached max-download-size, or None.
+    """
+
+    def __init__(self, transport):
+        self._transport = transport
+        self._max_download_size = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+    def Close(self):
+        """Closes the transport."""
+        self._transport.Close()
+
+    def _ReadResponse(self, command, info_callback=None):
+        """Reads the responses to a command until OKAY, FAIL or DATA.
+
+        Args:
+            command: string, the command for the error message.
+            info_callback: function called with the INFO and TEXT messages.
+
+        Returns:
+            a tuple of (status, payload), where status is "OKAY" or "DATA".
+
+        Raises:
+            FastbootError if the command fails.
+        """
+        while True:
+            response = self._transport.Read()
+            status = response[:4].decode("ascii", "replace")
+            payload = response[4:].decode("utf-8", "replace")
+            if status in ("INFO", "TEXT"):
+                logging.debug("fastboot %s: %s", command, payload)
+                if info_callback:
+                    info_callback(payload)
+                continue
+            if status in ("OKAY", "DATA"):
+                return status, payload
+            if status == "FAIL":
+                raise FastbootError("%s failed: %s" % (command, payload))
+            raise FastbootError("Unexpected response to %s: %r" %
+                                (command, response))
+
+    def _Command(self, command, info_callback=None):
+        """Sends a command and waits for the result.
+
+        Args:
+            command: string, e.g., "getvar:product".
+            info_callback: function called with the INFO and TEXT messages.
+
+        Returns:
+            string, the payload of OKAY.
+        """
+        self._transport.Write(command.encode("utf-8"))
+        status, payload = self._ReadResponse(command, info_callback)
+        if status != "OKAY":
+            raise FastbootError("Unexpected DATA response to %s." % command)
+        return payload
+
+    def GetVar(self, name):
+        """Returns a bootloader variable, e.g., product or unlocked."""
+        return self._Command("getvar:%s" % name)
+
+    def GetMaxDownloadSize(self):
+        """Returns the max-download-size of the bootloader, or None."""
+        if self._max_download_size is None:
+            try:
+                self._max_download_size = int(
+                    self.GetVar("max-download-size"), 0)
+            except (FastbootError, ValueError) as e:
+                logging.warning("Failed to get max-download-size: %s", e)
+                return None
+        return self._max_download_size
+
+    def Download(self, path):
+        """Sends a file to the bootloader's download buffer.
+
+        Args:
+            path: string, the local file.
+
+        Returns:
+            int, the number of bytes sent.
+        """
+        size = os.path.getsize(path)
+        command = "download:%08x" % size
+        self._transport.Write(command.encode("utf-8"))
+        status, payload = self._ReadResponse(command)
+        if status != "DATA" or int(payload, 16) != size:
+            raise FastbootError("Bootloader rejected download of %d bytes: "
+                                "%s %s" % (size, status, payload))
+        with open(path, "rb") as image_file:
+            while True:
+                data = image_file.read(_DOWNLOAD_CHUNK_BYTES)
+                if not data:
+                    break
+                self._transport.Write(data)
+        self._ReadResponse(command)
+        return size
+
+    def Flash(self, partition, path):
+        """Flashes an image to a partition.
+
+        Args:
+            partition: string, the partition name, e.g., "boot".
+            path: string, the local image file.
+
+        Returns:
+            int, the number of bytes sent.
+
+        Raises:
+            FastbootError if the image exceeds max-download-size, in which
+            case it has to be sent as sparse chunks by the fastboot binary.
+        """
+        max_size = self.GetMaxDownloadSize()
+        size = os.path.getsize(path)
+        if max_size is not None and size > max_size:
+            raise FastbootError("%s is %d bytes, larger than "
+                                "max-download-size %d." %
+                                (path, size, max_size))
+        self.Download(path)
+        self._Command("flash:%s" % partition)
+        return size
+
+    def Erase(self, partition):
+        """Erases a partition."""
+        self._Command("erase:%s" % partition)
+
+    def Reboot(self, target=None):
+        """Reboots the device.
+
+        Args:
+            target: string, e.g., "bootloader". None to boot normally.
+        """
+        self._Command("reboot-%s" % target if target else "reboot")
+
+    def Continue(self):
+        """Continues booting."""
+        self._Command("continue")
+
+
+def OpenFastbootClient(serial, timeout=DEFAULT_FASTBOOT_TIMEOUT_SECS):
+    """Connects to a device in fastboot mode.
+
+    Args:
+        serial: string, "tcp:<host>[:<port>]" or a USB serial number.
+        timeout: float, the timeout of a response in seconds.
+
+    Returns:
+        a FastbootClient, which the caller closes.
+    """
+    if serial.startswith(TCP_SERIAL_PREFIX):
+        address = serial[len(TCP_SERIAL_PREFIX):]
+        host, _, port = address.partition(":")
+        return FastbootClient(
+            TcpTransport(host,
+                         int(port) if port else DEFAULT_FASTBOOT_TCP_PORT,
+                         timeout))
+    return FastbootClient(UsbTransport(serial, timeout))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from host_controller.utils.fastboot import fake_fastboot_server
+from host_controller.utils.fastboot import fastboot_client
+
+
+class FastbootClientTest(unittest.TestCase):
+    """Tests for FastbootClient against a fake bootloader."""
+
+    def setUp(self):
+        """Starts a fake bootloader and writes an image."""
+        self._server = fake_fastboot_server.FakeFastbootServer()
+        self._server.SetVar("product", "walleye")
+        self._temp_dir = tempfile.mkdtemp()
+        self._image = os.path.join(self._temp_dir, "boot.img")
+        self._data = os.urandom(3 * 1024 * 1024 + 5)
+        with open(self._image, "wb") as image_file:
+            image_file.write(self._data)
+
+    def tearDown(self):
+        """Stops the fake bootloader."""
+        self._server.Close()
+        shutil.rmtree(self._temp_dir)
+
+    def testGetVar(self):
+        """Tests reading a variable."""
+        with fastboot_client.OpenFastbootClient(self._server.serial) as fb:
+            self.assertEqual("walleye", fb.GetVar("product"))
+
+    def testFlashOnOneConnection(self):
+        """Tests that a session runs all commands on one connection."""
+        with fastboot_client.OpenFastbootClient(self._server.serial) as fb:
+            self.assertEqual(len(self._data), fb.Flash("boot", self._image))
+            self.assertEqual(len(self._data),
+                             fb.Flash("vendor", self._image))
+            fb.Erase("vendor")
+            fb.Reboot("bootloader")
+        self.assertEqual(1, self._server.connections)
+        self.assertEqual({"boot": self._data}, self._server.partitions)
+        self.assertEqual([
+            "getvar:max-download-size", "download:00300005", "flash:boot",
+            "download:00300005", "flash:vendor", "erase:vendor",
+            "reboot-bootloader"
+        ], self._server.commands)
+
+    def testFlashTooLarge(self):
+        """Tests rejecting an image larger than max-download-size."""
+        self._server.SetVar("max-download-size", "0x100000")
+        with fastboot_client.OpenFastbootClient(self._server.serial) as fb:
+            with self.assertRaises(fastboot_client.FastbootError):
+                fb.Flash("boot", self._image)
+        self.assertEqual({}, self._server.partitions)
+
+    def testFail(self):
+        """Tests that FAIL raises and the session stays usable."""
+        self._server.SetFailure("flash:boot", "partition locked")
+        with fastboot_client.OpenFastbootClient(self._server.serial) as fb:
+            with self.assertRaisesRegexp(fastboot_client.FastbootError,
+                                         "partition locked"):
+                fb.Flash("boot", self._image)
+            self.assertEqual("walleye", fb.GetVar("product"))
+
+    def testConnectionRefused(self):
+        """Tests the error on an unreachable device."""
+        self._server.Close()
+        with self.assertRaises(fastboot_client.FastbootError):
+            fastboot_client.OpenFastbootClient(self._server.serial, 1)
+        self._server = fake_fastboot_server.FakeFastbootServer()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,478 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import getpass
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from host_controller import common
+from host_controller.utils.ipc import ipc_utils
+
+# Actions recorded in the audit log.
+AUDIT_BREAK = "break"
+AUDIT_EXPIRE = "expire"
+AUDIT_RECLAIM = "reclaim"
+
+# Keys of a lease describing its holder.
+_HOLDER_KEYS = ("pid", "job_id", "command", "acquired_time")
+
+
+class LeaseClient(object):
+    """Client of the named leases shared by the processes on the host.
+
+    A lease is held by one thread of one process until it is released,
+    broken, or expires without being renewed. The leases of dead processes
+    are reclaimed by the next operation. Waiters for a lease are queued in
+    FIFO order and woken up as soon as it is handed over to them.
+
+    Attributes:
+        _dir: string, the directory of the state file, the audit log and
+              the pipes of the waiters.
+        _state_file: StateFile, the leases and the wait queues.
+        _audit_path: string, the path to the audit log.
+        _liveness_check_secs: float, the interval at which a waiter checks
+                              for expired leases.
+    """
+
+    def __init__(self,
+                 lease_dir=None,
+                 liveness_check_secs=common.SEMAPHORE_LIVENESS_CHECK_SECS):
+        self._dir = lease_dir or os.path.join(
+            os.path.expanduser("~"), common._DEVICE_LEASE_DIR)
+        ipc_utils.MakeDirs(self._dir)
+        self._state_file = ipc_utils.StateFile(
+            os.path.join(self._dir, "leases.json"))
+        self._audit_path = os.path.join(self._dir, "audit.log")
+        self._liveness_check_secs = liveness_check_secs
+
+    def _PipePath(self, token):
+        """Returns the path to the named pipe of a waiter."""
+        return os.path.join(self._dir, "%s.fifo" % token)
+
+    def _Audit(self, action, name, lease, **extra):
+        """Appends a record to the audit log. Called with the state locked.
+
+        Args:
+            action: string, one of AUDIT_*.
+            name: string, the lease name.
+            lease: dict, the lease affected.
+            extra: additional keys of the record.
+        """
+        record = {
+            "time": time.time(),
+            "action": action,
+            "name": name,
+            "holder": dict((key, lease.get(key)) for key in _HOLDER_KEYS),
+            "by_pid": os.getpid(),
+            "by_user": getpass.getuser(),
+        }
+        record.update(extra)
+        with open(self._audit_path, "a") as audit_file:
+            audit_file.write(json.dumps(record) + "\n")
+
+    def _Update(self, update):
+        """Updates the state, hands over the free leases and wakes waiters.
+
+        Args:
+            update: function taking the state dict, which has "leases"
+                    mapping a name to a lease, and "queues" mapping a name
+                    to a list of waiters. It is called with the state file
+                    locked and may modify the state in place.
+
+        Returns:
+            the return value of update.
+        """
+        with self._state_file.Lock() as state:
+            state.setdefault("leases", {})
+            state.setdefault("queues", {})
+            self._Reclaim(state)
+            ret = update(state)
+            granted = self._Grant(state)
+        for token in granted:
+            ipc_utils.WakeupPipe.Wake(self._PipePath(token))
+        return ret
+
+    def _Reclaim(self, state):
+        """Drops the expired leases and the dead processes.
+
+        Args:
+            state: dict, the locked state which is modified in place.
+        """
+        now = time.time()
+        for name, lease in list(state["leases"].items()):
+            if lease["expiry_time"] <= now:
+                logging.warning("Lease %s of process %d expired.", name,
+                                lease["pid"])
+                self._Audit(AUDIT_EXPIRE, name, lease)
+            elif not ipc_utils.IsProcessAlive(lease):
+                logging.warning("Reclaiming lease %s of dead process %d.",
+                                name, lease["pid"])
+                self._Audit(AUDIT_RECLAIM, name, lease)
+            else:
+                continue
+            del state["leases"][name]
+        for name, queue in list(state["queues"].items()):
+            for waiter in [w for w in queue
+                           if not ipc_utils.IsProcessAlive(w)]:
+                queue.remove(waiter)
+                try:
+                    os.remove(self._PipePath(waiter["token"]))
+                except OSError:
+                    pass
+            if not queue:
+                del state["queues"][name]
+
+    def _Grant(self, state):
+        """Hands the free leases over to the first waiters.
+
+        Args:
+            state: dict, the locked state which is modified in place.
+
+        Returns:
+            a list of the tokens granted a lease, to be woken up.
+        """
+        now = time.time()
+        granted = []
+        for name, queue in list(state["queues"].items()):
+            if name in state["leases"]:
+                continue
+            waiter = queue.pop(0)
+            if not queue:
+                del state["queues"][name]
+            waiter["acquired_time"] = now
+            waiter["renewed_time"] = now
+            waiter["expiry_time"] = now + waiter["ttl"]
+            state["leases"][name] = waiter
+            granted.append(waiter["token"])
+        return granted
+
+    @staticmethod
+    def _IsHolder(state, name, token):
+        """Returns whether a token holds a lease in the state."""
+        lease = state["leases"].get(name)
+        return bool(lease and lease["token"] == token)
+
+    @staticmethod
+    def _Dequeue(state, name, token):
+        """Removes a timed-out waiter unless it has been granted the lease.
+
+        Returns:
+            True if the waiter holds the lease.
+        """
+        if LeaseClient._IsHolder(state, name, token):
+            return True
+        queue = [w for w in state["queues"].get(name, [])
+                 if w["token"] != token]
+        if queue:
+            state["queues"][name] = queue
+        else:
+            state["queues"].pop(name, None)
+        return False
+
+    def Acquire(self,
+                name,
+                ttl=common.DEVICE_LEASE_TTL_SECS,
+                timeout=None,
+                job_id=None,
+                command=None):
+        """Acquires a lease, waiting behind the earlier waiters.
+
+        Args:
+            name: string, the lease name, e.g., a device serial.
+            ttl: float, the number of seconds the lease lasts unless renewed.
+            timeout: float, the maximum time to wait in seconds. 0 not to
+                     wait; None to wait indefinitely.
+            job_id: string, the job for which the lease is held.
+            command: string, the command holding the lease. Defaults to the
+                     command line of this process.
+
+        Returns:
+            string, the token to renew and release the lease. None if timed
+            out.
+        """
+        if command is None:
+            command = " ".join(sys.argv)
+        entry = ipc_utils.NewProcessEntry(
+            ttl=ttl, job_id=job_id, command=command)
+        token = entry["token"]
+
+        if timeout == 0:
+            def _TryAcquire(state):
+                if name in state["leases"] or state["queues"].get(name):
+                    return False
+                state["queues"][name] = [entry]
+                return True
+
+            if not self._Update(_TryAcquire):
+                return None
+            return token
+
+        pipe = ipc_utils.WakeupPipe(self._PipePath(token))
+        try:
+            self._Update(
+                lambda state: state["queues"].setdefault(name, []).append(
+                    entry))
+            deadline = None if timeout is None else time.time() + timeout
+            while not self._Update(
+                    lambda state: self._IsHolder(state, name, token)):
+                wait_secs = self._liveness_check_secs
+                if deadline is not None:
+                    wait_secs = min(wait_secs, deadline - time.time())
+                    if wait_secs <= 0:
+                        if self._Update(lambda state: self._Dequeue(
+                                state, name, token)):
+                            return token
+                        return None
+                pipe.Wait(wait_secs)
+            return token
+        finally:
+            pipe.Close()
+
+    def Renew(self, name, token, ttl=common.DEVICE_LEASE_TTL_SECS):
+        """Extends a lease.
+
+        Args:
+            name: string, the lease name.
+            token: string, the token returned by Acquire.
+            ttl: float, the number of seconds from now the lease lasts.
+
+        Returns:
+            True if renewed; False if the lease has been lost.
+        """
+
+        def _Renew(state):
+            if not self._IsHolder(state, name, token):
+                return False
+            lease = state["leases"][name]
+            lease["renewed_time"] = time.time()
+            lease["expiry_time"] = lease["renewed_time"] + ttl
+            return True
+
+        return self._Update(_Renew)
+
+    def Release(self, name, token):
+        """Releases a lease and hands it over to the first waiter.
+
+        Args:
+            name: string, the lease name.
+            token: string, the token returned by Acquire.
+
+        Returns:
+            True if released; False if the lease has been lost.
+        """
+
+        def _Release(state):
+            if not self._IsHolder(state, name, token):
+                return False
+            del state["leases"][name]
+            return True
+
+        return self._Update(_Release)
+
+    def Break(self, name, reason=""):
+        """Forcibly releases a lease held by anyone and audits it.
+
+        Args:
+            name: string, the lease name.
+            reason: string, the reason recorded in the audit log.
+
+        Returns:
+            the dict of the broken lease. None if the lease is not held.
+        """
+
+        def _Break(state):
+            lease = state["leases"].pop(name, None)
+            if lease:
+                logging.warning("Breaking lease %s of process %d: %s", name,
+                                lease["pid"], reason)
+                self._Audit(AUDIT_BREAK, name, lease, reason=reason)
+            return lease
+
+        return self._Update(_Break)
+
+    def Query(self, name=None):
+        """Returns the leases and their waiters.
+
+        Args:
+            name: string, the lease name. None for all leases.
+
+        Returns:
+            a list of dicts sorted by name, each with "name", "holder" (the
+            lease dict or None) and "waiters" (a list of waiter dicts).
+        """
+
+        def _Query(state):
+            names = set(state["leases"]) | set(state["queues"])
+            if name is not None:
+                names &= set([name])
+            return [{
+                "name": lease_name,
+                "holder": state["leases"].get(lease_name),
+                "waiters": list(state["queues"].get(lease_name, [])),
+            } for lease_name in sorted(names)]
+
+        return self._Update(_Query)
+
+    def GetAuditLog(self, limit=None):
+        """Returns the latest records of the audit log.
+
+        Args:
+            limit: int, the maximum number of records. None for all.
+
+        Returns:
+            a list of dicts, the records in chronological order.
+        """
+        try:
+            with open(self._audit_path, "r") as audit_file:
+                lines = audit_file.readlines()
+        except IOError:
+            return []
+        if limit is not None:
+            lines = lines[-limit:] if limit > 0 else []
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logging.error("Corrupted audit record: %r", line)
+        return records
+
+
+class DeviceLock(object):
+    """Locks the devices with leases, in place of FileLock.
+
+    The leases held by this object are renewed by a background thread, so
+    that they expire shortly after the process hangs up or dies and are
+    reclaimed immediately once the process is gone.
+
+    Attributes:
+        _client: LeaseClient object.
+        _ttl: float, the number of seconds a lease lasts unless renewed.
+        _tokens: dict, maps a pid to a dict which maps a serial to the
+                 token of the lease held by the process. A forked child
+                 does not hold the leases of its parent.
+        _lock: threading.Lock, guards _tokens and _renewer.
+        _renewer: threading.Thread renewing the held leases.
+        _renewer_pid: int, the process in which _renewer was started.
+    """
+
+    def __init__(self, client=None, ttl=common.DEVICE_LEASE_TTL_SECS):
+        self._client = client or LeaseClient()
+        self._ttl = ttl
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._renewer = None
+        self._renewer_pid = None
+
+    @property
+    def client(self):
+        """getter for self._client"""
+        return self._client
+
+    def _HeldTokens(self):
+        """Returns the tokens held by this process. Called with the lock."""
+        return self._tokens.setdefault(os.getpid(), {})
+
+    def LockDevice(self,
+                   serial,
+                   suppress_lock_warning=False,
+                   block=False,
+                   job_id=None,
+                   command=None):
+        """Acquires the lease of a device.
+
+        Args:
+            serial: string, serial number of a device.
+            suppress_lock_warning: bool, True to suppress warning log output.
+            block: bool, True to wait until the lease is released.
+            job_id: string, the job for which the device is locked.
+            command: string, the command locking the device.
+
+        Returns:
+            True if successfully acquired the lease or already held by this
+            object. False otherwise.
+        """
+        with self._lock:
+            if serial in self._HeldTokens():
+                return True
+        token = self._client.Acquire(
+            serial,
+            self._ttl,
+            timeout=None if block else 0,
+            job_id=job_id,
+            command=command)
+        if token is None:
+            if not suppress_lock_warning:
+                holder = self._client.Query(serial)
+                logging.warning("Device %s is locked: %s", serial,
+                                holder[0]["holder"] if holder else None)
+            return False
+        with self._lock:
+            self._HeldTokens()[serial] = token
+            self._StartRenewer()
+        return True
+
+    def UnlockDevice(self, serial):
+        """Releases the lease of a device held by this object.
+
+        Args:
+            serial: string, serial number of a device.
+
+        Returns:
+            True if released. False if not held or lost.
+        """
+        with self._lock:
+            token = self._HeldTokens().pop(serial, None)
+        if token is None:
+            logging.error("Lock for the device %s does not exist." % serial)
+            return False
+        if not self._client.Release(serial, token):
+            logging.error("Lease of the device %s was lost.", serial)
+            return False
+        return True
+
+    def _StartRenewer(self):
+        """Starts the renewer thread if not running. Called with the lock."""
+        if (self._renewer and self._renewer.is_alive()
+                and self._renewer_pid == os.getpid()):
+            return
+        self._renewer = threading.Thread(target=self._RenewLoop)
+        self._renewer.daemon = True
+        self._renewer_pid = os.getpid()
+        self._renewer.start()
+
+    def _RenewLoop(self):
+        """Renews the held leases every third of the TTL until none is held."""
+        while True:
+            time.sleep(self._ttl / 3.0)
+            with self._lock:
+                tokens = dict(self._HeldTokens())
+            if not tokens:
+                with self._lock:
+                    if not self._HeldTokens():
+                        self._renewer = None
+                        return
+                continue
+            for serial, token in tokens.items():
+                if not self._client.Renew(serial, token, self._ttl):
+                    logging.error("Lease of the device %s was lost.", serial)
+                    with self._lock:
+                        if self._HeldTokens().get(serial) == token:
+                            del self._HeldTokens()[serial]
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from host_controller.utils.ipc import device_lease
+
+
+def _Holder(lease_dir, acquired):
+    """Acquires a lease and hangs until killed."""
+    client = device_lease.LeaseClient(lease_dir)
+    client.Acquire("serial1", ttl=60, job_id="crashed_job")
+    acquired.set()
+    time.sleep(60)
+
+
+def _LockInChild(lock, results):
+    """Locks a device with a DeviceLock inherited from the parent."""
+    results.put((lock.LockDevice("serial1", suppress_lock_warning=True),
+                 lock.LockDevice("serial2", suppress_lock_warning=True)))
+
+
+class DeviceLeaseTest(unittest.TestCase):
+    """Tests for LeaseClient and DeviceLock."""
+
+    def setUp(self):
+        """Creates a temp dir for the leases."""
+        self._temp_dir = tempfile.mkdtemp()
+        self._client = device_lease.LeaseClient(
+            self._temp_dir, liveness_check_secs=0.1)
+
+    def tearDown(self):
+        """Deletes the temp dir."""
+        shutil.rmtree(self._temp_dir)
+
+    def testAcquireRelease(self):
+        """Tests the contention and the holder metadata."""
+        token = self._client.Acquire(
+            "serial1", ttl=60, timeout=0, job_id="job1", command="test")
+        self.assertTrue(token)
+        self.assertIsNone(self._client.Acquire("serial1", timeout=0))
+        self.assertIsNone(self._client.Acquire("serial1", timeout=0.2))
+        self.assertTrue(self._client.Acquire("serial2", timeout=0))
+
+        leases = self._client.Query("serial1")
+        self.assertEqual(1, len(leases))
+        holder = leases[0]["holder"]
+        self.assertEqual(os.getpid(), holder["pid"])
+        self.assertEqual("job1", holder["job_id"])
+        self.assertEqual("test", holder["command"])
+        self.assertEqual([], leases[0]["waiters"])
+        self.assertEqual(["serial1", "serial2"],
+                         [lease["name"] for lease in self._client.Query()])
+
+        self.assertFalse(self._client.Release("serial1", "wrong_token"))
+        self.assertTrue(self._client.Release("serial1", token))
+        self.assertEqual([], self._client.Query("serial1"))
+
+    def testFifoHandOver(self):
+        """Tests that the waiters are granted the lease in order."""
+        token = self._client.Acquire("serial1", timeout=0)
+        order = []
+
+        def _Wait(index):
+            waiter_token = self._client.Acquire(
+                "serial1", job_id="job%d" % index)
+            order.append(index)
+            self._client.Release("serial1", waiter_token)
+
+        threads = []
+        for index in range(3):
+            thread = threading.Thread(target=_Wait, args=(index, ))
+            thread.start()
+            threads.append(thread)
+            while len(self._client.Query("serial1")[0]["waiters"]) <= index:
+                time.sleep(0.01)
+        self.assertEqual(["job0", "job1", "job2"], [
+            waiter["job_id"]
+            for waiter in self._client.Query("serial1")[0]["waiters"]
+        ])
+        self._client.Release("serial1", token)
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual([0, 1, 2], order)
+
+    def testExpiryAndRenewal(self):
+        """Tests that a lease expires unless renewed."""
+        token = self._client.Acquire("serial1", ttl=0.3, timeout=0)
+        time.sleep(0.2)
+        self.assertTrue(self._client.Renew("serial1", token, ttl=0.3))
+        time.sleep(0.2)
+        self.assertTrue(self._client.Query("serial1"))
+        time.sleep(0.2)
+        self.assertEqual([], self._client.Query("serial1"))
+        self.assertFalse(self._client.Renew("serial1", token))
+        self.assertEqual([device_lease.AUDIT_EXPIRE],
+                         [r["action"] for r in self._client.GetAuditLog()])
+
+    def testBreak(self):
+        """Tests that a broken lease is audited and handed over."""
+        self._client.Acquire("serial1", timeout=0, job_id="stuck_job")
+        self.assertIsNone(self._client.Break("serial2"))
+        lease = self._client.Break("serial1", reason="stuck")
+        self.assertEqual("stuck_job", lease["job_id"])
+        self.assertTrue(self._client.Acquire("serial1", timeout=0))
+
+        records = self._client.GetAuditLog()
+        self.assertEqual(1, len(records))
+        self.assertEqual(device_lease.AUDIT_BREAK, records[0]["action"])
+        self.assertEqual("serial1", records[0]["name"])
+        self.assertEqual("stuck", records[0]["reason"])
+        self.assertEqual("stuck_job", records[0]["holder"]["job_id"])
+        self.assertEqual([], self._client.GetAuditLog(limit=0))
+
+    def testCrashedHolder(self):
+        """Tests that the lease of a killed process is reclaimed."""
+        acquired = multiprocessing.Event()
+        process = multiprocessing.Process(
+            target=_Holder, args=(self._temp_dir, acquired))
+        process.start()
+        self.assertTrue(acquired.wait(10))
+        self.assertIsNone(self._client.Acquire("serial1", timeout=0.3))
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+        self.assertTrue(self._client.Acquire("serial1", timeout=5))
+        records = self._client.GetAuditLog()
+        self.assertEqual(device_lease.AUDIT_RECLAIM, records[-1]["action"])
+        self.assertEqual("crashed_job", records[-1]["holder"]["job_id"])
+
+    def testDeviceLock(self):
+        """Tests locking the devices and renewing their leases."""
+        lock = device_lease.DeviceLock(self._client, ttl=0.3)
+        other_lock = device_lease.DeviceLock(self._client, ttl=0.3)
+        self.assertTrue(lock.LockDevice("serial1", job_id="job1"))
+        self.assertTrue(lock.LockDevice("serial1"))
+        self.assertFalse(
+            other_lock.LockDevice("serial1", suppress_lock_warning=True))
+        # Renewed by the background thread beyond the TTL.
+        time.sleep(0.5)
+        self.assertEqual("job1",
+                         self._client.Query("serial1")[0]["holder"]["job_id"])
+        self.assertTrue(lock.UnlockDevice("serial1"))
+        self.assertFalse(lock.UnlockDevice("serial1"))
+        self.assertTrue(other_lock.LockDevice("serial1"))
+        self.assertTrue(other_lock.UnlockDevice("serial1"))
+
+
+    def testDeviceLockAfterFork(self):
+        """Tests that a forked child does not hold the parent's leases."""
+        lock = device_lease.DeviceLock(self._client, ttl=60)
+        self.assertTrue(lock.LockDevice("serial1"))
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_LockInChild, args=(lock, results))
+        process.start()
+        self.assertEqual((False, True), results.get(timeout=10))
+        process.join()
+        self.assertTrue(lock.LockDevice("serial1"))
+        self.assertTrue(lock.UnlockDevice("serial1"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,213 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import os
+import threading
+import time
+
+from host_controller import common
+from host_controller.utils.ipc import ipc_utils
+
+
+class FairSemaphore(object):
+    """Host-wide counting semaphore granting the slots in FIFO order.
+
+    The holders and the wait queue of a semaphore are kept in a state file
+    guarded by an fcntl lock. A waiter blocks on its own named pipe and is
+    woken up as soon as a slot is handed over to it on release, so that no
+    waiter polls nor barges ahead of the earlier ones. The slots of the
+    holders whose processes have died are reclaimed by the next operation
+    on the semaphore, or by a waiter every liveness_check_secs.
+
+    Each name is an independent resource with its own slots and queue.
+
+    Attributes:
+        _name: string, the name of the semaphore.
+        _max_value: int, the number of slots.
+        _dir: string, the directory of the state file and the pipes.
+        _state_file: StateFile, the holders and the wait queue.
+        _liveness_check_secs: float, the interval at which a waiter checks
+                              for dead holders.
+        _local: threading.local holding the tokens acquired by a thread.
+    """
+
+    def __init__(self,
+                 name,
+                 max_value=common.MAX_ADB_FASTBOOT_PROCESS,
+                 semaphore_dir=None,
+                 liveness_check_secs=common.SEMAPHORE_LIVENESS_CHECK_SECS):
+        self._name = name
+        self._max_value = max_value
+        self._dir = semaphore_dir or os.path.join(
+            os.path.expanduser("~"), common._SEMAPHORE_DIR)
+        ipc_utils.MakeDirs(self._dir)
+        self._state_file = ipc_utils.StateFile(
+            os.path.join(self._dir, name + ".json"))
+        self._liveness_check_secs = liveness_check_secs
+        self._local = threading.local()
+
+    def __enter__(self):
+        self.Acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Release()
+
+    def _PipePath(self, token):
+        """Returns the path to the named pipe of a waiter."""
+        return os.path.join(self._dir, "%s.%s.fifo" % (self._name, token))
+
+    def _Update(self, update):
+        """Updates the state, hands the free slots over and wakes up waiters.
+
+        Args:
+            update: function taking the state dict, which has "holders" and
+                    "queue", both lists of the entries from
+                    ipc_utils.NewProcessEntry. It is called with the state
+                    file locked and may modify the state in place.
+
+        Returns:
+            the return value of update.
+        """
+        with self._state_file.Lock() as state:
+            state.setdefault("holders", [])
+            state.setdefault("queue", [])
+            ret = update(state)
+            granted = self._Reclaim(state)
+        for token in granted:
+            ipc_utils.WakeupPipe.Wake(self._PipePath(token))
+        return ret
+
+    def _Reclaim(self, state):
+        """Drops the dead processes and hands the free slots to the waiters.
+
+        Args:
+            state: dict, the locked state which is modified in place.
+
+        Returns:
+            a list of the tokens granted a slot, to be woken up.
+        """
+        for holder in [h for h in state["holders"]
+                       if not ipc_utils.IsProcessAlive(h)]:
+            logging.warning("Reclaiming %s held by dead process %d.",
+                            self._name, holder["pid"])
+            state["holders"].remove(holder)
+        for waiter in [w for w in state["queue"]
+                       if not ipc_utils.IsProcessAlive(w)]:
+            state["queue"].remove(waiter)
+            try:
+                os.remove(self._PipePath(waiter["token"]))
+            except OSError:
+                pass
+
+        granted = []
+        while state["queue"] and len(state["holders"]) < self._max_value:
+            waiter = state["queue"].pop(0)
+            waiter["granted_time"] = time.time()
+            state["holders"].append(waiter)
+            granted.append(waiter["token"])
+        return granted
+
+    @staticmethod
+    def _IsHolder(state, token):
+        """Returns whether a token holds a slot in the state."""
+        return any(h["token"] == token for h in state["holders"])
+
+    def Acquire(self, timeout=None):
+        """Waits for a slot in the order of the calls.
+
+        Args:
+            timeout: float, the maximum time to wait in seconds. None to
+                     wait indefinitely.
+
+        Returns:
+            True if a slot is acquired; False if timed out.
+        """
+        entry = ipc_utils.NewProcessEntry()
+        token = entry["token"]
+        pipe = ipc_utils.WakeupPipe(self._PipePath(token))
+        try:
+            self._Update(lambda state: state["queue"].append(entry))
+            deadline = None if timeout is None else time.time() + timeout
+            while not self._Update(
+                    lambda state: self._IsHolder(state, token)):
+                wait_secs = self._liveness_check_secs
+                if deadline is not None:
+                    wait_secs = min(wait_secs, deadline - time.time())
+                    if wait_secs <= 0:
+                        acquired = self._Update(
+                            lambda state: self._Dequeue(state, token))
+                        break
+                pipe.Wait(wait_secs)
+            else:
+                acquired = True
+        finally:
+            pipe.Close()
+
+        if acquired:
+            if not hasattr(self._local, "tokens"):
+                self._local.tokens = []
+            self._local.tokens.append(token)
+        else:
+            logging.warning("Timed out waiting for semaphore %s.", self._name)
+        return acquired
+
+    def _Dequeue(self, state, token):
+        """Removes a timed-out waiter unless it has been granted a slot.
+
+        Returns:
+            True if the waiter holds a slot.
+        """
+        if self._IsHolder(state, token):
+            return True
+        state["queue"] = [w for w in state["queue"] if w["token"] != token]
+        return False
+
+    def Release(self):
+        """Releases the slot most recently acquired by the calling thread.
+
+        The slot is handed over to the longest waiter, if any, which is
+        woken up immediately.
+        """
+        tokens = getattr(self._local, "tokens", None)
+        if not tokens:
+            logging.error("Semaphore %s released without being acquired.",
+                          self._name)
+            return
+        token = tokens.pop()
+
+        def _Remove(state):
+            state["holders"] = [
+                h for h in state["holders"] if h["token"] != token
+            ]
+
+        self._Update(_Remove)
+
+    def GetStatus(self):
+        """Returns the holders and the waiters of the semaphore.
+
+        Returns:
+            a dict with "max_value", "holders" and "queue". The holders
+            and the waiters are lists of dicts with "pid", "request_time"
+            and, for the holders, "granted_time".
+        """
+        with self._state_file.Lock(write=False) as state:
+            return {
+                "max_value": self._max_value,
+                "holders": list(state.get("holders", [])),
+                "queue": list(state.get("queue", [])),
+            }
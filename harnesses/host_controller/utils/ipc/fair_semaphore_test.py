@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from host_controller.utils.ipc import fair_semaphore
+
+# Time for which each worker of the stress test holds a slot in secs.
+_HOLD_SECS = 0.2
+
+
+def _Worker(semaphore_dir, index, start_time, results):
+    """Acquires a slot after a delay, holds it and reports the timestamps.
+
+    Args:
+        semaphore_dir: string, the directory of the semaphore.
+        index: int, the worker index, which orders the requests.
+        start_time: float, the time at which the first worker requests.
+        results: multiprocessing.Queue receiving (index, request time,
+                 granted time, released time).
+    """
+    sem = fair_semaphore.FairSemaphore(
+        "stress", max_value=2, semaphore_dir=semaphore_dir)
+    time.sleep(max(0, start_time + index * 0.02 - time.time()))
+    request_time = time.time()
+    sem.Acquire()
+    granted_time = time.time()
+    time.sleep(_HOLD_SECS)
+    released_time = time.time()
+    sem.Release()
+    results.put((index, request_time, granted_time, released_time))
+
+
+def _Holder(semaphore_dir, acquired):
+    """Acquires a slot and hangs until killed."""
+    sem = fair_semaphore.FairSemaphore(
+        "crash", max_value=1, semaphore_dir=semaphore_dir)
+    sem.Acquire()
+    acquired.set()
+    time.sleep(60)
+
+
+class FairSemaphoreTest(unittest.TestCase):
+    """Tests for FairSemaphore."""
+
+    def setUp(self):
+        """Creates a temp dir for the semaphores."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Deletes the temp dir."""
+        shutil.rmtree(self._temp_dir)
+
+    def _CreateSemaphore(self, name, max_value, **kwargs):
+        return fair_semaphore.FairSemaphore(
+            name, max_value=max_value, semaphore_dir=self._temp_dir,
+            **kwargs)
+
+    def testAcquireRelease(self):
+        """Tests the slot count, the timeout and the status."""
+        sem = self._CreateSemaphore("sem", 2)
+        self.assertTrue(sem.Acquire())
+        self.assertTrue(sem.Acquire(timeout=1))
+        start_time = time.time()
+        self.assertFalse(sem.Acquire(timeout=0.2))
+        self.assertLess(time.time() - start_time, 1)
+        status = sem.GetStatus()
+        self.assertEqual(2, len(status["holders"]))
+        self.assertEqual([], status["queue"])
+        sem.Release()
+        with sem:
+            self.assertEqual(2, len(sem.GetStatus()["holders"]))
+        sem.Release()
+        self.assertEqual([], sem.GetStatus()["holders"])
+
+    def testIndependentResources(self):
+        """Tests that each name has its own slots."""
+        sem1 = self._CreateSemaphore("sem1", 1)
+        sem2 = self._CreateSemaphore("sem2", 1)
+        self.assertTrue(sem1.Acquire())
+        self.assertTrue(sem2.Acquire(timeout=0.5))
+        sem1.Release()
+        sem2.Release()
+
+    def testFifoWakeup(self):
+        """Tests that the threads are woken up in order without polling."""
+        sem = self._CreateSemaphore("sem", 1, liveness_check_secs=60)
+        sem.Acquire()
+        order = []
+
+        def _Wait(index):
+            sem.Acquire()
+            order.append((index, time.time()))
+            sem.Release()
+
+        threads = []
+        for index in range(5):
+            thread = threading.Thread(target=_Wait, args=(index, ))
+            thread.start()
+            threads.append(thread)
+            while len(sem.GetStatus()["queue"]) <= index:
+                time.sleep(0.01)
+        released_time = time.time()
+        sem.Release()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(list(range(5)), [index for index, _ in order])
+        self.assertLess(order[-1][1] - released_time, 1)
+
+    def testCrashedHolder(self):
+        """Tests that the slot of a killed process is reclaimed."""
+        acquired = multiprocessing.Event()
+        process = multiprocessing.Process(
+            target=_Holder, args=(self._temp_dir, acquired))
+        process.start()
+        self.assertTrue(acquired.wait(10))
+        sem = self._CreateSemaphore("crash", 1, liveness_check_secs=0.1)
+        self.assertFalse(sem.Acquire(timeout=0.3))
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+        self.assertTrue(sem.Acquire(timeout=5))
+        self.assertEqual(os.getpid(), sem.GetStatus()["holders"][0]["pid"])
+        sem.Release()
+
+    def testStress(self):
+        """Tests that the wait latency tracks the slot availability.
+
+        Eight processes request two slots 20ms apart. Each slot is granted
+        in request order right after a holder releases it, so the total
+        time is the hold time multiplied by the number of rounds.
+        """
+        results = multiprocessing.Queue()
+        start_time = time.time() + 0.5
+        processes = [
+            multiprocessing.Process(
+                target=_Worker,
+                args=(self._temp_dir, index, start_time, results))
+            for index in range(8)
+        ]
+        for process in processes:
+            process.start()
+        records = sorted(results.get(timeout=30) for _ in processes)
+        for process in processes:
+            process.join()
+
+        grants = sorted(records, key=lambda record: record[2])
+        self.assertEqual(list(range(8)), [record[0] for record in grants])
+        releases = sorted(record[3] for record in records)
+        for index, request_time, granted_time, _ in records:
+            if index < 2:
+                self.assertLess(granted_time - request_time, 0.1)
+                continue
+            # Granted as soon as one of the earlier holders released.
+            released_before = [t for t in releases if t <= granted_time]
+            self.assertEqual(index - 1, len(released_before))
+            self.assertLess(granted_time - released_before[-1], 0.1)
+        makespan = max(releases) - min(r[1] for r in records)
+        self.assertLess(makespan, 4 * _HOLD_SECS + 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
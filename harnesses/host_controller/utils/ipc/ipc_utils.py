@@ -0,0 +1,214 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import contextlib
+import errno
+import fcntl
+import json
+import logging
+import os
+import select
+import threading
+import time
+import uuid
+
+# Locks serializing the threads of this process per state file, since
+# fcntl locks are held per process.
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+def _GetThreadLock(path):
+    """Returns the process-local lock of a state file."""
+    with _thread_locks_lock:
+        return _thread_locks.setdefault(path, threading.Lock())
+
+
+def MakeDirs(path):
+    """Creates a directory and its parents if they do not exist."""
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def GetProcessStartTime(pid):
+    """Returns the start time of a process, which tells it from a reused pid.
+
+    Args:
+        pid: int, the process id.
+
+    Returns:
+        string, the start time in clock ticks since boot; an empty string if
+        /proc is not available. None if the process does not exist or is a
+        zombie, whose locks and leases can be reclaimed.
+    """
+    try:
+        with open("/proc/%d/stat" % pid, "r") as stat_file:
+            stat = stat_file.read()
+        # The command name in parentheses may contain spaces.
+        fields = stat[stat.rindex(")") + 2:].split()
+        if fields[0] == "Z":
+            return None
+        return fields[19]
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return None
+    return ""
+
+
+def NewProcessEntry(pid=None, **metadata):
+    """Returns an entry identifying the calling thread of this process.
+
+    Args:
+        pid: int, the process the entry identifies instead, e.g., a child
+             recorded by its parent. None for the calling process.
+        metadata: additional keys of the entry.
+
+    Returns:
+        a dict with a unique "token", "pid", "start_time", "request_time"
+        and the metadata.
+    """
+    if pid is None:
+        pid = os.getpid()
+    entry = {
+        "token": uuid.uuid4().hex,
+        "pid": pid,
+        "start_time": GetProcessStartTime(pid),
+        "request_time": time.time(),
+    }
+    entry.update(metadata)
+    return entry
+
+
+def IsProcessAlive(entry):
+    """Returns whether the process of an entry is running.
+
+    Args:
+        entry: dict with "pid" and "start_time", e.g., from NewProcessEntry.
+    """
+    start_time = GetProcessStartTime(entry["pid"])
+    return start_time is not None and (not start_time or
+                                       start_time == entry["start_time"])
+
+
+class StateFile(object):
+    """A JSON object in a file shared by the processes on the host.
+
+    Attributes:
+        _path: string, the path to the file.
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+    @contextlib.contextmanager
+    def Lock(self, write=True):
+        """Locks the file and yields its content.
+
+        Args:
+            write: bool, whether to write the content back on exit.
+
+        Yields:
+            a dict, the content which the caller may modify in place.
+            Empty if the file does not exist or is corrupted.
+        """
+        thread_lock = _GetThreadLock(self._path)
+        with thread_lock:
+            with open(self._path, "a+") as state_file:
+                fcntl.lockf(state_file, fcntl.LOCK_EX)
+                try:
+                    state_file.seek(0)
+                    content = state_file.read()
+                    try:
+                        state = json.loads(content) if content else {}
+                    except ValueError:
+                        logging.error("Corrupted state file %s: %r",
+                                      self._path, content)
+                        state = {}
+                    yield state
+                    if write:
+                        state_file.seek(0)
+                        state_file.truncate(0)
+                        state_file.write(json.dumps(state))
+                        state_file.flush()
+                finally:
+                    fcntl.lockf(state_file, fcntl.LOCK_UN)
+
+
+class WakeupPipe(object):
+    """A named pipe on which a waiter blocks until another process wakes it.
+
+    The pipe is opened before the waiter is published, so that no wakeup
+    is lost between publishing and waiting.
+
+    Attributes:
+        _path: string, the path to the named pipe.
+        _fd: int, the file descriptor opened for reading.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        os.mkfifo(path)
+        self._fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+
+    def Wait(self, timeout):
+        """Waits for a wakeup.
+
+        Args:
+            timeout: float, the maximum time to wait in seconds.
+
+        Returns:
+            True if woken up; False if timed out.
+        """
+        readable, _, _ = select.select([self._fd], [], [], max(0, timeout))
+        if readable:
+            os.read(self._fd, 16)
+        return bool(readable)
+
+    def Close(self):
+        """Closes and deletes the named pipe."""
+        os.close(self._fd)
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def Wake(path):
+        """Wakes up the waiter on a named pipe, if it is waiting.
+
+        Args:
+            path: string, the path to the named pipe.
+        """
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            # ENXIO or ENOENT if the waiter is gone; it checks the state
+            # before waiting again.
+            logging.debug("Failed to wake up %s: %s", path, e)
+            return
+        try:
+            os.write(fd, b"1")
+        except OSError as e:
+            logging.debug("Failed to wake up %s: %s", path, e)
+        finally:
+            os.close(fd)
@@ -0,0 +1,258 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import ctypes
+import multiprocessing
+import os
+import time
+
+from host_controller import common
+
+# Maximum length of a key in bytes.
+_KEY_SIZE = 64
+
+
+class _Record(ctypes.Structure):
+    """A fixed-size record of the table.
+
+    Attributes:
+        seq: the sequence number, which is odd while the record is written.
+        version: the table version at which the value was last changed.
+        key: the key, e.g., a device serial.
+        value: the status value.
+    """
+    _fields_ = [
+        ("seq", ctypes.c_uint32),
+        ("version", ctypes.c_uint64),
+        ("key", ctypes.c_char * _KEY_SIZE),
+        ("value", ctypes.c_int32),
+    ]
+
+
+def _EncodeKey(key):
+    """Returns the key as bytes to be stored in a record."""
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8")
+    if len(key) > _KEY_SIZE:
+        raise KeyError("Key longer than %d bytes: %r" % (_KEY_SIZE, key))
+    return key
+
+
+def _DecodeKey(key):
+    """Returns the key read from a record as a string."""
+    return key if isinstance(key, str) else key.decode("utf-8")
+
+
+class SharedStatusTable(object):
+    """Table of the device status in memory shared with the process pool.
+
+    A drop-in replacement for SharedDict which does not go through a
+    manager process. The records are allocated in an array of fixed-size
+    records in shared memory and never freed, so that the index of a key
+    can be cached by each process. The table has to be created before the
+    processes sharing it are forked.
+
+    Reads do not lock. A writer makes a record's sequence number odd while
+    it updates the record, and a reader retries until it reads the same
+    even sequence number before and after reading the value. The writers
+    are serialized by the lock of a condition variable, on which the
+    changes are notified.
+
+    Attributes:
+        _capacity: int, the maximum number of records.
+        _records: multiprocessing.RawArray of _Record.
+        _count: multiprocessing.RawValue, the number of allocated records.
+        _version: multiprocessing.RawValue, incremented on every change.
+        _changed: multiprocessing.Condition, guards the writes and notifies
+                  the changes.
+        _indexes: dict, maps a key to the index of its record, cached by the
+                  process.
+        _indexes_pid: int, the process which _indexes belong to.
+    """
+
+    def __init__(self, capacity=common.MAX_DEVICE_STATUS_RECORDS):
+        self._capacity = capacity
+        self._records = multiprocessing.RawArray(_Record, capacity)
+        self._count = multiprocessing.RawValue(ctypes.c_uint32, 0)
+        self._version = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self._changed = multiprocessing.Condition()
+        self._indexes = {}
+        self._indexes_pid = None
+
+    def _FindIndex(self, key):
+        """Returns the index of a key's record without locking.
+
+        Args:
+            key: bytes, the encoded key.
+
+        Returns:
+            int, the index. None if the key has no record.
+        """
+        if self._indexes_pid != os.getpid():
+            self._indexes = {}
+            self._indexes_pid = os.getpid()
+        index = self._indexes.get(key)
+        if index is None:
+            # Records are published by incrementing _count after the key
+            # is written, and their keys never change.
+            for index in range(len(self._indexes), self._count.value):
+                self._indexes[self._records[index].key] = index
+            index = self._indexes.get(key)
+        return index
+
+    def _Read(self, index):
+        """Reads a consistent (value, version) of a record without locking."""
+        record = self._records[index]
+        while True:
+            seq = record.seq
+            if seq & 1:
+                time.sleep(0)
+                continue
+            value = record.value
+            version = record.version
+            if record.seq == seq:
+                return value, version
+
+    def _Write(self, key, value, only_if_absent=False):
+        """Allocates the record of a key if needed and writes the value.
+
+        Args:
+            key: bytes, the encoded key.
+            value: int, the status value.
+            only_if_absent: bool, whether to write the value only if the
+                            key has no record.
+
+        Returns:
+            int, the index of the record.
+        """
+        with self._changed:
+            index = self._FindIndex(key)
+            if index is None:
+                index = self._count.value
+                if index >= self._capacity:
+                    raise KeyError("Status table is full: %r" % key)
+                self._records[index].key = key
+                self._count.value = index + 1
+                self._indexes[key] = index
+            elif only_if_absent:
+                return index
+            record = self._records[index]
+            if record.value == value and record.version:
+                return index
+            self._version.value += 1
+            record.seq += 1
+            record.value = value
+            record.version = self._version.value
+            record.seq += 1
+            self._changed.notify_all()
+        return index
+
+    def __getitem__(self, key):
+        """Returns the status of a device.
+
+        Args:
+            key: string, serial number of a device.
+
+        Returns:
+            integer value defined in _DEVICE_STATUS_DICT.
+        """
+        encoded_key = _EncodeKey(key)
+        index = self._FindIndex(encoded_key)
+        if index is None:
+            index = self._Write(
+                encoded_key,
+                common._DEVICE_STATUS_DICT["unknown"],
+                only_if_absent=True)
+        return self._Read(index)[0]
+
+    def __setitem__(self, key, value):
+        """Sets the status of a device.
+
+        if the value is not a defined one, device status is set to "unknown".
+
+        Args:
+            key: string, serial number of a device.
+            value: integer, status value defined in _DEVICE_STATUS_DICT.
+        """
+        if value not in range(len(common._DEVICE_STATUS_DICT)):
+            value = common._DEVICE_STATUS_DICT["unknown"]
+        self._Write(_EncodeKey(key), value)
+
+    def __contains__(self, key):
+        return self._FindIndex(_EncodeKey(key)) is not None
+
+    def __len__(self):
+        return self._count.value
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        """Returns the status of a device, or default if it has no record."""
+        index = self._FindIndex(_EncodeKey(key))
+        return default if index is None else self._Read(index)[0]
+
+    def keys(self):
+        """Returns the list of the keys."""
+        return [
+            _DecodeKey(self._records[index].key)
+            for index in range(self._count.value)
+        ]
+
+    def items(self):
+        """Returns the list of (key, status value) pairs."""
+        return [(_DecodeKey(self._records[index].key), self._Read(index)[0])
+                for index in range(self._count.value)]
+
+    @property
+    def version(self):
+        """The version of the table, which is incremented on every change."""
+        return self._version.value
+
+    def GetChanges(self, version):
+        """Returns the records changed after a version.
+
+        Args:
+            version: int, a version previously read from the table.
+
+        Returns:
+            a dict mapping the key to the status value of each record
+            changed after the version.
+        """
+        changes = {}
+        for index in range(self._count.value):
+            value, record_version = self._Read(index)
+            if record_version > version:
+                changes[_DecodeKey(self._records[index].key)] = value
+        return changes
+
+    def WaitForChange(self, version, timeout=None):
+        """Waits until the table changes after a version.
+
+        Args:
+            version: int, a version previously read from the table.
+            timeout: float, the maximum time to wait in seconds. None to
+                     wait indefinitely.
+
+        Returns:
+            int, the current version, which equals the given one if timed
+            out.
+        """
+        with self._changed:
+            if self._version.value == version:
+                self._changed.wait(timeout)
+            return self._version.value
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import multiprocessing
+import threading
+import time
+import unittest
+
+from host_controller import common
+from host_controller.utils.ipc import shared_dict
+from host_controller.utils.ipc import shared_status_table
+
+_UNKNOWN = common._DEVICE_STATUS_DICT["unknown"]
+_READY = common._DEVICE_STATUS_DICT["ready"]
+_USE = common._DEVICE_STATUS_DICT["use"]
+
+# Number of accesses timed by the benchmark.
+_BENCHMARK_ACCESSES = 2000
+
+
+def _Worker(table, index, results):
+    """Marks a device in use and reports what it reads in the child."""
+    table["serial%d" % index] = _USE
+    results.put((index, table["serial0"], sorted(table.keys())))
+
+
+def _TimeAccesses(status):
+    """Returns the seconds taken by the reads and writes of a status dict."""
+    start_time = time.time()
+    for count in range(_BENCHMARK_ACCESSES // 2):
+        status["serial%d" % (count % 8)] = _READY
+        status["serial%d" % (count % 8)]
+    return time.time() - start_time
+
+
+class SharedStatusTableTest(unittest.TestCase):
+    """Tests for SharedStatusTable."""
+
+    def setUp(self):
+        """Creates a table."""
+        self._table = shared_status_table.SharedStatusTable(capacity=16)
+
+    def testDictApi(self):
+        """Tests the behavior shared with SharedDict."""
+        self.assertNotIn("serial1", self._table)
+        self.assertIsNone(self._table.get("serial1"))
+        self.assertEqual(_UNKNOWN, self._table["serial1"])
+        self.assertIn("serial1", self._table)
+        self._table["serial2"] = _READY
+        self.assertEqual(_READY, self._table["serial2"])
+        self._table["serial2"] = 100
+        self.assertEqual(_UNKNOWN, self._table["serial2"])
+        self._table[u"serial3"] = _USE
+        self.assertEqual(_USE, self._table["serial3"])
+        self.assertEqual(3, len(self._table))
+        self.assertEqual(["serial1", "serial2", "serial3"],
+                         list(self._table))
+        self.assertEqual([("serial1", _UNKNOWN), ("serial2", _UNKNOWN),
+                          ("serial3", _USE)], self._table.items())
+
+    def testCapacity(self):
+        """Tests the limits of the fixed-size records."""
+        with self.assertRaises(KeyError):
+            self._table["s" * 65] = _READY
+        for index in range(16):
+            self._table["serial%d" % index] = _READY
+        with self.assertRaises(KeyError):
+            self._table["serial16"] = _READY
+
+    def testProcesses(self):
+        """Tests that the forked processes share the records."""
+        self._table["serial0"] = _READY
+        self._table["serial1"]
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=_Worker, args=(self._table, index, results))
+            for index in range(1, 4)
+        ]
+        for process in processes:
+            process.start()
+        records = sorted(results.get(timeout=10) for _ in processes)
+        for process in processes:
+            process.join()
+        for index, serial0, keys in records:
+            self.assertEqual(_READY, serial0)
+            self.assertIn("serial%d" % index, keys)
+        self.assertEqual(["serial0", "serial1", "serial2", "serial3"],
+                         sorted(self._table.keys()))
+        for index in range(1, 4):
+            self.assertEqual(_USE, self._table["serial%d" % index])
+
+    def testChangeNotification(self):
+        """Tests waiting for and listing the changed records."""
+        self._table["serial1"] = _READY
+        version = self._table.version
+        self._table["serial1"] = _READY
+        self.assertEqual(version, self._table.version)
+        self.assertEqual(version, self._table.WaitForChange(version, 0.1))
+
+        timer = threading.Timer(0.2, self._table.__setitem__,
+                                ("serial2", _USE))
+        timer.start()
+        start_time = time.time()
+        new_version = self._table.WaitForChange(version, 5)
+        timer.join()
+        self.assertGreater(new_version, version)
+        self.assertLess(time.time() - start_time, 2)
+        self.assertEqual({"serial2": _USE}, self._table.GetChanges(version))
+        self.assertEqual({}, self._table.GetChanges(new_version))
+
+    def testBenchmark(self):
+        """Compares the access time with the manager-backed SharedDict."""
+        manager = multiprocessing.Manager()
+        try:
+            dict_secs = _TimeAccesses(shared_dict.SharedDict(manager))
+        finally:
+            manager.shutdown()
+        table_secs = _TimeAccesses(self._table)
+        logging.info("%d accesses: SharedDict %.3fs, SharedStatusTable "
+                     "%.3fs", _BENCHMARK_ACCESSES, dict_secs, table_secs)
+        self.assertLess(table_secs * 2, dict_secs)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()
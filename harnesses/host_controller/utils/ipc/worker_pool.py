@@ -0,0 +1,373 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import atexit
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Status of a task in the result of WorkerPool.Run.
+TASK_DONE = "done"
+TASK_FAILED = "failed"
+TASK_CRASHED = "crashed"
+TASK_CANCELLED = "cancelled"
+
+# Internal status reported by a worker when it takes a task.
+_TASK_STARTED = "started"
+
+# Interval at which the liveness of the busy workers is checked in seconds.
+_LIVENESS_CHECK_SECS = 1
+
+# Time a cancelled task has to return before its worker is killed in
+# seconds.
+_CANCEL_GRACE_SECS = 30
+
+
+class TaskCancelledError(BaseException):
+    """Raised in a task when it is cancelled.
+
+    It does not derive from Exception so that the tasks do not catch it.
+    """
+    pass
+
+
+class TaskResult(object):
+    """The result of a task.
+
+    Attributes:
+        status: string, TASK_DONE, TASK_FAILED (the function raised an
+                exception), TASK_CRASHED (the worker died), or
+                TASK_CANCELLED (a sibling failed).
+        value: the return value of the function if done, or the error
+               message.
+        exit_code: int, the exit code of the crashed worker, or None.
+    """
+
+    def __init__(self, status, value=None, exit_code=None):
+        self.status = status
+        self.value = value
+        self.exit_code = exit_code
+
+    def __repr__(self):
+        return "TaskResult(%s, %r, %r)" % (self.status, self.value,
+                                          self.exit_code)
+
+
+def _WorkerMain(function, task_queue, result_queue, started, worker_id,
+                max_tasks, idle_secs):
+    """Runs tasks in a worker process until told to stop.
+
+    SIGTERM raises TaskCancelledError in the running task, after which the
+    worker takes the next task. The exception is raised when the task next
+    runs Python code, e.g., when it polls a subprocess.
+
+    The worker leads a process group, so that the subprocesses of a task,
+    e.g., fastboot, are signaled together with the worker.
+
+    Args:
+        function: the function called with each task.
+        task_queue: multiprocessing.Queue of (task id, task), or None to
+                    stop.
+        result_queue: multiprocessing.Queue to which (worker id, task id,
+                      status, value) is put.
+        started: multiprocessing.RawValue, set to the id of the task being
+                 started. Unlike the queue, it is not lost if the worker
+                 dies right after.
+        worker_id: int, identifies the worker in the results.
+        max_tasks: int, the number of tasks after which the worker exits.
+                   0 for no limit.
+        idle_secs: float, the idle time after which the worker exits.
+    """
+    running = [False]
+
+    def _Cancel(signum, frame):
+        if running[0]:
+            running[0] = False
+            raise TaskCancelledError()
+
+    signal.signal(signal.SIGTERM, _Cancel)
+    os.setpgrp()
+    parent_pid = os.getppid()
+    num_tasks = 0
+    while not max_tasks or num_tasks < max_tasks:
+        try:
+            item = task_queue.get(timeout=idle_secs)
+        except queue.Empty:
+            return
+        if item is None or os.getppid() != parent_pid:
+            return
+        task_id, task = item
+        try:
+            running[0] = True
+            started.value = task_id
+            try:
+                # The parent interrupts the task only after receiving this.
+                result_queue.put((worker_id, task_id, _TASK_STARTED, None))
+                value = function(task)
+            finally:
+                running[0] = False
+            result_queue.put((worker_id, task_id, TASK_DONE, value))
+        except TaskCancelledError:
+            result_queue.put((worker_id, task_id, TASK_CANCELLED, None))
+        except Exception as e:
+            logging.exception("Task %d failed.", task_id)
+            result_queue.put((worker_id, task_id, TASK_FAILED,
+                              "%s: %s" % (type(e).__name__, e)))
+        num_tasks += 1
+
+
+def _SignalWorker(process, signum):
+    """Sends a signal to the process group of a worker.
+
+    Args:
+        process: multiprocessing.Process object, the worker whose pid is
+                 also the id of its group.
+        signum: int, the signal number.
+    """
+    try:
+        os.killpg(process.pid, signum)
+        return
+    except OSError:
+        pass
+    # The worker has not created its group yet.
+    if process.is_alive():
+        try:
+            os.kill(process.pid, signum)
+        except OSError:
+            pass
+
+
+class _Worker(object):
+    """A worker process and the task it is running.
+
+    Attributes:
+        process: multiprocessing.Process object.
+        task_queue: multiprocessing.Queue feeding the worker.
+        started: multiprocessing.RawValue, the id of the last task started.
+    """
+
+    def __init__(self, process, task_queue, started):
+        self.process = process
+        self.task_queue = task_queue
+        self.started = started
+
+
+class WorkerPool(object):
+    """A bounded pool of forked worker processes reused across the runs.
+
+    The workers are forked on demand from the calling process and kept
+    warm for the next run, so that a run does not pay for forking and
+    tearing down a process per task. A task runs in isolation from the
+    caller like a forked child; the function receives whatever state it
+    needs as part of the task.
+
+    A worker exits after max_tasks_per_worker tasks or after being idle
+    for idle_secs, and is forked again when needed. A worker which dies
+    while running a task fails the task with its exit code. A cancelled
+    task is interrupted by SIGTERM, which also terminates the subprocesses
+    of the task, and its worker is kept; the worker is killed only if the
+    task does not return in time.
+
+    Attributes:
+        _function: the function called with each task in the workers.
+        _max_workers: int, the maximum number of the workers.
+        _max_tasks_per_worker: int, 0 for no limit.
+        _idle_secs: float, the idle time after which a worker exits.
+        _workers: dict, maps a worker id to a _Worker.
+        _next_worker_id: int, the id of the next forked worker.
+        _result_queue: multiprocessing.Queue of the results.
+        _lock: threading.Lock, serializes the runs.
+    """
+
+    def __init__(self, function, max_workers, max_tasks_per_worker=0,
+                 idle_secs=600):
+        self._function = function
+        self._max_workers = max_workers
+        self._max_tasks_per_worker = max_tasks_per_worker
+        self._idle_secs = idle_secs
+        self._workers = {}
+        self._next_worker_id = 0
+        self._result_queue = multiprocessing.Queue()
+        self._lock = threading.Lock()
+        atexit.register(self.Close)
+
+    def _Fork(self):
+        """Forks a worker process and returns its id."""
+        worker_id = self._next_worker_id
+        self._next_worker_id += 1
+        task_queue = multiprocessing.Queue()
+        started = multiprocessing.RawValue("i", -1)
+        process = multiprocessing.Process(
+            target=_WorkerMain,
+            args=(self._function, task_queue, self._result_queue, started,
+                  worker_id, self._max_tasks_per_worker, self._idle_secs))
+        process.start()
+        self._workers[worker_id] = _Worker(process, task_queue, started)
+        return worker_id
+
+    def _Remove(self, worker_id, kill=False):
+        """Stops tracking a worker, killing it if requested."""
+        worker = self._workers.pop(worker_id)
+        if kill:
+            # Also kills the subprocesses left by a worker which exited.
+            _SignalWorker(worker.process, signal.SIGKILL)
+        worker.process.join()
+
+    def GetNumWorkers(self):
+        """Returns the number of the live worker processes."""
+        with self._lock:
+            return len(self._workers)
+
+    def Run(self, tasks, cancel_on_failure=True):
+        """Runs tasks in parallel and waits for all of them.
+
+        Args:
+            tasks: list of the picklable arguments of the function.
+            cancel_on_failure: bool, whether to interrupt the running tasks
+                               and cancel the pending ones once a task
+                               fails, crashes or returns False.
+
+        Returns:
+            a list of TaskResult objects in the order of the tasks.
+        """
+        with self._lock:
+            return self._Run(tasks, cancel_on_failure)
+
+    def _Run(self, tasks, cancel_on_failure):
+        """Runs tasks with the lock held."""
+        results = [None] * len(tasks)
+        pending = list(range(len(tasks)))
+        # Maps a worker id to [task id, whether the task started].
+        running = {}
+        cancel_deadline = None
+
+        for worker_id in [w for w, worker in self._workers.items()
+                          if not worker.process.is_alive()]:
+            self._Remove(worker_id)
+
+        while pending or running:
+            idle = [w for w in self._workers if w not in running]
+            while pending and (idle or len(self._workers) < self._max_workers):
+                worker_id = idle.pop(0) if idle else self._Fork()
+                task_id = pending.pop(0)
+                running[worker_id] = [task_id, False]
+                self._workers[worker_id].task_queue.put(
+                    (task_id, tasks[task_id]))
+
+            try:
+                worker_id, task_id, status, value = self._result_queue.get(
+                    timeout=_LIVENESS_CHECK_SECS)
+            except queue.Empty:
+                crashed = self._CheckLiveness(running, pending, results)
+                if crashed and cancel_on_failure and cancel_deadline is None:
+                    cancel_deadline = self._Cancel(running, pending, results)
+                elif cancel_deadline:
+                    # Cancels the tasks requeued by _CheckLiveness.
+                    self._Cancel({}, pending, results)
+                if cancel_deadline and time.time() > cancel_deadline:
+                    for worker_id, (task_id, _) in list(running.items()):
+                        logging.error("Killing worker %d running cancelled "
+                                      "task %d.", worker_id, task_id)
+                        results[task_id] = TaskResult(TASK_CANCELLED)
+                        self._Remove(worker_id, kill=True)
+                    running = {}
+                continue
+
+            if running.get(worker_id, [None])[0] != task_id:
+                continue  # from a run of a killed worker.
+            if status == _TASK_STARTED:
+                running[worker_id][1] = True
+                if cancel_deadline:
+                    self._Interrupt(worker_id)
+                continue
+            del running[worker_id]
+            results[task_id] = TaskResult(status, value)
+            if (cancel_on_failure and cancel_deadline is None and
+                    (status != TASK_DONE or value is False)):
+                cancel_deadline = self._Cancel(running, pending, results)
+        return results
+
+    def _CheckLiveness(self, running, pending, results):
+        """Handles the workers which died with a task assigned.
+
+        The task of a worker which exited before starting it, e.g., on the
+        idle timeout, is queued again. Otherwise the task crashed.
+
+        Returns:
+            True if any task crashed.
+        """
+        crashed = False
+        for worker_id, (task_id, _) in list(running.items()):
+            worker = self._workers[worker_id]
+            process = worker.process
+            if process.is_alive():
+                continue
+            del running[worker_id]
+            self._Remove(worker_id)
+            if worker.started.value != task_id:
+                pending.insert(0, task_id)
+                continue
+            logging.error("Worker %d died with %s running task %d.",
+                          worker_id, process.exitcode, task_id)
+            results[task_id] = TaskResult(TASK_CRASHED,
+                                          exit_code=process.exitcode)
+            crashed = True
+        return crashed
+
+    def _Cancel(self, running, pending, results):
+        """Cancels the pending tasks and interrupts the running ones.
+
+        The tasks not started yet are interrupted once they start.
+
+        Returns:
+            the time by which the interrupted tasks are to return.
+        """
+        for task_id in pending:
+            results[task_id] = TaskResult(TASK_CANCELLED)
+        del pending[:]
+        for worker_id, (_, started) in running.items():
+            if started:
+                self._Interrupt(worker_id)
+        return time.time() + _CANCEL_GRACE_SECS
+
+    def _Interrupt(self, worker_id):
+        """Raises TaskCancelledError in the task running in a worker.
+
+        The subprocesses of the task are terminated as well.
+        """
+        _SignalWorker(self._workers[worker_id].process, signal.SIGTERM)
+
+    def Close(self):
+        """Stops the workers."""
+        with self._lock:
+            for worker in self._workers.values():
+                try:
+                    worker.task_queue.put(None)
+                except (AssertionError, OSError, ValueError):
+                    pass
+            deadline = time.time() + 5
+            for worker_id in list(self._workers):
+                self._workers[worker_id].process.join(
+                    max(0, deadline - time.time()))
+                self._Remove(worker_id, kill=True)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from host_controller.utils.ipc import ipc_utils
+from host_controller.utils.ipc import worker_pool
+
+# Number of the runs and the tasks per run in the benchmark.
+_BENCHMARK_RUNS = 20
+_BENCHMARK_TASKS = 4
+
+
+def _Task(task):
+    """Runs a test task of (action, argument)."""
+    action, arg = task
+    if action == "pid":
+        return os.getpid()
+    if action == "sleep":
+        # Sleeps in steps, as the signal may wake up another thread.
+        deadline = time.time() + arg
+        while time.time() < deadline:
+            time.sleep(0.05)
+        return True
+    if action == "raise":
+        raise ValueError(arg)
+    if action == "spawn":
+        child = subprocess.Popen(["sleep", "30"])
+        with open(arg, "w") as pid_file:
+            pid_file.write(str(child.pid))
+        child.wait()
+        return True
+    if action == "raise_on_file":
+        while not os.path.exists(arg):
+            time.sleep(0.05)
+        raise ValueError(arg)
+    if action == "exit":
+        os._exit(arg)
+    return arg
+
+
+def _RunInProcess(task, result_queue):
+    """Runs a task in a process forked for it, as the console used to."""
+    result_queue.put(_Task(task))
+
+
+class WorkerPoolTest(unittest.TestCase):
+    """Tests for WorkerPool."""
+
+    def setUp(self):
+        """Creates a pool of two workers."""
+        self._pool = worker_pool.WorkerPool(_Task, 2)
+
+    def tearDown(self):
+        """Stops the workers."""
+        self._pool.Close()
+
+    def testReuseWorkers(self):
+        """Tests that the runs share at most max_workers processes."""
+        first = self._pool.Run([("pid", None)] * 5)
+        second = self._pool.Run([("pid", None)] * 2)
+        self.assertEqual([worker_pool.TASK_DONE] * 5,
+                         [result.status for result in first])
+        pids = set(result.value for result in first + second)
+        self.assertEqual(2, len(pids))
+        self.assertNotIn(os.getpid(), pids)
+        self.assertEqual(2, self._pool.GetNumWorkers())
+
+    def testResults(self):
+        """Tests the results in the order of the tasks."""
+        results = self._pool.Run([("sleep", 0.2), ("value", "a"),
+                                  ("value", 3)])
+        self.assertEqual([True, "a", 3],
+                         [result.value for result in results])
+
+    def testFailureCancelsSiblings(self):
+        """Tests interrupting the running and the pending tasks."""
+        start_time = time.time()
+        results = self._pool.Run([("raise", "broken"), ("sleep", 30),
+                                  ("sleep", 30)])
+        self.assertLess(time.time() - start_time, 10)
+        self.assertEqual(worker_pool.TASK_FAILED, results[0].status)
+        self.assertEqual("ValueError: broken", results[0].value)
+        self.assertEqual([worker_pool.TASK_CANCELLED] * 2,
+                         [result.status for result in results[1:]])
+        # The interrupted worker is kept warm.
+        pids = set(r.value for r in self._pool.Run([("pid", None)] * 2))
+        self.assertEqual(2, self._pool.GetNumWorkers())
+        self.assertEqual(2, len(pids))
+
+    def testCancelKillsSubprocesses(self):
+        """Tests terminating the subprocesses of an interrupted task."""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            pid_path = os.path.join(temp_dir, "pid")
+            results = self._pool.Run([("spawn", pid_path),
+                                      ("raise_on_file", pid_path)])
+            with open(pid_path, "r") as pid_file:
+                child_pid = int(pid_file.read())
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEqual(worker_pool.TASK_CANCELLED, results[0].status)
+        deadline = time.time() + 10
+        while (ipc_utils.GetProcessStartTime(child_pid) is not None and
+               time.time() < deadline):
+            time.sleep(0.05)
+        self.assertIsNone(ipc_utils.GetProcessStartTime(child_pid))
+
+    def testFalseCancelsSiblings(self):
+        """Tests that a task returning False fails the run."""
+        results = self._pool.Run([("value", False), ("sleep", 30)])
+        self.assertEqual(worker_pool.TASK_DONE, results[0].status)
+        self.assertFalse(results[0].value)
+        self.assertEqual(worker_pool.TASK_CANCELLED, results[1].status)
+
+    def testNoCancel(self):
+        """Tests running all tasks despite a failure."""
+        results = self._pool.Run([("raise", "broken"), ("sleep", 0.2),
+                                  ("value", 1)],
+                                 cancel_on_failure=False)
+        self.assertEqual([
+            worker_pool.TASK_FAILED, worker_pool.TASK_DONE,
+            worker_pool.TASK_DONE
+        ], [result.status for result in results])
+
+    def testCrash(self):
+        """Tests the exit code of a worker dying in a task."""
+        results = self._pool.Run([("exit", 3), ("value", 1)],
+                                 cancel_on_failure=False)
+        self.assertEqual(worker_pool.TASK_CRASHED, results[0].status)
+        self.assertEqual(3, results[0].exit_code)
+        self.assertEqual(1, results[1].value)
+        self.assertEqual(worker_pool.TASK_DONE,
+                         self._pool.Run([("value", 1)] * 2)[0].status)
+
+    def testRecycleWorkers(self):
+        """Tests requeuing the tasks given to the exited workers."""
+        pool = worker_pool.WorkerPool(_Task, 1, max_tasks_per_worker=1)
+        try:
+            results = pool.Run([("pid", None)] * 3)
+        finally:
+            pool.Close()
+        self.assertEqual([worker_pool.TASK_DONE] * 3,
+                         [result.status for result in results])
+        self.assertEqual(3, len(set(result.value for result in results)))
+
+    def testBenchmark(self):
+        """Compares the run time with a process forked per task."""
+        tasks = [("value", True)] * _BENCHMARK_TASKS
+        start_time = time.time()
+        for _ in range(_BENCHMARK_RUNS):
+            result_queue = multiprocessing.Queue()
+            processes = [
+                multiprocessing.Process(
+                    target=_RunInProcess, args=(task, result_queue))
+                for task in tasks
+            ]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+        fork_secs = time.time() - start_time
+
+        pool = worker_pool.WorkerPool(_Task, _BENCHMARK_TASKS)
+        try:
+            start_time = time.time()
+            for _ in range(_BENCHMARK_RUNS):
+                pool.Run(tasks)
+            pool_secs = time.time() - start_time
+        finally:
+            pool.Close()
+        logging.info("%d runs of %d tasks: process per task %.3fs, "
+                     "WorkerPool %.3fs", _BENCHMARK_RUNS, _BENCHMARK_TASKS,
+                     fork_secs, pool_secs)
+        self.assertLess(pool_secs, fork_secs)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()
@@ -0,0 +1,436 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import contextlib
+import logging
+import os
+import re
+import threading
+import time
+
+from host_controller import common
+from host_controller.utils.ipc import ipc_utils
+from host_controller.utils.usb import usb_utils
+
+# Segment of the devices not found in sysfs, e.g., connected over TCP.
+UNKNOWN_SEGMENT = "unknown"
+
+# Transfers smaller than this are not used to measure the throughput.
+_MIN_SAMPLE_BYTES = 1024 * 1024
+
+# Weight of the latest sample in the moving averages.
+_EWMA_WEIGHT = 0.3
+
+# The sysfs directory of a root hub, which follows its host controller.
+_ROOT_HUB_PATTERN = re.compile(r"^usb\d+$")
+
+
+def GetSegments(devpath):
+    """Returns the bus segments which a USB device's transfers go through.
+
+    Args:
+        devpath: string, the device path in sysfs, e.g.,
+                 "/devices/pci0000:00/0000:00:14.0/usb1/1-2/1-2.3".
+
+    Returns:
+        a list of strings, the host controller, the root hub and the hubs
+        from the upstream, e.g., ["0000:00:14.0", "usb1", "1-2"].
+    """
+    parts = [part for part in devpath.split("/") if part]
+    for index, part in enumerate(parts):
+        if _ROOT_HUB_PATTERN.match(part):
+            return parts[max(0, index - 1):-1]
+    return [UNKNOWN_SEGMENT]
+
+
+def IsBulkCommand(command, bulk_commands):
+    """Returns whether an adb or fastboot command is a bulk transfer.
+
+    Args:
+        command: list of strings, the command and its arguments, which may
+                 contain spaces.
+        bulk_commands: collection of strings, the bulk transfer commands.
+    """
+    words = " ".join(command).split()
+    return bool(words) and words[0] in bulk_commands
+
+
+def GetFileBytes(command):
+    """Returns the total size of the files in a command.
+
+    Args:
+        command: list of strings, the command and its arguments, which may
+                 contain spaces.
+
+    Returns:
+        int, the number of bytes of the arguments which are files.
+    """
+    num_bytes = 0
+    for arg in " ".join(command).split():
+        if os.path.isfile(arg):
+            num_bytes += os.path.getsize(arg)
+    return num_bytes
+
+
+class BulkTransfer(object):
+    """A bulk transfer admitted by the scheduler.
+
+    Attributes:
+        num_bytes: int, the number of bytes transferred.
+        success: bool, whether the transfer succeeded. Only the successful
+                 transfers are used to measure the throughput.
+    """
+
+    def __init__(self, num_bytes=0):
+        self.num_bytes = num_bytes
+        self.success = False
+
+
+class UsbTransferScheduler(object):
+    """Admits the bulk transfers to the devices per USB bus segment.
+
+    A transfer goes through the host controller, the root hub and the hubs
+    upstream of its device, and is admitted when none of these segments is
+    saturated. The host-wide state is kept in a file like FairSemaphore, so
+    that the console and the job pool processes share the segments. The
+    waiters are admitted in FIFO order per segment; a waiter does not pass
+    an earlier one blocked on a segment they share.
+
+    The concurrency limit of a segment is derived from the throughput
+    measured at each number of concurrent transfers on it. A segment
+    admits common.MAX_ADB_FASTBOOT_PROCESS transfers like the host-wide
+    semaphore until it is measured, and goes lower only if the measured
+    transfers did not raise the aggregate throughput by more than min_gain.
+    Above that, one more transfer is admitted while it has not been
+    measured, or while it raised the throughput by more than min_gain. The
+    devices not found in sysfs share UNKNOWN_SEGMENT, which is limited to
+    common.MAX_ADB_FASTBOOT_PROCESS transfers.
+
+    Attributes:
+        _dir: string, the directory of the state file and the pipes.
+        _state_file: StateFile, the transfers, the waiters and the
+                     measurements of the segments.
+        _resolver: UsbDeviceResolver, maps a serial to its sysfs path.
+        _max_transfers: int, the maximum concurrency of a segment.
+        _min_gain: float, the minimum relative gain in the throughput.
+        _sample_ttl_secs: float, the time a measurement is used.
+        _liveness_check_secs: float, the interval at which a waiter checks
+                              for dead transfers.
+    """
+
+    def __init__(self,
+                 state_dir=None,
+                 resolver=None,
+                 max_transfers=common.USB_SEGMENT_MAX_TRANSFERS,
+                 min_gain=common.USB_SEGMENT_MIN_GAIN,
+                 sample_ttl_secs=common.USB_SEGMENT_SAMPLE_TTL_SECS,
+                 liveness_check_secs=common.SEMAPHORE_LIVENESS_CHECK_SECS):
+        self._dir = state_dir or os.path.join(
+            os.path.expanduser("~"), common._USB_TRANSFER_DIR)
+        ipc_utils.MakeDirs(self._dir)
+        self._state_file = ipc_utils.StateFile(
+            os.path.join(self._dir, "transfers.json"))
+        self._resolver = resolver or usb_utils.GetUsbDeviceResolver()
+        self._max_transfers = max_transfers
+        self._min_gain = min_gain
+        self._sample_ttl_secs = sample_ttl_secs
+        self._liveness_check_secs = liveness_check_secs
+
+    def _PipePath(self, token):
+        """Returns the path to the named pipe of a waiter."""
+        return os.path.join(self._dir, "%s.fifo" % token)
+
+    def GetDeviceSegments(self, serial):
+        """Returns the bus segments of a device.
+
+        Args:
+            serial: string, the device serial.
+
+        Returns:
+            a list of strings, see GetSegments.
+        """
+        for devpath, device in self._resolver.GetDevices().items():
+            if device["serial"] == serial:
+                return GetSegments(devpath)
+        return [UNKNOWN_SEGMENT]
+
+    def _GetLimit(self, segment, state, now):
+        """Returns the number of concurrent transfers admitted on a segment.
+
+        Args:
+            segment: string, the segment name.
+            state: dict, the locked state.
+            now: float, the current time.
+        """
+        if segment == UNKNOWN_SEGMENT:
+            return common.MAX_ADB_FASTBOOT_PROCESS
+        initial_limit = min(common.MAX_ADB_FASTBOOT_PROCESS,
+                            self._max_transfers)
+        samples = state["segments"].get(segment, {}).get("samples", {})
+        previous = None
+        for count in range(1, self._max_transfers + 1):
+            sample = samples.get(str(count))
+            if not sample or now - sample["time"] > self._sample_ttl_secs:
+                return max(count, initial_limit)
+            total = sample["bps"] * count
+            if previous is not None and total < previous * (1 + self._min_gain):
+                return count - 1
+            previous = total
+        return self._max_transfers
+
+    @staticmethod
+    def _CountTransfers(state, segment):
+        """Returns the number of running transfers on a segment."""
+        return sum(1 for transfer in state["transfers"]
+                   if segment in transfer["segments"])
+
+    @staticmethod
+    def _GetSegmentState(state, segment):
+        """Returns the measurements of a segment, creating them if absent."""
+        return state["segments"].setdefault(segment, {
+            "samples": {},
+            "wait_avg": 0.0,
+            "wait_max": 0.0,
+            "admitted": 0,
+        })
+
+    def _Update(self, update):
+        """Updates the state, admits the waiters and wakes them up.
+
+        Args:
+            update: function taking the state dict, which has "transfers"
+                    and "queue", lists of the entries from
+                    ipc_utils.NewProcessEntry with "serial" and "segments",
+                    and "segments" mapping a segment to its measurements.
+                    It is called with the state file locked and may modify
+                    the state in place.
+
+        Returns:
+            the return value of update.
+        """
+        with self._state_file.Lock() as state:
+            state.setdefault("transfers", [])
+            state.setdefault("queue", [])
+            state.setdefault("segments", {})
+            ret = update(state)
+            granted = self._Admit(state)
+        for token in granted:
+            ipc_utils.WakeupPipe.Wake(self._PipePath(token))
+        return ret
+
+    def _Admit(self, state):
+        """Drops the dead processes and admits the waiters.
+
+        Args:
+            state: dict, the locked state which is modified in place.
+
+        Returns:
+            a list of the tokens admitted, to be woken up.
+        """
+        for transfer in [t for t in state["transfers"]
+                         if not ipc_utils.IsProcessAlive(t)]:
+            logging.warning("Dropping transfer to %s of dead process %d.",
+                            transfer["serial"], transfer["pid"])
+            state["transfers"].remove(transfer)
+        for waiter in [w for w in state["queue"]
+                       if not ipc_utils.IsProcessAlive(w)]:
+            state["queue"].remove(waiter)
+            try:
+                os.remove(self._PipePath(waiter["token"]))
+            except OSError:
+                pass
+
+        now = time.time()
+        granted = []
+        blocked = set()
+        for waiter in list(state["queue"]):
+            segments = waiter["segments"]
+            if blocked.intersection(segments) or any(
+                    self._CountTransfers(state, segment) >= self._GetLimit(
+                        segment, state, now) for segment in segments):
+                blocked.update(segments)
+                continue
+            state["queue"].remove(waiter)
+            waiter["granted_time"] = now
+            waiter["concurrency"] = {}
+            state["transfers"].append(waiter)
+            wait_secs = now - waiter["request_time"]
+            for segment in segments:
+                count = self._CountTransfers(state, segment)
+                for transfer in state["transfers"]:
+                    if segment in transfer["segments"]:
+                        transfer["concurrency"][segment] = max(
+                            transfer["concurrency"].get(segment, 0), count)
+                segment_state = self._GetSegmentState(state, segment)
+                segment_state["wait_avg"] += _EWMA_WEIGHT * (
+                    wait_secs - segment_state["wait_avg"])
+                segment_state["wait_max"] = max(segment_state["wait_max"],
+                                                wait_secs)
+                segment_state["admitted"] += 1
+            granted.append(waiter["token"])
+        return granted
+
+    @staticmethod
+    def _IsAdmitted(state, token):
+        """Returns whether a token is admitted in the state."""
+        return any(t["token"] == token for t in state["transfers"])
+
+    def Acquire(self, serial, timeout=None):
+        """Waits until a transfer to a device is admitted.
+
+        Args:
+            serial: string, the device serial.
+            timeout: float, the maximum time to wait in seconds. None to
+                     wait indefinitely.
+
+        Returns:
+            string, the token to release the transfer. None if timed out.
+        """
+        entry = ipc_utils.NewProcessEntry(
+            serial=serial, segments=self.GetDeviceSegments(serial))
+        token = entry["token"]
+        pipe = ipc_utils.WakeupPipe(self._PipePath(token))
+        try:
+            self._Update(lambda state: state["queue"].append(entry))
+            deadline = None if timeout is None else time.time() + timeout
+            while not self._Update(
+                    lambda state: self._IsAdmitted(state, token)):
+                wait_secs = self._liveness_check_secs
+                if deadline is not None:
+                    wait_secs = min(wait_secs, deadline - time.time())
+                    if wait_secs <= 0:
+                        if self._Update(
+                                lambda state: self._Dequeue(state, token)):
+                            return token
+                        logging.warning(
+                            "Timed out waiting for a transfer to %s.", serial)
+                        return None
+                pipe.Wait(wait_secs)
+            return token
+        finally:
+            pipe.Close()
+
+    def _Dequeue(self, state, token):
+        """Removes a timed-out waiter unless it has been admitted.
+
+        Returns:
+            True if the waiter is admitted.
+        """
+        if self._IsAdmitted(state, token):
+            return True
+        state["queue"] = [w for w in state["queue"] if w["token"] != token]
+        return False
+
+    def Release(self, token, num_bytes=0):
+        """Ends a transfer and measures the throughput of its segments.
+
+        Args:
+            token: string, the token returned by Acquire.
+            num_bytes: int, the number of bytes transferred. 0 not to
+                       measure the throughput, e.g., if the transfer failed.
+        """
+
+        def _Release(state):
+            for transfer in state["transfers"]:
+                if transfer["token"] == token:
+                    break
+            else:
+                logging.error("Transfer %s released without being admitted.",
+                              token)
+                return
+            state["transfers"].remove(transfer)
+            now = time.time()
+            duration = now - transfer["granted_time"]
+            if num_bytes < _MIN_SAMPLE_BYTES or duration <= 0:
+                return
+            bps = num_bytes / duration
+            for segment in transfer["segments"]:
+                count = str(transfer["concurrency"].get(segment, 1))
+                samples = self._GetSegmentState(state, segment)["samples"]
+                sample = samples.get(count)
+                if sample and now - sample["time"] <= self._sample_ttl_secs:
+                    sample["bps"] += _EWMA_WEIGHT * (bps - sample["bps"])
+                    sample["time"] = now
+                else:
+                    samples[count] = {"bps": bps, "time": now}
+
+        self._Update(_Release)
+
+    @contextlib.contextmanager
+    def Transfer(self, serial, num_bytes=0):
+        """Runs a bulk transfer to a device once admitted.
+
+        Args:
+            serial: string, the device serial.
+            num_bytes: int, the number of bytes to transfer.
+
+        Yields:
+            a BulkTransfer object, whose success the caller sets.
+        """
+        transfer = BulkTransfer(num_bytes)
+        token = self.Acquire(serial)
+        try:
+            yield transfer
+        finally:
+            self.Release(token, transfer.num_bytes if transfer.success else 0)
+
+    def GetStatus(self):
+        """Returns the status of the segments.
+
+        Returns:
+            a list of dicts sorted by the segment name, each with "segment",
+            "transfers" (running), "queued", "limit", "wait_avg" and
+            "wait_max" in seconds, "admitted", and "mbps", the aggregate
+            throughput measured at the limit in MB/s, or None.
+        """
+        with self._state_file.Lock(write=False) as state:
+            state.setdefault("transfers", [])
+            state.setdefault("queue", [])
+            state.setdefault("segments", {})
+            now = time.time()
+            segments = set(state["segments"])
+            for entry in state["transfers"] + state["queue"]:
+                segments.update(entry["segments"])
+            ret = []
+            for segment in sorted(segments):
+                segment_state = state["segments"].get(segment, {})
+                limit = self._GetLimit(segment, state, now)
+                sample = segment_state.get("samples", {}).get(str(limit))
+                ret.append({
+                    "segment": segment,
+                    "transfers": self._CountTransfers(state, segment),
+                    "queued": sum(1 for waiter in state["queue"]
+                                  if segment in waiter["segments"]),
+                    "limit": limit,
+                    "wait_avg": segment_state.get("wait_avg", 0.0),
+                    "wait_max": segment_state.get("wait_max", 0.0),
+                    "admitted": segment_state.get("admitted", 0),
+                    "mbps": (sample["bps"] * limit / 1e6 if sample else None),
+                })
+            return ret
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def GetTransferScheduler():
+    """Returns the UsbTransferScheduler shared in the current process."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = UsbTransferScheduler()
+        return _scheduler
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from host_controller.utils.usb import transfer_scheduler
+
+_HUB1 = "/devices/pci0000:00/0000:00:14.0/usb1/1-1"
+_HUB2 = "/devices/pci0000:00/0000:00:15.0/usb3/3-2"
+
+
+class UsbTransferSchedulerTest(unittest.TestCase):
+    """Tests for UsbTransferScheduler."""
+
+    def setUp(self):
+        """Attaches two devices to a hub and one to another controller."""
+        self._temp_dir = tempfile.mkdtemp()
+        resolver = mock.Mock()
+        resolver.GetDevices.return_value = {
+            _HUB1 + "/1-1.1": {"serial": "device1"},
+            _HUB1 + "/1-1.2": {"serial": "device2"},
+            _HUB2 + "/3-2.1": {"serial": "device3"},
+        }
+        self._scheduler = transfer_scheduler.UsbTransferScheduler(
+            self._temp_dir, resolver, max_transfers=4, liveness_check_secs=1)
+
+    def tearDown(self):
+        """Deletes the temp dir."""
+        shutil.rmtree(self._temp_dir)
+
+    def _GetStatus(self, segment):
+        """Returns the status of a segment."""
+        for status in self._scheduler.GetStatus():
+            if status["segment"] == segment:
+                return status
+        return None
+
+    def _GetSamples(self, segment):
+        """Returns the throughput measured on a segment per concurrency."""
+        with self._scheduler._state_file.Lock(write=False) as state:
+            return state["segments"][segment]["samples"]
+
+    def testGetSegments(self):
+        """Tests mapping a device to its controller and hubs."""
+        self.assertEqual(["0000:00:14.0", "usb1", "1-1"],
+                         self._scheduler.GetDeviceSegments("device1"))
+        self.assertEqual(["0000:00:14.0", "usb1"],
+                         transfer_scheduler.GetSegments(
+                             "/devices/pci0000:00/0000:00:14.0/usb1/1-4"))
+        self.assertEqual([transfer_scheduler.UNKNOWN_SEGMENT],
+                         self._scheduler.GetDeviceSegments("emulator-5554"))
+
+    def testAdmission(self):
+        """Tests that a saturated hub does not hold up another controller."""
+        token1 = self._scheduler.Acquire("device1")
+        token2 = self._scheduler.Acquire("device2", timeout=0.2)
+        self.assertTrue(token2)
+        self.assertIsNone(self._scheduler.Acquire("device2", timeout=0.2))
+        token3 = self._scheduler.Acquire("device3", timeout=0.2)
+        self.assertTrue(token3)
+
+        admitted = []
+        thread = threading.Thread(
+            target=lambda: admitted.append(self._scheduler.Acquire("device2")))
+        thread.start()
+        while not self._GetStatus("1-1")["queued"]:
+            time.sleep(0.01)
+        # An unmeasured hub admits as many as the host-wide semaphore.
+        self.assertEqual(2, self._GetStatus("1-1")["transfers"])
+        self.assertEqual(2, self._GetStatus("1-1")["limit"])
+        time.sleep(0.1)
+        self._scheduler.Release(token1, num_bytes=10 * 1024 * 1024)
+        thread.join(5)
+        self.assertTrue(admitted[0])
+        status = self._GetStatus("1-1")
+        self.assertEqual(0, status["queued"])
+        self.assertEqual(2, status["limit"])
+        self.assertEqual(3, status["admitted"])
+        self.assertGreater(status["wait_max"], 0.05)
+        self._scheduler.Release(admitted[0])
+        self._scheduler.Release(token2)
+        self._scheduler.Release(token3)
+        self.assertEqual(0, self._GetStatus("usb1")["transfers"])
+
+    def testLimitFromThroughput(self):
+        """Tests the limit derived from the measured throughput."""
+        now = time.time()
+
+        def _State(bps2, time2=now):
+            return {
+                "segments": {
+                    "1-1": {
+                        "samples": {
+                            "1": {"bps": 100.0, "time": now},
+                            "2": {"bps": bps2, "time": time2},
+                        }
+                    }
+                }
+            }
+
+        get_limit = self._scheduler._GetLimit
+        # An unmeasured segment starts from MAX_ADB_FASTBOOT_PROCESS.
+        self.assertEqual(2, get_limit("1-1", {"segments": {}}, now))
+        # Two transfers do not raise the aggregate throughput by 10%.
+        self.assertEqual(1, get_limit("1-1", _State(52.0), now))
+        # Two transfers do; three are tried next.
+        self.assertEqual(3, get_limit("1-1", _State(60.0), now))
+        # The expired measurement is probed again.
+        self.assertEqual(2, get_limit("1-1", _State(52.0, now - 2 * 86400),
+                                      now))
+        self.assertEqual(
+            2,
+            get_limit(transfer_scheduler.UNKNOWN_SEGMENT, _State(52.0), now))
+
+    def testTransfer(self):
+        """Tests that only the successful transfers are measured."""
+        with self._scheduler.Transfer("device1", 10 * 1024 * 1024):
+            pass
+        self.assertEqual({}, self._GetSamples("1-1"))
+        with self._scheduler.Transfer("device1",
+                                      10 * 1024 * 1024) as transfer:
+            time.sleep(0.01)
+            transfer.success = True
+        self.assertEqual(["1"], list(self._GetSamples("1-1")))
+        status = self._GetStatus("1-1")
+        self.assertEqual(2, status["limit"])
+        self.assertEqual(0, status["transfers"])
+
+
+if __name__ == "__main__":
+    unittest.main()
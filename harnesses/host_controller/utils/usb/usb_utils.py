@@ -17,12 +17,246 @@
 import fcntl
 import logging
 import os
-
-from vts.utils.python.common import cmd_utils
+import threading
 
 # _IO('U', 20)
 USBDEVFS_RESET = ord("U") << 8 | 20
 
+# Root of sysfs and the directory listing the USB devices in it.
+_SYSFS_ROOT = "/sys"
+_SYSFS_USB_DEVICES_DIR = os.path.join("bus", "usb", "devices")
+
+# USB interface (class, subclass, protocol) of adb and fastboot.
+_ADB_INTERFACE = ("ff", "42", "01")
+_FASTBOOT_INTERFACE = ("ff", "42", "03")
+
+# Mode of a USB device, derived from its interfaces.
+USB_MODE_ADB = "adb"
+USB_MODE_FASTBOOT = "fastboot"
+
+
+def _ReadAttribute(path, name):
+    """Reads a sysfs attribute.
+
+    Returns:
+        string, the stripped value. None if the attribute does not exist.
+    """
+    try:
+        with open(os.path.join(path, name), "r") as attr_file:
+            return attr_file.read().strip()
+    except IOError:
+        return None
+
+
+def ReadUsbDevice(sysfs_root, devpath):
+    """Reads the attributes of a USB device from sysfs.
+
+    Args:
+        sysfs_root: string, the path where sysfs is mounted.
+        devpath: string, the device path relative to sysfs_root, e.g.,
+                 "/devices/pci0000:00/0000:00:14.0/usb1/1-2".
+
+    Returns:
+        a dict with "serial", "usb_path" (the device file), "port_path"
+        and "mode" (USB_MODE_ADB, USB_MODE_FASTBOOT or None). None if the
+        device has no serial number.
+    """
+    dev_dir = os.path.join(sysfs_root, devpath.lstrip("/"))
+    serial = _ReadAttribute(dev_dir, "serial")
+    if not serial:
+        return None
+    busnum = _ReadAttribute(dev_dir, "busnum")
+    devnum = _ReadAttribute(dev_dir, "devnum")
+    usb_path = None
+    if busnum and devnum:
+        usb_path = "/dev/bus/usb/%03d/%03d" % (int(busnum), int(devnum))
+
+    mode = None
+    try:
+        entries = os.listdir(dev_dir)
+    except OSError:
+        entries = []
+    for entry in sorted(entries):
+        if ":" not in entry:
+            continue
+        interface_dir = os.path.join(dev_dir, entry)
+        interface = tuple(
+            (_ReadAttribute(interface_dir, name) or "").lower()
+            for name in ("bInterfaceClass", "bInterfaceSubClass",
+                         "bInterfaceProtocol"))
+        if interface == _FASTBOOT_INTERFACE:
+            mode = USB_MODE_FASTBOOT
+        elif interface == _ADB_INTERFACE:
+            mode = USB_MODE_ADB
+    return {
+        "serial": serial,
+        "usb_path": usb_path,
+        "port_path": os.path.basename(devpath),
+        "mode": mode,
+    }
+
+
+def ReadBulkInterface(sysfs_root, devpath, mode):
+    """Reads the bulk endpoints of the adb or fastboot interface of a device.
+
+    Args:
+        sysfs_root: string, the path where sysfs is mounted.
+        devpath: string, the device path relative to sysfs_root.
+        mode: string, USB_MODE_ADB or USB_MODE_FASTBOOT.
+
+    Returns:
+        a tuple of (interface number, bulk in endpoint, bulk out endpoint)
+        as ints. None if the device has no such interface.
+    """
+    expected = _FASTBOOT_INTERFACE if mode == USB_MODE_FASTBOOT else (
+        _ADB_INTERFACE)
+    dev_dir = os.path.join(sysfs_root, devpath.lstrip("/"))
+    try:
+        entries = os.listdir(dev_dir)
+    except OSError:
+        return None
+    for entry in sorted(entries):
+        if ":" not in entry:
+            continue
+        interface_dir = os.path.join(dev_dir, entry)
+        interface = tuple(
+            (_ReadAttribute(interface_dir, name) or "").lower()
+            for name in ("bInterfaceClass", "bInterfaceSubClass",
+                         "bInterfaceProtocol"))
+        if interface != expected:
+            continue
+        endpoints = {}
+        for ep_entry in os.listdir(interface_dir):
+            if not ep_entry.startswith("ep_"):
+                continue
+            ep_dir = os.path.join(interface_dir, ep_entry)
+            if _ReadAttribute(ep_dir, "type") != "Bulk":
+                continue
+            endpoints[_ReadAttribute(ep_dir, "direction")] = int(
+                _ReadAttribute(ep_dir, "bEndpointAddress"), 16)
+        if "in" in endpoints and "out" in endpoints:
+            return (int(_ReadAttribute(interface_dir, "bInterfaceNumber"),
+                        16), endpoints["in"], endpoints["out"])
+    return None
+
+
+def ScanUsbDevices(sysfs_root=_SYSFS_ROOT):
+    """Reads the USB devices attached to the host from sysfs.
+
+    Args:
+        sysfs_root: string, the path where sysfs is mounted.
+
+    Returns:
+        a dict, maps a device path to the result of ReadUsbDevice.
+    """
+    devices_dir = os.path.join(sysfs_root, _SYSFS_USB_DEVICES_DIR)
+    real_root = os.path.realpath(sysfs_root)
+    ret = {}
+    try:
+        entries = os.listdir(devices_dir)
+    except OSError as e:
+        logging.error("Failed to list USB devices: %s", e)
+        return ret
+    for entry in entries:
+        if ":" in entry:  # an interface, not a device.
+            continue
+        real_path = os.path.realpath(os.path.join(devices_dir, entry))
+        devpath = "/" + os.path.relpath(real_path, real_root)
+        device = ReadUsbDevice(sysfs_root, devpath)
+        if device:
+            ret[devpath] = device
+    return ret
+
+
+class UsbDeviceResolver(object):
+    """Maps the serial numbers of the USB devices to their sysfs attributes.
+
+    sysfs is walked in-process, reading the serial, busnum and devnum
+    attributes of each device. While hotplug events are being tracked, the
+    result is cached until the next event invalidates it; otherwise sysfs
+    is walked on every call.
+
+    Attributes:
+        _sysfs_root: string, the path where sysfs is mounted.
+        _lock: threading.Lock, guards the fields below.
+        _hotplug_tracked: bool, whether the hotplug events invalidate the
+                          cache.
+        _devices: dict, the cached result of ScanUsbDevices, or None.
+    """
+
+    def __init__(self, sysfs_root=_SYSFS_ROOT):
+        self._sysfs_root = sysfs_root
+        self._lock = threading.Lock()
+        self._hotplug_tracked = False
+        self._devices = None
+
+    def SetHotplugTracked(self, tracked):
+        """Sets whether Invalidate is called on every USB hotplug event.
+
+        Args:
+            tracked: bool, True to cache the devices between the events.
+        """
+        with self._lock:
+            self._hotplug_tracked = tracked
+            self._devices = None
+
+    def Invalidate(self):
+        """Drops the cached devices. Called on USB hotplug events."""
+        with self._lock:
+            self._devices = None
+
+    def GetDevices(self):
+        """Returns the USB devices with serial numbers.
+
+        Returns:
+            a dict, maps a device path in sysfs to the result of
+            ReadUsbDevice.
+        """
+        with self._lock:
+            if self._devices is None or not self._hotplug_tracked:
+                self._devices = ScanUsbDevices(self._sysfs_root)
+            return dict(self._devices)
+
+    def GetFilePaths(self):
+        """Returns a dict, maps a serial number to the device file path."""
+        return dict((device["serial"], device["usb_path"])
+                    for device in self.GetDevices().values()
+                    if device["usb_path"])
+
+    def GetBulkInterface(self, serial, mode):
+        """Returns the device file and the bulk interface of a device.
+
+        Args:
+            serial: string, the serial number.
+            mode: string, USB_MODE_ADB or USB_MODE_FASTBOOT.
+
+        Returns:
+            a tuple of (device file path, interface number, bulk in
+            endpoint, bulk out endpoint). None if the device is not
+            attached in the mode.
+        """
+        for devpath, device in self.GetDevices().items():
+            if (device["serial"] == serial and device["mode"] == mode and
+                    device["usb_path"]):
+                interface = ReadBulkInterface(self._sysfs_root, devpath,
+                                              mode)
+                if interface:
+                    return (device["usb_path"], ) + interface
+        return None
+
+    def GetPortPaths(self):
+        """Returns a dict, maps a serial number to the port path."""
+        return dict((device["serial"], device["port_path"])
+                    for device in self.GetDevices().values())
+
+
+_resolver = UsbDeviceResolver()
+
+
+def GetUsbDeviceResolver():
+    """Returns the UsbDeviceResolver shared in the current process."""
+    return _resolver
+
 
 def GetDevicesUSBFilePath():
     """Sweeps through connected USB device info and maps serial number to them.
@@ -31,30 +265,20 @@ def GetDevicesUSBFilePath():
         A dict, serial numbers of the devices as the key, device file path
         corresponding to the serial number as the value.
     """
-    ret = {}
+    return _resolver.GetFilePaths()
 
-    sh_stdout, sh_stderr, ret_code = cmd_utils.ExecuteOneShellCommand("which udevadm")
-    if ret_code != 0:
-        logging.error("`udevadm` doesn't exist on the host; "
-                      "please install 'udev' pkg before retrying.")
-        return ret
 
-    sh_stdout, _, _ = cmd_utils.ExecuteOneShellCommand(
-        "find /sys/bus/usb/devices/usb*/ -name dev")
-    lines = sh_stdout.split()
-    for line in lines:
-        syspath = os.path.dirname(line)
-        devname, _, _ = cmd_utils.ExecuteOneShellCommand(
-            "udevadm info -q name -p %s" % syspath)
-        if devname.startswith("bus/"):
-            serial, _, _ = cmd_utils.ExecuteOneShellCommand(
-                "udevadm info -q property --export -p %s | grep ID_SERIAL_SHORT"
-                % syspath)
-            if serial:
-                device_serial = serial.split("=")[1].strip().strip("'")
-                ret[device_serial] = os.path.join("/dev", devname.strip())
+def GetDevicesUSBPortPath():
+    """Maps the serial numbers of the USB devices to their port paths.
 
-    return ret
+    A port path (e.g., "1-2.3") is stable across re-enumeration, unlike the
+    device file path, and identifies the hub and the cable in use.
+
+    Returns:
+        A dict, serial numbers of the devices as the key, port path as the
+        value.
+    """
+    return _resolver.GetPortPaths()
 
 
 def ResetDeviceUsb(dev_file_path):
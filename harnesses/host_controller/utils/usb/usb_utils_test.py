@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from host_controller.utils.usb import usb_utils
+
+
+class UsbUtilsTest(unittest.TestCase):
+    """Tests for the USB device resolver against a fake sysfs."""
+
+    def setUp(self):
+        """Creates a fake sysfs with a hub and an attached device."""
+        self._sysfs = tempfile.mkdtemp()
+        self._devices_dir = os.path.join(self._sysfs, "bus", "usb",
+                                         "devices")
+        os.makedirs(self._devices_dir)
+        self._AddDevice("usb1", None, 1, 1)
+        self._AddDevice("usb1/1-1", None, 1, 2)
+        self._AddDevice("usb1/1-1/1-1.2", "serial1", 1, 5, "ff 42 01")
+        self._resolver = usb_utils.UsbDeviceResolver(self._sysfs)
+
+    def tearDown(self):
+        """Deletes the fake sysfs."""
+        shutil.rmtree(self._sysfs)
+
+    def _AddDevice(self, path, serial, busnum, devnum, interface=None):
+        """Creates a USB device in the fake sysfs.
+
+        Args:
+            path: string, the device path under the PCI controller.
+            serial: string, the serial number. None for a hub.
+            busnum: int, the bus number.
+            devnum: int, the device number.
+            interface: string, "<class> <subclass> <protocol>" of the first
+                       interface.
+        """
+        dev_dir = os.path.join(self._sysfs, "devices", "pci0000:00", path)
+        os.makedirs(dev_dir)
+        attrs = {"busnum": str(busnum), "devnum": str(devnum)}
+        if serial:
+            attrs["serial"] = serial
+        for name, value in attrs.items():
+            with open(os.path.join(dev_dir, name), "w") as attr_file:
+                attr_file.write(value + "\n")
+        name = os.path.basename(path)
+        if interface:
+            interface_dir = os.path.join(dev_dir, name + ":1.0")
+            os.makedirs(interface_dir)
+            for attr, value in zip(("bInterfaceClass", "bInterfaceSubClass",
+                                    "bInterfaceProtocol"), interface.split()):
+                with open(os.path.join(interface_dir, attr), "w") as f:
+                    f.write(value + "\n")
+        os.symlink(os.path.relpath(dev_dir, self._devices_dir),
+                   os.path.join(self._devices_dir, name))
+
+    def testScanUsbDevices(self):
+        """Tests reading the devices with serial numbers from sysfs."""
+        self.assertEqual({
+            "/devices/pci0000:00/usb1/1-1/1-1.2": {
+                "serial": "serial1",
+                "usb_path": "/dev/bus/usb/001/005",
+                "port_path": "1-1.2",
+                "mode": usb_utils.USB_MODE_ADB,
+            }
+        }, usb_utils.ScanUsbDevices(self._sysfs))
+
+    def testResolverCache(self):
+        """Tests that sysfs is walked once between hotplug events."""
+        self.assertEqual({"serial1": "/dev/bus/usb/001/005"},
+                         self._resolver.GetFilePaths())
+        self._AddDevice("usb1/1-1/1-1.3", "serial2", 1, 6, "ff 42 03")
+        self.assertEqual({"serial1": "1-1.2", "serial2": "1-1.3"},
+                         self._resolver.GetPortPaths())
+
+        self._resolver.SetHotplugTracked(True)
+        with mock.patch.object(usb_utils, "ScanUsbDevices",
+                               wraps=usb_utils.ScanUsbDevices) as mock_scan:
+            self._resolver.GetFilePaths()
+            self._AddDevice("usb1/1-1/1-1.4", "serial3", 1, 7)
+            self.assertEqual(["serial1", "serial2"],
+                             sorted(self._resolver.GetFilePaths()))
+            self._resolver.Invalidate()
+            self.assertEqual("/dev/bus/usb/001/007",
+                             self._resolver.GetFilePaths()["serial3"])
+            self.assertEqual(2, mock_scan.call_count)
+
+    def testGetBulkInterface(self):
+        """Tests reading the bulk endpoints of the fastboot interface."""
+        self._AddDevice("usb1/1-1/1-1.3", "serial2", 1, 6, "ff 42 03")
+        interface_dir = os.path.join(self._sysfs, "devices", "pci0000:00",
+                                     "usb1/1-1/1-1.3/1-1.3:1.0")
+        with open(os.path.join(interface_dir, "bInterfaceNumber"), "w") as f:
+            f.write("00\n")
+        for name, ep_type, direction in (("ep_81", "Bulk", "in"),
+                                         ("ep_01", "Bulk", "out"),
+                                         ("ep_82", "Interrupt", "in")):
+            ep_dir = os.path.join(interface_dir, name)
+            os.makedirs(ep_dir)
+            for attr, value in (("type", ep_type), ("direction", direction),
+                                ("bEndpointAddress", name[3:])):
+                with open(os.path.join(ep_dir, attr), "w") as f:
+                    f.write(value + "\n")
+
+        self.assertEqual(
+            ("/dev/bus/usb/001/006", 0, 0x81, 0x01),
+            self._resolver.GetBulkInterface("serial2",
+                                            usb_utils.USB_MODE_FASTBOOT))
+        self.assertIsNone(
+            self._resolver.GetBulkInterface("serial1",
+                                            usb_utils.USB_MODE_FASTBOOT))
+
+    def testGetDevicesUSBFilePath(self):
+        """Tests the module functions using the shared resolver."""
+        with mock.patch.object(usb_utils, "_resolver", self._resolver):
+            self.assertEqual({"serial1": "/dev/bus/usb/001/005"},
+                             usb_utils.GetDevicesUSBFilePath())
+            self.assertEqual({"serial1": "1-1.2"},
+                             usb_utils.GetDevicesUSBPortPath())
+
+
+if __name__ == "__main__":
+    unittest.main()
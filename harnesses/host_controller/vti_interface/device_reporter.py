@@ -0,0 +1,172 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import threading
+import time
+
+from host_controller import common
+
+# Keys of a device record compared with the acknowledged one.
+_DEVICE_KEYS = ("serial", "product", "status")
+
+
+class _HostState(object):
+    """The state of a host last acknowledged by the endpoint.
+
+    Attributes:
+        devices: dict, maps a serial to the acknowledged device record.
+        full_needed: bool, whether a full snapshot has to be uploaded.
+        sent_times: dict, maps a serial to the time its change was last
+                    uploaded.
+        full_time: float, the time of the last full snapshot.
+        version: string, the acknowledged host version. None if it has to
+                 be uploaded.
+        version_time: float, the time the host version was last uploaded.
+    """
+
+    def __init__(self):
+        self.devices = {}
+        self.full_needed = True
+        self.sent_times = {}
+        self.full_time = 0
+        self.version = None
+        self.version_time = 0
+
+
+class DeviceReporter(object):
+    """Uploads the changes of the device info and the host version to VTI.
+
+    The records acknowledged by the endpoint are kept per host, and only the
+    records which differ from them are uploaded. A full snapshot is uploaded
+    first, every full_snapshot_secs, after a device is detached, and after
+    a failed upload, so that the endpoint converges even if it missed an
+    update. A device's change is uploaded at most once every
+    flap_window_secs; the changes in between are coalesced into the latest
+    one, and dropped if the device is back to the acknowledged record.
+
+    Attributes:
+        _client: VtiEndpointClient object.
+        _full_snapshot_secs: float, the interval between full snapshots.
+        _flap_window_secs: float, the minimum interval between the uploads
+                           of a device.
+        _hosts: dict, maps a hostname to its _HostState.
+        _lock: threading.Lock, serializes the reports.
+    """
+
+    def __init__(self,
+                 client,
+                 full_snapshot_secs=common.DEVICE_REPORT_FULL_SNAPSHOT_SECS,
+                 flap_window_secs=common.DEVICE_REPORT_FLAP_WINDOW_SECS):
+        self._client = client
+        self._full_snapshot_secs = full_snapshot_secs
+        self._flap_window_secs = flap_window_secs
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def Reset(self, hostname=None):
+        """Makes the next reports upload full snapshots.
+
+        Args:
+            hostname: string, the host to reset. None for all hosts.
+        """
+        with self._lock:
+            if hostname is None:
+                self._hosts = {}
+            else:
+                self._hosts.pop(hostname, None)
+
+    def ReportDevices(self, hostname, devices):
+        """Uploads the device records changed since the last acknowledgement.
+
+        Args:
+            hostname: string, the hostname of a target host.
+            devices: a list of dicts, containing info about all detected
+                     devices that are attached to the host.
+
+        Returns:
+            a list of dicts, the device records uploaded. None if the upload
+            failed.
+        """
+        with self._lock:
+            state = self._hosts.setdefault(hostname, _HostState())
+            now = time.time()
+            current = {}
+            for device in devices:
+                current[device["serial"]] = dict(
+                    (key, device[key]) for key in _DEVICE_KEYS)
+
+            full = (state.full_needed
+                    or now - state.full_time >= self._full_snapshot_secs
+                    or any(serial not in current for serial in state.devices))
+            uploads = []
+            for device in devices:
+                record = current[device["serial"]]
+                if full:
+                    uploads.append(record)
+                    continue
+                if state.devices.get(record["serial"]) == record:
+                    continue
+                sent_time = state.sent_times.get(record["serial"], 0)
+                if now - sent_time < self._flap_window_secs:
+                    logging.debug("Coalescing the change of device %s.",
+                                  record["serial"])
+                    continue
+                uploads.append(record)
+            if not uploads and not full:
+                return uploads
+
+            if not self._client.UploadDeviceInfo(hostname, uploads):
+                state.full_needed = True
+                return None
+            for record in uploads:
+                if state.devices.get(record["serial"]) != record:
+                    state.sent_times[record["serial"]] = now
+                state.devices[record["serial"]] = record
+            if full:
+                state.devices = current
+                state.sent_times = dict(
+                    (serial, sent_time)
+                    for serial, sent_time in state.sent_times.items()
+                    if serial in current)
+                state.full_time = now
+                state.full_needed = False
+            return uploads
+
+    def ReportHostVersion(self, hostname, vtslab_version):
+        """Uploads the host version if it has not been acknowledged.
+
+        The version is uploaded again every full_snapshot_secs.
+
+        Args:
+            hostname: string, the name of the host.
+            vtslab_version: string, current version of vtslab package.
+
+        Returns:
+            True if uploaded, False if failed, None if not needed.
+        """
+        with self._lock:
+            state = self._hosts.setdefault(hostname, _HostState())
+            now = time.time()
+            if (state.version == vtslab_version
+                    and now - state.version_time < self._full_snapshot_secs):
+                return None
+            if not self._client.UploadHostVersion(hostname, vtslab_version):
+                state.version = None
+                return False
+            state.version = vtslab_version
+            state.version_time = now
+            return True
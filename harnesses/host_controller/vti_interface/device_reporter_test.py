@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from host_controller import common
+from host_controller.vti_interface import device_reporter
+from host_controller.vti_interface import fake_vti_endpoint
+from host_controller.vti_interface import vti_endpoint_client
+
+_ONLINE = common._DEVICE_STATUS_DICT["online"]
+_USE = common._DEVICE_STATUS_DICT["use"]
+_FASTBOOT = common._DEVICE_STATUS_DICT["fastboot"]
+
+
+def _Device(serial, status, product="somefish"):
+    """Returns a device record."""
+    return {"serial": serial, "product": product, "status": status}
+
+
+class DeviceReporterTest(unittest.TestCase):
+    """Tests for DeviceReporter against the fake VTI endpoint."""
+
+    def setUp(self):
+        """Starts the fake endpoint and controls the reporter's clock."""
+        self._endpoint = fake_vti_endpoint.FakeVtiEndpoint()
+        self._client = vti_endpoint_client.VtiEndpointClient(
+            self._endpoint.url)
+        self._reporter = device_reporter.DeviceReporter(
+            self._client, full_snapshot_secs=600, flap_window_secs=60)
+        self._now = 1000.0
+        self._time_patcher = mock.patch(
+            "host_controller.vti_interface.device_reporter.time")
+        self._time_patcher.start().time.side_effect = lambda: self._now
+
+    def tearDown(self):
+        """Stops the fake endpoint."""
+        self._time_patcher.stop()
+        self._endpoint.Close()
+
+    def _Report(self, devices, secs=30):
+        """Advances the clock and reports the devices."""
+        self._now += secs
+        return self._reporter.ReportDevices("host1", devices)
+
+    def _UploadedSerials(self):
+        """Returns the serials in each device upload."""
+        return [
+            sorted(device["serial"] for device in payload["devices"])
+            for payload in self._endpoint.GetRequests("/host/v1/set")
+        ]
+
+    def testDeltaUploads(self):
+        """Tests that only the changed records are uploaded."""
+        self._Report([_Device("d1", _ONLINE), _Device("d2", _ONLINE)])
+        self.assertEqual([], self._Report(
+            [_Device("d1", _ONLINE), _Device("d2", _ONLINE)]))
+        self._Report([_Device("d1", _USE), _Device("d2", _ONLINE)])
+        self._Report([_Device("d1", _USE), _Device("d2", _ONLINE),
+                      _Device("d3", _FASTBOOT)])
+        self.assertEqual([["d1", "d2"], ["d1"], ["d3"]],
+                         self._UploadedSerials())
+
+        # A detached device and the periodic reconciliation are snapshots.
+        self._Report([_Device("d1", _USE), _Device("d3", _FASTBOOT)])
+        self._Report([_Device("d1", _USE), _Device("d3", _FASTBOOT)], 600)
+        self.assertEqual([["d1", "d3"], ["d1", "d3"]],
+                         self._UploadedSerials()[3:])
+
+    def testFlapCoalescing(self):
+        """Tests that the changes within the flap window are coalesced."""
+        self._Report([_Device("d1", _ONLINE)])
+        self._Report([_Device("d1", _FASTBOOT)], 20)
+        # Flaps back to the acknowledged status within the window.
+        self._Report([_Device("d1", _ONLINE)], 20)
+        self.assertEqual([["d1"]], self._UploadedSerials())
+        self._Report([_Device("d1", _USE)], 20)
+        self._Report([_Device("d1", _ONLINE)], 10)
+        self._Report([_Device("d1", _FASTBOOT)], 10)
+        # Only the latest change is uploaded after the window.
+        self._Report([_Device("d1", _FASTBOOT)], 40)
+        self.assertEqual([_ONLINE, _USE, _FASTBOOT], [
+            payload["devices"][0]["status"]
+            for payload in self._endpoint.GetRequests("/host/v1/set")
+        ])
+
+    def testConvergence(self):
+        """Tests that the endpoint converges after failed uploads."""
+        sequence = [
+            [_Device("d1", _ONLINE), _Device("d2", _ONLINE)],
+            [_Device("d1", _USE), _Device("d2", _ONLINE)],
+            [_Device("d1", _USE), _Device("d2", _FASTBOOT)],
+            [_Device("d1", _ONLINE), _Device("d2", _FASTBOOT),
+             _Device("d3", _ONLINE)],
+            [_Device("d1", _ONLINE), _Device("d2", _USE),
+             _Device("d3", _ONLINE)],
+        ]
+        for index, devices in enumerate(sequence):
+            if index == 2:
+                self._endpoint.failures = 1
+            self._Report(devices)
+        for _ in range(3):
+            self._Report(sequence[-1])
+        self.assertEqual(
+            dict((device["serial"], device) for device in sequence[-1]),
+            self._endpoint.devices["host1"])
+        self.assertLess(
+            sum(len(serials) for serials in self._UploadedSerials()),
+            sum(len(devices) for devices in sequence) + 3 * 3)
+
+    def testHostVersion(self):
+        """Tests that the host version is uploaded when unacknowledged."""
+        self._endpoint.failures = 1
+        self.assertFalse(self._reporter.ReportHostVersion("host1", "v1"))
+        self.assertTrue(self._reporter.ReportHostVersion("host1", "v1"))
+        self.assertIsNone(self._reporter.ReportHostVersion("host1", "v1"))
+        self.assertTrue(self._reporter.ReportHostVersion("host1", "v2"))
+        self._now += 600
+        self.assertTrue(self._reporter.ReportHostVersion("host1", "v2"))
+        self.assertEqual({"host1": "v2"}, self._endpoint.versions)
+        self.assertEqual(4, len(self._endpoint.GetRequests("set_version")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+#
+# Copyright (C) 2018 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""In-process stand-in of the VTI endpoint for the unit tests."""
+
+import json
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+
+
+class FakeVtiEndpoint(object):
+    """Serves the host APIs of the VTI endpoint on localhost.
+
+    host/v1/set updates the uploaded device records of a host, keeping the
+    others, and lab/v1/set_version stores the version of a host.
+
+    Attributes:
+        url: string, the base URL of the endpoint API.
+        requests: list of (path, payload dict) tuples received.
+        devices: dict, maps a hostname to a dict which maps a serial to the
+                 device record.
+        versions: dict, maps a hostname to the version.
+        failures: int, the number of the next requests to fail with 500.
+        _lock: threading.Lock, guards the fields above.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.devices = {}
+        self.versions = {}
+        self.failures = 0
+        self._lock = threading.Lock()
+        endpoint = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            """Handles a request with the endpoint."""
+
+            def do_POST(self):
+                length = int(self.headers.get("content-length", 0))
+                payload = json.loads(self.rfile.read(length).decode("utf-8"))
+                code = endpoint._Handle(self.path, payload)
+                self.send_response(code)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *args):
+                pass
+
+        self._server = HTTPServer(("127.0.0.1", 0), _Handler)
+        self.url = "http://127.0.0.1:%d/_ah/api/" % self._server.server_port
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def Close(self):
+        """Stops the server."""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def _Handle(self, path, payload):
+        """Applies a request.
+
+        Args:
+            path: string, the request path.
+            payload: dict, the request body.
+
+        Returns:
+            int, the HTTP status code.
+        """
+        with self._lock:
+            self.requests.append((path, payload))
+            if self.failures > 0:
+                self.failures -= 1
+                return 500
+            if path.endswith("/host/v1/set"):
+                host_devices = self.devices.setdefault(payload["hostname"], {})
+                for device in payload["devices"]:
+                    host_devices[device["serial"]] = device
+            elif path.endswith("/lab/v1/set_version"):
+                self.versions[payload["hostname"]] = payload["vtslab_version"]
+            else:
+                return 404
+            return 200
+
+    def GetRequests(self, suffix):
+        """Returns the payloads of the requests whose path ends with suffix."""
+        with self._lock:
+            return [payload for path, payload in self.requests
+                    if path.endswith(suffix)]
@@ -395,6 +395,9 @@ class VtiEndpointClient(object):
         Args:
             hostname: string, the name of the host.
             vtslab_version: string, current version of vtslab package.
+
+        Returns:
+            True if successful, False otherwise.
         """
         url = self._url + "lab/v1/set_version"
         host = {}
@@ -408,9 +411,11 @@ class VtiEndpointClient(object):
         except (requests.exceptions.ConnectionError,
                 requests.exceptions.Timeout) as e:
             logging.exception(e)
-            return
+            return False
         if response.status_code != requests.codes.ok:
             logging.error("UploadHostVersion error: %s", response)
+            return False
+        return True
 
     def CheckBootUpStatus(self):
         """Checks whether the device_img + gsi from the job fails to boot up.